@@ -0,0 +1,476 @@
+"""
+This module compiles the accessor expressions of output processors into
+callables once, so wrapped calls look them up instead of evaluating them.
+
+Two accessor forms are supported. The lambda form is any Python lambda,
+eg. ``lambda arguments: arguments['instance'].model_name``, evaluated once.
+The path form is a declarative expression that is compiled into getter
+closures without eval, eg.
+
+    instance.__dict__|first_of(model,model_name) or instance.model_id
+
+A path starts at one of the PATH_ROOTS, walks attributes, dict keys or
+indexes with ``.name`` / ``[0]``, applies PATH_FILTERS with ``|filter`` or
+``|filter(arg,...)``, and falls back to the next alternative on ``or``.
+Quoted strings are literals and parentheses group alternatives.
+"""
+
+import logging
+import re
+import weakref
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# Names an event accessor can bind to: the wrapped call arguments or its response
+ACCESSOR_INPUT_KEYS = ("arguments", "response")
+LAMBDA_PREFIX = "lambda"
+
+# Marks an output processor attribute whose value is fixed for the life of the wrapped instance
+STATIC_ATTRIBUTE_KEY = "static"
+
+# Path roots and the key of the accessor arguments they read
+PATH_ROOTS = {
+    "instance": "instance",
+    "args": "args",
+    "kwargs": "kwargs",
+    "output": "output",
+    "response": "output",
+}
+
+_accessor_cache = {}
+
+
+class CompiledAccessor:
+    """An accessor expression from the metamodel compiled into a callable."""
+    __slots__ = ("source", "func", "input_key")
+
+    def __init__(self, source: str, func: Callable, input_key: Optional[str]):
+        self.source = source
+        self.func = func
+        self.input_key = input_key
+
+    def __call__(self, value):
+        return self.func(value)
+
+
+def _accessor_namespace() -> dict:
+    # Accessors have always been evaluated against the wrap_common globals
+    # (resolve_from_alias, extract_messages, ...), keep the same namespace.
+    # pylint: disable=import-outside-toplevel
+    from monocle_apptrace import wrap_common
+    return vars(wrap_common)
+
+
+def _get_input_key(source: str) -> Optional[str]:
+    input_key = None
+    for keyword in ACCESSOR_INPUT_KEYS:
+        if keyword in source:
+            input_key = keyword
+    return input_key
+
+
+def _first_of(*keys):
+    def first_of(value):
+        if isinstance(value, dict):
+            for key in keys:
+                if key in value:
+                    return value[key]
+            return None
+        for key in keys:
+            if hasattr(value, key):
+                return getattr(value, key)
+        return None
+    return first_of
+
+
+def _prefix(text):
+    return lambda value: text + value if isinstance(value, str) else None
+
+
+def _from_namespace(name):
+    def factory():
+        return _accessor_namespace()[name]
+    return factory
+
+
+# Filters usable in path accessors, each a factory returning the filter function
+PATH_FILTERS = {
+    "first_of": _first_of,
+    "prefix": _prefix,
+    "type_name": lambda: lambda value: type(value).__name__,
+    "str": lambda: str,
+    "vectorstore_deployment": _from_namespace("get_vectorstore_deployment"),
+    "messages": _from_namespace("extract_messages"),
+    "assistant_message": _from_namespace("extract_assistant_message"),
+}
+
+
+class PathSyntaxError(ValueError):
+    pass
+
+
+class _PathParser:
+    """Recursive descent parser turning a path accessor into nested closures."""
+    _name = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+    _index = re.compile(r"-?[0-9]+")
+
+    def __init__(self, source: str):
+        self.source = source
+        self.pos = 0
+
+    def parse(self) -> Callable:
+        func = self._expression()
+        self._skip_space()
+        if self.pos != len(self.source):
+            self._fail("unexpected input")
+        return func
+
+    def _fail(self, message):
+        raise PathSyntaxError(f"{message} at position {self.pos}")
+
+    def _skip_space(self):
+        while self.pos < len(self.source) and self.source[self.pos].isspace():
+            self.pos += 1
+
+    def _peek(self, text) -> bool:
+        self._skip_space()
+        return self.source.startswith(text, self.pos)
+
+    def _expect(self, text):
+        if not self._peek(text):
+            self._fail(f"expected '{text}'")
+        self.pos += len(text)
+
+    def _match(self, pattern) -> str:
+        self._skip_space()
+        match = pattern.match(self.source, self.pos)
+        if not match:
+            self._fail("expected a name")
+        self.pos = match.end()
+        return match.group()
+
+    def _expression(self) -> Callable:
+        terms = [self._term()]
+        while self._peek_or():
+            self.pos += 2
+            terms.append(self._term())
+        if len(terms) == 1:
+            return terms[0]
+        if len(terms) == 2:
+            first, second = terms
+            return lambda arguments: first(arguments) or second(arguments)
+        terms = tuple(terms)
+
+        def first_truthy(arguments):
+            value = None
+            for term in terms:
+                value = term(arguments)
+                if value:
+                    return value
+            return value
+        return first_truthy
+
+    def _peek_or(self) -> bool:
+        if not self._peek("or"):
+            return False
+        end = self.pos + 2
+        return end == len(self.source) or not (self.source[end].isalnum() or self.source[end] == "_")
+
+    def _term(self) -> Callable:
+        primary, root_key = self._primary()
+        steps = []
+        while True:
+            if self._peek("."):
+                self.pos += 1
+                self._skip_space()
+                if self._index.match(self.source, self.pos):
+                    steps.append(_item_getter(int(self._match(self._index))))
+                else:
+                    steps.append(_attribute_getter(self._match(self._name)))
+            elif self._peek("["):
+                self.pos += 1
+                steps.append(_item_getter(int(self._match(self._index))))
+                self._expect("]")
+            elif self._peek("|"):
+                self.pos += 1
+                steps.append(self._filter())
+            else:
+                break
+        return _chain(primary, root_key, tuple(steps))
+
+    def _primary(self):
+        self._skip_space()
+        if self._peek("("):
+            self.pos += 1
+            func = self._expression()
+            self._expect(")")
+            return func, None
+        if self._peek("'") or self._peek('"'):
+            literal = self._string()
+            return lambda arguments: literal, None
+        root = self._match(self._name)
+        if root not in PATH_ROOTS:
+            self._fail(f"unknown root '{root}', expected one of {', '.join(PATH_ROOTS)}")
+        key = PATH_ROOTS[root]
+        return lambda arguments: arguments.get(key), key
+
+    def _string(self) -> str:
+        quote = self.source[self.pos]
+        end = self.source.find(quote, self.pos + 1)
+        if end == -1:
+            self._fail("unterminated string")
+        literal = self.source[self.pos + 1:end]
+        self.pos = end + 1
+        return literal
+
+    def _filter(self) -> Callable:
+        name = self._match(self._name)
+        if name not in PATH_FILTERS:
+            self._fail(f"unknown filter '{name}'")
+        filter_args = []
+        if self._peek("("):
+            self.pos += 1
+            if not self._peek(")"):
+                filter_args.append(self._filter_arg())
+                while self._peek(","):
+                    self.pos += 1
+                    filter_args.append(self._filter_arg())
+            self._expect(")")
+        try:
+            return PATH_FILTERS[name](*filter_args)
+        except TypeError:
+            self._fail(f"invalid arguments for filter '{name}'")
+
+    def _filter_arg(self) -> str:
+        self._skip_space()
+        if self._peek("'") or self._peek('"'):
+            return self._string()
+        end = self.pos
+        while end < len(self.source) and self.source[end] not in ",)":
+            end += 1
+        arg = self.source[self.pos:end].strip()
+        if not arg:
+            self._fail("empty filter argument")
+        self.pos = end
+        return arg
+
+
+def _chain(primary, root_key, steps):
+    # Specialize the common shapes so a path costs about as much as the lambda it replaces
+    if root_key is not None and steps and getattr(steps[0], "attribute_name", None):
+        primary = _root_attribute_getter(root_key, steps[0].attribute_name)
+        steps = steps[1:]
+    if not steps:
+        return primary
+    if len(steps) == 1:
+        step = steps[0]
+
+        def one_step(arguments):
+            value = primary(arguments)
+            return None if value is None else step(value)
+        return one_step
+    if len(steps) == 2:
+        first, second = steps
+
+        def two_steps(arguments):
+            value = primary(arguments)
+            if value is None:
+                return None
+            value = first(value)
+            return None if value is None else second(value)
+        return two_steps
+
+    def walk(arguments):
+        value = primary(arguments)
+        for step in steps:
+            if value is None:
+                return None
+            value = step(value)
+        return value
+    return walk
+
+
+def _root_attribute_getter(root_key, name):
+    def get(arguments):
+        value = arguments.get(root_key)
+        if isinstance(value, dict):
+            return value.get(name)
+        return getattr(value, name, None)
+    return get
+
+
+def _attribute_getter(name):
+    def get(value):
+        if isinstance(value, dict):
+            return value.get(name)
+        return getattr(value, name, None)
+    get.attribute_name = name
+    return get
+
+
+def _item_getter(index):
+    def get(value):
+        try:
+            return value[index]
+        except (IndexError, KeyError, TypeError):
+            return None
+    return get
+
+
+def compile_path(source: str) -> Callable:
+    """
+    Compile a path accessor into a function of the accessor arguments.
+
+    @param source: The path expression, eg. instance.__dict__|first_of(model,model_name)
+    @return: The getter function
+    @raise PathSyntaxError: if the expression is not a valid path
+    """
+    return _PathParser(source).parse()
+
+
+def is_lambda_accessor(source: str) -> bool:
+    return source.lstrip().startswith(LAMBDA_PREFIX)
+
+
+def compile_accessor(source: str) -> Optional[CompiledAccessor]:
+    """
+    Compile an accessor expression, bypassing the cache.
+
+    @param source: The accessor expression from the output processor
+    @return: The compiled accessor, or None if the expression is invalid
+    """
+    if not is_lambda_accessor(source):
+        try:
+            return CompiledAccessor(source, compile_path(source), "arguments")
+        except Exception as e:
+            logger.error(f"Error compiling accessor '{source}': {e}")
+            return None
+    try:
+        func = eval(source, _accessor_namespace())  # pylint: disable=eval-used
+    except Exception as e:
+        logger.error(f"Error compiling accessor '{source}': {e}")
+        return None
+    if not callable(func):
+        logger.error(f"Error compiling accessor '{source}': expression is not callable")
+        return None
+    return CompiledAccessor(source, func, _get_input_key(source))
+
+
+def get_accessor(source: str) -> Optional[CompiledAccessor]:
+    """
+    Return the compiled accessor for an expression, compiling it on first use.
+
+    Invalid expressions are cached as None so they are reported only once.
+    """
+    try:
+        return _accessor_cache[source]
+    except KeyError:
+        accessor = compile_accessor(source)
+        _accessor_cache[source] = accessor
+        return accessor
+
+
+def compile_output_processor(output_processor: dict) -> int:
+    """
+    Compile every attribute and event accessor of an output processor up front.
+
+    @param output_processor: The output processor loaded from the entity json
+    @return: The number of accessors that failed to compile
+    """
+    errors = 0
+    if not isinstance(output_processor, dict):
+        return errors
+    accessors = [processor.get("accessor")
+                 for processors in output_processor.get("attributes", [])
+                 for processor in processors]
+    accessors += [attribute.get("accessor")
+                  for event in output_processor.get("events", [])
+                  for attribute in event.get("attributes", [])]
+    for source in accessors:
+        if isinstance(source, str) and source and get_accessor(source) is None:
+            errors += 1
+    return errors
+
+
+def clear_accessor_cache() -> None:
+    _accessor_cache.clear()
+
+
+class StaticAttributeCache:
+    """
+    Per-instance cache of accessor results for attributes marked static in the
+    metamodel, eg. the model name or deployment of an LLM client.
+
+    Entries are keyed by id() and dropped by a weakref callback when the
+    instance is collected, so unhashable clients (pydantic models) are supported.
+    Instances that can't be weakly referenced are never cached.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._unsupported_types = set()
+
+    def _get_values(self, instance) -> Optional[dict]:
+        key = id(instance)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0]() is instance:
+            return entry[1]
+        instance_type = type(instance)
+        if instance is None or instance_type in self._unsupported_types:
+            return None
+        try:
+            ref = weakref.ref(instance, lambda dead_ref: self._evict(key, dead_ref))
+        except TypeError:
+            self._unsupported_types.add(instance_type)
+            return None
+        values = {}
+        self._entries[key] = (ref, values)
+        return values
+
+    def _evict(self, key, dead_ref):
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] is dead_ref:
+            del self._entries[key]
+
+    def resolve(self, instance, accessor: CompiledAccessor, arguments: dict):
+        """
+        Return the accessor result for this instance, evaluating it only on first use.
+
+        @param instance: The wrapped instance the static attribute belongs to
+        @param accessor: The compiled accessor of the attribute
+        @param arguments: The accessor arguments of the current call
+        """
+        return self.get_or_compute(instance, accessor.source, accessor.func, arguments)
+
+    def get_or_compute(self, instance, key: str, func: Callable, *args):
+        """
+        Return the value cached under key for this instance, calling func(*args) only on first use.
+
+        @param instance: The instance the value belongs to
+        @param key: The cache key of the value, unique per kind of value
+        @param func: Computes the value when it is not cached yet
+        """
+        values = self._get_values(instance)
+        if values is None:
+            return func(*args)
+        try:
+            return values[key]
+        except KeyError:
+            value = func(*args)
+            values[key] = value
+            return value
+
+    def invalidate(self, instance) -> None:
+        entry = self._entries.get(id(instance))
+        if entry is not None and entry[0]() is instance:
+            del self._entries[id(instance)]
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+static_attribute_cache = StaticAttributeCache()
@@ -0,0 +1,278 @@
+"""
+Aggregation of repeated sibling spans.
+
+Agent loops and map-reduce chains call the same retriever or LLM many times under one parent.
+The AggregatingSpanProcessor holds the ended spans under their parent until the parent ends.
+It then folds the sibling leaf spans with the same name, span.type and entity attributes into
+one summary span, with the count, the duration statistics and the token totals of the folded
+spans. A few exemplar spans of every group are passed on unchanged.
+
+The summary span is a sibling of the folded spans and gets a new span id. It carries the
+attributes all the folded spans have in common, and the token totals of the folded spans in a
+metadata event like the inference spans, so token accounting over the exported spans stays
+correct. Spans with an error status, spans with children and groups smaller than min_count are
+passed on unchanged.
+
+Siblings whose parent doesn't end within max_buffer_age_millis are flushed by a background
+worker, which waits for the oldest buffer to reach that age, so they are passed on even when no
+other span ends.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Union
+from opentelemetry.context import Context
+from opentelemetry.sdk.trace import Event, ReadableSpan, Span, SpanProcessor
+from opentelemetry.sdk.trace.id_generator import RandomIdGenerator
+from opentelemetry.trace import SpanContext, StatusCode
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MIN_COUNT = 5
+DEFAULT_MAX_EXEMPLARS = 2
+DEFAULT_MAX_BUFFERED_SPANS = 10000
+DEFAULT_MAX_BUFFER_AGE_MILLIS = 60000
+DEFAULT_FLUSH_TIMEOUT_MILLIS = 30000
+MAX_TRACKED_SPAN_IDS = 4096
+
+META_DATA_EVENT = "metadata"
+TOKEN_KEYS = ("completion_tokens", "prompt_tokens", "total_tokens")
+COUNT_KEY = "aggregate.count"
+EXEMPLAR_COUNT_KEY = "aggregate.exemplar_count"
+DURATION_MIN_KEY = "aggregate.duration.min_ms"
+DURATION_MAX_KEY = "aggregate.duration.max_ms"
+DURATION_SUM_KEY = "aggregate.duration.sum_ms"
+TOKEN_KEY_PREFIX = "aggregate"
+
+
+def get_group_key(span: ReadableSpan):
+    """Sibling spans with the same key are folded together."""
+    attributes = span.attributes or {}
+    entities = tuple(sorted((key, value if not isinstance(value, list) else tuple(value))
+                            for key, value in attributes.items() if key.startswith("entity.")))
+    return span.name, attributes.get("span.type"), entities
+
+
+def get_token_counts(span: ReadableSpan) -> Dict[str, int]:
+    token_counts = {}
+    for event in span.events:
+        if event.name != META_DATA_EVENT or not event.attributes:
+            continue
+        for key in TOKEN_KEYS:
+            value = event.attributes.get(key)
+            if isinstance(value, (int, float)):
+                token_counts[key] = token_counts.get(key, 0) + value
+    return token_counts
+
+
+def _add_bounded(span_ids: OrderedDict, span_id: int):
+    span_ids[span_id] = None
+    if len(span_ids) > MAX_TRACKED_SPAN_IDS:
+        span_ids.popitem(last=False)
+
+
+class _SiblingBuffer:
+    """The ended spans of one parent, with whether each one had children."""
+
+    __slots__ = ("created", "spans")
+
+    def __init__(self):
+        self.created = time.monotonic()
+        self.spans = []
+
+
+class AggregatingSpanProcessor(SpanProcessor):
+    """
+    Span processor that folds repeated sibling spans into summary spans before passing
+    the spans to the wrapped span processors.
+    """
+
+    def __init__(self, span_processors: Union[SpanProcessor, List[SpanProcessor]],
+                 min_count: int = DEFAULT_MIN_COUNT,
+                 max_exemplars: int = DEFAULT_MAX_EXEMPLARS,
+                 max_buffered_spans: int = DEFAULT_MAX_BUFFERED_SPANS,
+                 max_buffer_age_millis: int = DEFAULT_MAX_BUFFER_AGE_MILLIS):
+        """
+        @param span_processors: The span processors the spans are passed to
+        @param min_count: Groups of sibling spans smaller than this are passed on unchanged
+        @param max_exemplars: Spans of a group passed on unchanged, the first and the slowest ones
+        @param max_buffered_spans: When more spans wait for their parent, the oldest siblings are flushed
+        @param max_buffer_age_millis: Siblings waiting longer for their parent, eg. one that ended before
+            them or in another process, are flushed
+        """
+        if isinstance(span_processors, SpanProcessor):
+            span_processors = [span_processors]
+        self.span_processors = list(span_processors)
+        self.min_count = max(min_count, 2)
+        self.max_exemplars = max(max_exemplars, 0)
+        self.max_buffered_spans = max_buffered_spans
+        self.max_buffer_age = max_buffer_age_millis / 1000
+        self._buffers: "OrderedDict[int, _SiblingBuffer]" = OrderedDict()
+        self._buffered_spans = 0
+        self._ended_parents: "OrderedDict[int, None]" = OrderedDict()
+        # Parents whose children were flushed before they ended, they are never folded
+        self._evicted_parents: "OrderedDict[int, None]" = OrderedDict()
+        self._lock = threading.Condition()
+        self._id_generator = RandomIdGenerator()
+        self._shutdown = False
+        self._worker = threading.Thread(name="MonocleAggregationEviction", target=self._run, daemon=True)
+        self._worker.start()
+
+    def on_start(self, span: Span, parent_context: Optional[Context] = None) -> None:
+        for processor in self.span_processors:
+            processor.on_start(span, parent_context=parent_context)
+
+    def on_end(self, span: ReadableSpan) -> None:
+        span_id = span.get_span_context().span_id
+        parent = span.parent
+        with self._lock:
+            ready = self._evict()
+            buffer = self._buffers.pop(span_id, None)
+            if buffer is not None:
+                self._buffered_spans -= len(buffer.spans)
+                ready.extend(self._aggregate(buffer.spans))
+            has_children = buffer is not None or span_id in self._evicted_parents
+            if parent is None or parent.is_remote or parent.span_id in self._ended_parents:
+                ready.append(span)
+            else:
+                parent_buffer = self._buffers.get(parent.span_id)
+                if parent_buffer is None:
+                    parent_buffer = self._buffers[parent.span_id] = _SiblingBuffer()
+                    if len(self._buffers) == 1:
+                        # The worker waits for the oldest buffer to expire
+                        self._lock.notify()
+                parent_buffer.spans.append((span, has_children))
+                self._buffered_spans += 1
+            _add_bounded(self._ended_parents, span_id)
+        self._forward(ready)
+
+    def _evict(self) -> List[ReadableSpan]:
+        """Flushes the oldest siblings while over the buffer bounds."""
+        ready = []
+        now = time.monotonic()
+        while self._buffers:
+            parent_span_id, buffer = next(iter(self._buffers.items()))
+            if self._buffered_spans <= self.max_buffered_spans and now - buffer.created <= self.max_buffer_age:
+                break
+            del self._buffers[parent_span_id]
+            self._buffered_spans -= len(buffer.spans)
+            _add_bounded(self._evicted_parents, parent_span_id)
+            ready.extend(self._aggregate(buffer.spans))
+        return ready
+
+    def _aggregate(self, siblings) -> List[ReadableSpan]:
+        """Folds the groups of repeated leaf spans, returns the spans to pass on."""
+        ready = []
+        groups = {}
+        for (span, has_children) in siblings:
+            if has_children or (span.status is not None and span.status.status_code == StatusCode.ERROR):
+                ready.append(span)
+            else:
+                groups.setdefault(get_group_key(span), []).append(span)
+        for group in groups.values():
+            if len(group) < self.min_count:
+                ready.extend(group)
+                continue
+            exemplars = self._get_exemplars(group)
+            ready.extend(exemplars)
+            folded = [span for span in group if span not in exemplars]
+            if folded:
+                ready.append(self._get_summary_span(folded, len(exemplars)))
+        return ready
+
+    def _get_exemplars(self, group) -> List[ReadableSpan]:
+        if self.max_exemplars == 0:
+            return []
+        exemplars = [group[0]]
+        for span in sorted(group[1:], key=lambda span: span.end_time - span.start_time, reverse=True):
+            if len(exemplars) >= self.max_exemplars:
+                break
+            exemplars.append(span)
+        return exemplars
+
+    def _get_summary_span(self, folded: List[ReadableSpan], exemplar_count: int) -> ReadableSpan:
+        first = folded[0]
+        common_attributes = dict(first.attributes or {})
+        durations = []
+        token_counts = {}
+        for span in folded:
+            durations.append((span.end_time - span.start_time) / 1e6)
+            attributes = span.attributes or {}
+            for key in [key for key, value in common_attributes.items() if attributes.get(key) != value]:
+                del common_attributes[key]
+            for key, value in get_token_counts(span).items():
+                token_counts[key] = token_counts.get(key, 0) + value
+        common_attributes.update({
+            COUNT_KEY: len(folded),
+            EXEMPLAR_COUNT_KEY: exemplar_count,
+            DURATION_MIN_KEY: min(durations),
+            DURATION_MAX_KEY: max(durations),
+            DURATION_SUM_KEY: sum(durations)
+        })
+        end_time = max(span.end_time for span in folded)
+        events = []
+        if token_counts:
+            common_attributes.update({f"{TOKEN_KEY_PREFIX}.{key}": value for key, value in token_counts.items()})
+            events.append(Event(name=META_DATA_EVENT, attributes=token_counts, timestamp=end_time))
+        first_context = first.get_span_context()
+        return ReadableSpan(
+            name=first.name,
+            context=SpanContext(trace_id=first_context.trace_id,
+                                span_id=self._id_generator.generate_span_id(),
+                                is_remote=False,
+                                trace_flags=first_context.trace_flags,
+                                trace_state=first_context.trace_state),
+            parent=first.parent,
+            resource=first.resource,
+            attributes=common_attributes,
+            events=events,
+            kind=first.kind,
+            status=first.status,
+            start_time=min(span.start_time for span in folded),
+            end_time=end_time,
+            instrumentation_scope=first.instrumentation_scope,
+        )
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._shutdown:
+                    if self._buffers:
+                        timeout = next(iter(self._buffers.values())).created + self.max_buffer_age - time.monotonic()
+                        if timeout < 0:
+                            break
+                    else:
+                        timeout = None
+                    self._lock.wait(timeout)
+                if self._shutdown:
+                    return
+                ready = self._evict()
+            self._forward(ready)
+
+    def _forward(self, spans: List[ReadableSpan]) -> None:
+        for span in spans:
+            for processor in self.span_processors:
+                processor.on_end(span)
+
+    def _flush_buffers(self) -> None:
+        with self._lock:
+            ready = []
+            for buffer in self._buffers.values():
+                ready.extend(self._aggregate(buffer.spans))
+            self._buffers.clear()
+            self._buffered_spans = 0
+        self._forward(ready)
+
+    def force_flush(self, timeout_millis: int = DEFAULT_FLUSH_TIMEOUT_MILLIS) -> bool:
+        self._flush_buffers()
+        return all([processor.force_flush(timeout_millis) for processor in self.span_processors])
+
+    def shutdown(self) -> None:
+        with self._lock:
+            self._shutdown = True
+            self._lock.notify()
+        self._worker.join(DEFAULT_FLUSH_TIMEOUT_MILLIS / 1000)
+        self._flush_buffers()
+        for processor in self.span_processors:
+            processor.shutdown()
@@ -0,0 +1,289 @@
+"""
+Batch calls.
+
+A batch wrapper emits one span for the whole batch. Every input of the batch is an item:
+the instrumented calls made for it directly under the batch span, eg. its invoke, or the invoke
+of every step of a RunnableSequence, are timed together for the latency distribution set on the
+batch span, and only a sampled share of the items get their own spans. The steps of a sequence
+batch run as children of one langchain run per input, the parent run of the callbacks in their
+config tells which input a call is made for. A sampled item made of several calls gets an item
+span, parent of the spans of its calls. An item that is not sampled runs under a non recording
+span of a sampled out trace, so nothing below it is traced either. A batch of 100k inputs then
+produces one span plus the sampled items, instead of a span tree per input.
+"""
+import inspect
+import logging
+import os
+import threading
+import time
+import weakref
+from typing import Any, Dict, Optional
+from opentelemetry.context import attach, detach
+from opentelemetry.trace import (NonRecordingSpan, Span, SpanContext, Status, StatusCode, TraceFlags, Tracer,
+                                 get_current_span, set_span_in_context, use_span)
+
+logger = logging.getLogger(__name__)
+
+BATCH_ITEM_SAMPLE_RATE_ENV = "MONOCLE_BATCH_ITEM_SAMPLE_RATE"
+ITEM_COUNT_KEY = "batch.item_count"
+MAX_CONCURRENCY_KEY = "batch.max_concurrency"
+PEAK_CONCURRENCY_KEY = "batch.peak_concurrency"
+ERROR_COUNT_KEY = "batch.error_count"
+ITEM_CALL_COUNT_KEY = "batch.item_call_count"
+SAMPLED_ITEM_COUNT_KEY = "batch.sampled_item_count"
+ITEM_INDEX_KEY = "batch.item_index"
+ITEM_LATENCY_KEY_PREFIX = "batch.item_latency"
+ITEM_LATENCY_PERCENTILES = (("p50", 0.5), ("p90", 0.9), ("p99", 0.99))
+
+# Batches in progress, by the span id of their batch span
+_active_batches: Dict[int, "BatchScope"] = {}
+
+
+def get_item_sample_rate(to_wrap) -> float:
+    """
+    The share of batch items traced with their own spans, from the batch_item_sample_rate of the
+    wrapped method or the MONOCLE_BATCH_ITEM_SAMPLE_RATE environment variable, 0 by default.
+    """
+    sample_rate = to_wrap.get("batch_item_sample_rate", os.environ.get(BATCH_ITEM_SAMPLE_RATE_ENV, 0))
+    try:
+        return min(max(float(sample_rate), 0.0), 1.0)
+    except (TypeError, ValueError):
+        logger.warning(f"Invalid batch item sample rate {sample_rate}, items are not traced")
+        return 0.0
+
+
+def get_batch_scope() -> Optional["BatchScope"]:
+    """Returns the batch whose span is the current span, ie. the current call is an item of that batch."""
+    if not _active_batches:
+        return None
+    return _active_batches.get(get_current_span().get_span_context().span_id)
+
+
+def get_max_concurrency(config) -> Optional[int]:
+    """The max_concurrency of a langchain RunnableConfig, or of the first of a list of them."""
+    if isinstance(config, list):
+        config = config[0] if config else None
+    if isinstance(config, dict):
+        return config.get("max_concurrency")
+    return None
+
+
+def get_item_key(config) -> Optional[Any]:
+    """The parent run of the callbacks of a langchain RunnableConfig, the same for the calls made for one input."""
+    callbacks = config.get("callbacks") if isinstance(config, dict) else None
+    return getattr(callbacks, "parent_run_id", None)
+
+
+class BatchItem:
+    """An input of a batch, with the time spent in the calls made for it."""
+    __slots__ = ("index", "sampled", "span", "duration", "end_time")
+
+    def __init__(self, index: int, sampled: bool):
+        self.index = index
+        self.sampled = sampled
+        # The item span of a sampled item made of several calls
+        self.span: Optional[Span] = None
+        # Seconds spent in its calls, without the time waiting for the other inputs between the steps
+        self.duration = 0.0
+        self.end_time: Optional[int] = None
+
+
+class BatchScope:
+    """Collects the item timings of a batch call and sets them on the batch span when it ends."""
+
+    def __init__(self, tracer: Tracer, span: Span, item_sample_rate: float, args, kwargs):
+        """
+        @param tracer: Starts the item spans
+        @param span: The batch span, the current span of the batch call
+        @param item_sample_rate: The share of the items traced with their own spans
+        @param args: Arguments of the batch call, the inputs first and the config second
+        @param kwargs: Keyword arguments of the batch call
+        """
+        self.tracer = tracer
+        self.span = span
+        self.item_sample_rate = item_sample_rate
+        span_context = span.get_span_context()
+        self.unsampled_span = NonRecordingSpan(SpanContext(trace_id=span_context.trace_id,
+                                                           span_id=span_context.span_id,
+                                                           is_remote=False,
+                                                           trace_flags=TraceFlags(TraceFlags.DEFAULT)))
+        inputs = args[0] if args else kwargs.get("inputs")
+        self.item_count = len(inputs) if hasattr(inputs, "__len__") else None
+        config = args[1] if len(args) > 1 else kwargs.get("config")
+        self.max_concurrency = get_max_concurrency(config)
+        # The parent runs of the batch call itself, shared by all its inputs when the calls are their invoke
+        self._shared_keys = {None}
+        self._shared_keys.update(get_item_key(item_config) for item_config in
+                                 (config if isinstance(config, list) else [config]))
+        self.items = []
+        self._items_by_key: Dict[Any, BatchItem] = {}
+        self.sampled_items = 0
+        self.in_flight = 0
+        self.peak_concurrency = 0
+        self._lock = threading.Lock()
+        self._finished = False
+        _active_batches[span_context.span_id] = self
+
+    def _start_item(self, args, kwargs) -> BatchItem:
+        """Returns the item a call is made for, counting the new items and sampling them by their index."""
+        key = get_item_key(args[1] if len(args) > 1 else kwargs.get("config"))
+        if key in self._shared_keys:
+            # A call made for its own input, eg. the invoke of Runnable.batch
+            key = None
+        with self._lock:
+            self.in_flight += 1
+            if self.in_flight > self.peak_concurrency:
+                self.peak_concurrency = self.in_flight
+            item = self._items_by_key.get(key) if key is not None else None
+            if item is None:
+                index = len(self.items)
+                # Deterministic, samples exactly the sample rate share of the items
+                item = BatchItem(index, int((index + 1) * self.item_sample_rate) > int(index * self.item_sample_rate))
+                self.items.append(item)
+                if item.sampled:
+                    self.sampled_items += 1
+                if key is not None:
+                    self._items_by_key[key] = item
+                    if item.sampled:
+                        # The parent of the spans of the steps of the input
+                        item.span = self.tracer.start_span(f"{getattr(self.span, 'name', 'batch')}.item",
+                                                           context=set_span_in_context(self.span),
+                                                           attributes={ITEM_INDEX_KEY: index})
+        return item
+
+    def _end_item(self, item: BatchItem, start: float):
+        duration = time.perf_counter() - start
+        end_time = time.time_ns()
+        with self._lock:
+            self.in_flight -= 1
+            item.duration += duration
+            item.end_time = end_time
+
+    def _use_item_span(self, item: BatchItem):
+        """Makes the item span current, the failures of the calls are recorded on the item span only."""
+        if item.span is not None:
+            return use_span(item.span)
+        # The batch span is current already for the items of a single call
+        return use_span(self.span if item.sampled else self.unsampled_span, record_exception=False,
+                        set_status_on_exception=False)
+
+    def call_item(self, call, wrapped, instance, args, kwargs):
+        """Calls an item of the batch, through the wrapper call if the item is sampled."""
+        item = self._start_item(args, kwargs)
+        start = time.perf_counter()
+        try:
+            with self._use_item_span(item):
+                if item.sampled:
+                    result = call(wrapped, instance, args, kwargs)
+                else:
+                    result = wrapped(*args, **kwargs)
+        except BaseException:
+            self._end_item(item, start)
+            raise
+        if inspect.isawaitable(result):
+            return self._await_item(result, start, item)
+        self._end_item(item, start)
+        return result
+
+    async def _await_item(self, awaitable, start: float, item: BatchItem):
+        try:
+            # The coroutine runs here, so the span of the item has to be current while awaiting it
+            with self._use_item_span(item):
+                return await awaitable
+        finally:
+            self._end_item(item, start)
+
+    def get_attributes(self, outputs=None) -> Dict[str, Any]:
+        attributes = {
+            ITEM_CALL_COUNT_KEY: len(self.items),
+            SAMPLED_ITEM_COUNT_KEY: self.sampled_items,
+            PEAK_CONCURRENCY_KEY: self.peak_concurrency
+        }
+        if self.item_count is not None:
+            attributes[ITEM_COUNT_KEY] = self.item_count
+        if self.max_concurrency is not None:
+            attributes[MAX_CONCURRENCY_KEY] = self.max_concurrency
+        if isinstance(outputs, list):
+            attributes[ERROR_COUNT_KEY] = sum(1 for output in outputs if isinstance(output, Exception))
+        if self.items:
+            latencies = sorted(item.duration * 1000 for item in self.items)
+            attributes[f"{ITEM_LATENCY_KEY_PREFIX}.mean_ms"] = sum(latencies) / len(latencies)
+            for (name, percentile) in ITEM_LATENCY_PERCENTILES:
+                attributes[f"{ITEM_LATENCY_KEY_PREFIX}.{name}_ms"] = latencies[min(len(latencies) - 1, int(len(latencies) * percentile))]
+            attributes[f"{ITEM_LATENCY_KEY_PREFIX}.max_ms"] = latencies[-1]
+        return attributes
+
+    def finish(self, outputs=None, exception: Optional[BaseException] = None):
+        """Sets the batch attributes on the span and ends it."""
+        if self._finished:
+            return
+        self._finished = True
+        _active_batches.pop(self.span.get_span_context().span_id, None)
+        for item in self._items_by_key.values():
+            if item.span is not None:
+                item.span.end(end_time=item.end_time)
+        try:
+            self.span.set_attributes(self.get_attributes(outputs))
+            if exception is not None:
+                self.span.record_exception(exception)
+                self.span.set_status(Status(StatusCode.ERROR, f"{type(exception).__name__}: {exception}"))
+        except Exception:
+            logger.exception("exception in finishing the batch span")
+        finally:
+            self.span.end()
+
+    def _finish_when_collected(self, generator):
+        # A generator that is never iterated doesn't run its finally when collected
+        weakref.finalize(generator, self.finish)
+        return generator
+
+    def trace_as_completed(self, iterator):
+        """
+        Passes through the results of batch_as_completed, ends the batch when they are exhausted,
+        or when the results are collected without being exhausted.
+        """
+        return self._finish_when_collected(self._trace_as_completed(iterator))
+
+    def atrace_as_completed(self, iterator):
+        """
+        Passes through the results of abatch_as_completed, ends the batch when they are exhausted,
+        or when the results are collected without being exhausted.
+        """
+        return self._finish_when_collected(self._atrace_as_completed(iterator))
+
+    def _trace_as_completed(self, iterator):
+        exception = None
+        try:
+            while True:
+                # The items are submitted while iterating, as children of the batch span
+                token = attach(set_span_in_context(self.span))
+                try:
+                    result = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    detach(token)
+                yield result
+        except Exception as e:
+            exception = e
+            raise
+        finally:
+            self.finish(exception=exception)
+
+    async def _atrace_as_completed(self, iterator):
+        exception = None
+        try:
+            while True:
+                token = attach(set_span_in_context(self.span))
+                try:
+                    result = await iterator.__anext__()
+                except StopAsyncIteration:
+                    return
+                finally:
+                    detach(token)
+                yield result
+        except Exception as e:
+            exception = e
+            raise
+        finally:
+            self.finish(exception=exception)
@@ -0,0 +1,255 @@
+"""
+Deferred span enrichment.
+
+By default the wrappers resolve the metamodel attributes and events of a span
+(process_span, token usage, context output) inline, before the wrapped call
+returns to user code. When a DeferredEnrichmentSpanProcessor is registered on
+the tracer provider, the wrappers only capture what those steps need and the
+processor runs them on a background worker after the span ends, just before
+handing the span to the downstream span processors (and so the exporters).
+
+Safety contract for the captured values:
+- The arguments named in SNAPSHOT_ARGUMENTS (the call args, kwargs and return
+  value) are snapshotted when the step is captured: tuples, lists and dicts are
+  copied two levels deep, so appending to a message list or updating a dict
+  after the call does not change what gets traced. The objects inside those
+  containers (messages, documents, responses) are kept by reference and must
+  not be mutated in place after the call returns.
+- Everything else, notably the wrapped instance, is kept by reference. Entity
+  attributes read from the instance are expected to be configuration (model
+  name, endpoint, deployment) that does not change between the call and export.
+- The steps run inside a copy of the request's context, so values set with
+  opentelemetry context (workflow name, session properties) resolve the same
+  as they would inline.
+"""
+import contextvars
+import logging
+import threading
+from collections import deque
+from typing import Callable, List, Optional, Sequence, Union
+from opentelemetry.context import Context
+from opentelemetry.sdk.trace import Event, ReadableSpan, Span, SpanLimits, SpanProcessor
+from opentelemetry.sdk.util import BoundedList
+from opentelemetry.util.types import Attributes
+from opentelemetry.attributes import BoundedAttributes
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_ARGUMENTS = ("args", "kwargs", "return_value", "response")
+DEFAULT_MAX_QUEUE_SIZE = 2048
+DEFAULT_FLUSH_TIMEOUT_MILLIS = 30000
+# For a span that isn't an SDK span
+_NO_LIMITS = SpanLimits(max_span_attributes=SpanLimits.UNSET, max_events=SpanLimits.UNSET,
+                        max_links=SpanLimits.UNSET, max_event_attributes=SpanLimits.UNSET,
+                        max_attribute_length=SpanLimits.UNSET, max_span_attribute_length=SpanLimits.UNSET)
+
+# span_id -> captured enrichment steps for the spans started under a deferred processor
+_pending_enrichments = {}
+
+
+def _snapshot(value, depth: int = 2):
+    if depth == 0:
+        return value
+    if isinstance(value, list):
+        return [_snapshot(item, depth - 1) for item in value]
+    if isinstance(value, tuple):
+        return tuple(_snapshot(item, depth - 1) for item in value)
+    if isinstance(value, dict):
+        return {key: _snapshot(item, depth - 1) for key, item in value.items()}
+    return value
+
+
+def submit_enrichment(span: Span, func: Callable, **kwargs) -> bool:
+    """
+    Capture an enrichment step to be run on the deferred enrichment worker.
+
+    @param span: The span being enriched
+    @param func: The enrichment function, called as func(span=..., **kwargs)
+    @param kwargs: The arguments of the enrichment function
+    @return: False if the span is not handled by a deferred enrichment processor
+        and the step has to run inline
+    """
+    steps = _pending_enrichments.get(span.get_span_context().span_id)
+    if steps is None:
+        return False
+    for name in SNAPSHOT_ARGUMENTS:
+        if name in kwargs:
+            kwargs[name] = _snapshot(kwargs[name])
+    steps.append((contextvars.copy_context(), func, kwargs))
+    return True
+
+
+class DeferredSpan:
+    """
+    Stand-in for an ended span, passed to the enrichment steps on the worker.
+    It records the attributes and events the steps set and builds the
+    enriched ReadableSpan from them, within the span limits of the original
+    span and keeping the counts of what it dropped.
+    """
+
+    def __init__(self, span: ReadableSpan, limits: Optional[SpanLimits] = None):
+        """
+        @param span: The ended span
+        @param limits: The span limits of the tracer provider the span was created with
+        """
+        self._span = span
+        self._limits = limits or getattr(span, "_limits", None) or _NO_LIMITS
+        self._attributes = BoundedAttributes(self._limits.max_span_attributes, span.attributes, immutable=False,
+                                             max_value_len=self._limits.max_span_attribute_length)
+        self._attributes.dropped += span.dropped_attributes
+        self._events = BoundedList.from_seq(self._limits.max_events, span.events)
+        self._events.dropped += span.dropped_events
+        self._links = BoundedList.from_seq(self._limits.max_links, span.links)
+        self._links.dropped += span.dropped_links
+
+    @property
+    def name(self) -> str:
+        return self._span.name
+
+    @property
+    def parent(self):
+        return self._span.parent
+
+    @property
+    def resource(self):
+        return self._span.resource
+
+    @property
+    def attributes(self) -> Attributes:
+        return self._attributes
+
+    @property
+    def events(self) -> Sequence[Event]:
+        return self._events
+
+    def get_span_context(self):
+        return self._span.get_span_context()
+
+    def is_recording(self) -> bool:
+        return True
+
+    def set_attribute(self, key: str, value) -> None:
+        self._attributes[key] = value
+
+    def set_attributes(self, attributes: Attributes) -> None:
+        for key, value in attributes.items():
+            self.set_attribute(key, value)
+
+    def add_event(self, name: str, attributes: Attributes = None, timestamp: int = None) -> None:
+        self._events.append(Event(
+            name=name,
+            attributes=BoundedAttributes(self._limits.max_event_attributes, attributes, immutable=True,
+                                         max_value_len=self._limits.max_attribute_length),
+            timestamp=timestamp or self._span.end_time,
+        ))
+
+    def to_readable_span(self) -> ReadableSpan:
+        span = self._span
+        return ReadableSpan(
+            name=span.name,
+            context=span.context,
+            parent=span.parent,
+            resource=span.resource,
+            attributes=self._attributes,
+            events=self._events,
+            links=self._links,
+            kind=span.kind,
+            status=span.status,
+            start_time=span.start_time,
+            end_time=span.end_time,
+            instrumentation_scope=span.instrumentation_scope,
+        )
+
+
+class DeferredEnrichmentSpanProcessor(SpanProcessor):
+    """
+    Span processor that runs the captured enrichment steps of a span on a
+    background worker once the span ends, and then passes the enriched span to
+    the wrapped span processors.
+
+    Spans without captured steps (not instrumented by Monocle, or enriched
+    inline) are passed through on the calling thread. When more than
+    max_queue_size spans are waiting, the span is enriched on the calling
+    thread instead of being dropped. Register at most one instance per
+    tracer provider.
+    """
+
+    def __init__(self, span_processors: Union[SpanProcessor, List[SpanProcessor]],
+                 max_queue_size: int = DEFAULT_MAX_QUEUE_SIZE):
+        if isinstance(span_processors, SpanProcessor):
+            span_processors = [span_processors]
+        self.span_processors = list(span_processors)
+        self.max_queue_size = max_queue_size
+        self._queue = deque()
+        self._condition = threading.Condition()
+        self._in_progress = 0
+        self._shutdown = False
+        # The ended spans handed to on_end don't carry the limits of their tracer provider
+        self._span_limits = None
+        self._worker = threading.Thread(name="MonocleDeferredEnrichment", target=self._run, daemon=True)
+        self._worker.start()
+
+    def on_start(self, span: Span, parent_context: Context = None) -> None:
+        if not self._shutdown:
+            _pending_enrichments[span.get_span_context().span_id] = []
+            self._span_limits = getattr(span, "_limits", None)
+        for processor in self.span_processors:
+            processor.on_start(span, parent_context=parent_context)
+
+    def on_end(self, span: ReadableSpan) -> None:
+        steps = _pending_enrichments.pop(span.get_span_context().span_id, None)
+        if not steps:
+            self._forward(span)
+            return
+        with self._condition:
+            if not self._shutdown and len(self._queue) < self.max_queue_size:
+                self._queue.append((span, steps))
+                self._condition.notify()
+                return
+        self._enrich_and_forward(span, steps)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._queue and not self._shutdown:
+                    self._condition.wait()
+                if not self._queue:
+                    return
+                span, steps = self._queue.popleft()
+                self._in_progress += 1
+            try:
+                self._enrich_and_forward(span, steps)
+            finally:
+                with self._condition:
+                    self._in_progress -= 1
+                    self._condition.notify_all()
+
+    def _enrich_and_forward(self, span: ReadableSpan, steps) -> None:
+        deferred_span = DeferredSpan(span, self._span_limits)
+        for context, func, kwargs in steps:
+            try:
+                context.run(func, span=deferred_span, **kwargs)
+            except Exception as e:
+                logger.exception(f"Error enriching span {span.name}: {e}")
+        self._forward(deferred_span.to_readable_span())
+
+    def _forward(self, span: ReadableSpan) -> None:
+        for processor in self.span_processors:
+            processor.on_end(span)
+
+    def _drain(self, timeout_millis: int) -> bool:
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._queue and self._in_progress == 0,
+                                            timeout=timeout_millis / 1000)
+
+    def force_flush(self, timeout_millis: int = DEFAULT_FLUSH_TIMEOUT_MILLIS) -> bool:
+        drained = self._drain(timeout_millis)
+        return all([processor.force_flush(timeout_millis) for processor in self.span_processors]) and drained
+
+    def shutdown(self) -> None:
+        with self._condition:
+            self._shutdown = True
+            self._condition.notify_all()
+        self._worker.join(DEFAULT_FLUSH_TIMEOUT_MILLIS / 1000)
+        for processor in self.span_processors:
+            processor.shutdown()
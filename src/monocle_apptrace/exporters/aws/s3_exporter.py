@@ -1,9 +1,6 @@
 import os
-import time
-import random
-import datetime
 import logging
-import asyncio
+from typing import Optional
 import boto3
 from botocore.exceptions import ClientError
 from botocore.exceptions import (
@@ -13,32 +10,34 @@ from botocore.exceptions import (
     EndpointConnectionError,
     ReadTimeoutError,
 )
-from opentelemetry.sdk.trace import ReadableSpan
-from opentelemetry.sdk.trace.export import SpanExporter, SpanExportResult
 from monocle_apptrace.exporters.base_exporter import SpanExporterBase
-from typing import Sequence
-import json
+from monocle_apptrace.exporters.dedup import ContentDeduplicator
 logger = logging.getLogger(__name__)
 
 class S3SpanExporter(SpanExporterBase):
-    def __init__(self, bucket_name=None, region_name=None):
-        super().__init__()
+    retryable_exceptions = (EndpointConnectionError, ConnectionClosedError, ReadTimeoutError, ConnectTimeoutError)
+    # S3 rejects multipart upload parts under 5 MiB but the last one
+    min_part_size = 5 * 1024 * 1024
+    max_parts = 10000
+
+    def __init__(self, bucket_name=None, region_name=None, deduplicator: ContentDeduplicator = None, s3_client=None,
+                 **kwargs):
+        """
+        @param bucket_name: The bucket of the trace objects, MONOCLE_S3_BUCKET_NAME by default
+        @param region_name: The AWS region of the bucket
+        @param deduplicator: Deduplicates the event payloads of every uploaded object
+        @param s3_client: The S3 client, a boto3 client with the AWS environment credentials by default
+        @param kwargs: The batching, retry, compression, key layout and append mode options of SpanExporterBase
+        """
+        super().__init__(deduplicator=deduplicator, **kwargs)
         # Use environment variables if credentials are not provided
-        DEFAULT_FILE_PREFIX = "monocle_trace_"
-        DEFAULT_TIME_FORMAT = "%Y-%m-%d_%H.%M.%S"
-        self.max_batch_size = 500
-        self.export_interval = 1
-        self.s3_client = boto3.client(
+        self.s3_client = s3_client or boto3.client(
             's3',
             aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
             aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
             region_name=region_name,
         )
         self.bucket_name = bucket_name or os.getenv('MONOCLE_S3_BUCKET_NAME','default-bucket')
-        self.file_prefix = DEFAULT_FILE_PREFIX
-        self.time_format = DEFAULT_TIME_FORMAT
-        self.export_queue = []
-        self.last_export_time = time.time()
 
         # Check if bucket exists or create it
         if not self.__bucket_exists(self.bucket_name):
@@ -80,79 +79,46 @@ class S3SpanExporter(SpanExporterBase):
             logger.error(f"Type error while checking bucket existence: {e}")
             raise e
 
-    def export(self, spans: Sequence[ReadableSpan]) -> SpanExportResult:
-        """Synchronous export method that internally handles async logic."""
-        try:
-            # Run the asynchronous export logic in an event loop
-            asyncio.run(self.__export_async(spans))
-            return SpanExportResult.SUCCESS
-        except Exception as e:
-            logger.error(f"Error exporting spans: {e}")
-            return SpanExportResult.FAILURE
-
-    async def __export_async(self, spans: Sequence[ReadableSpan]) -> SpanExportResult:
-        try:
-            # Add spans to the export queue
-            for span in spans:
-                self.export_queue.append(span)
-                # If the queue reaches MAX_BATCH_SIZE, export the spans
-                if len(self.export_queue) >= self.max_batch_size:
-                    await self.__export_spans()
-
-            # Check if it's time to force a flush
-            current_time = time.time()
-            if current_time - self.last_export_time >= self.export_interval:
-                await self.__export_spans()  # Export spans if time interval has passed
-                self.last_export_time = current_time  # Reset the last export time
-
-            return SpanExportResult.SUCCESS
-        except Exception as e:
-            logger.error(f"Error exporting spans: {e}")
-            return SpanExportResult.FAILURE
-
-    def __serialize_spans(self, spans: Sequence[ReadableSpan]) -> str:
-        try:
-            # Serialize spans to JSON or any other format you prefer
-            valid_json_list = []
-            for span in spans:
-                try:
-                    valid_json_list.append(span.to_json(indent=0).replace("\n", ""))
-                except json.JSONDecodeError as e:
-                    logger.warning(f"Invalid JSON format in span data: {span.context.span_id}. Error: {e}")
-                    continue
-            ndjson_data = "\n".join(valid_json_list) + "\n"
-            return ndjson_data
-        except Exception as e:
-            logger.warning(f"Error serializing spans: {e}")
-
-
-    async def __export_spans(self):
-        if len(self.export_queue) == 0:
-            return
-
-        # Take a batch of spans from the queue
-        batch_to_export = self.export_queue[:self.max_batch_size]
-        serialized_data = self.__serialize_spans(batch_to_export)
-        self.export_queue = self.export_queue[self.max_batch_size:]
-        try:
-            self.__upload_to_s3(serialized_data)
-        except Exception as e:
-            logger.error(f"Failed to upload span batch: {e}")
-
-    @SpanExporterBase.retry_with_backoff(exceptions=(EndpointConnectionError, ConnectionClosedError, ReadTimeoutError, ConnectTimeoutError))
-    def __upload_to_s3(self, span_data_batch: str):
-        current_time = datetime.datetime.now().strftime(self.time_format)
-        file_name = f"{self.file_prefix}{current_time}.ndjson"
+    def _upload(self, key: str, data: bytes, content_type: Optional[str] = None,
+                content_encoding: Optional[str] = None) -> None:
+        content_arguments = {}
+        if content_type:
+            content_arguments["ContentType"] = content_type
+        if content_encoding:
+            content_arguments["ContentEncoding"] = content_encoding
         self.s3_client.put_object(
             Bucket=self.bucket_name,
-            Key=file_name,
-            Body=span_data_batch
+            Key=key,
+            Body=data,
+            **content_arguments
         )
-        logger.info(f"Span batch uploaded to AWS S3 as {file_name}.")
+        logger.info(f"Span batch uploaded to AWS S3 as {key}.")
+
+    def _begin_object(self, key: str, content_type: Optional[str], content_encoding: Optional[str]):
+        content_arguments = {}
+        if content_type:
+            content_arguments["ContentType"] = content_type
+        if content_encoding:
+            content_arguments["ContentEncoding"] = content_encoding
+        response = self.s3_client.create_multipart_upload(Bucket=self.bucket_name, Key=key, **content_arguments)
+        return key, response["UploadId"]
+
+    def _upload_part(self, handle, part_number: int, data: bytes):
+        key, upload_id = handle
+        response = self.s3_client.upload_part(Bucket=self.bucket_name, Key=key, UploadId=upload_id,
+                                              PartNumber=part_number, Body=data)
+        return {"PartNumber": part_number, "ETag": response["ETag"]}
+
+    def _commit_object(self, handle, parts: list) -> None:
+        key, upload_id = handle
+        self.s3_client.complete_multipart_upload(Bucket=self.bucket_name, Key=key, UploadId=upload_id,
+                                                 MultipartUpload={"Parts": parts})
+        logger.info(f"Span object of {len(parts)} parts uploaded to AWS S3 as {key}.")
 
-    async def force_flush(self, timeout_millis: int = 30000) -> bool:
-        await self.__export_spans()  # Export any remaining spans in the queue
-        return True
+    def _abort_object(self, handle) -> None:
+        key, upload_id = handle
+        self.s3_client.abort_multipart_upload(Bucket=self.bucket_name, Key=key, UploadId=upload_id)
 
     def shutdown(self) -> None:
+        super().shutdown()
         logger.info("S3SpanExporter has been shut down.")
@@ -1,27 +1,30 @@
 import os
-import time
-import random
-import datetime
+import base64
 import logging
-import asyncio
-from azure.storage.blob import BlobServiceClient, BlobClient, ContainerClient
+from typing import Optional
+from azure.storage.blob import BlobServiceClient, BlobClient, BlobBlock, ContainerClient, ContentSettings
 from azure.core.exceptions import ResourceNotFoundError, ClientAuthenticationError, ServiceRequestError
-from opentelemetry.sdk.trace import ReadableSpan
-from opentelemetry.sdk.trace.export import SpanExporter, SpanExportResult
-from typing import Sequence
 from monocle_apptrace.exporters.base_exporter import SpanExporterBase
-import json
+from monocle_apptrace.exporters.dedup import ContentDeduplicator
 logger = logging.getLogger(__name__)
 
 class AzureBlobSpanExporter(SpanExporterBase):
-    def __init__(self, connection_string=None, container_name=None):
-        super().__init__()
-        DEFAULT_FILE_PREFIX = "monocle_trace_"
-        DEFAULT_TIME_FORMAT = "%Y-%m-%d_%H.%M.%S"
-        self.max_batch_size = 500
-        self.export_interval = 1
+    retryable_exceptions = (ResourceNotFoundError, ClientAuthenticationError, ServiceRequestError)
+    # A block blob commits at most 50000 staged blocks, the service discards the uncommitted ones after a week
+    max_parts = 50000
+
+    def __init__(self, connection_string=None, container_name=None, deduplicator: ContentDeduplicator = None,
+                 blob_service_client=None, **kwargs):
+        """
+        @param connection_string: The storage account connection string, MONOCLE_BLOB_CONNECTION_STRING by default
+        @param container_name: The container of the trace blobs, MONOCLE_BLOB_CONTAINER_NAME by default
+        @param deduplicator: Deduplicates the event payloads of every uploaded blob
+        @param blob_service_client: The blob service client, created from the connection string by default
+        @param kwargs: The batching, retry, compression, key layout and append mode options of SpanExporterBase
+        """
+        super().__init__(deduplicator=deduplicator, **kwargs)
         # Use default values if none are provided
-        if not connection_string:
+        if not connection_string and blob_service_client is None:
             connection_string = os.getenv('MONOCLE_BLOB_CONNECTION_STRING')
             if not connection_string:
                 raise ValueError("Azure Storage connection string is not provided or set in environment variables.")
@@ -29,10 +32,8 @@ class AzureBlobSpanExporter(SpanExporterBase):
         if not container_name:
             container_name = os.getenv('MONOCLE_BLOB_CONTAINER_NAME', 'default-container')
 
-        self.blob_service_client = BlobServiceClient.from_connection_string(connection_string)
+        self.blob_service_client = blob_service_client or BlobServiceClient.from_connection_string(connection_string)
         self.container_name = container_name
-        self.file_prefix = DEFAULT_FILE_PREFIX
-        self.time_format = DEFAULT_TIME_FORMAT
 
         # Check if container exists or create it
         if not self.__container_exists(container_name):
@@ -58,68 +59,35 @@ class AzureBlobSpanExporter(SpanExporterBase):
             logger.error(f"Unexpected error when checking if container {container_name} exists: {e}")
             raise e
 
-    def export(self, spans: Sequence[ReadableSpan]) -> SpanExportResult:
-        """Synchronous export method that internally handles async logic."""
-        try:
-            # Run the asynchronous export logic in an event loop
-            asyncio.run(self._export_async(spans))
-            return SpanExportResult.SUCCESS
-        except Exception as e:
-            logger.error(f"Error exporting spans: {e}")
-            return SpanExportResult.FAILURE
-
-    async def _export_async(self, spans: Sequence[ReadableSpan]):
-        """The actual async export logic is run here."""
-        # Add spans to the export queue
-        for span in spans:
-            self.export_queue.append(span)
-            if len(self.export_queue) >= self.max_batch_size:
-                await self.__export_spans()
-
-        # Force a flush if the interval has passed
-        current_time = time.time()
-        if current_time - self.last_export_time >= self.export_interval:
-            await self.__export_spans()
-            self.last_export_time = current_time
-
-    def __serialize_spans(self, spans: Sequence[ReadableSpan]) -> str:
-        try:
-            valid_json_list = []
-            for span in spans:
-                try:
-                    valid_json_list.append(span.to_json(indent=0).replace("\n", ""))
-                except json.JSONDecodeError as e:
-                    logger.warning(f"Invalid JSON format in span data: {span.context.span_id}. Error: {e}")
-                    continue
-
-            ndjson_data = "\n".join(valid_json_list) + "\n"
-            return ndjson_data
-        except Exception as e:
-            logger.warning(f"Error serializing spans: {e}")
+    def _upload(self, key: str, data: bytes, content_type: Optional[str] = None,
+                content_encoding: Optional[str] = None) -> None:
+        content_arguments = {}
+        if content_type:
+            content_arguments["content_settings"] = ContentSettings(content_type=content_type,
+                                                                    content_encoding=content_encoding)
+        blob_client = self.blob_service_client.get_blob_client(container=self.container_name, blob=key)
+        # The keys are unique, only a retry of the same object overwrites it
+        blob_client.upload_blob(data, overwrite=True, **content_arguments)
+        logger.info(f"Span batch uploaded to Azure Blob Storage as {key}.")
 
-    async def __export_spans(self):
-        if len(self.export_queue) == 0:
-            return
-
-        batch_to_export = self.export_queue[:self.max_batch_size]
-        serialized_data = self.__serialize_spans(batch_to_export)
-        self.export_queue = self.export_queue[self.max_batch_size:]
-        try:
-            self.__upload_to_blob(serialized_data)
-        except Exception as e:
-            logger.error(f"Failed to upload span batch: {e}")
+    def _begin_object(self, key: str, content_type: Optional[str], content_encoding: Optional[str]):
+        content_settings = (ContentSettings(content_type=content_type, content_encoding=content_encoding)
+                            if content_type else None)
+        return self.blob_service_client.get_blob_client(container=self.container_name, blob=key), content_settings
 
-    @SpanExporterBase.retry_with_backoff(exceptions=(ResourceNotFoundError, ClientAuthenticationError, ServiceRequestError))
-    def __upload_to_blob(self, span_data_batch: str):
-        current_time = datetime.datetime.now().strftime(self.time_format)
-        file_name = f"{self.file_prefix}{current_time}.ndjson"
-        blob_client = self.blob_service_client.get_blob_client(container=self.container_name, blob=file_name)
-        blob_client.upload_blob(span_data_batch, overwrite=True)
-        logger.info(f"Span batch uploaded to Azure Blob Storage as {file_name}.")
+    def _upload_part(self, handle, part_number: int, data: bytes):
+        blob_client, _ = handle
+        # The block ids of a blob must all have the same length
+        block_id = base64.b64encode(f"{part_number:08d}".encode("ascii")).decode("ascii")
+        blob_client.stage_block(block_id, data)
+        return block_id
 
-    async def force_flush(self, timeout_millis: int = 30000) -> bool:
-        await self.__export_spans()
-        return True
+    def _commit_object(self, handle, parts: list) -> None:
+        blob_client, content_settings = handle
+        content_arguments = {"content_settings": content_settings} if content_settings is not None else {}
+        blob_client.commit_block_list([BlobBlock(block_id=block_id) for block_id in parts], **content_arguments)
+        logger.info(f"Span blob of {len(parts)} blocks uploaded to Azure Blob Storage as {blob_client.blob_name}.")
 
     def shutdown(self) -> None:
+        super().shutdown()
         logger.info("AzureBlobSpanExporter has been shut down.")
@@ -1,31 +1,487 @@
+"""
+Background upload engine of the object storage exporters.
+
+export() serializes the spans to NDJSON lines on the calling thread, usually the
+BatchSpanProcessor worker, and queues them. A dedicated upload thread groups the
+queued lines into one object and uploads it when:
+- max_batch_size lines are queued,
+- max_batch_bytes of lines are queued, or
+- the oldest queued line has waited export_interval seconds.
+
+An upload failing with one of the retryable_exceptions of the exporter is scheduled
+again with exponential backoff and jitter, and the upload thread keeps uploading
+the other batches meanwhile, so neither the application nor the span processor
+wait for a slow store. The queue holds at most max_queue_size lines, the spans
+exported while it is full are dropped.
+
+force_flush uploads everything queued, including the batches waiting for a retry,
+and waits for it. shutdown flushes, then stops the upload thread.
+
+A batch holding spans of several workflows, dates or hours is uploaded as one object
+per partition, with collision free keys and a manifest, see object_layout.py. The
+objects are optionally compressed as they are serialized, see compression.py.
+
+In append mode the batches are appended to one open object per partition instead,
+so readers get a few large objects rather than many small ones. The object is
+uploaded in parts of part_size bytes, S3 multipart upload parts or staged Blob
+blocks, and committed once it holds max_object_bytes, after object_interval
+seconds, or on flush. Only the part being filled is held in memory. An object
+committed before its first part is full is uploaded in one request. Appending
+runs on the upload thread, which retries a failed part or commit with backoff
+before giving up on the object.
+"""
 import time
 import random
 import logging
+import threading
 from abc import ABC, abstractmethod
+from collections import deque
 from opentelemetry.sdk.trace import ReadableSpan
-from opentelemetry.sdk.trace.export import SpanExporter, SpanExportResult
-from typing import Sequence
-import asyncio
+from opentelemetry.sdk.trace.export import SpanExportResult
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Type
+from monocle_apptrace.exporters.compression import ObjectCompression, get_compression, get_compression_from_env
+from monocle_apptrace.exporters.dedup import ContentDeduplicator, get_deduplicated_records, get_deduplicator_from_env
+from monocle_apptrace.exporters.object_layout import (MANIFEST_CONTENT_TYPE, OBJECT_EXTENSION, Manifest, ObjectKeyLayout,
+                                                      SpanInfo, get_manifest, get_manifest_key, get_span_info)
+from monocle_apptrace.exporters.span_serializer import dumps, serialize_span
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_MAX_BATCH_SIZE = 500
+DEFAULT_MAX_BATCH_BYTES = 4 * 1024 * 1024
+DEFAULT_EXPORT_INTERVAL = 1
+DEFAULT_MAX_QUEUE_SIZE = 20000
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_FLUSH_TIMEOUT_MILLIS = 30000
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+DEFAULT_MAX_OBJECT_BYTES = 256 * 1024 * 1024
+DEFAULT_OBJECT_INTERVAL = 300
+DEFAULT_FILE_PREFIX = "monocle_trace_"
+DEFAULT_TIME_FORMAT = "%Y-%m-%d_%H.%M.%S"
+
+
+class PendingUpload:
+    """
+    A serialized object and its manifest, with its failed attempts and when to try it again.
+    A retry reuses the key, so an upload that succeeded without a response is overwritten.
+    """
+    __slots__ = ("key", "data", "span_count", "digests", "manifest_key", "manifest", "data_uploaded", "attempt",
+                 "due_time")
+
+    def __init__(self, key: str, data: bytes, span_count: int, manifest: Optional[bytes] = None,
+                 digests: Sequence[str] = ()):
+        self.key = key
+        self.data = data
+        self.span_count = span_count
+        # The dictionary entries first emitted in the object
+        self.digests = digests
+        self.manifest_key = get_manifest_key(key)
+        self.manifest = manifest
+        self.data_uploaded = False
+        self.attempt = 0
+        self.due_time = 0.0
+
+
+class AppendObject:
+    """An object being appended to, with the part being filled and the parts already uploaded."""
+
+    def __init__(self, key: str, workflow: str, compressor, opened_at: float):
+        self.key = key
+        self.compressor = compressor
+        self.opened_at = opened_at
+        self.manifest = Manifest(workflow)
+        # The dictionary entries written in the object
+        self.digests = set()
+        # The multipart upload or blob handle, created with the first part
+        self.handle = None
+        self.parts = []
+        self.buffer: List[bytes] = []
+        self.buffered_bytes = 0
+        self.size = 0
+
+    def write(self, data: bytes) -> None:
+        if data:
+            self.buffer.append(data)
+            self.buffered_bytes += len(data)
+            self.size += len(data)
+
+    def take_buffer(self, limit: Optional[int] = None) -> bytes:
+        """The buffered bytes, at most limit of them, the rest stays buffered."""
+        data = b"".join(self.buffer)
+        rest = data[limit:] if limit is not None else b""
+        self.buffer = [rest] if rest else []
+        self.buffered_bytes = len(rest)
+        return data[:limit] if rest else data
+
+
 class SpanExporterBase(ABC):
-    def __init__(self):
-        self.backoff_factor = 2
-        self.max_retries = 10
-        self.export_queue = []
-        self.last_export_time = time.time()
+    retryable_exceptions: Tuple[Type[BaseException], ...] = ()
+    # The smallest part but the last the store accepts, and the most parts of an object
+    min_part_size = 0
+    max_parts = 10000
 
-    @abstractmethod
-    async def export(self, spans: Sequence[ReadableSpan]) -> SpanExportResult:
-        pass
+    def __init__(self, max_batch_size: int = DEFAULT_MAX_BATCH_SIZE, max_batch_bytes: int = DEFAULT_MAX_BATCH_BYTES,
+                 export_interval: float = DEFAULT_EXPORT_INTERVAL, max_queue_size: int = DEFAULT_MAX_QUEUE_SIZE,
+                 max_retries: int = DEFAULT_MAX_RETRIES, backoff_in_seconds: float = 1,
+                 max_backoff_in_seconds: float = 32, deduplicator: ContentDeduplicator = None,
+                 compression: Optional[str] = None, compression_level: Optional[int] = None,
+                 key_template: Optional[str] = None, write_manifest: bool = True, append_mode: bool = False,
+                 part_size: int = DEFAULT_PART_SIZE, max_object_bytes: int = DEFAULT_MAX_OBJECT_BYTES,
+                 object_interval: float = DEFAULT_OBJECT_INTERVAL):
+        """
+        @param max_batch_size: Spans uploaded in one object
+        @param max_batch_bytes: Serialized bytes that trigger an upload, an object holds at least one span
+        @param export_interval: Seconds a span waits in the queue before it is uploaded
+        @param max_queue_size: Spans queued for upload, the spans exported when it is full are dropped
+        @param max_retries: Retries of an upload failing with a retryable exception before it is dropped
+        @param backoff_in_seconds: Delay before the first retry, doubled for every retry
+        @param max_backoff_in_seconds: Maximum delay between retries
+        @param deduplicator: Deduplicates the event payloads of every uploaded object,
+            set from MONOCLE_DEDUP_PAYLOADS by default
+        @param compression: gzip or lzma to compress the uploaded objects, set from
+            MONOCLE_EXPORT_COMPRESSION by default
+        @param compression_level: The gzip level or the lzma preset
+        @param key_template: The object keys, MONOCLE_OBJECT_KEY_TEMPLATE or partitioned by
+            workflow, date and hour by default
+        @param write_manifest: Uploads a manifest of the trace ids and time range of every object
+        @param append_mode: Appends the batches to one large object per partition
+        @param part_size: Bytes uploaded in one part in append mode, at least the min_part_size of the store
+        @param max_object_bytes: Bytes that commit an object in append mode
+        @param object_interval: Seconds an object stays open in append mode
+        """
+        self.max_batch_size = max_batch_size
+        self.max_batch_bytes = max_batch_bytes
+        self.export_interval = export_interval
+        self.max_queue_size = max_queue_size
+        self.max_retries = max_retries
+        self.backoff_in_seconds = backoff_in_seconds
+        self.max_backoff_in_seconds = max_backoff_in_seconds
+        self.deduplicator = deduplicator or get_deduplicator_from_env()
+        self.compression: Optional[ObjectCompression] = (get_compression(compression, compression_level) if compression
+                                                         else get_compression_from_env())
+        self.key_layout = ObjectKeyLayout(key_template)
+        self.write_manifest = write_manifest
+        self.append_mode = append_mode
+        self.part_size = max(part_size, self.min_part_size)
+        self.max_object_bytes = max(max_object_bytes, self.part_size)
+        self.object_interval = object_interval
+        # Only used by the upload thread
+        self._open_objects: Dict[Tuple[str, str, str], AppendObject] = {}
+        self.file_prefix = DEFAULT_FILE_PREFIX
+        self.time_format = DEFAULT_TIME_FORMAT
+        # (monotonic enqueue time, serialized span, span info)
+        self.export_queue = deque()
+        self._queued_bytes = 0
+        self._retries: List[PendingUpload] = []
+        self._condition = threading.Condition()
+        self._in_progress = 0
+        self._flush_requests = 0
+        self._shutdown = False
+        # Started by the first export
+        self._worker: Optional[threading.Thread] = None
 
     @abstractmethod
-    async def force_flush(self, timeout_millis: int = 30000) -> bool:
-        pass
+    def _upload(self, key: str, data: bytes, content_type: Optional[str] = None,
+                content_encoding: Optional[str] = None) -> None:
+        """Uploads an object, raises on failure."""
+
+    def _begin_object(self, key: str, content_type: Optional[str], content_encoding: Optional[str]):
+        """Starts an object uploaded in parts, returns its handle."""
+        raise NotImplementedError(f"{type(self).__name__} doesn't support the append mode")
+
+    def _upload_part(self, handle, part_number: int, data: bytes):
+        """Uploads a part of an object, part numbers start at 1, returns what _commit_object needs of it."""
+        raise NotImplementedError(f"{type(self).__name__} doesn't support the append mode")
+
+    def _commit_object(self, handle, parts: list) -> None:
+        """Assembles the uploaded parts into the object."""
+        raise NotImplementedError(f"{type(self).__name__} doesn't support the append mode")
+
+    def _abort_object(self, handle) -> None:
+        """Discards the uploaded parts of an object."""
+
+    def _serialize_span(self, span: ReadableSpan) -> bytes:
+        return serialize_span(span)
+
+    def _get_batch_records(self, lines: Sequence[bytes], carried: Iterable[str] = ()) -> Iterator[bytes]:
+        if self.deduplicator is None:
+            yield from lines
+            return
+        # Every uploaded object carries the dictionary entries it references in the batch scope
+        self.deduplicator.begin_batch(carried)
+        for line in lines:
+            try:
+                for record in get_deduplicated_records(line, self.deduplicator):
+                    yield dumps(record)
+            except ValueError as e:
+                logger.warning(f"Invalid JSON format in span data. Error: {e}")
+
+    def _serialize_batch(self, lines: Sequence[bytes]) -> bytes:
+        if self.compression is None:
+            return b"\n".join(self._get_batch_records(lines)) + b"\n"
+        compressor = self.compression.new_compressor()
+        chunks = [compressor.compress(record + b"\n") for record in self._get_batch_records(lines)]
+        chunks.append(compressor.flush())
+        return b"".join(chunks)
+
+    def export(self, spans: Sequence[ReadableSpan]) -> SpanExportResult:
+        """Queues the spans for upload, without waiting for it."""
+        if self._shutdown:
+            return SpanExportResult.FAILURE
+        entries = []
+        for span in spans:
+            try:
+                entries.append((self._serialize_span(span), get_span_info(span)))
+            except Exception as e:
+                logger.warning(f"Error serializing span {span.name}: {e}")
+        now = time.monotonic()
+        with self._condition:
+            if self._worker is None:
+                self._worker = threading.Thread(name=f"Monocle{type(self).__name__}", target=self._run, daemon=True)
+                self._worker.start()
+            dropped = max(0, len(self.export_queue) + len(entries) - self.max_queue_size)
+            for line, info in entries[:len(entries) - dropped]:
+                self.export_queue.append((now, line, info))
+                self._queued_bytes += len(line)
+            self._condition.notify()
+        if dropped:
+            logger.warning(f"{type(self).__name__} upload queue is full, dropped {dropped} spans")
+        return SpanExportResult.SUCCESS
+
+    def _is_batch_ready(self, now: float) -> bool:
+        return bool(self.export_queue) and (
+            len(self.export_queue) >= self.max_batch_size
+            or self._queued_bytes >= self.max_batch_bytes
+            or now - self.export_queue[0][0] >= self.export_interval
+            or self._flush_requests > 0)
+
+    def _get_due_retry(self, now: float) -> Optional[PendingUpload]:
+        for upload in self._retries:
+            if upload.due_time <= now:
+                self._retries.remove(upload)
+                return upload
+        return None
+
+    def _get_due_objects(self, now: float) -> List[Tuple[str, str, str]]:
+        return [partition for partition, append_object in self._open_objects.items()
+                if self._flush_requests > 0 or now - append_object.opened_at >= self.object_interval]
+
+    def _get_wait_time(self, now: float) -> Optional[float]:
+        due_times = [upload.due_time for upload in self._retries]
+        due_times += [append_object.opened_at + self.object_interval for append_object in self._open_objects.values()]
+        if self.export_queue:
+            due_times.append(self.export_queue[0][0] + self.export_interval)
+        return max(0.0, min(due_times) - now) if due_times else None
+
+    def _take_batch(self) -> List[Tuple[bytes, SpanInfo]]:
+        entries = []
+        size = 0
+        while self.export_queue and len(entries) < self.max_batch_size and (not entries or size < self.max_batch_bytes):
+            _, line, info = self.export_queue.popleft()
+            entries.append((line, info))
+            size += len(line)
+        self._queued_bytes -= size
+        return entries
+
+    def _get_uploads(self, entries: List[Tuple[bytes, SpanInfo]]) -> List[PendingUpload]:
+        """The objects of a batch, one per partition."""
+        partitions: Dict[Tuple[str, str, str], List[Tuple[bytes, SpanInfo]]] = {}
+        for entry in entries:
+            partitions.setdefault(entry[1].partition, []).append(entry)
+        extension = OBJECT_EXTENSION + (self.compression.extension if self.compression is not None else "")
+        uploads = []
+        for partition, partition_entries in partitions.items():
+            key = self.key_layout.get_key(partition, self.file_prefix, self.time_format, extension)
+            data = self._serialize_batch([line for line, _ in partition_entries])
+            digests = self.deduplicator.take_new_digests() if self.deduplicator is not None else ()
+            manifest = get_manifest(key, [info for _, info in partition_entries]) if self.write_manifest else None
+            uploads.append(PendingUpload(key, data, len(partition_entries), manifest, digests))
+        return uploads
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if self._shutdown:
+                        return
+                    now = time.monotonic()
+                    upload = self._get_due_retry(now)
+                    entries = self._take_batch() if upload is None and self._is_batch_ready(now) else None
+                    # The queued spans are appended before the objects are committed on flush
+                    due_objects = self._get_due_objects(now) if upload is None and not entries else None
+                    if upload is not None or entries or due_objects:
+                        break
+                    self._condition.wait(self._get_wait_time(now))
+                self._in_progress += 1
+            retries = []
+            try:
+                if due_objects:
+                    for partition in due_objects:
+                        self._commit_append_object(partition)
+                elif entries and self.append_mode:
+                    self._append(entries)
+                else:
+                    for pending_upload in [upload] if upload is not None else self._get_uploads(entries):
+                        retry = self._try_upload(pending_upload)
+                        if retry is not None:
+                            retries.append(retry)
+            except Exception as e:
+                logger.error(f"Error uploading span batch: {e}")
+            finally:
+                with self._condition:
+                    self._retries.extend(retries)
+                    self._in_progress -= 1
+                    self._condition.notify_all()
+
+    def _try_upload(self, upload: PendingUpload) -> Optional[PendingUpload]:
+        """Uploads a batch, returns it if the upload has to be retried."""
+        try:
+            if not upload.data_uploaded:
+                content_type = self.compression.content_type if self.compression is not None else None
+                content_encoding = self.compression.content_encoding if self.compression is not None else None
+                self._upload(upload.key, upload.data, content_type, content_encoding)
+                upload.data_uploaded = True
+                if self.deduplicator is not None:
+                    # The next objects reference the entries of this one in the process scope
+                    self.deduplicator.mark_emitted(upload.digests)
+            if upload.manifest is not None:
+                self._upload(upload.manifest_key, upload.manifest, MANIFEST_CONTENT_TYPE)
+            return None
+        except self.retryable_exceptions as e:
+            if upload.attempt < self.max_retries:
+                upload.attempt += 1
+                delay = min(self.max_backoff_in_seconds, self.backoff_in_seconds * (2 ** (upload.attempt - 1)))
+                delay = delay * (1 + random.uniform(-0.1, 0.1))  # Add jitter
+                upload.due_time = time.monotonic() + delay
+                logger.warning(f"Network connectivity error, Attempt {upload.attempt} failed: {e}. "
+                               f"Retrying in {delay:.2f} seconds...")
+                return upload
+            logger.error(f"Failed to upload span batch of {upload.span_count} spans after "
+                         f"{upload.attempt + 1} attempts: {e}")
+        except Exception as e:
+            logger.error(f"Failed to upload span batch of {upload.span_count} spans: {e}")
+        return None
+
+    def _call_with_retries(self, func, *args):
+        """Calls an upload function of the append mode on the upload thread, retrying with backoff."""
+        attempt = 0
+        while True:
+            try:
+                return func(*args)
+            except self.retryable_exceptions as e:
+                if attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                delay = min(self.max_backoff_in_seconds, self.backoff_in_seconds * (2 ** (attempt - 1)))
+                delay = delay * (1 + random.uniform(-0.1, 0.1))  # Add jitter
+                logger.warning(f"Network connectivity error, Attempt {attempt} failed: {e}. "
+                               f"Retrying in {delay:.2f} seconds...")
+                time.sleep(delay)
+
+    def _get_content_settings(self) -> Tuple[Optional[str], Optional[str]]:
+        if self.compression is None:
+            return None, None
+        return self.compression.content_type, self.compression.content_encoding
+
+    def _append(self, entries: List[Tuple[bytes, SpanInfo]]) -> None:
+        partitions: Dict[Tuple[str, str, str], List[Tuple[bytes, SpanInfo]]] = {}
+        for entry in entries:
+            partitions.setdefault(entry[1].partition, []).append(entry)
+        for partition, partition_entries in partitions.items():
+            append_object = self._open_objects.get(partition)
+            if append_object is None:
+                extension = OBJECT_EXTENSION + (self.compression.extension if self.compression is not None else "")
+                append_object = AppendObject(
+                    self.key_layout.get_key(partition, self.file_prefix, self.time_format, extension), partition[0],
+                    self.compression.new_compressor() if self.compression is not None else None, time.monotonic())
+                self._open_objects[partition] = append_object
+            for record in self._get_batch_records([line for line, _ in partition_entries], append_object.digests):
+                record += b"\n"
+                append_object.write(append_object.compressor.compress(record) if append_object.compressor else record)
+            if self.deduplicator is not None:
+                append_object.digests.update(self.deduplicator.take_new_digests())
+            for _, info in partition_entries:
+                append_object.manifest.add(info)
+            try:
+                while append_object.buffered_bytes >= self.part_size:
+                    self._upload_append_part(append_object)
+            except Exception as e:
+                self._discard_append_object(partition, e)
+                continue
+            if append_object.size >= self.max_object_bytes or len(append_object.parts) >= self.max_parts - 1:
+                self._commit_append_object(partition)
+
+    def _upload_append_part(self, append_object: AppendObject, last: bool = False) -> None:
+        if append_object.handle is None:
+            append_object.handle = self._call_with_retries(self._begin_object, append_object.key,
+                                                           *self._get_content_settings())
+        # Every part but the last has the same size
+        data = append_object.take_buffer(None if last else self.part_size)
+        append_object.parts.append(self._call_with_retries(self._upload_part, append_object.handle,
+                                                           len(append_object.parts) + 1, data))
+
+    def _commit_append_object(self, partition: Tuple[str, str, str]) -> None:
+        append_object = self._open_objects[partition]
+        try:
+            if append_object.compressor is not None:
+                append_object.write(append_object.compressor.flush())
+                append_object.compressor = None
+            if append_object.handle is None:
+                self._call_with_retries(self._upload, append_object.key, append_object.take_buffer(),
+                                        *self._get_content_settings())
+            else:
+                if append_object.buffered_bytes or not append_object.parts:
+                    self._upload_append_part(append_object, last=True)
+                self._call_with_retries(self._commit_object, append_object.handle, append_object.parts)
+            del self._open_objects[partition]
+            if self.deduplicator is not None:
+                self.deduplicator.mark_emitted(append_object.digests)
+            if self.write_manifest:
+                self._call_with_retries(self._upload, get_manifest_key(append_object.key),
+                                        append_object.manifest.to_json(append_object.key), MANIFEST_CONTENT_TYPE)
+        except Exception as e:
+            self._discard_append_object(partition, e)
+
+    def _discard_append_object(self, partition: Tuple[str, str, str], error: Exception) -> None:
+        append_object = self._open_objects.pop(partition, None)
+        if append_object is None:
+            logger.error(f"Failed to upload the manifest of {partition}: {error}")
+            return
+        logger.error(f"Failed to upload {append_object.key}, dropped {append_object.manifest.span_count} spans: {error}")
+        if append_object.handle is not None:
+            try:
+                self._abort_object(append_object.handle)
+            except Exception as e:
+                logger.warning(f"Failed to abort the upload of {append_object.key}: {e}")
+
+    def _is_drained(self) -> bool:
+        return not self.export_queue and not self._retries and not self._open_objects and self._in_progress == 0
+
+    def force_flush(self, timeout_millis: int = DEFAULT_FLUSH_TIMEOUT_MILLIS) -> bool:
+        """Uploads the queued spans and the batches waiting for a retry, waits for it."""
+        with self._condition:
+            self._flush_requests += 1
+            for upload in self._retries:
+                upload.due_time = 0.0
+            self._condition.notify_all()
+            try:
+                return self._condition.wait_for(self._is_drained, timeout=timeout_millis / 1000)
+            finally:
+                self._flush_requests -= 1
 
     def shutdown(self) -> None:
-        pass
+        if self._shutdown:
+            return
+        drained = self.force_flush()
+        with self._condition:
+            self._shutdown = True
+            lost = (len(self.export_queue) + sum(upload.span_count for upload in self._retries)
+                    + sum(append_object.manifest.span_count for append_object in self._open_objects.values()))
+            self._condition.notify_all()
+        if self._worker is not None:
+            self._worker.join(DEFAULT_FLUSH_TIMEOUT_MILLIS / 1000)
+        if not drained:
+            logger.error(f"{type(self).__name__} shut down before uploading {lost} spans")
 
     @staticmethod
     def retry_with_backoff(retries=3, backoff_in_seconds=1, max_backoff_in_seconds=32, exceptions=(Exception,)):
@@ -45,4 +501,4 @@ class SpanExporterBase(ABC):
 
             return wrapper
 
-        return decorator
\ No newline at end of file
+        return decorator
@@ -0,0 +1,83 @@
+"""
+Compression of the NDJSON objects uploaded by the S3 and Blob exporters.
+
+The records of a batch are fed one at a time to a streaming compressor, so the
+uncompressed object is never built in memory. gzip objects are uploaded with
+Content-Encoding: gzip and an .ndjson.gz name, HTTP clients and most log tools
+decompress them transparently. xz objects, from the lzma module when Python is
+built with it, compress better at a higher CPU cost and are uploaded as
+application/x-xz with an .ndjson.xz name, since xz isn't an HTTP content coding.
+
+Enabled by passing compression="gzip" or compression="lzma" to the exporter, or
+with MONOCLE_EXPORT_COMPRESSION.
+"""
+import logging
+import os
+import zlib
+from typing import Callable, Optional
+
+try:
+    import lzma
+except ImportError:  # Python built without liblzma
+    lzma = None
+
+logger = logging.getLogger(__name__)
+
+COMPRESSION_ENV = "MONOCLE_EXPORT_COMPRESSION"
+GZIP = "gzip"
+LZMA = "lzma"
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+# On trace JSON gzip 6 is smaller and cheaper than the fast xz presets, xz pays off only at its
+# default preset, see tests/compression_benchmark.py
+DEFAULT_LEVELS = {GZIP: 6, LZMA: 6}
+
+
+class ObjectCompression:
+    """How the uploaded objects are compressed, named and described."""
+
+    def __init__(self, name: str, extension: str, content_type: str, content_encoding: Optional[str],
+                 compressor_factory: Callable):
+        self.name = name
+        self.extension = extension
+        self.content_type = content_type
+        self.content_encoding = content_encoding
+        self._compressor_factory = compressor_factory
+
+    def new_compressor(self):
+        """A streaming compressor, with compress(data) and flush() returning the compressed chunks."""
+        return self._compressor_factory()
+
+
+def get_compression(name: Optional[str], level: Optional[int] = None) -> Optional[ObjectCompression]:
+    """
+    @param name: gzip, lzma or None for uncompressed objects
+    @param level: The gzip level, 1 to 9, or the lzma preset, 0 to 9
+    @raise ValueError: if the compression is unknown or lzma is not available
+    """
+    if not name:
+        return None
+    name = name.lower()
+    if name == GZIP:
+        level = DEFAULT_LEVELS[GZIP] if level is None else level
+        # wbits 31 writes the gzip header and trailer
+        return ObjectCompression(GZIP, ".gz", NDJSON_CONTENT_TYPE, GZIP,
+                                 lambda: zlib.compressobj(level, zlib.DEFLATED, 31))
+    if name in (LZMA, "xz"):
+        if lzma is None:
+            raise ValueError("lzma compression is not supported by this Python build")
+        level = DEFAULT_LEVELS[LZMA] if level is None else level
+        return ObjectCompression(LZMA, ".xz", "application/x-xz", None,
+                                 lambda: lzma.LZMACompressor(format=lzma.FORMAT_XZ, preset=level))
+    raise ValueError(f"Unsupported compression {name}, expecting {GZIP} or {LZMA}")
+
+
+def get_compression_from_env() -> Optional[ObjectCompression]:
+    """The compression set by MONOCLE_EXPORT_COMPRESSION, None if it is not set or invalid."""
+    name = os.environ.get(COMPRESSION_ENV, "").strip()
+    if not name or name.lower() in ("0", "false", "no", "none"):
+        return None
+    try:
+        return get_compression(name)
+    except ValueError as e:
+        logger.warning(f"Invalid {COMPRESSION_ENV}: {e}")
+        return None
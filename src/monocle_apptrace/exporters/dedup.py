@@ -0,0 +1,217 @@
+"""
+Content addressed deduplication of the large strings of the span events.
+
+The same system prompt and prompt template are captured in the data.input event of every
+inference span. The ContentDeduplicator replaces every event attribute string of at least
+min_length characters with a reference to its SHA-256, and emits each distinct string once as a
+dictionary record ahead of the spans that reference it:
+    {"monocle.dictionary": {"<sha256>": "<string>"}}
+    {"name": "langchain.chat", ..., "events": [{"name": "data.input", "attributes": {"input": ["monocle.ref:sha256:<sha256>", ...]}}]}
+
+With the "batch" scope every export batch, eg. an uploaded object or a trace file, carries the
+dictionary entries it references. With the "process" scope a string is emitted once per process,
+so the records must be read in order. rehydrate restores the original spans.
+
+Enabled by passing a ContentDeduplicator to the exporter, or with MONOCLE_DEDUP_PAYLOADS=batch or
+MONOCLE_DEDUP_PAYLOADS=process. In the process scope, a batch references the entries emitted by the
+batches stored before it: the exporter passes the digests of a batch to mark_emitted once it is
+written or uploaded, so the entries of a dropped batch are emitted again by the next ones, and the
+objects must be read in the order of their keys. The Okahu exporter sends its requests concurrently
+and doesn't get them stored in order, it always uses the batch scope.
+
+    python -m monocle_apptrace.exporters.dedup trace_files... > rehydrated.ndjson
+"""
+import hashlib
+import json
+import logging
+import os
+import sys
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Union
+from monocle_apptrace.exporters.span_serializer import loads
+
+logger = logging.getLogger(__name__)
+
+DICTIONARY_KEY = "monocle.dictionary"
+REF_PREFIX = "monocle.ref:sha256:"
+DEDUP_ENV = "MONOCLE_DEDUP_PAYLOADS"
+BATCH_SCOPE = "batch"
+PROCESS_SCOPE = "process"
+DEFAULT_MIN_LENGTH = 256
+DEFAULT_MAX_ENTRIES = 4096
+
+
+class ContentDeduplicator:
+    """Replaces the repeated large strings of the span events with content hash references."""
+
+    def __init__(self, min_length: int = DEFAULT_MIN_LENGTH, scope: str = BATCH_SCOPE,
+                 max_entries: int = DEFAULT_MAX_ENTRIES):
+        """
+        @param min_length: Shorter strings are kept inline
+        @param scope: "batch" to emit the dictionary entries in every export batch referencing them,
+            "process" to emit them once per process
+        @param max_entries: Strings stored in the process scope that are remembered, the least
+            recently used ones are emitted again
+        """
+        if scope not in (BATCH_SCOPE, PROCESS_SCOPE):
+            raise ValueError(f"Unsupported dedup scope {scope}, expecting {BATCH_SCOPE} or {PROCESS_SCOPE}")
+        self.min_length = min_length
+        self.scope = scope
+        self.max_entries = max_entries
+        # The entries stored by the previous batches in the process scope
+        self._emitted: "OrderedDict[str, None]" = OrderedDict()
+        # The entries written in the current batch, and the ones not passed to mark_emitted yet
+        self._batch_digests: Set[str] = set()
+        self._new_digests: List[str] = []
+
+    def begin_batch(self, carried: Iterable[str] = ()) -> None:
+        """
+        Starts an export batch, in the batch scope its dictionary entries are emitted again.
+
+        @param carried: The digests of the entries already written ahead of the batch, eg. in the
+            object the batch is appended to
+        """
+        self._batch_digests = set(carried)
+        self._new_digests = []
+
+    def take_new_digests(self) -> List[str]:
+        """The digests of the entries emitted in the batch since the last call, to pass to mark_emitted."""
+        digests, self._new_digests = self._new_digests, []
+        return digests
+
+    def mark_emitted(self, digests: Iterable[str]) -> None:
+        """
+        Records that the batch carrying the entries was stored, in the process scope the next batches
+        reference them without emitting them again.
+        """
+        if self.scope != PROCESS_SCOPE:
+            return
+        for digest in digests:
+            self._emitted[digest] = None
+            self._emitted.move_to_end(digest)
+        while len(self._emitted) > self.max_entries:
+            self._emitted.popitem(last=False)
+
+    def _get_reference(self, value: str, entries: Dict[str, str]) -> str:
+        digest = hashlib.sha256(value.encode("utf-8", "surrogatepass")).hexdigest()
+        if digest in self._emitted:
+            self._emitted.move_to_end(digest)
+        elif digest not in self._batch_digests:
+            entries[digest] = value
+            self._batch_digests.add(digest)
+            self._new_digests.append(digest)
+        return REF_PREFIX + digest
+
+    def _dedup_value(self, value, entries: Dict[str, str]):
+        if isinstance(value, str):
+            return self._get_reference(value, entries) if len(value) >= self.min_length else value
+        if isinstance(value, (list, tuple)):
+            return [self._get_reference(item, entries) if isinstance(item, str) and len(item) >= self.min_length
+                    else item for item in value]
+        return value
+
+    def dedup(self, span: Dict[str, Any]) -> Dict[str, str]:
+        """
+        Replaces the large event attribute strings of a serialized span with references.
+
+        @param span: The span as a JSON object, eg. format_span(span), changed in place
+        @return: The dictionary entries not emitted yet in the scope, to write before the span
+        """
+        entries = {}
+        for event in span.get("events") or []:
+            attributes = event.get("attributes")
+            if attributes:
+                event["attributes"] = {key: self._dedup_value(value, entries) for key, value in attributes.items()}
+        return entries
+
+
+def get_references(span: Dict[str, Any]) -> List[str]:
+    """The digests of the dictionary entries a deduplicated span references."""
+    references = []
+    for event in span.get("events") or []:
+        for value in (event.get("attributes") or {}).values():
+            for item in value if isinstance(value, (list, tuple)) else (value,):
+                if isinstance(item, str) and item.startswith(REF_PREFIX):
+                    references.append(item[len(REF_PREFIX):])
+    return references
+
+
+def get_dictionary_record(entries: Dict[str, str]) -> Dict[str, Dict[str, str]]:
+    return {DICTIONARY_KEY: entries}
+
+
+def get_deduplicated_records(span_json: Union[str, bytes], deduplicator: ContentDeduplicator) -> List[Dict[str, Any]]:
+    """The records to export for a serialized span, its new dictionary entries if any and the span."""
+    span = loads(span_json)
+    entries = deduplicator.dedup(span)
+    return [get_dictionary_record(entries), span] if entries else [span]
+
+
+def get_deduplicator_from_env() -> Optional[ContentDeduplicator]:
+    """The deduplicator set by MONOCLE_DEDUP_PAYLOADS, batch or process, None if it is not set."""
+    scope = os.environ.get(DEDUP_ENV, "").strip().lower()
+    if not scope or scope in ("0", "false", "no"):
+        return None
+    if scope in ("1", "true", "yes"):
+        scope = BATCH_SCOPE
+    try:
+        return ContentDeduplicator(scope=scope)
+    except ValueError as e:
+        logger.warning(f"Invalid {DEDUP_ENV}: {e}")
+        return None
+
+
+def _rehydrate_value(value, dictionary: Dict[str, str]):
+    if isinstance(value, str) and value.startswith(REF_PREFIX):
+        return dictionary.get(value[len(REF_PREFIX):], value)
+    if isinstance(value, list):
+        return [_rehydrate_value(item, dictionary) for item in value]
+    return value
+
+
+def rehydrate(records: Iterable[Dict[str, Any]], dictionary: Optional[Dict[str, str]] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Restores the strings referenced by the spans, reading the dictionary records in order.
+
+    @param records: The exported records, dictionary records and spans
+    @param dictionary: Entries known before the records, eg. the dictionary of an Okahu batch
+    @return: The spans, with the original strings
+    """
+    dictionary = dict(dictionary or {})
+    for record in records:
+        if DICTIONARY_KEY in record:
+            dictionary.update(record[DICTIONARY_KEY])
+            continue
+        for event in record.get("events") or []:
+            attributes = event.get("attributes")
+            if attributes:
+                event["attributes"] = {key: _rehydrate_value(value, dictionary) for key, value in attributes.items()}
+        yield record
+
+
+def parse_records(text: str) -> List[Dict[str, Any]]:
+    """Parses the records of an exported file, NDJSON or the concatenated JSON of the file exporter."""
+    decoder = json.JSONDecoder()
+    records = []
+    index = 0
+    while True:
+        while index < len(text) and text[index].isspace():
+            index += 1
+        if index >= len(text):
+            return records
+        record, index = decoder.raw_decode(text, index)
+        records.append(record)
+
+
+def read_spans(paths: Iterable[str]) -> Iterator[Dict[str, Any]]:
+    """The rehydrated spans of exported files, read in order so the process scope is supported."""
+    def get_records():
+        for path in paths:
+            with open(path, encoding="utf-8") as file:
+                yield from parse_records(file.read())
+    return rehydrate(get_records())
+
+
+if __name__ == "__main__":
+    for rehydrated_span in read_spans(sys.argv[1:]):
+        print(json.dumps(rehydrated_span))
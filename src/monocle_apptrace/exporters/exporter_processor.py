@@ -1,9 +1,40 @@
+"""
+Task processors running the requests of an exporter off the span processor thread.
+
+An exporter given a task processor, eg. the Okahu exporter, queues one task per
+batch and returns. ThreadPoolExportTaskProcessor runs the tasks on max_in_flight
+worker threads. AsyncioExportTaskProcessor runs them on an event loop thread, with
+at most max_in_flight at a time: coroutine functions are awaited, other callables
+run on a pool of max_in_flight threads.
+
+Both hold at most max_backlog tasks waiting for a free slot. When the backlog is
+full, the drop policy drops the new task with a warning, and the block policy makes
+queue_task wait up to block_timeout seconds for room before dropping it.
+force_flush waits for the queued and running tasks, and stop drains them before it
+stops the workers.
+
+MONOCLE_EXPORT_TASK_PROCESSOR=thread or asyncio sets the task processor of the
+exporters created without one.
+"""
 from abc import ABC, abstractmethod
+import asyncio
 import logging
-from typing import Callable
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
 
 logger = logging.getLogger(__name__)
 
+TASK_PROCESSOR_ENV = "MONOCLE_EXPORT_TASK_PROCESSOR"
+DROP = "drop"
+BLOCK = "block"
+DEFAULT_MAX_IN_FLIGHT = 4
+DEFAULT_MAX_BACKLOG = 64
+DEFAULT_BLOCK_TIMEOUT = 10
+DEFAULT_FLUSH_TIMEOUT_MILLIS = 30000
+
 class ExportTaskProcessor(ABC):
 
     @abstractmethod
@@ -16,4 +47,218 @@ class ExportTaskProcessor(ABC):
 
     @abstractmethod
     def queue_task(self, async_task: Callable[[Callable, any], any] = None, args: any = None):
-        return
\ No newline at end of file
+        return
+
+    def force_flush(self, timeout_millis: int = DEFAULT_FLUSH_TIMEOUT_MILLIS) -> bool:
+        """Waits for the queued tasks, returns False on timeout."""
+        return True
+
+
+def _call_task(async_task: Callable, args):
+    return async_task(args) if args is not None else async_task()
+
+
+class BoundedExportTaskProcessor(ExportTaskProcessor):
+    """The backlog, policy and draining of the task processors, the subclasses run the tasks."""
+
+    def __init__(self, max_in_flight: int = DEFAULT_MAX_IN_FLIGHT, max_backlog: int = DEFAULT_MAX_BACKLOG,
+                 backlog_policy: str = DROP, block_timeout: Optional[float] = DEFAULT_BLOCK_TIMEOUT):
+        """
+        @param max_in_flight: Tasks running at the same time, size the connection pool of the exporter to it
+        @param max_backlog: Tasks waiting for a free slot
+        @param backlog_policy: drop or block the new tasks when the backlog is full
+        @param block_timeout: Seconds the block policy waits for room before dropping the task, None to wait forever
+        @raise ValueError: if the policy is unknown or max_in_flight is below 1
+        """
+        if backlog_policy not in (DROP, BLOCK):
+            raise ValueError(f"Unsupported backlog policy {backlog_policy}, expecting {DROP} or {BLOCK}")
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be at least 1")
+        self.max_in_flight = max_in_flight
+        self.max_backlog = max_backlog
+        self.backlog_policy = backlog_policy
+        self.block_timeout = block_timeout
+        self.dropped_tasks = 0
+        self._condition = threading.Condition()
+        # Queued or running tasks
+        self._pending = 0
+        self._running = False
+
+    @abstractmethod
+    def _submit(self, async_task: Callable, args) -> None:
+        """Hands a task to the workers, called with the condition held."""
+
+    def _has_room(self) -> bool:
+        return self._pending < self.max_in_flight + self.max_backlog
+
+    def queue_task(self, async_task: Callable[[Callable, any], any] = None, args: any = None) -> bool:
+        """Queues async_task(args), returns False if the task is dropped."""
+        with self._condition:
+            if self._running and not self._has_room() and self.backlog_policy == BLOCK:
+                self._condition.wait_for(lambda: self._has_room() or not self._running, self.block_timeout)
+            if not self._running:
+                logger.warning(f"{type(self).__name__} is not running, dropping the export task")
+                return False
+            if not self._has_room():
+                self.dropped_tasks += 1
+                logger.warning(f"{type(self).__name__} backlog is full, dropped an export task")
+                return False
+            self._pending += 1
+            self._submit(async_task, args)
+        return True
+
+    def _task_done(self) -> None:
+        with self._condition:
+            self._pending -= 1
+            self._condition.notify_all()
+
+    def _run_task(self, async_task: Callable, args) -> None:
+        try:
+            _call_task(async_task, args)
+        except Exception as e:
+            logger.error(f"Export task failed: {e}")
+        finally:
+            self._task_done()
+
+    def force_flush(self, timeout_millis: int = DEFAULT_FLUSH_TIMEOUT_MILLIS) -> bool:
+        with self._condition:
+            return self._condition.wait_for(lambda: self._pending == 0, timeout=timeout_millis / 1000)
+
+    def _begin_stop(self, timeout_millis: int) -> bool:
+        """Drains the tasks and refuses new ones, returns False if they didn't all complete."""
+        drained = self.force_flush(timeout_millis)
+        with self._condition:
+            was_running = self._running
+            self._running = False
+            self._condition.notify_all()
+            if was_running and not drained:
+                logger.error(f"{type(self).__name__} stopped before running {self._pending} export tasks")
+        return was_running
+
+
+class ThreadPoolExportTaskProcessor(BoundedExportTaskProcessor):
+    """Runs the export tasks on max_in_flight worker threads."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._tasks = deque()
+        self._workers: List[threading.Thread] = []
+
+    def start(self):
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+            self._workers = [threading.Thread(name=f"MonocleExportTask-{index}", target=self._run, daemon=True)
+                             for index in range(self.max_in_flight)]
+        for worker in self._workers:
+            worker.start()
+
+    def _submit(self, async_task: Callable, args) -> None:
+        self._tasks.append((async_task, args))
+        self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._tasks and self._running:
+                    self._condition.wait()
+                if not self._tasks:
+                    return
+                async_task, args = self._tasks.popleft()
+            self._run_task(async_task, args)
+
+    def stop(self, timeout_millis: int = DEFAULT_FLUSH_TIMEOUT_MILLIS):
+        if not self._begin_stop(timeout_millis):
+            return
+        with self._condition:
+            # The tasks still queued after the timeout are dropped
+            self._pending -= len(self._tasks)
+            self._tasks.clear()
+        for worker in self._workers:
+            worker.join(timeout_millis / 1000)
+
+
+class AsyncioExportTaskProcessor(BoundedExportTaskProcessor):
+    """
+    Runs the export tasks on an event loop thread, at most max_in_flight at a time.
+    Coroutine functions are awaited on the loop, other callables run on a pool of
+    max_in_flight threads.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+            self._loop = asyncio.new_event_loop()
+            self._executor = ThreadPoolExecutor(max_workers=self.max_in_flight,
+                                                thread_name_prefix="MonocleExportTask")
+            self._thread = threading.Thread(name="MonocleExportTaskLoop", target=self._run, daemon=True)
+        started = threading.Event()
+        self._thread.start()
+        self._loop.call_soon_threadsafe(started.set)
+        started.wait()
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        # Created on the loop, Python 3.8 and 3.9 bind it to the current loop
+        self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        self._loop.run_forever()
+
+    def _submit(self, async_task: Callable, args) -> None:
+        asyncio.run_coroutine_threadsafe(self._run_async_task(async_task, args), self._loop)
+
+    async def _run_async_task(self, async_task: Callable, args) -> None:
+        try:
+            async with self._semaphore:
+                if asyncio.iscoroutinefunction(async_task):
+                    await _call_task(async_task, args)
+                else:
+                    await self._loop.run_in_executor(self._executor, _call_task, async_task, args)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Export task failed: {e}")
+        finally:
+            self._task_done()
+
+    async def _cancel_tasks(self) -> None:
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stop(self, timeout_millis: int = DEFAULT_FLUSH_TIMEOUT_MILLIS):
+        if not self._begin_stop(timeout_millis):
+            return
+        try:
+            # The tasks still waiting after the timeout are cancelled
+            asyncio.run_coroutine_threadsafe(self._cancel_tasks(), self._loop).result(timeout_millis / 1000)
+        except Exception as e:
+            logger.warning(f"Failed to cancel the export tasks: {e}")
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout_millis / 1000)
+        if not self._thread.is_alive():
+            self._loop.close()
+        self._executor.shutdown(wait=False)
+
+
+def get_task_processor_from_env() -> Optional[ExportTaskProcessor]:
+    """The task processor set by MONOCLE_EXPORT_TASK_PROCESSOR, thread or asyncio, None if it is not set."""
+    name = os.environ.get(TASK_PROCESSOR_ENV, "").strip().lower()
+    if not name or name in ("0", "false", "no", "none"):
+        return None
+    if name in ("thread", "threads", "thread_pool"):
+        return ThreadPoolExportTaskProcessor()
+    if name == "asyncio":
+        return AsyncioExportTaskProcessor()
+    logger.warning(f"Invalid {TASK_PROCESSOR_ENV}: {name}, expecting thread or asyncio")
+    return None
@@ -1,5 +1,7 @@
 #pylint: disable=consider-using-with
 
+import json
+import logging
 from os import linesep, path
 from io import TextIOWrapper
 from datetime import datetime
@@ -7,10 +9,20 @@ from typing import Optional, Callable, Sequence
 from opentelemetry.sdk.trace import ReadableSpan
 from opentelemetry.sdk.trace.export import SpanExporter, SpanExportResult
 from opentelemetry.sdk.resources import SERVICE_NAME
+from monocle_apptrace.exporters.dedup import ContentDeduplicator, get_dictionary_record, get_deduplicator_from_env
+from monocle_apptrace.exporters.span_serializer import format_span
+
+logger = logging.getLogger(__name__)
 
 DEFAULT_FILE_PREFIX:str = "monocle_trace_"
 DEFAULT_TIME_FORMAT:str = "%Y-%m-%d_%H.%M.%S"
 
+def format_record(record: dict) -> str:
+    return json.dumps(record, indent=4) + linesep
+
+def default_formatter(span: ReadableSpan) -> str:
+    return format_record(format_span(span))
+
 class FileSpanExporter(SpanExporter):
     current_trace_id: int = None
     current_file_path: str = None
@@ -23,8 +35,8 @@ class FileSpanExporter(SpanExporter):
         time_format = DEFAULT_TIME_FORMAT,
         formatter: Callable[
             [ReadableSpan], str
-        ] = lambda span: span.to_json()
-        + linesep,
+        ] = default_formatter,
+        deduplicator: Optional[ContentDeduplicator] = None,
     ):
         self.out_handle:TextIOWrapper = None
         self.formatter = formatter
@@ -32,23 +44,45 @@ class FileSpanExporter(SpanExporter):
         self.output_path = out_path
         self.file_prefix = file_prefix
         self.time_format = time_format
+        # Every trace file carries the dictionary entries it references in the batch scope
+        self.deduplicator = deduplicator or get_deduplicator_from_env()
+        if self.deduplicator is not None and formatter is not default_formatter:
+            # The output of a custom formatter may not be a span in JSON
+            logger.warning("Payload deduplication is not supported with a custom formatter, it is disabled")
+            self.deduplicator = None
 
     def export(self, spans: Sequence[ReadableSpan]) -> SpanExportResult:
         for span in spans:
             if span.context.trace_id != self.current_trace_id:
                 self.rotate_file(span.resource.attributes[SERVICE_NAME],
                                 span.context.trace_id)
-            self.out_handle.write(self.formatter(span))
+            if self.deduplicator is None:
+                self.out_handle.write(self.formatter(span))
+            else:
+                record = format_span(span)
+                entries = self.deduplicator.dedup(record)
+                if entries:
+                    self.out_handle.write(format_record(get_dictionary_record(entries)))
+                self.out_handle.write(format_record(record))
         self.out_handle.flush()
+        self.mark_emitted()
         return SpanExportResult.SUCCESS
 
+    def mark_emitted(self) -> None:
+        """The dictionary entries written to the trace file are referenced by the next files in the process scope."""
+        if self.deduplicator is not None:
+            self.deduplicator.mark_emitted(self.deduplicator.take_new_digests())
+
     def rotate_file(self, trace_name:str, trace_id:int) -> None:
         self.reset_handle()
+        self.mark_emitted()
         self.current_file_path = path.join(self.output_path,
                         self.file_prefix + trace_name + "_" + hex(trace_id) + "_"
                         + datetime.now().strftime(self.time_format) + ".json")
         self.out_handle = open(self.current_file_path, "w", encoding='UTF-8')
         self.current_trace_id = trace_id
+        if self.deduplicator is not None:
+            self.deduplicator.begin_batch()
 
     def force_flush(self, timeout_millis: int = 30000) -> bool:
         self.out_handle.flush()
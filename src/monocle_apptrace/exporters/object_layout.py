@@ -0,0 +1,141 @@
+"""
+Names of the objects uploaded by the S3 and Blob exporters, and their manifests.
+
+The default key is partitioned hive style by workflow and by the UTC date and
+hour the spans started, and ends with a suffix unique to the process, the
+exporter and the object, so concurrent batches and processes never write the
+same key:
+
+    workflow=coffee_bot/date=2024-12-10/hour=10/monocle_trace_2024-12-10_10.00.00_4242-9f1c2b7a_000001_c0ffee42.ndjson
+
+A batch with spans of several partitions is uploaded as one object per partition.
+The template placeholders are workflow, date, hour, file_prefix, timestamp (the
+upload time in the exporter time_format), process, sequence, random and extension.
+"{file_prefix}{timestamp}{extension}" is the legacy flat layout.
+
+Next to every object a manifest lists the trace ids and the time range of its spans,
+so a query can pick the objects of a trace or a time range without reading them:
+
+    workflow=coffee_bot/date=2024-12-10/hour=10/monocle_trace_..._c0ffee42.manifest.json
+    {"object": "...ndjson", "workflow": "coffee_bot", "span_count": 500, "trace_ids": ["0x..."],
+     "start_time": "2024-12-10T10:00:00.120000Z", "end_time": "2024-12-10T10:00:41.870000Z"}
+"""
+import datetime
+import itertools
+import json
+import os
+import re
+import secrets
+from typing import Iterable, Optional, Tuple
+from opentelemetry.sdk.resources import SERVICE_NAME
+from opentelemetry.sdk.trace import ReadableSpan
+
+KEY_TEMPLATE_ENV = "MONOCLE_OBJECT_KEY_TEMPLATE"
+DEFAULT_KEY_TEMPLATE = ("workflow={workflow}/date={date}/hour={hour}/"
+                        "{file_prefix}{timestamp}_{process}_{sequence}_{random}{extension}")
+OBJECT_EXTENSION = ".ndjson"
+MANIFEST_EXTENSION = ".manifest.json"
+MANIFEST_CONTENT_TYPE = "application/json"
+UNKNOWN_WORKFLOW = "unknown"
+
+_process_token = None
+_process_pid = None
+_unsafe_characters = re.compile(r"[^A-Za-z0-9._-]")
+
+
+class SpanInfo:
+    """What the key and the manifest of an object need from each of its spans."""
+    __slots__ = ("partition", "trace_id", "start_time", "end_time")
+
+    def __init__(self, partition: Tuple[str, str, str], trace_id: int, start_time: int, end_time: int):
+        self.partition = partition
+        self.trace_id = trace_id
+        self.start_time = start_time
+        self.end_time = end_time
+
+
+def get_process_token() -> str:
+    """
+    Unique to this process, a pid can be reused by another host or container. Made again when the
+    pid changes, so the workers forked by a pre-fork server don't share the token of their parent.
+    """
+    global _process_token, _process_pid
+    pid = os.getpid()
+    if pid != _process_pid:
+        _process_token = f"{pid}-{secrets.token_hex(4)}"
+        _process_pid = pid
+    return _process_token
+
+
+def _to_datetime(time_ns: int) -> datetime.datetime:
+    return datetime.datetime.fromtimestamp(time_ns / 1e9, tz=datetime.timezone.utc)
+
+
+def _format_time(time_ns: int) -> str:
+    return _to_datetime(time_ns).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def get_span_info(span: ReadableSpan) -> SpanInfo:
+    """The partition of a span: its workflow, the service name of the resource, and its UTC start date and hour."""
+    workflow = span.resource.attributes.get(SERVICE_NAME) if span.resource is not None else None
+    workflow = _unsafe_characters.sub("_", str(workflow)) if workflow else UNKNOWN_WORKFLOW
+    start_time = span.start_time or 0
+    started = _to_datetime(start_time)
+    return SpanInfo((workflow, started.strftime("%Y-%m-%d"), started.strftime("%H")),
+                    span.context.trace_id, start_time, span.end_time or start_time)
+
+
+class ObjectKeyLayout:
+    """Builds the collision free keys of the uploaded objects and their manifests."""
+
+    def __init__(self, key_template: Optional[str] = None):
+        """@param key_template: The key template, MONOCLE_OBJECT_KEY_TEMPLATE or the partitioned layout by default"""
+        self.key_template = key_template or os.environ.get(KEY_TEMPLATE_ENV) or DEFAULT_KEY_TEMPLATE
+        self._sequence = itertools.count(1)
+
+    def get_key(self, partition: Tuple[str, str, str], file_prefix: str, time_format: str, extension: str) -> str:
+        workflow, date, hour = partition
+        return self.key_template.format(
+            workflow=workflow, date=date, hour=hour, file_prefix=file_prefix,
+            timestamp=datetime.datetime.now().strftime(time_format), process=get_process_token(),
+            sequence=f"{next(self._sequence):06d}", random=secrets.token_hex(4), extension=extension)
+
+
+def get_manifest_key(key: str) -> str:
+    base, separator, _ = key.rpartition(OBJECT_EXTENSION)
+    return (base if separator else key) + MANIFEST_EXTENSION
+
+
+class Manifest:
+    """The trace ids and time range of the spans written to an object."""
+
+    def __init__(self, workflow: str):
+        self.workflow = workflow
+        self.span_count = 0
+        self.trace_ids = set()
+        self.start_time = None
+        self.end_time = None
+
+    def add(self, info: SpanInfo) -> None:
+        self.span_count += 1
+        self.trace_ids.add(info.trace_id)
+        self.start_time = info.start_time if self.start_time is None else min(self.start_time, info.start_time)
+        self.end_time = info.end_time if self.end_time is None else max(self.end_time, info.end_time)
+
+    def to_json(self, key: str) -> bytes:
+        return json.dumps({
+            "object": key,
+            "workflow": self.workflow,
+            "span_count": self.span_count,
+            "trace_ids": [f"0x{trace_id:032x}" for trace_id in sorted(self.trace_ids)],
+            "start_time": _format_time(self.start_time or 0),
+            "end_time": _format_time(self.end_time or 0),
+        }).encode("utf-8")
+
+
+def get_manifest(key: str, infos: Iterable[SpanInfo]) -> bytes:
+    manifest = None
+    for info in infos:
+        manifest = manifest or Manifest(info.partition[0])
+        manifest.add(info)
+    return manifest.to_json(key)
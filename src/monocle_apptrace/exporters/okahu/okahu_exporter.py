@@ -1,16 +1,46 @@
-import json
+"""
+Exporter sending the spans to the Okahu ingestion endpoint.
+
+A batch is cut into requests whose JSON body stays under max_request_bytes, so a
+batch of large data.input events doesn't hit the ingestion size limit. With payload
+deduplication, every request carries the dictionary entries its spans reference.
+The bodies are optionally gzip compressed, with Content-Encoding: gzip. Every
+request is retried on its own, with exponential backoff and jitter, when it times
+out, loses its connection or gets a 408, 429 or 5xx response. With a task processor
+each request is a separate task, so the requests of a batch are sent concurrently
+and a retried request holds up only its own worker. Without one, the requests are
+sent on the span processor thread, so the requests and retries of an export call
+are given max_export_seconds in total: a retry that would end past it isn't made,
+and the requests left once it has passed fail without being sent.
+"""
 import logging
 import os
-from typing import Callable, Optional, Sequence
+import random
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
 import requests
+from requests.adapters import DEFAULT_POOLSIZE, HTTPAdapter
 from opentelemetry.sdk.trace import ReadableSpan
 from opentelemetry.sdk.trace.export import SpanExporter, SpanExportResult, ConsoleSpanExporter
-from requests.exceptions import ReadTimeout
+from requests.exceptions import ConnectionError as RequestConnectionError, Timeout
 
-from monocle_apptrace.exporters.exporter_processor import ExportTaskProcessor
+from monocle_apptrace.exporters.compression import ObjectCompression, get_compression
+from monocle_apptrace.exporters.exporter_processor import ExportTaskProcessor, get_task_processor_from_env
+from monocle_apptrace.exporters.dedup import (BATCH_SCOPE, ContentDeduplicator, get_deduplicator_from_env,
+                                              get_references)
+from monocle_apptrace.exporters.span_serializer import dumps, format_span
 
 REQUESTS_SUCCESS_STATUS_CODES = (200, 202)
+RETRYABLE_STATUS_CODES = (408, 429, 500, 502, 503, 504)
 OKAHU_PROD_INGEST_ENDPOINT = "https://ingest.okahu.co/api/v1/trace/ingest"
+OKAHU_COMPRESSION_ENV = "OKAHU_COMPRESSION"
+DEFAULT_MAX_REQUEST_BYTES = 4 * 1024 * 1024
+DEFAULT_MAX_RETRIES = 3
+# The export timeout of the BatchSpanProcessor
+DEFAULT_MAX_EXPORT_SECONDS = 30
+# {"batch":[],"dictionary":{}}, and the quotes, colon and comma around the digest of a dictionary entry
+BODY_OVERHEAD = 28
+ENTRY_OVERHEAD = 68
 
 logger = logging.getLogger(__name__)
 
@@ -21,9 +51,32 @@ class OkahuSpanExporter(SpanExporter):
             endpoint: Optional[str] = None,
             timeout: Optional[int] = None,
             session: Optional[requests.Session] = None,
-            task_processor: ExportTaskProcessor = None
+            task_processor: ExportTaskProcessor = None,
+            deduplicator: ContentDeduplicator = None,
+            compression: Optional[str] = None,
+            compression_level: Optional[int] = None,
+            max_request_bytes: int = DEFAULT_MAX_REQUEST_BYTES,
+            max_retries: int = DEFAULT_MAX_RETRIES,
+            backoff_in_seconds: float = 1,
+            max_backoff_in_seconds: float = 32,
+            max_export_seconds: float = DEFAULT_MAX_EXPORT_SECONDS
     ):
-        """Okahu exporter."""
+        """
+        Okahu exporter.
+
+        @param task_processor: Sends the batches off the span processor thread, eg. a
+            ThreadPoolExportTaskProcessor, set from MONOCLE_EXPORT_TASK_PROCESSOR by default.
+            The batches are sent on the calling thread without one.
+        @param compression: gzip to compress the request bodies, set from OKAHU_COMPRESSION by default
+        @param compression_level: The gzip level
+        @param max_request_bytes: Uncompressed bytes of a request body, a span larger than that is sent alone
+        @param max_retries: Retries of a request that timed out or got a retryable status
+        @param backoff_in_seconds: Delay before the first retry, doubled for every retry
+        @param max_backoff_in_seconds: Maximum delay between retries
+        @param max_export_seconds: Time the requests of an export call, with their retries, can take
+            when they are sent on the calling thread
+        @raise ValueError: if the compression is not gzip
+        """
         okahu_endpoint: str = os.environ.get("OKAHU_INGESTION_ENDPOINT", OKAHU_PROD_INGEST_ENDPOINT)
         self.endpoint = endpoint or okahu_endpoint
         api_key: str = os.environ.get("OKAHU_API_KEY")
@@ -31,14 +84,36 @@ class OkahuSpanExporter(SpanExporter):
         if not api_key:
             raise ValueError("OKAHU_API_KEY not set.")
         self.timeout = timeout or 15
+        self.compression: Optional[ObjectCompression] = get_compression(
+            compression or os.environ.get(OKAHU_COMPRESSION_ENV), compression_level)
+        if self.compression is not None and self.compression.content_encoding is None:
+            raise ValueError(f"Unsupported Okahu request compression {self.compression.name}, expecting gzip")
+        self.max_request_bytes = max_request_bytes
+        self.max_retries = max_retries
+        self.backoff_in_seconds = backoff_in_seconds
+        self.max_backoff_in_seconds = max_backoff_in_seconds
+        self.max_export_seconds = max_export_seconds
+        self.task_processor = task_processor or get_task_processor_from_env()
         self.session = session or requests.Session()
+        max_in_flight = getattr(self.task_processor, "max_in_flight", None)
+        if session is None and max_in_flight:
+            # One pooled connection per request in flight, the default pool keeps only 10
+            adapter = HTTPAdapter(pool_maxsize=max(DEFAULT_POOLSIZE, max_in_flight))
+            self.session.mount("https://", adapter)
+            self.session.mount("http://", adapter)
         self.session.headers.update(
             {"Content-Type": "application/json", "x-api-key": api_key}
         )
 
-        self.task_processor = task_processor or None
-        if task_processor is not None:
-            task_processor.start()
+        # The strings referenced by a request are sent in its dictionary
+        self.deduplicator = deduplicator or get_deduplicator_from_env()
+        if self.deduplicator is not None and self.deduplicator.scope != BATCH_SCOPE:
+            # The requests are sent concurrently and retried on their own, a request can't rely on another one
+            logger.warning(f"The Okahu exporter doesn't support the {self.deduplicator.scope} dedup scope, "
+                           f"using the {BATCH_SCOPE} scope")
+            self.deduplicator = ContentDeduplicator(min_length=self.deduplicator.min_length, scope=BATCH_SCOPE)
+        if self.task_processor is not None:
+            self.task_processor.start()
 
     def export(self, spans: Sequence[ReadableSpan]) -> SpanExportResult:
         # After the call to Shutdown subsequent calls to Export are
@@ -48,63 +123,132 @@ class OkahuSpanExporter(SpanExporter):
 
         if self._closed:
             logger.warning("Exporter already shutdown, ignoring batch")
-            return SpanExportResult.FAILUREencoder
+            return SpanExportResult.FAILURE
         if len(spans) == 0:
             return
 
-        span_list = {
-            "batch": []
-        }
+        if self.deduplicator is not None:
+            self.deduplicator.begin_batch()
+        okahu_requests = self._get_requests(spans)
+
+        # if async task function is present, then push the requests to async tasks
+        if self.task_processor is not None and callable(self.task_processor.queue_task):
+            queued = [self.task_processor.queue_task(self._send_request, request) for request in okahu_requests]
+            return SpanExportResult.FAILURE if False in queued else SpanExportResult.SUCCESS
+        # The retries sleep on the span processor thread, the export call is bounded instead
+        deadline = time.monotonic() + self.max_export_seconds
+        results = [self._send_request(request, deadline) for request in okahu_requests]
+        return SpanExportResult.SUCCESS if all(result == SpanExportResult.SUCCESS for result in results) \
+            else SpanExportResult.FAILURE
 
-        # append the batch object with all the spans object
+    def _get_requests(self, spans: Sequence[ReadableSpan]) -> List[Tuple[bytes, int]]:
+        """The request bodies of a batch and their span counts, under max_request_bytes where possible."""
+        # The dictionary entries emitted for the batch, a request carries the ones its spans reference
+        emitted: Dict[str, str] = {}
+        okahu_requests = []
+        lines: List[bytes] = []
+        dictionary: Dict[str, str] = {}
+        size = BODY_OVERHEAD
         for span in spans:
-            # create a object from serialized span
-            obj = json.loads(span.to_json())
-            if obj["parent_id"] is None:
-                obj["parent_id"] = "None"
-            else:
-                obj["parent_id"] = remove_0x_from_start(obj["parent_id"])
-            if obj["context"] is not None:
-                obj["context"]["trace_id"] = remove_0x_from_start(obj["context"]["trace_id"])
-                obj["context"]["span_id"] = remove_0x_from_start(obj["context"]["span_id"])
-            span_list["batch"].append(obj)
-
-        def send_spans_to_okahu(span_list_local=None):
+            # Okahu takes the ids without the 0x prefix, and "None" as the parent of a root span
+            obj = format_span(span, id_prefix="", root_parent_id="None")
+            entries = self.deduplicator.dedup(obj) if self.deduplicator is not None else {}
+            emitted.update(entries)
+            line = dumps(obj)
+            references = get_references(obj)
+            new_entries = {digest: emitted[digest] for digest in references if digest not in dictionary}
+            entries_size = sum(len(dumps(value)) + ENTRY_OVERHEAD for value in new_entries.values())
+            if lines and size + len(line) + 1 + entries_size > self.max_request_bytes:
+                okahu_requests.append(self._get_body(lines, dictionary))
+                lines, dictionary, size = [], {}, BODY_OVERHEAD
+            elif not lines and size + len(line) + entries_size > self.max_request_bytes:
+                logger.warning(f"Span {span.name} is larger than max_request_bytes, sending it in its own request")
+            lines.append(line)
+            dictionary.update(new_entries)
+            size += len(line) + 1 + entries_size
+        if lines:
+            okahu_requests.append(self._get_body(lines, dictionary))
+        return okahu_requests
+
+    def _get_body(self, lines: List[bytes], dictionary: Dict[str, str]) -> Tuple[bytes, int]:
+        body = b'{"batch":[' + b",".join(lines) + b"]"
+        if dictionary:
+            body += b',"dictionary":' + dumps(dictionary)
+        body += b"}"
+        if self.compression is not None:
+            compressor = self.compression.new_compressor()
+            body = compressor.compress(body) + compressor.flush()
+        return body, len(lines)
+
+    def _send_request(self, request: Tuple[bytes, int], deadline: Optional[float] = None) -> SpanExportResult:
+        """
+        Posts a request body, retrying it with backoff, returns whether it was accepted.
+
+        @param deadline: time.monotonic() after which the request is no longer sent or retried
+        """
+        body, span_count = request
+        headers = {"Content-Encoding": self.compression.content_encoding} if self.compression is not None else None
+        attempt = 0
+        while True:
+            retry_after = None
+            timeout = self.timeout
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logger.warning("Trace export of %d spans skipped, the export call took over %s seconds",
+                                   span_count, self.max_export_seconds)
+                    return SpanExportResult.FAILURE
+                timeout = min(timeout, remaining)
             try:
                 result = self.session.post(
                     url=self.endpoint,
-                    data=json.dumps(span_list_local),
-                    timeout=self.timeout,
+                    data=body,
+                    timeout=timeout,
+                    headers=headers,
                 )
-                if result.status_code not in REQUESTS_SUCCESS_STATUS_CODES:
+                if result.status_code in REQUESTS_SUCCESS_STATUS_CODES:
+                    logger.info("%d spans successfully exported to okahu", span_count)
+                    return SpanExportResult.SUCCESS
+                if result.status_code not in RETRYABLE_STATUS_CODES or attempt >= self.max_retries:
                     logger.error(
                         "Traces cannot be uploaded; status code: %s, message %s",
                         result.status_code,
                         result.text,
                     )
                     return SpanExportResult.FAILURE
-                logger.warning("spans successfully exported to okahu")
-                return SpanExportResult.SUCCESS
-            except ReadTimeout as e:
-                logger.warning("Trace export timed out: %s", str(e))
+                error = f"status code {result.status_code}"
+                retry_after = result.headers.get("Retry-After") if result.headers is not None else None
+            except (Timeout, RequestConnectionError) as e:
+                if attempt >= self.max_retries:
+                    logger.warning("Trace export of %d spans failed: %s", span_count, str(e))
+                    return SpanExportResult.FAILURE
+                error = str(e)
+            attempt += 1
+            delay = min(self.max_backoff_in_seconds, self.backoff_in_seconds * (2 ** (attempt - 1)))
+            delay = delay * (1 + random.uniform(-0.1, 0.1))  # Add jitter
+            if retry_after is not None and str(retry_after).isdigit():
+                delay = min(self.max_backoff_in_seconds, max(delay, int(retry_after)))
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                logger.warning(f"Trace export attempt {attempt} failed: {error}. Not retrying, "
+                               f"the export call would take over {self.max_export_seconds} seconds")
                 return SpanExportResult.FAILURE
-
-        # if async task function is present, then push the request to asnc task
-
-        if self.task_processor is not None and callable(self.task_processor.queue_task):
-            self.task_processor.queue_task(send_spans_to_okahu, span_list)
-            return SpanExportResult.SUCCESS
-        return send_spans_to_okahu(span_list)
+            logger.warning(f"Trace export attempt {attempt} failed: {error}. Retrying in {delay:.2f} seconds...")
+            time.sleep(delay)
 
     def shutdown(self) -> None:
         if self._closed:
             logger.warning("Exporter already shutdown, ignoring call")
             return
+        self._closed = True
+        # The queued batches are sent before the session is closed
+        if self.task_processor is not None:
+            self.task_processor.stop()
         if hasattr(self, 'session'):
             self.session.close()
-        self._closed = True
 
     def force_flush(self, timeout_millis: int = 30000) -> bool:
+        if self.task_processor is not None:
+            return self.task_processor.force_flush(timeout_millis)
         return True
 
 
@@ -0,0 +1,115 @@
+"""
+Serialization of the spans in the Monocle span format, see metamodel/spans/span_format.json.
+
+ReadableSpan.to_json builds the span as a dict, dumps it with the resource dumped and
+loaded again, and the exporters then loaded it to change it and dumped it once more.
+format_span builds the same dict straight from the span fields, and dumps writes it
+in one pass, with orjson when it is installed and the json module otherwise. The
+resource is formatted once for all the spans sharing it, and the timestamps of the
+same second share their formatted date and time.
+
+Once dumped, the span only differs from span.to_json() in the timestamps, rounded to
+the microsecond from the integer nanoseconds instead of their float value. In the
+dict, the sequence attributes are the tuples of the span.
+"""
+import datetime
+import json
+from typing import Any, Dict, Optional
+from opentelemetry.sdk.trace import ReadableSpan
+from opentelemetry.trace import SpanKind
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+HEX_PREFIX = "0x"
+_kind_names = {kind: str(kind) for kind in SpanKind}
+# The last resource formatted and the last second of a timestamp, replaced as a whole so threads can share them
+_resource_cache = (None, None)
+_second_cache = (None, None)
+
+
+def format_time(time_ns: int) -> str:
+    """The UTC ISO 8601 time of a timestamp in nanoseconds, to the microsecond."""
+    global _second_cache
+    seconds, micros = divmod((time_ns + 500) // 1000, 1000000)
+    cached_seconds, prefix = _second_cache
+    if cached_seconds != seconds:
+        prefix = datetime.datetime.fromtimestamp(seconds, tz=datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+        _second_cache = (seconds, prefix)
+    return f"{prefix}.{micros:06d}Z"
+
+
+def _format_resource(resource) -> Dict[str, Any]:
+    global _resource_cache
+    cached_resource, formatted = _resource_cache
+    if cached_resource is not resource:
+        formatted = {"attributes": dict(resource.attributes), "schema_url": resource.schema_url}
+        _resource_cache = (resource, formatted)
+    return formatted
+
+
+def _format_attributes(attributes) -> Optional[Dict[str, Any]]:
+    return dict(attributes) if attributes is not None else None
+
+
+def _format_context(context, id_prefix: str) -> Dict[str, str]:
+    return {
+        "trace_id": f"{id_prefix}{context.trace_id:032x}",
+        "span_id": f"{id_prefix}{context.span_id:016x}",
+        "trace_state": repr(context.trace_state) if context.trace_state else "[]",
+    }
+
+
+def format_span(span: ReadableSpan, id_prefix: str = HEX_PREFIX, root_parent_id: Optional[str] = None) -> Dict[str, Any]:
+    """
+    The span in the Monocle span format, as a dict. Its resource dict is shared by the spans of the
+    resource and must not be changed.
+
+    @param span: The ended span
+    @param id_prefix: Written before the hex trace, span and parent ids
+    @param root_parent_id: The parent_id of a root span
+    """
+    status = span.status
+    formatted_status = {"status_code": status.status_code.name}
+    if status.description:
+        formatted_status["description"] = status.description
+    parent = span.parent
+    return {
+        "name": span.name,
+        "context": _format_context(span.context, id_prefix) if span.context else None,
+        "kind": _kind_names.get(span.kind) or str(span.kind),
+        "parent_id": f"{id_prefix}{parent.span_id:016x}" if parent is not None else root_parent_id,
+        "start_time": format_time(span.start_time) if span.start_time else None,
+        "end_time": format_time(span.end_time) if span.end_time else None,
+        "status": formatted_status,
+        "attributes": _format_attributes(span.attributes),
+        "events": [{"name": event.name, "timestamp": format_time(event.timestamp),
+                    "attributes": _format_attributes(event.attributes)} for event in span.events],
+        "links": [{"context": _format_context(link.context, id_prefix),
+                   "attributes": _format_attributes(link.attributes)} for link in span.links],
+        "resource": _format_resource(span.resource),
+    }
+
+
+def dumps(obj: Any) -> bytes:
+    """Compact UTF-8 JSON, from orjson when it is installed."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:  # eg. a lone surrogate or an integer over 64 bits, written by the json module
+            pass
+    try:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    except UnicodeEncodeError:
+        return json.dumps(obj, separators=(",", ":")).encode("ascii")
+
+
+def loads(data):
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+def serialize_span(span: ReadableSpan) -> bytes:
+    """The span in the Monocle span format, as one line of JSON."""
+    return dumps(format_span(span))
@@ -1,11 +1,10 @@
 import logging
 from opentelemetry import context as context_api
-from opentelemetry.context import attach, set_value
 from opentelemetry.instrumentation.utils import (
     _SUPPRESS_INSTRUMENTATION_KEY,
 )
 from monocle_apptrace.wrap_common import PROMPT_INPUT_KEY, PROMPT_OUTPUT_KEY, WORKFLOW_TYPE_MAP, with_tracer_wrapper, DATA_INPUT_KEY
-from monocle_apptrace.utils import set_embedding_model, set_attribute
+from monocle_apptrace.request_context import RequestContext, EMBEDDING_MODEL_KEY
 
 logger = logging.getLogger(__name__)
 
@@ -15,19 +14,19 @@ def wrap(tracer, to_wrap, wrapped, instance, args, kwargs):
     if context_api.get_value(_SUPPRESS_INSTRUMENTATION_KEY):
         return wrapped(*args, **kwargs)
     name = "haystack_pipeline"
-    attach(set_value("workflow_name", name))
-    inputs = set()
-    workflow_input = get_workflow_input(args, inputs)
-    embedding_model = get_embedding_model(instance)
-    set_embedding_model(embedding_model)
-    set_attribute(DATA_INPUT_KEY, workflow_input)
 
-
-    with tracer.start_as_current_span(f"{name}.workflow") as span:
+    with RequestContext(workflow_name=name), tracer.start_as_current_span(f"{name}.workflow") as span:
+        if not span.is_recording():
+            return wrapped(*args, **kwargs)
+        inputs = set()
+        workflow_input = get_workflow_input(args, inputs)
+        embedding_model = get_embedding_model(instance)
         span.set_attribute(PROMPT_INPUT_KEY, workflow_input)
         workflow_name = span.resource.attributes.get("service.name")
         set_workflow_attributes(span, workflow_name)
-        response = wrapped(*args, **kwargs)
+        # Scope the pipeline input and embedding model to this run, for the component spans
+        with RequestContext(attributes={EMBEDDING_MODEL_KEY: embedding_model, DATA_INPUT_KEY: workflow_input}):
+            response = wrapped(*args, **kwargs)
         set_workflow_output(span, response)
     return response
 
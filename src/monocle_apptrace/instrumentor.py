@@ -1,6 +1,7 @@
 import logging, os
-from typing import Collection, List
-from wrapt import wrap_function_wrapper
+from typing import Collection, Dict, List
+from itertools import count
+from wrapt import register_post_import_hook, wrap_function_wrapper
 from opentelemetry.trace import get_tracer
 from opentelemetry.instrumentation.instrumentor import BaseInstrumentor
 from opentelemetry.instrumentation.utils import unwrap
@@ -10,18 +11,27 @@ from opentelemetry.sdk.resources import SERVICE_NAME, Resource
 from opentelemetry import trace
 from opentelemetry.context import get_value, attach, set_value
 from monocle_apptrace.utils import process_wrapper_method_config
-from monocle_apptrace.wrap_common import SESSION_PROPERTIES_KEY
+from monocle_apptrace.wrap_common import SESSION_PROPERTIES_KEY, refresh_root_span_attributes
 from monocle_apptrace.wrapper import INBUILT_METHODS_LIST, WrapperMethod
 from monocle_apptrace.exporters.monocle_exporters import get_monocle_exporter
+from monocle_apptrace.enrichment import DeferredEnrichmentSpanProcessor
+from monocle_apptrace.aggregation import AggregatingSpanProcessor
+from monocle_apptrace.tail_sampling import TailSamplingSpanProcessor
+from monocle_apptrace.sampling import get_monocle_sampler
+from monocle_apptrace.payload import PayloadPolicy, reset_payload_policies
+from monocle_apptrace.request_context import WORKFLOW_NAME_KEY, RequestContext, request_context
 
 logger = logging.getLogger(__name__)
 
 _instruments = ()
+# Generations of the import hooks, shared by the MonocleInstrumentor singleton across instrument calls
+_hook_generations = count(1)
 
 class MonocleInstrumentor(BaseInstrumentor):
     workflow_name: str = ""
     user_wrapper_methods: list[WrapperMethod] = []
     instrumented_method_list: list[object] = []
+    _hook_generation: int = 0
 
     def __init__(
             self,
@@ -29,6 +39,11 @@ class MonocleInstrumentor(BaseInstrumentor):
         self.user_wrapper_methods = user_wrapper_methods or []
         super().__init__()
 
+    def instrument(self, **kwargs):
+        # Resolve the process level root span attributes once here instead of for every root span
+        refresh_root_span_attributes()
+        super().instrument(**kwargs)
+
     def instrumentation_dependencies(self) -> Collection[str]:
         return _instruments
 
@@ -48,26 +63,48 @@ class MonocleInstrumentor(BaseInstrumentor):
         process_wrapper_method_config(user_method_list)
         final_method_list = user_method_list + INBUILT_METHODS_LIST
 
+        # Wrap the methods of a module when it is first imported, or now if it already is,
+        # so the frameworks the app doesn't use are not imported
+        self._hook_generation = next(_hook_generations)
+        methods_by_package = {}
         for wrapped_method in final_method_list:
+            methods_by_package.setdefault(wrapped_method.get("package"), []).append(wrapped_method)
+        for wrap_package, wrapped_methods in methods_by_package.items():
             try:
-                wrap_package = wrapped_method.get("package")
-                wrap_object = wrapped_method.get("object")
-                wrap_method = wrapped_method.get("method")
-                wrapper = wrapped_method.get("wrapper")
-                wrap_function_wrapper(
-                    wrap_package,
-                    f"{wrap_object}.{wrap_method}" if wrap_object else wrap_method,
-                    wrapper(tracer, wrapped_method),
-                )
-                self.instrumented_method_list.append(wrapped_method)
+                register_post_import_hook(
+                    self._get_import_hook(tracer, wrapped_methods, user_method_list, self._hook_generation),
+                    wrap_package)
             except Exception as ex:
-                if wrapped_method in user_method_list:
-                    logger.error(f"""_instrument wrap Exception: {str(ex)}
-                                for package: {wrap_package},
-                                object:{wrap_object},
-                                method:{wrap_method}""")
+                logger.error(f"_instrument import hook Exception: {str(ex)} for package: {wrap_package}")
+
+    def _get_import_hook(self, tracer, wrapped_methods, user_method_list, generation):
+        def wrap_methods(module):
+            if generation != self._hook_generation:
+                # Registered before an uninstrument call
+                return
+            for wrapped_method in wrapped_methods:
+                try:
+                    wrap_package = wrapped_method.get("package")
+                    wrap_object = wrapped_method.get("object")
+                    wrap_method = wrapped_method.get("method")
+                    wrapper = wrapped_method.get("wrapper")
+                    wrap_function_wrapper(
+                        module,
+                        f"{wrap_object}.{wrap_method}" if wrap_object else wrap_method,
+                        wrapper(tracer, wrapped_method),
+                    )
+                    self.instrumented_method_list.append(wrapped_method)
+                except Exception as ex:
+                    if wrapped_method in user_method_list:
+                        logger.error(f"""_instrument wrap Exception: {str(ex)}
+                                    for package: {wrap_package},
+                                    object:{wrap_object},
+                                    method:{wrap_method}""")
+        return wrap_methods
 
     def _uninstrument(self, **kwargs):
+        # The import hooks of the modules not imported yet no longer wrap them
+        self._hook_generation = next(_hook_generations)
         for wrapped_method in self.instrumented_method_list:
             try:
                 wrap_package = wrapped_method.get("package")
@@ -86,28 +123,58 @@ class MonocleInstrumentor(BaseInstrumentor):
 def setup_monocle_telemetry(
         workflow_name: str,
         span_processors: List[SpanProcessor] = None,
-        wrapper_methods: List[WrapperMethod] = None):
+        wrapper_methods: List[WrapperMethod] = None,
+        deferred_enrichment: bool = False,
+        aggregate_spans: bool = False,
+        tail_sampling: bool = False,
+        sampling_rate: float = None,
+        workflow_sampling_rates: Dict[str, float] = None,
+        span_type_sampling_rates: Dict[str, float] = None,
+        payload_policy: PayloadPolicy = None):
     resource = Resource(attributes={
         SERVICE_NAME: workflow_name
     })
     span_processors = span_processors or [BatchSpanProcessor(get_monocle_exporter())]
-    trace_provider = TracerProvider(resource=resource)
-    attach(set_value("workflow_name", workflow_name))
+    if payload_policy is not None:
+        # The default budget of the data.input and data.output events, set_payload_policy refines it per span type
+        reset_payload_policies(payload_policy)
+    # Head sampling, from the arguments or the MONOCLE_SAMPLING_RATE* environment variables
+    sampler = get_monocle_sampler(workflow_name, sampling_rate, workflow_sampling_rates, span_type_sampling_rates)
+    trace_provider = TracerProvider(resource=resource, sampler=sampler)
+    attach(set_value(WORKFLOW_NAME_KEY, workflow_name))
     tracer_provider_default = trace.get_tracer_provider()
     provider_type = type(tracer_provider_default).__name__
     is_proxy_provider = "Proxy" in provider_type
     for processor in span_processors:
         processor.on_start = on_processor_start
+    if aggregate_spans:
+        # Fold repeated sibling spans, after the enrichment so span.type and token usage are set
+        span_processors = [AggregatingSpanProcessor(span_processors)]
+    if tail_sampling:
+        # Keep the failed, slow and expensive traces and a share of the others
+        span_processors = [TailSamplingSpanProcessor(span_processors)]
+    if deferred_enrichment:
+        # Resolve the span attributes on a background worker instead of the request thread
+        span_processors = [DeferredEnrichmentSpanProcessor(span_processors)]
+    for processor in span_processors:
         if not is_proxy_provider:
             tracer_provider_default.add_span_processor(processor)
         else:
             trace_provider.add_span_processor(processor)
     if is_proxy_provider:
         trace.set_tracer_provider(trace_provider)
+    else:
+        # The spans are created by the provider already set, with its own sampler
+        trace_provider = tracer_provider_default
+        if sampler is not None:
+            logger.warning(f"A tracer provider ({provider_type}) is already set, its sampler is used instead of "
+                           f"the Monocle sampling rates")
     instrumentor = MonocleInstrumentor(user_wrapper_methods=wrapper_methods or [])
     # instrumentor.app_name = workflow_name
     if not instrumentor.is_instrumented_by_opentelemetry:
-        instrumentor.instrument(trace_provider=trace_provider)
+        instrumentor.instrument(tracer_provider=trace_provider)
+    else:
+        refresh_root_span_attributes()
 
 def on_processor_start(span: Span, parent_context):
     context_properties = get_value(SESSION_PROPERTIES_KEY)
@@ -117,5 +184,12 @@ def on_processor_start(span: Span, parent_context):
                 f"{SESSION_PROPERTIES_KEY}.{key}", value
             )
 
-def set_context_properties(properties: dict) -> None:
-    attach(set_value(SESSION_PROPERTIES_KEY, properties))
\ No newline at end of file
+def set_context_properties(properties: dict):
+    """
+    Set the session properties in the current context, they are added to every span as session.<key> attributes.
+    Prefer request_context(properties=...), which detaches them at the end of the request.
+
+    @param properties: The session properties
+    @return: The context token, pass it to opentelemetry.context.detach to remove the properties
+    """
+    return attach(set_value(SESSION_PROPERTIES_KEY, properties))
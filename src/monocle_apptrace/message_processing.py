@@ -17,13 +17,17 @@ def extract_messages(args):
             messages.append(args_input)
             return messages
         if args and isinstance(args, tuple) and len(args) > 0:
-            if hasattr(args[0], "messages") and isinstance(args[0].messages, list):
+            if isinstance(args[0], str):  # a prompt, sent as a human message
+                messages.append({"human": args[0]})
+            elif hasattr(args[0], "messages") and isinstance(args[0].messages, list):
                 for msg in args[0].messages:
                     if hasattr(msg, 'content') and hasattr(msg, 'type'):
                         messages.append({msg.type: msg.content})
-            elif isinstance(args[0], list):  #llama
+            elif isinstance(args[0], list):
                 for msg in args[0]:
-                    if hasattr(msg, 'content') and hasattr(msg, 'role'):
+                    if hasattr(msg, 'content') and hasattr(msg, 'type') and not hasattr(msg, 'role'):  # langchain
+                        messages.append({msg.type: msg.content})
+                    elif hasattr(msg, 'content') and hasattr(msg, 'role'):  # llama
                         if hasattr(msg.role, 'value'):
                             role = msg.role.value
                         else:
@@ -41,6 +45,8 @@ def extract_messages(args):
 
 def extract_assistant_message(response):
     try:
+        if response is None:
+            return []
         if isinstance(response, str):
             return [response]
         if hasattr(response, "content"):
@@ -0,0 +1,215 @@
+"""
+Precompiled bundle of the metamodel maps.
+
+The langchain, llamaindex, haystack and botocore method maps reference entity files, which
+get_wrapper_methods_config reads and parses again for every method entry. The bundle holds the
+validated maps with every entity file parsed once, in one marshal file loaded in one step. marshal
+is builtin and reads plain dicts and lists faster than json and pickle.
+
+The bundle records the SHA-256, size and modification time of every source file. When a map or
+entity file changed since the bundle was built, or the bundle can't be read, eg. by another Python
+version, the maps are loaded from the JSON sources as before. Loading only stats the sources: a
+source whose size and modification time match is current, one whose size differs is changed, and
+only a source with the same size and another modification time, eg. after a checkout, is hashed.
+In an installed release of the version the bundle was built for, the sources are not hashed. The
+build and the test compare the hashes of all the sources. The build compiles every accessor to validate it, so the accessors
+of a bundled map are compiled on first use by get_accessor instead of when the map is loaded.
+Rebuild the bundle after changing the maps, the build fails on invalid maps, entities or accessors:
+
+    python -m monocle_apptrace.metamodel_bundle
+"""
+import hashlib
+import importlib.metadata
+import json
+import logging
+import os
+import marshal
+import sys
+from typing import List, Optional
+from monocle_apptrace.accessor import compile_output_processor
+from monocle_apptrace.utils import get_wrapper_method, get_wrapper_methods_config
+
+logger = logging.getLogger(__name__)
+
+BASE_PATH = os.path.dirname(os.path.abspath(__file__))
+MAPS_PATH = os.path.join("metamodel", "maps")
+BUNDLE_PATH = os.path.join(BASE_PATH, "metamodel", "bundle.marshal")
+BUNDLE_VERSION = 2
+PACKAGE_NAME = "monocle_apptrace"
+MARSHAL_VERSION = 4
+METHODS_FILES = ("langchain_methods.json", "llamaindex_methods.json", "haystack_methods.json", "botocore_methods.json")
+REQUIRED_KEYS = ("package", "method", "wrapper_package", "wrapper_method")
+
+
+def _read(base_path: str, relative_path: str) -> bytes:
+    with open(os.path.join(base_path, relative_path), "rb") as source_file:
+        return source_file.read()
+
+
+def _get_digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _get_source(base_path: str, relative_path: str, data: bytes) -> dict:
+    stat = os.stat(os.path.join(base_path, relative_path))
+    return {"sha256": _get_digest(data), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def _get_release_version(base_path: str) -> Optional[str]:
+    """The version of the installed distribution in base_path, None for an editable install or a source tree."""
+    try:
+        distribution = importlib.metadata.distribution(PACKAGE_NAME)
+        if os.path.abspath(str(distribution.locate_file(PACKAGE_NAME))) != os.path.abspath(base_path):
+            return None
+        direct_url = distribution.read_text("direct_url.json")
+        if direct_url and json.loads(direct_url).get("dir_info", {}).get("editable"):
+            return None
+        return distribution.version
+    except (importlib.metadata.PackageNotFoundError, ValueError):
+        return None
+
+
+def _validate_method(wrapper_method: dict, where: str, errors: List[str]) -> None:
+    for key in REQUIRED_KEYS:
+        if not wrapper_method.get(key):
+            errors.append(f"{where}: missing {key}")
+    for package_key, method_key in (("wrapper_package", "wrapper_method"),
+                                    ("span_name_getter_package", "span_name_getter_method")):
+        if wrapper_method.get(package_key) and wrapper_method.get(method_key):
+            try:
+                get_wrapper_method(wrapper_method[package_key], wrapper_method[method_key])
+            except (ImportError, AttributeError) as e:
+                errors.append(f"{where}: invalid {method_key} {wrapper_method[method_key]}: {e}")
+
+
+def build_bundle(base_path: str = BASE_PATH) -> dict:
+    """
+    Validates the method maps and the entity files they reference.
+
+    @param base_path: The monocle_apptrace package directory
+    @return: The bundle
+    @raise ValueError: Listing the invalid maps, entities and accessors
+    """
+    errors = []
+    sources = {}
+    methods = {}
+    entities = {}
+    for methods_file in METHODS_FILES:
+        methods_path = os.path.join(MAPS_PATH, methods_file)
+        try:
+            data = _read(base_path, methods_path)
+            sources[methods_path] = _get_source(base_path, methods_path, data)
+            wrapper_methods = json.loads(data)["wrapper_methods"]
+        except (OSError, ValueError, KeyError) as e:
+            errors.append(f"{methods_path}: {e!r}")
+            continue
+        for index, wrapper_method in enumerate(wrapper_methods):
+            where = f"{methods_path} entry {index}"
+            _validate_method(wrapper_method, where, errors)
+            output_processor = wrapper_method.get("output_processor")
+            if not output_processor:
+                continue
+            entity_path = output_processor[0]
+            if entity_path in entities or entity_path in sources:
+                continue
+            try:
+                data = _read(base_path, entity_path)
+                sources[entity_path] = _get_source(base_path, entity_path, data)
+                entity = json.loads(data)
+            except (OSError, ValueError) as e:
+                errors.append(f"{where}: invalid output_processor {entity_path}: {e!r}")
+                continue
+            if not isinstance(entity, dict) or "type" not in entity:
+                errors.append(f"{entity_path}: missing type")
+            elif compile_output_processor(entity) > 0:
+                errors.append(f"{entity_path}: invalid accessor")
+            entities[entity_path] = entity
+        methods[methods_file] = wrapper_methods
+    if errors:
+        raise ValueError("Invalid metamodel:\n" + "\n".join(errors))
+    try:
+        package_version = importlib.metadata.version(PACKAGE_NAME)
+    except importlib.metadata.PackageNotFoundError:
+        package_version = None
+    return {"version": BUNDLE_VERSION, "package_version": package_version, "sources": sources, "methods": methods,
+            "entities": entities}
+
+
+def write_bundle(base_path: str = BASE_PATH, bundle_path: Optional[str] = None) -> dict:
+    bundle = build_bundle(base_path)
+    with open(bundle_path or BUNDLE_PATH, "wb") as bundle_file:
+        marshal.dump(bundle, bundle_file, MARSHAL_VERSION)
+    return bundle
+
+
+def load_bundle(base_path: str = BASE_PATH, bundle_path: Optional[str] = None, verify: bool = False) -> Optional[dict]:
+    """
+    The bundle, or None if it is missing, unreadable or older than its sources.
+
+    @param verify: Compare the hashes of all the sources instead of their sizes and modification times
+    """
+    bundle_path = bundle_path or BUNDLE_PATH
+    try:
+        with open(bundle_path, "rb") as bundle_file:
+            bundle = marshal.load(bundle_file)
+        if bundle.get("version") != BUNDLE_VERSION:
+            logger.info(f"Metamodel bundle {bundle_path} has another version, loading the JSON maps")
+            return None
+        release = None
+        for source_path, source in bundle["sources"].items():
+            if verify:
+                current = _get_digest(_read(base_path, source_path)) == source["sha256"]
+            else:
+                stat = os.stat(os.path.join(base_path, source_path))
+                current = stat.st_size == source["size"]
+                if current and stat.st_mtime_ns != source["mtime_ns"]:
+                    # Copied, eg. by a checkout or an install, the sources of a release are not edited
+                    if release is None:
+                        release = bundle["package_version"] is not None and \
+                            _get_release_version(base_path) == bundle["package_version"]
+                    current = release or _get_digest(_read(base_path, source_path)) == source["sha256"]
+            if not current:
+                logger.info(f"Metamodel bundle is older than {source_path}, loading the JSON maps")
+                return None
+        return bundle
+    except FileNotFoundError:
+        logger.info(f"Metamodel bundle {bundle_path} not found, loading the JSON maps")
+    except Exception as e:
+        logger.warning(f"Metamodel bundle {bundle_path} can't be loaded, loading the JSON maps: {e!r}")
+    return None
+
+
+_bundle = None
+_bundle_loaded = False
+
+
+def get_wrapper_methods(methods_file: str) -> list:
+    """
+    The wrapper methods of a map, eg. langchain_methods.json, with their wrappers and output processors
+    resolved like get_wrapper_methods_config does, from the bundle if it is current.
+    """
+    global _bundle, _bundle_loaded
+    if not _bundle_loaded:
+        _bundle = load_bundle()
+        _bundle_loaded = True
+    if _bundle is None or methods_file not in _bundle["methods"]:
+        return get_wrapper_methods_config(wrapper_methods_config_path=os.path.join(BASE_PATH, MAPS_PATH, methods_file),
+                                          attributes_config_base_path=BASE_PATH)
+    wrapper_methods = _bundle["methods"][methods_file]
+    for wrapper_method in wrapper_methods:
+        wrapper_method["wrapper"] = get_wrapper_method(wrapper_method["wrapper_package"], wrapper_method["wrapper_method"])
+        if "span_name_getter_method" in wrapper_method:
+            wrapper_method["span_name_getter"] = get_wrapper_method(wrapper_method["span_name_getter_package"],
+                                                                    wrapper_method["span_name_getter_method"])
+        if isinstance(wrapper_method.get("output_processor"), list):
+            wrapper_method["output_processor"] = _bundle["entities"][wrapper_method["output_processor"][0]]
+    return wrapper_methods
+
+
+if __name__ == "__main__":
+    try:
+        written = write_bundle()
+    except ValueError as error:
+        sys.exit(str(error))
+    print(f"Wrote {BUNDLE_PATH}: {sum(len(methods) for methods in written['methods'].values())} methods, "
+          f"{len(written['entities'])} entity files")
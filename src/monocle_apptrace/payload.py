@@ -0,0 +1,351 @@
+"""
+Byte budgeted capture of the data.input and data.output events.
+
+Prompts, retrieved context and responses are captured as span events, and a RAG prompt of tens
+of KB is held by every queued span and exported with it. A PayloadPolicy bounds each event
+attribute to max_bytes of UTF-8: the head of the payload is kept, and the last tail_bytes of it
+after a "..." marker. The strings are sliced before they are joined or stringified, so a large
+payload is never copied whole. A truncated attribute gets <attribute>.truncated and
+<attribute>.length, its length in characters. hash_payload adds <attribute>.sha256 of the full
+payload, and metadata_only captures only the length, item count and hash. A payload produced in
+pieces, eg. the text of a stream, is kept within the budget while it arrives by a PayloadBuffer.
+
+Policies are set per span.type and event name with set_payload_policy. The default policy can be
+set with setup_monocle_telemetry(payload_policy=...) or the environment:
+    MONOCLE_PAYLOAD_MAX_BYTES=16384
+    MONOCLE_PAYLOAD_TAIL_BYTES=4096
+    MONOCLE_PAYLOAD_HASH=true
+    MONOCLE_PAYLOAD_METADATA_ONLY=true
+"""
+import hashlib
+import logging
+import os
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 16384
+DEFAULT_TAIL_BYTES = 4096
+RETRIEVAL_OUTPUT_MAX_BYTES = 100
+HASH_CHUNK_SIZE = 65536
+TRUNCATION_MARKER = "..."
+TRUNCATED_SUFFIX = ".truncated"
+LENGTH_SUFFIX = ".length"
+COUNT_SUFFIX = ".count"
+HASH_SUFFIX = ".sha256"
+
+MAX_BYTES_ENV = "MONOCLE_PAYLOAD_MAX_BYTES"
+TAIL_BYTES_ENV = "MONOCLE_PAYLOAD_TAIL_BYTES"
+HASH_ENV = "MONOCLE_PAYLOAD_HASH"
+METADATA_ONLY_ENV = "MONOCLE_PAYLOAD_METADATA_ONLY"
+
+
+class PayloadPolicy:
+    """How much of the payload of an event attribute is captured."""
+
+    def __init__(self, max_bytes: Optional[int] = DEFAULT_MAX_BYTES, tail_bytes: int = 0,
+                 hash_payload: bool = False, metadata_only: bool = False):
+        """
+        @param max_bytes: The UTF-8 bytes of payload kept per event attribute, None to keep it all
+        @param tail_bytes: Of these, the bytes kept from the end of the payload
+        @param hash_payload: Adds the SHA-256 of the full payload, eg. to match prompts without keeping them
+        @param metadata_only: Captures only the length, item count and hash of the payload
+        """
+        self.max_bytes = max(max_bytes, 0) if max_bytes is not None else None
+        self.tail_bytes = min(max(tail_bytes, 0), self.max_bytes) if self.max_bytes is not None else 0
+        self.hash_payload = hash_payload
+        self.metadata_only = metadata_only
+
+    def __repr__(self):
+        return (f"PayloadPolicy(max_bytes={self.max_bytes}, tail_bytes={self.tail_bytes}, "
+                f"hash_payload={self.hash_payload}, metadata_only={self.metadata_only})")
+
+
+class PayloadText(str):
+    """The text kept by a PayloadBuffer, with the length and hash of the whole payload."""
+    full_length: int = 0
+    sha256: Optional[str] = None
+    truncated: bool = False
+
+
+class PayloadBuffer:
+    """
+    Collects a payload produced in pieces, keeping only what the policy captures of it: the head
+    and the tail of the payload, and its length and hash.
+    """
+
+    def __init__(self, policy: PayloadPolicy):
+        self.policy = policy
+        self.length = 0
+        self._digest = hashlib.sha256() if policy.hash_payload else None
+        max_bytes = 0 if policy.metadata_only else policy.max_bytes
+        # The share of the tail capture_payload keeps of a single string
+        self._tail_bytes = min(policy.tail_bytes, max_bytes // 2) if max_bytes else 0
+        self._head_bytes = max_bytes - self._tail_bytes if max_bytes is not None else None
+        self._head = []
+        self._head_size = 0
+        self._tail = []
+        self._tail_size = 0
+        self.truncated = False
+
+    def add(self, text: str) -> None:
+        if not text:
+            return
+        self.length += len(text)
+        if self._digest is not None:
+            _update_hash(self._digest, text)
+        if self._head_bytes is None or self._head_size < self._head_bytes:
+            # A character takes at least a byte, so the head holds head_bytes bytes once it holds as many characters
+            self._head.append(text)
+            self._head_size += len(text)
+            return
+        self.truncated = True
+        if not self._tail_bytes:
+            return
+        self._tail.append(text)
+        self._tail_size += len(text)
+        while self._tail_size - len(self._tail[0]) >= self._tail_bytes:
+            self._tail_size -= len(self._tail.pop(0))
+
+    def get_text(self) -> PayloadText:
+        """The text kept, captured as the whole payload by capture_payload."""
+        text = "".join(self._head)
+        if self.truncated:
+            text += TRUNCATION_MARKER + "".join(self._tail)
+        text = PayloadText(text)
+        text.full_length = self.length
+        text.sha256 = self._digest.hexdigest() if self._digest is not None else None
+        text.truncated = self.truncated
+        return text
+
+
+def _get_env_flag(name: str) -> bool:
+    return os.environ.get(name, "").strip().lower() in ("1", "true", "yes")
+
+
+def get_default_policy_from_env() -> PayloadPolicy:
+    max_bytes, tail_bytes = DEFAULT_MAX_BYTES, DEFAULT_TAIL_BYTES
+    try:
+        if os.environ.get(MAX_BYTES_ENV):
+            max_bytes = int(os.environ[MAX_BYTES_ENV])
+            # 0 or less keeps the whole payload
+            max_bytes = max_bytes if max_bytes > 0 else None
+            tail_bytes = max_bytes // 4 if max_bytes else 0
+        if os.environ.get(TAIL_BYTES_ENV):
+            tail_bytes = int(os.environ[TAIL_BYTES_ENV])
+    except ValueError:
+        logger.warning(f"Invalid {MAX_BYTES_ENV} or {TAIL_BYTES_ENV}, using the default payload budget")
+        max_bytes, tail_bytes = DEFAULT_MAX_BYTES, DEFAULT_TAIL_BYTES
+    return PayloadPolicy(max_bytes=max_bytes, tail_bytes=tail_bytes, hash_payload=_get_env_flag(HASH_ENV),
+                         metadata_only=_get_env_flag(METADATA_ONLY_ENV))
+
+
+_policies: Dict[Tuple[Optional[str], Optional[str]], PayloadPolicy] = {}
+
+
+def set_payload_policy(policy: PayloadPolicy, span_type: Optional[str] = None, event_name: Optional[str] = None):
+    """
+    Sets the payload policy of the events of a span type, eg. set_payload_policy(PayloadPolicy(1024), "retrieval").
+
+    @param policy: The policy
+    @param span_type: The span.type it applies to, None for all
+    @param event_name: The event it applies to, eg. data.input, None for all
+    """
+    _policies[(span_type, event_name)] = policy
+
+
+def get_payload_policy(span_type: Optional[str], event_name: Optional[str]) -> PayloadPolicy:
+    """The most specific policy set for the span type and event."""
+    return _policies.get((span_type, event_name)) or _policies.get((span_type, None)) or \
+        _policies.get((None, event_name)) or _policies[(None, None)]
+
+
+def reset_payload_policies(default_policy: Optional[PayloadPolicy] = None):
+    """Removes the policies set, the retriever outputs keep their short excerpt under the new default."""
+    default_policy = default_policy or get_default_policy_from_env()
+    _policies.clear()
+    _policies[(None, None)] = default_policy
+    _policies[("retrieval", "data.output")] = PayloadPolicy(
+        max_bytes=RETRIEVAL_OUTPUT_MAX_BYTES, hash_payload=default_policy.hash_payload,
+        metadata_only=default_policy.metadata_only)
+
+
+reset_payload_policies()
+
+
+def _utf8_head(text: str, max_bytes: int) -> str:
+    if text.isascii():
+        return text
+    return text.encode("utf-8", "ignore")[:max_bytes].decode("utf-8", "ignore")
+
+
+def _utf8_tail(text: str, max_bytes: int) -> str:
+    if text.isascii():
+        return text
+    return text.encode("utf-8", "ignore")[-max_bytes:].decode("utf-8", "ignore")
+
+
+def _take(pieces: Sequence[str], size: int, from_end: bool = False) -> str:
+    """The first, or last, size characters of the pieces, copying only those."""
+    taken, taken_size = [], 0
+    for piece in (reversed(pieces) if from_end else pieces):
+        if taken_size >= size:
+            break
+        piece = piece[-(size - taken_size):] if from_end else piece[:size - taken_size]
+        taken.append(piece)
+        taken_size += len(piece)
+    return "".join(reversed(taken)) if from_end else "".join(taken)
+
+
+def bounded_join(parts: Sequence[str], sep: str, max_bytes: Optional[int], tail_bytes: int = 0):
+    """
+    Joins the parts, cut to max_bytes of UTF-8 if needed, without copying the characters cut.
+
+    @return: The text, the bytes it holds and whether it was truncated
+    """
+    pieces = _with_separators(parts, sep)
+    if max_bytes is None:
+        text = "".join(pieces)
+        return text, len(text), False
+    if sum(len(piece) for piece in pieces) <= max_bytes:
+        # At most max_bytes characters, but they may take more bytes
+        text = "".join(pieces)
+        size = len(text) if text.isascii() else len(text.encode("utf-8", "ignore"))
+        if size <= max_bytes:
+            return text, size, False
+        pieces = [text]
+    tail_bytes = min(tail_bytes, max_bytes)
+    head_bytes = max_bytes - tail_bytes
+    text = _utf8_head(_take(pieces, head_bytes), head_bytes) + TRUNCATION_MARKER
+    if tail_bytes:
+        text += _utf8_tail(_take(pieces, tail_bytes, from_end=True), tail_bytes)
+    return text, max_bytes, True
+
+
+def _update_hash(digest, text: str):
+    for start in range(0, len(text), HASH_CHUNK_SIZE):
+        digest.update(text[start:start + HASH_CHUNK_SIZE].encode("utf-8", "ignore"))
+
+
+def _get_length_and_hash(texts, hash_payload: bool) -> Tuple[int, Optional[str]]:
+    """The length in characters of the texts and their SHA-256, hashing them in chunks."""
+    texts = list(texts)
+    if len(texts) == 1 and isinstance(texts[0], PayloadText):
+        return texts[0].full_length, texts[0].sha256 if hash_payload else None
+    digest = hashlib.sha256() if hash_payload else None
+    length = 0
+    for text in texts:
+        length += len(text)
+        if digest is not None:
+            _update_hash(digest, text)
+    return length, digest.hexdigest() if digest is not None else None
+
+
+def _with_separators(parts: Sequence[str], sep: str):
+    pieces = []
+    for part in parts:
+        if pieces and sep:
+            pieces.append(sep)
+        pieces.append(part)
+    return pieces
+
+
+def _get_texts(item):
+    """The strings of a payload item, a message dict is captured by its values."""
+    if isinstance(item, str):
+        return [item]
+    if isinstance(item, dict):
+        return [value for value in item.values() if isinstance(value, str)]
+    return [str(item)]
+
+
+def _capture_item(item, policy: PayloadPolicy, remaining: Optional[int]):
+    """Returns the item as a string within the remaining bytes, the bytes it holds and whether it was cut."""
+    if isinstance(item, dict):
+        captured, used, truncated = {}, 0, False
+        for key, value in item.items():
+            if isinstance(value, str):
+                budget = remaining - used if remaining is not None else None
+                tail_bytes = min(policy.tail_bytes, budget // 2) if budget is not None else 0
+                value, size, cut = bounded_join((value,), "", budget, tail_bytes)
+                used += size
+                truncated = truncated or cut
+            captured[key] = value
+        return str(captured), used, truncated
+    if not isinstance(item, str):
+        item = str(item)
+    tail_bytes = min(policy.tail_bytes, remaining // 2) if remaining is not None else 0
+    return bounded_join((item,), "", remaining, tail_bytes)
+
+
+def capture_payload(attributes: Dict[str, Any], policy: PayloadPolicy) -> Dict[str, Any]:
+    """
+    Applies the policy to the attributes of a data.input or data.output event.
+    Lists, eg. of messages, share the budget and become lists of strings.
+
+    @param attributes: The event attributes, strings and lists are captured within the budget
+    @param policy: The payload policy of the span type and event
+    @return: The attributes to record
+    """
+    captured = {}
+    for key, value in attributes.items():
+        if not isinstance(value, (str, list, tuple)):
+            captured[key] = value
+            continue
+        items = [value] if isinstance(value, str) else value
+        if policy.hash_payload or policy.metadata_only:
+            length, digest = _get_length_and_hash((text for item in items for text in _get_texts(item)),
+                                                  policy.hash_payload)
+            if digest is not None:
+                captured[f"{key}{HASH_SUFFIX}"] = digest
+            if policy.metadata_only:
+                captured[f"{key}{LENGTH_SUFFIX}"] = length
+                if not isinstance(value, str):
+                    captured[f"{key}{COUNT_SUFFIX}"] = len(value)
+                continue
+        remaining = policy.max_bytes
+        truncated = False
+        texts = []
+        for item in items:
+            if remaining is not None and remaining <= 0:
+                # The budget is spent, the other items are dropped
+                truncated = True
+                break
+            text, size, cut = _capture_item(item, policy, remaining)
+            texts.append(text)
+            truncated = truncated or cut or (isinstance(item, PayloadText) and item.truncated)
+            if remaining is not None:
+                remaining -= size
+        captured[key] = texts[0] if isinstance(value, str) else texts
+        if truncated:
+            captured[f"{key}{TRUNCATED_SUFFIX}"] = True
+            captured[f"{key}{LENGTH_SUFFIX}"] = _get_length_and_hash(
+                (text for item in items for text in _get_texts(item)), False)[0]
+    return captured
+
+
+def capture_text(key: str, parts: Sequence[str], policy: PayloadPolicy, sep: str = " ") -> Dict[str, Any]:
+    """
+    Captures the parts joined with sep as one attribute, eg. the documents of a retriever output,
+    copying only the bytes within the budget.
+
+    @param key: The event attribute
+    @param parts: The strings to join
+    @param policy: The payload policy of the span type and event
+    @param sep: The separator of the parts
+    @return: The attributes to record
+    """
+    captured = {}
+    if policy.hash_payload or policy.metadata_only:
+        length, digest = _get_length_and_hash(_with_separators(parts, sep), policy.hash_payload)
+        if digest is not None:
+            captured[f"{key}{HASH_SUFFIX}"] = digest
+        if policy.metadata_only:
+            captured[f"{key}{LENGTH_SUFFIX}"] = length
+            return captured
+    text, _, truncated = bounded_join(parts, sep, policy.max_bytes, policy.tail_bytes)
+    captured[key] = text
+    if truncated:
+        captured[f"{key}{TRUNCATED_SUFFIX}"] = True
+        captured[f"{key}{LENGTH_SUFFIX}"] = sum(len(piece) for piece in _with_separators(parts, sep))
+    return captured
@@ -0,0 +1,129 @@
+"""
+Resolves the provider host name and the inference endpoint of an LLM client.
+
+The resolvers in PROVIDER_RESOLVERS are applied in order, each one reading the
+client configuration of one family of SDKs, and later resolvers override what
+earlier ones found. The result only depends on the client configuration, so it
+is cached per wrapped instance; call invalidate_provider(instance) after
+replacing the client of an instance.
+"""
+import logging
+from functools import lru_cache
+from typing import Callable, Dict, Optional, Tuple
+from urllib.parse import urlparse
+from monocle_apptrace.accessor import static_attribute_cache
+
+logger = logging.getLogger(__name__)
+
+PROVIDER_URL = "provider_url"
+INFERENCE_ENDPOINT = "inference_endpoint"
+PROVIDER_CACHE_KEY = "monocle.provider"
+
+
+def _get_attribute_path(obj, *names):
+    for name in names:
+        obj = getattr(obj, name, None)
+        if obj is None:
+            return None
+    return obj
+
+
+def _resolve_openai_client(instance) -> Optional[dict]:
+    """OpenAI and Azure OpenAI SDK clients, eg. langchain ChatOpenAI and AzureChatOpenAI."""
+    base_url = _get_attribute_path(instance, "client", "_client", "base_url")
+    if base_url is None:
+        return None
+    host = getattr(base_url, "host", None)
+    return {
+        PROVIDER_URL: host if isinstance(host, str) else None,
+        INFERENCE_ENDPOINT: base_url if isinstance(base_url, str) else str(base_url)
+    }
+
+
+def _resolve_botocore_client(instance) -> Optional[dict]:
+    """Bedrock and SageMaker runtime clients, either wrapped by a framework or the boto3 client itself."""
+    endpoint_url = _get_attribute_path(instance, "client", "meta", "endpoint_url") \
+        or _get_attribute_path(instance, "meta", "endpoint_url")
+    if not isinstance(endpoint_url, str):
+        return None
+    return {INFERENCE_ENDPOINT: endpoint_url}
+
+
+def _resolve_api_base(instance) -> Optional[dict]:
+    """Clients configured with an api_base url, eg. llama-index OpenAI and langchain community LLMs."""
+    api_base = getattr(instance, "api_base", None)
+    if not isinstance(api_base, str):
+        return None
+    return {PROVIDER_URL: api_base}
+
+
+def _resolve_mistral_client(instance) -> Optional[dict]:
+    """Mistral AI SDK clients, eg. llama-index MistralAI."""
+    server_url = _get_attribute_path(instance, "_client", "sdk_configuration", "server_url")
+    if not isinstance(server_url, str):
+        return None
+    return {INFERENCE_ENDPOINT: server_url}
+
+
+PROVIDER_RESOLVERS: Dict[str, Callable[[object], Optional[dict]]] = {
+    "openai": _resolve_openai_client,
+    "botocore": _resolve_botocore_client,
+    "api_base": _resolve_api_base,
+    "mistral": _resolve_mistral_client,
+}
+
+
+def register_provider_resolver(name: str, resolver: Callable[[object], Optional[dict]]) -> None:
+    """
+    Add a provider resolver, or replace the resolver registered under the same name.
+
+    @param name: The name of the resolver
+    @param resolver: Takes the wrapped instance and returns a dict with the provider_url
+        and/or inference_endpoint it found, or None if the instance is not a client it knows
+    """
+    PROVIDER_RESOLVERS[name] = resolver
+    static_attribute_cache.clear()
+
+
+@lru_cache(maxsize=256)
+def get_host_name(provider_url: str) -> str:
+    """Returns the host name of a provider url, or the url itself if it has no scheme."""
+    try:
+        return urlparse(provider_url).hostname or provider_url
+    except ValueError:
+        return provider_url
+
+
+def resolve_provider(instance) -> Tuple[str, str]:
+    """
+    Resolve the provider host name and inference endpoint of an instance without caching.
+
+    @param instance: The wrapped LLM or client instance
+    @return: The (provider name, inference endpoint) tuple, empty strings if not found
+    """
+    provider = {PROVIDER_URL: "", INFERENCE_ENDPOINT: ""}
+    for name, resolver in PROVIDER_RESOLVERS.items():
+        try:
+            result = resolver(instance)
+        except Exception as e:
+            logger.debug(f"Provider resolver {name} failed: {e}")
+            continue
+        if result:
+            provider.update({key: value for key, value in result.items() if value})
+    provider_url = provider[PROVIDER_URL]
+    return get_host_name(provider_url) if provider_url else provider_url, provider[INFERENCE_ENDPOINT]
+
+
+def get_provider_name(instance) -> Tuple[str, str]:
+    """
+    Returns the provider host name and inference endpoint of an instance, resolved once per instance.
+
+    @param instance: The wrapped LLM or client instance
+    @return: The (provider name, inference endpoint) tuple, empty strings if not found
+    """
+    return static_attribute_cache.get_or_compute(instance, PROVIDER_CACHE_KEY, resolve_provider, instance)
+
+
+def invalidate_provider(instance) -> None:
+    """Drop the cached provider of an instance, eg. after its client was replaced."""
+    static_attribute_cache.invalidate(instance)
@@ -0,0 +1,105 @@
+"""
+Request scoped Monocle state.
+
+The values (session properties, workflow name, embedding model and other
+context attributes) are stored in the opentelemetry context, which is a
+contextvar, so every thread and asyncio task sees its own values. A
+request_context scope attaches them on entry and always detaches them on
+exit, so nothing leaks into later requests handled by the same thread.
+
+    with request_context(properties={"user_id": user_id}):
+        chain.invoke(query)
+
+    @request_context(workflow_name="billing_bot")
+    async def handle(query):
+        return await chain.ainvoke(query)
+"""
+import functools
+import inspect
+import logging
+from contextvars import ContextVar
+from typing import Any, Dict, Optional, Tuple
+from opentelemetry.context import attach, detach, get_current, get_value, set_value
+
+logger = logging.getLogger(__name__)
+
+SESSION_PROPERTIES_KEY = "session"
+WORKFLOW_NAME_KEY = "workflow_name"
+EMBEDDING_MODEL_KEY = "embedding_model"
+
+# The (scope, token) of the scopes entered in the current thread or task, so a scope shared by
+# concurrent requests detaches the context its own request attached
+_scope_tokens: ContextVar[Tuple[tuple, ...]] = ContextVar("monocle_request_context_tokens", default=())
+
+
+class RequestContext:
+    """
+    Context manager and decorator that sets Monocle state for the duration of a request.
+
+    The session properties are merged with the ones of an enclosing scope. Each decorated
+    call gets its own scope, and the same scope can be entered by concurrent threads or tasks.
+    """
+
+    def __init__(self, properties: Optional[Dict[str, Any]] = None, workflow_name: Optional[str] = None,
+                 attributes: Optional[Dict[str, Any]] = None):
+        """
+        @param properties: Session properties, added to every span as session.<key> attributes
+        @param workflow_name: Overrides the workflow name of the spans started in the scope
+        @param attributes: Other context values, read with get_attribute, eg. data.input or embedding_model
+        """
+        self.properties = properties
+        self.workflow_name = workflow_name
+        self.attributes = attributes
+
+    def __enter__(self):
+        context = get_current()
+        if self.properties:
+            outer_properties = get_value(SESSION_PROPERTIES_KEY, context)
+            properties = {**outer_properties, **self.properties} if outer_properties else self.properties
+            context = set_value(SESSION_PROPERTIES_KEY, properties, context)
+        if self.workflow_name:
+            context = set_value(WORKFLOW_NAME_KEY, self.workflow_name, context)
+        if self.attributes:
+            for key, value in self.attributes.items():
+                context = set_value(key, value, context)
+        token = attach(context)
+        _scope_tokens.set(_scope_tokens.get() + ((self, token),))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        scope_tokens = _scope_tokens.get()
+        # The innermost entry of this scope, scopes are exited in the reverse order they were entered
+        index = next(index for index in range(len(scope_tokens) - 1, -1, -1) if scope_tokens[index][0] is self)
+        _scope_tokens.set(scope_tokens[:index] + scope_tokens[index + 1:])
+        detach(scope_tokens[index][1])
+        return False
+
+    def _copy(self):
+        return RequestContext(self.properties, self.workflow_name, self.attributes)
+
+    def __call__(self, func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with self._copy():
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self._copy():
+                return func(*args, **kwargs)
+        return wrapper
+
+
+def request_context(properties: Optional[Dict[str, Any]] = None, workflow_name: Optional[str] = None,
+                    attributes: Optional[Dict[str, Any]] = None) -> RequestContext:
+    """
+    Scope Monocle state to a request, usable as a context manager or a decorator.
+
+    @param properties: Session properties, added to every span as session.<key> attributes
+    @param workflow_name: Overrides the workflow name of the spans started in the scope
+    @param attributes: Other context values, read with get_attribute, eg. data.input or embedding_model
+    @return: The RequestContext scope
+    """
+    return RequestContext(properties=properties, workflow_name=workflow_name, attributes=attributes)
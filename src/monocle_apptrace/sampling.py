@@ -0,0 +1,135 @@
+"""
+Head sampling per workflow.
+
+The MonocleSampler decides at the start of a trace whether it is recorded, at the sampling rate of
+the workflow the trace belongs to: the workflow_name of setup_monocle_telemetry, or the one set by
+request_context for the request. Rates can be overridden per span.type, which the Monocle wrappers
+set when they start a span: a span with an override is recorded only if its parent is and the
+trace id falls within the override rate, so eg. retrieval spans can be kept for 10% of the traces.
+
+The decision compares the trace id with the rate the same way as TraceIdRatioBased, so all the
+processes of a distributed trace configured with the same rates make the same decision. Spans
+of a trace that is not recorded are skipped by the wrappers without any extraction.
+
+The rates are read from the arguments of setup_monocle_telemetry, or the environment:
+    MONOCLE_SAMPLING_RATE=0.1
+    MONOCLE_WORKFLOW_SAMPLING_RATES=billing_bot=0.5,chat_bot=0.01
+    MONOCLE_SPAN_TYPE_SAMPLING_RATES=retrieval=0.1
+"""
+import logging
+import os
+from typing import Dict, Optional, Sequence
+from opentelemetry.context import Context, get_value
+from opentelemetry.sdk.trace.sampling import Decision, Sampler, SamplingResult, TraceIdRatioBased
+from opentelemetry.trace import Link, SpanKind, get_current_span
+from opentelemetry.trace.span import TraceState
+from opentelemetry.util.types import Attributes
+from monocle_apptrace.request_context import WORKFLOW_NAME_KEY
+
+logger = logging.getLogger(__name__)
+
+SAMPLING_RATE_ENV = "MONOCLE_SAMPLING_RATE"
+WORKFLOW_SAMPLING_RATES_ENV = "MONOCLE_WORKFLOW_SAMPLING_RATES"
+SPAN_TYPE_SAMPLING_RATES_ENV = "MONOCLE_SPAN_TYPE_SAMPLING_RATES"
+SPAN_TYPE_KEY = "span.type"
+
+
+def _to_rate(value) -> float:
+    return min(max(float(value), 0.0), 1.0)
+
+
+def parse_sampling_rates(value: Optional[str]) -> Dict[str, float]:
+    """
+    Parses name=rate pairs separated by commas, eg. "billing_bot=0.5,chat_bot=0.01".
+
+    @param value: The pairs, eg. from an environment variable
+    @return: The rates by name, invalid pairs are logged and skipped
+    """
+    rates = {}
+    for pair in (value or "").split(","):
+        if not pair.strip():
+            continue
+        name, _, rate = pair.partition("=")
+        try:
+            rates[name.strip()] = _to_rate(rate)
+        except ValueError:
+            logger.warning(f"Invalid sampling rate {pair}, expecting name=rate")
+    return rates
+
+
+class MonocleSampler(Sampler):
+    """Samples traces by the rate of their workflow, with optional overrides per span.type."""
+
+    def __init__(self, rate: float = 1.0, workflow_rates: Optional[Dict[str, float]] = None,
+                 span_type_rates: Optional[Dict[str, float]] = None):
+        """
+        @param rate: The sampling rate of the workflows without their own rate
+        @param workflow_rates: Sampling rates by workflow name
+        @param span_type_rates: Sampling rates by span.type, applied to the spans of a recorded trace too
+        """
+        self.rate = _to_rate(rate)
+        self.workflow_rates = {name: _to_rate(rate) for name, rate in (workflow_rates or {}).items()}
+        self.span_type_rates = {name: _to_rate(rate) for name, rate in (span_type_rates or {}).items()}
+        self._bounds = {}
+        for rate in [self.rate, *self.workflow_rates.values(), *self.span_type_rates.values()]:
+            self._bounds[rate] = TraceIdRatioBased.get_bound_for_rate(rate)
+
+    def _is_sampled(self, trace_id: int, rate: float) -> bool:
+        return trace_id & TraceIdRatioBased.TRACE_ID_LIMIT < self._bounds[rate]
+
+    def should_sample(self, parent_context: Optional[Context], trace_id: int, name: str,
+                      kind: Optional[SpanKind] = None, attributes: Attributes = None,
+                      links: Optional[Sequence[Link]] = None,
+                      trace_state: Optional[TraceState] = None) -> SamplingResult:
+        parent_span_context = get_current_span(parent_context).get_span_context()
+        span_type_rate = self.span_type_rates.get(attributes.get(SPAN_TYPE_KEY)) \
+            if attributes and self.span_type_rates else None
+        if parent_span_context.is_valid:
+            # Spans of a trace follow its decision, unless their span.type has its own rate
+            sampled = parent_span_context.trace_flags.sampled and \
+                      (span_type_rate is None or self._is_sampled(trace_id, span_type_rate))
+            trace_state = parent_span_context.trace_state
+        else:
+            if span_type_rate is None:
+                workflow_name = get_value(WORKFLOW_NAME_KEY, parent_context)
+                rate = self.workflow_rates.get(workflow_name, self.rate) if workflow_name else self.rate
+            else:
+                rate = span_type_rate
+            sampled = self._is_sampled(trace_id, rate)
+        if sampled:
+            return SamplingResult(Decision.RECORD_AND_SAMPLE, attributes, trace_state)
+        return SamplingResult(Decision.DROP, None, trace_state)
+
+    def get_description(self) -> str:
+        return f"MonocleSampler{{rate={self.rate}, workflows={self.workflow_rates}, span_types={self.span_type_rates}}}"
+
+
+def get_monocle_sampler(workflow_name: str, sampling_rate: Optional[float] = None,
+                        workflow_sampling_rates: Optional[Dict[str, float]] = None,
+                        span_type_sampling_rates: Optional[Dict[str, float]] = None) -> Optional[MonocleSampler]:
+    """
+    Builds the sampler from the arguments of setup_monocle_telemetry, falling back on the environment.
+
+    @param workflow_name: The workflow of setup_monocle_telemetry, sampled at sampling_rate
+    @param sampling_rate: The sampling rate of the workflow, and of the other workflows without their own rate
+    @param workflow_sampling_rates: Sampling rates by workflow name, eg. for workflows set with request_context
+    @param span_type_sampling_rates: Sampling rates by span.type
+    @return: The sampler, or None if no sampling is configured
+    """
+    if sampling_rate is None and os.environ.get(SAMPLING_RATE_ENV):
+        try:
+            sampling_rate = _to_rate(os.environ[SAMPLING_RATE_ENV])
+        except ValueError:
+            logger.warning(f"Invalid {SAMPLING_RATE_ENV} {os.environ[SAMPLING_RATE_ENV]}, sampling is not configured")
+    if workflow_sampling_rates is None:
+        workflow_sampling_rates = parse_sampling_rates(os.environ.get(WORKFLOW_SAMPLING_RATES_ENV))
+    if span_type_sampling_rates is None:
+        span_type_sampling_rates = parse_sampling_rates(os.environ.get(SPAN_TYPE_SAMPLING_RATES_ENV))
+    if sampling_rate is None and not workflow_sampling_rates and not span_type_sampling_rates:
+        return None
+    workflow_rates = dict(workflow_sampling_rates)
+    rate = 1.0
+    if sampling_rate is not None:
+        rate = sampling_rate
+        workflow_rates.setdefault(workflow_name, sampling_rate)
+    return MonocleSampler(rate=rate, workflow_rates=workflow_rates, span_type_rates=span_type_sampling_rates)
@@ -0,0 +1,277 @@
+"""
+Streaming inference calls.
+
+A stream wrapper hands the application a proxy of the returned iterator or async iterator.
+The proxy passes every chunk through as soon as it arrives, records the stream timings and
+ends the inference span once the stream is exhausted, fails or is closed. The text of the chunks
+is collected for the data.output event within the payload budget of the span type, so only the
+head and the tail the event keeps are buffered. The last chunk is kept for the response
+attributes, token usage is reported on the final chunk.
+
+While the stream produces a chunk, its span is the current span and the context records the model
+instance streaming. A model without native streaming falls back to its own invoke inside stream,
+the inference wrappers skip the calls of that instance so the call is traced once.
+"""
+import logging
+import time
+from typing import Any, Callable, Dict, Optional
+from opentelemetry.context import Context, attach, detach, get_value, set_value
+from opentelemetry.trace import Span, Status, StatusCode, get_current_span, set_span_in_context
+from wrapt import ObjectProxy
+from monocle_apptrace.payload import PayloadBuffer
+
+logger = logging.getLogger(__name__)
+
+TIME_TO_FIRST_TOKEN_KEY = "stream.time_to_first_token_ms"
+CHUNK_COUNT_KEY = "stream.chunk_count"
+DURATION_KEY = "stream.duration_ms"
+INTER_CHUNK_LATENCY_MEAN_KEY = "stream.inter_chunk_latency.mean_ms"
+INTER_CHUNK_LATENCY_P50_KEY = "stream.inter_chunk_latency.p50_ms"
+INTER_CHUNK_LATENCY_P95_KEY = "stream.inter_chunk_latency.p95_ms"
+INTER_CHUNK_LATENCY_MAX_KEY = "stream.inter_chunk_latency.max_ms"
+# The instance and span of the stream in progress
+STREAM_KEY = "monocle.stream"
+
+
+def get_stream_context(span: Span, instance=None) -> Context:
+    """The context producing the chunks, with the stream span current."""
+    return set_value(STREAM_KEY, (instance, span), set_span_in_context(span))
+
+
+def is_streaming(instance) -> bool:
+    """Whether the call is made by the stream of the instance, directly under its span."""
+    stream = get_value(STREAM_KEY)
+    return stream is not None and stream[0] is instance and get_current_span() is stream[1]
+
+
+class StreamMetrics:
+    """Timings of a stream, measured from the start of the call in milliseconds."""
+
+    __slots__ = ("start", "last_chunk", "first_chunk_latency", "chunk_count", "gaps")
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.last_chunk = None
+        self.first_chunk_latency = None
+        self.chunk_count = 0
+        self.gaps = []
+
+    def on_chunk(self):
+        now = time.perf_counter()
+        if self.last_chunk is None:
+            self.first_chunk_latency = (now - self.start) * 1000
+        else:
+            self.gaps.append((now - self.last_chunk) * 1000)
+        self.last_chunk = now
+        self.chunk_count += 1
+
+    def get_attributes(self) -> Dict[str, Any]:
+        attributes = {
+            CHUNK_COUNT_KEY: self.chunk_count,
+            DURATION_KEY: (time.perf_counter() - self.start) * 1000
+        }
+        if self.first_chunk_latency is not None:
+            attributes[TIME_TO_FIRST_TOKEN_KEY] = self.first_chunk_latency
+        if self.gaps:
+            gaps = sorted(self.gaps)
+            attributes[INTER_CHUNK_LATENCY_MEAN_KEY] = sum(gaps) / len(gaps)
+            attributes[INTER_CHUNK_LATENCY_P50_KEY] = gaps[len(gaps) // 2]
+            attributes[INTER_CHUNK_LATENCY_P95_KEY] = gaps[min(len(gaps) - 1, int(len(gaps) * 0.95))]
+            attributes[INTER_CHUNK_LATENCY_MAX_KEY] = gaps[-1]
+        return attributes
+
+
+def get_chunk_text(chunk) -> Optional[str]:
+    """The text a chunk adds to the output: a string, a langchain message chunk, or a llama index response delta."""
+    if isinstance(chunk, str):
+        return chunk
+    content = getattr(chunk, "content", None)
+    if isinstance(content, str):
+        return content
+    delta = getattr(chunk, "delta", None)
+    return delta if isinstance(delta, str) else None
+
+
+class StreamOutput:
+    """The text of the chunks of a stream, within the payload budget of its data.output event."""
+
+    __slots__ = ("buffer", "has_text")
+
+    def __init__(self, buffer: PayloadBuffer):
+        self.buffer = buffer
+        self.has_text = False
+
+    def on_chunk(self, chunk):
+        text = get_chunk_text(chunk)
+        if text is not None:
+            self.has_text = True
+            self.buffer.add(text)
+
+    def get_text(self):
+        """The text collected, None if no chunk had text."""
+        return self.buffer.get_text() if self.has_text else None
+
+
+def finish_stream_span(span: Span, metrics: StreamMetrics, response, on_finish: Optional[Callable],
+                       exception: Optional[BaseException] = None, output: Optional[StreamOutput] = None):
+    """
+    Sets the stream attributes on the span and ends it.
+
+    @param span: The inference span of the stream
+    @param metrics: The timings of the stream
+    @param response: The last chunk, or None if the stream produced nothing
+    @param on_finish: Called as on_finish(span, response, text) to set the response attributes, with the
+        text of the chunks or None
+    @param exception: The exception that ended the stream, if any
+    @param output: The text of the chunks
+    """
+    try:
+        span.set_attributes(metrics.get_attributes())
+        if exception is not None:
+            span.record_exception(exception)
+            span.set_status(Status(StatusCode.ERROR, f"{type(exception).__name__}: {exception}"))
+        elif on_finish is not None and response is not None:
+            on_finish(span, response, output.get_text() if output is not None else None)
+    except Exception:
+        logger.exception("exception in finishing the stream span")
+    finally:
+        span.end()
+
+
+class TracedStream(ObjectProxy):
+    """Proxy of the iterator returned by a streaming call, ends the span when the stream ends."""
+
+    def __init__(self, wrapped, span: Span, on_finish: Optional[Callable] = None, metrics: StreamMetrics = None,
+                 output: Optional[StreamOutput] = None, instance=None):
+        super().__init__(wrapped)
+        self._self_span = span
+        self._self_context = get_stream_context(span, instance)
+        self._self_on_finish = on_finish
+        self._self_metrics = metrics or StreamMetrics()
+        self._self_output = output
+        self._self_response = None
+        self._self_finished = False
+
+    def _finish(self, exception: Optional[BaseException] = None):
+        if self._self_finished:
+            return
+        self._self_finished = True
+        finish_stream_span(self._self_span, self._self_metrics, self._self_response, self._self_on_finish, exception,
+                           self._self_output)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        # Spans started by the stream producer are children of the inference span
+        token = attach(self._self_context)
+        try:
+            chunk = next(self.__wrapped__)
+        except StopIteration:
+            self._finish()
+            raise
+        except Exception as e:
+            self._finish(e)
+            raise
+        finally:
+            detach(token)
+        self._self_metrics.on_chunk()
+        if self._self_output is not None:
+            self._self_output.on_chunk(chunk)
+        self._self_response = chunk
+        return chunk
+
+    def close(self):
+        try:
+            close = getattr(self.__wrapped__, "close", None)
+            if close is not None:
+                close()
+        finally:
+            self._finish()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def __del__(self):
+        # The application stopped reading without closing the stream
+        self._finish()
+
+
+class AsyncTracedStream(ObjectProxy):
+    """Proxy of the async iterator returned by a streaming call, ends the span when the stream ends."""
+
+    def __init__(self, wrapped, span: Span, on_finish: Optional[Callable] = None, metrics: StreamMetrics = None,
+                 output: Optional[StreamOutput] = None, instance=None):
+        super().__init__(wrapped)
+        self._self_span = span
+        self._self_context = get_stream_context(span, instance)
+        self._self_on_finish = on_finish
+        self._self_metrics = metrics or StreamMetrics()
+        self._self_output = output
+        self._self_response = None
+        self._self_finished = False
+
+    def _finish(self, exception: Optional[BaseException] = None):
+        if self._self_finished:
+            return
+        self._self_finished = True
+        finish_stream_span(self._self_span, self._self_metrics, self._self_response, self._self_on_finish, exception,
+                           self._self_output)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        token = attach(self._self_context)
+        try:
+            chunk = await self.__wrapped__.__anext__()
+        except StopAsyncIteration:
+            self._finish()
+            raise
+        except Exception as e:
+            self._finish(e)
+            raise
+        finally:
+            detach(token)
+        self._self_metrics.on_chunk()
+        if self._self_output is not None:
+            self._self_output.on_chunk(chunk)
+        self._self_response = chunk
+        return chunk
+
+    async def aclose(self):
+        try:
+            aclose = getattr(self.__wrapped__, "aclose", None)
+            if aclose is not None:
+                await aclose()
+        finally:
+            self._finish()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.aclose()
+        return False
+
+    def __del__(self):
+        self._finish()
+
+
+def trace_streaming_callback(callback: Callable, metrics: StreamMetrics) -> Callable:
+    """
+    Wraps a streaming callback, eg. the streaming_callback of haystack generators, to record the chunk timings.
+
+    @param callback: The callback of the application, called with every chunk
+    @param metrics: Records the chunk timings
+    @return: The wrapped callback
+    """
+    def traced_callback(chunk, *args, **kwargs):
+        metrics.on_chunk()
+        return callback(chunk, *args, **kwargs)
+
+    return traced_callback
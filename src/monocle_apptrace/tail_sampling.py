@@ -0,0 +1,210 @@
+"""
+Tail based sampling.
+
+The TailSamplingSpanProcessor buffers the ended spans of every trace until the local root span
+of the trace ends. It then keeps the whole trace if any of its spans failed, the root span took
+longer than latency_threshold_millis, the trace used more than token_threshold tokens (from the
+metadata events of the inference spans) or it has a span with one of keep_span_types. The other
+traces are kept at sample_rate, decided by the trace id so every process of a distributed trace
+makes the same decision.
+
+Spans ending after the decision follow it. Traces whose root never ends in this process, or that
+are buffered longer than max_trace_age_millis or beyond max_buffered_spans, are decided on the
+spans buffered so far. A background worker waits for the oldest buffered trace to reach
+max_trace_age_millis, so an orphaned trace is decided even when no other span ends.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterable, List, Optional, Union
+from opentelemetry.context import Context
+from opentelemetry.sdk.trace import ReadableSpan, Span, SpanProcessor
+from opentelemetry.sdk.trace.sampling import TraceIdRatioBased
+from opentelemetry.trace import StatusCode
+from monocle_apptrace.aggregation import get_token_counts
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SAMPLE_RATE = 0.05
+DEFAULT_LATENCY_THRESHOLD_MILLIS = 10000
+DEFAULT_TOKEN_THRESHOLD = 10000
+DEFAULT_MAX_BUFFERED_SPANS = 100000
+DEFAULT_MAX_TRACE_AGE_MILLIS = 60000
+DEFAULT_FLUSH_TIMEOUT_MILLIS = 30000
+MAX_DECIDED_TRACES = 4096
+
+
+class _TraceBuffer:
+    """The ended spans of a trace, with what the sampling decision needs."""
+
+    __slots__ = ("created", "spans", "interesting")
+
+    def __init__(self):
+        self.created = time.monotonic()
+        self.spans = []
+        self.interesting = False
+
+
+class TailSamplingSpanProcessor(SpanProcessor):
+    """
+    Span processor that passes only the sampled traces to the wrapped span processors,
+    deciding once the whole trace ended.
+    """
+
+    def __init__(self, span_processors: Union[SpanProcessor, List[SpanProcessor]],
+                 sample_rate: float = DEFAULT_SAMPLE_RATE,
+                 latency_threshold_millis: Optional[float] = DEFAULT_LATENCY_THRESHOLD_MILLIS,
+                 token_threshold: Optional[int] = DEFAULT_TOKEN_THRESHOLD,
+                 keep_span_types: Iterable[str] = (),
+                 keep_errors: bool = True,
+                 max_buffered_spans: int = DEFAULT_MAX_BUFFERED_SPANS,
+                 max_trace_age_millis: int = DEFAULT_MAX_TRACE_AGE_MILLIS):
+        """
+        @param span_processors: The span processors the sampled spans are passed to
+        @param sample_rate: The share of the other traces that is kept
+        @param latency_threshold_millis: Traces whose root span took longer are kept, None to disable
+        @param token_threshold: Traces that used more tokens in total are kept, None to disable
+        @param keep_span_types: Traces with a span of one of these span.type are kept, eg. "retrieval"
+        @param keep_errors: Traces with a span with an error status are kept
+        @param max_buffered_spans: When more spans are buffered, the oldest traces are decided early
+        @param max_trace_age_millis: Traces buffered longer are decided early, eg. when their root
+            span is in another process
+        """
+        if isinstance(span_processors, SpanProcessor):
+            span_processors = [span_processors]
+        self.span_processors = list(span_processors)
+        self.sample_rate = min(max(sample_rate, 0.0), 1.0)
+        self._trace_id_bound = TraceIdRatioBased.get_bound_for_rate(self.sample_rate)
+        self.latency_threshold = latency_threshold_millis * 1e6 if latency_threshold_millis is not None else None
+        self.token_threshold = token_threshold
+        self.keep_span_types = frozenset(keep_span_types)
+        self.keep_errors = keep_errors
+        self.max_buffered_spans = max_buffered_spans
+        self.max_trace_age = max_trace_age_millis / 1000
+        self.kept_traces = 0
+        self.dropped_traces = 0
+        self.evicted_traces = 0
+        self._traces: "OrderedDict[int, _TraceBuffer]" = OrderedDict()
+        self._tokens = {}
+        self._buffered_spans = 0
+        self._decided: "OrderedDict[int, bool]" = OrderedDict()
+        self._lock = threading.Condition()
+        self._shutdown = False
+        self._worker = threading.Thread(name="MonocleTailSamplingEviction", target=self._run, daemon=True)
+        self._worker.start()
+
+    def on_start(self, span: Span, parent_context: Optional[Context] = None) -> None:
+        for processor in self.span_processors:
+            processor.on_start(span, parent_context=parent_context)
+
+    def _is_interesting(self, span: ReadableSpan) -> bool:
+        """Whether the span alone makes its trace worth keeping, also counts its tokens."""
+        if self.keep_errors and span.status is not None and span.status.status_code == StatusCode.ERROR:
+            return True
+        if self.keep_span_types and span.attributes and span.attributes.get("span.type") in self.keep_span_types:
+            return True
+        if self.token_threshold is not None:
+            token_counts = get_token_counts(span)
+            if token_counts:
+                trace_id = span.get_span_context().trace_id
+                total = token_counts.get("total_tokens") or \
+                        token_counts.get("prompt_tokens", 0) + token_counts.get("completion_tokens", 0)
+                self._tokens[trace_id] = self._tokens.get(trace_id, 0) + total
+                if self._tokens[trace_id] > self.token_threshold:
+                    return True
+        return False
+
+    def _is_sampled(self, trace_id: int) -> bool:
+        return trace_id & TraceIdRatioBased.TRACE_ID_LIMIT < self._trace_id_bound
+
+    def on_end(self, span: ReadableSpan) -> None:
+        trace_id = span.get_span_context().trace_id
+        parent = span.parent
+        ready = []
+        with self._lock:
+            decision = self._decided.get(trace_id)
+            if decision is not None:
+                # The trace was decided before this span ended
+                if decision:
+                    ready.append(span)
+            else:
+                buffer = self._traces.get(trace_id)
+                if buffer is None:
+                    buffer = self._traces[trace_id] = _TraceBuffer()
+                    if len(self._traces) == 1:
+                        # The worker waits for the oldest trace to expire
+                        self._lock.notify()
+                buffer.spans.append(span)
+                self._buffered_spans += 1
+                if not buffer.interesting and self._is_interesting(span):
+                    buffer.interesting = True
+                if parent is None or parent.is_remote:
+                    slow = self.latency_threshold is not None and span.end_time - span.start_time > self.latency_threshold
+                    ready.extend(self._decide(trace_id, buffer.interesting or slow))
+            ready.extend(self._evict())
+        self._forward(ready)
+
+    def _decide(self, trace_id: int, interesting: bool) -> List[ReadableSpan]:
+        """Removes the trace from the buffer, returns its spans if it is kept."""
+        buffer = self._traces.pop(trace_id)
+        self._buffered_spans -= len(buffer.spans)
+        self._tokens.pop(trace_id, None)
+        keep = interesting or self._is_sampled(trace_id)
+        self._decided[trace_id] = keep
+        if len(self._decided) > MAX_DECIDED_TRACES:
+            self._decided.popitem(last=False)
+        if keep:
+            self.kept_traces += 1
+            return buffer.spans
+        self.dropped_traces += 1
+        return []
+
+    def _evict(self, force: bool = False) -> List[ReadableSpan]:
+        """Decides the oldest traces while over the buffer bounds."""
+        ready = []
+        now = time.monotonic()
+        while self._traces:
+            trace_id, buffer = next(iter(self._traces.items()))
+            if not force and self._buffered_spans <= self.max_buffered_spans and now - buffer.created <= self.max_trace_age:
+                break
+            self.evicted_traces += 1
+            ready.extend(self._decide(trace_id, buffer.interesting))
+        return ready
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._shutdown:
+                    if self._traces:
+                        timeout = next(iter(self._traces.values())).created + self.max_trace_age - time.monotonic()
+                        if timeout < 0:
+                            break
+                    else:
+                        timeout = None
+                    self._lock.wait(timeout)
+                if self._shutdown:
+                    return
+                ready = self._evict()
+            self._forward(ready)
+
+    def _forward(self, spans: List[ReadableSpan]) -> None:
+        for span in spans:
+            for processor in self.span_processors:
+                processor.on_end(span)
+
+    def force_flush(self, timeout_millis: int = DEFAULT_FLUSH_TIMEOUT_MILLIS) -> bool:
+        with self._lock:
+            ready = self._evict(force=True)
+        self._forward(ready)
+        return all([processor.force_flush(timeout_millis) for processor in self.span_processors])
+
+    def shutdown(self) -> None:
+        with self._lock:
+            self._shutdown = True
+            self._lock.notify()
+            ready = self._evict(force=True)
+        self._worker.join(DEFAULT_FLUSH_TIMEOUT_MILLIS / 1000)
+        self._forward(ready)
+        for processor in self.span_processors:
+            processor.shutdown()
@@ -2,17 +2,18 @@ import logging
 import json
 from importlib import import_module
 import os
-from opentelemetry.trace import NonRecordingSpan,Span
+from opentelemetry.trace import Span, SpanContext
 from opentelemetry.trace.propagation import _SPAN_KEY
 from opentelemetry.context import (attach, detach,get_current)
 from opentelemetry.context import attach, set_value, get_value
 from monocle_apptrace.constants import service_name_map, service_type_map
+from monocle_apptrace.accessor import compile_output_processor
+from monocle_apptrace.batch import get_batch_scope
+from monocle_apptrace.request_context import EMBEDDING_MODEL_KEY, WORKFLOW_NAME_KEY
 from json.decoder import JSONDecodeError
 
 logger = logging.getLogger(__name__)
 
-embedding_model_context = {}
-
 def set_span_attribute(span, name, value):
     if value is not None:
         if value != "":
@@ -40,20 +41,51 @@ def dont_throw(func):
 def with_tracer_wrapper(func):
     """Helper for providing tracer for wrapper functions."""
 
+    def factory(tracer, to_wrap):
+        def call(wrapped, instance, args, kwargs):
+            return func(tracer, to_wrap, wrapped, instance, args, kwargs)
+        return call
+
+    return with_specialized_tracer_wrapper(factory)
+
+def with_specialized_tracer_wrapper(factory):
+    """
+    Helper for providing tracer for wrappers that are specialized per wrapped method.
+
+    @param factory: Called once per wrapped method at instrument time as factory(tracer, to_wrap),
+        returns the function called as function(wrapped, instance, args, kwargs) on every invocation
+    @return: The wrapper function taking the tracer and to_wrap entry
+    """
+
     def _with_tracer(tracer, to_wrap):
+        call = factory(tracer, to_wrap)
+        skip_span = bool(to_wrap.get("skip_span"))
+
         def wrapper(wrapped, instance, args, kwargs):
             token = None
+            sampled_out = False
             try:
                 _parent_span_context = get_current()
                 if _parent_span_context is not None and _parent_span_context.get(_SPAN_KEY, None):
                     parent_span: Span = _parent_span_context.get(_SPAN_KEY, None)
-                    is_invalid_span = isinstance(parent_span, NonRecordingSpan)
-                    if is_invalid_span:
+                    parent_span_context = parent_span.get_span_context()
+                    if not parent_span_context.is_valid:
                         token = attach(context={})
+                    else:
+                        sampled_out = is_sampled_out(parent_span_context) and not skip_span
             except Exception as e:
                 logger.error("Exception in attaching parent context: %s", e)
 
-            val = func(tracer, to_wrap, wrapped, instance, args, kwargs)
+            if sampled_out:
+                # The whole trace is sampled out, don't create a span or extract anything
+                return wrapped(*args, **kwargs)
+
+            batch = get_batch_scope()
+            if batch is not None:
+                # An item of a batch call, traced only if the item is sampled
+                val = batch.call_item(call, wrapped, instance, args, kwargs)
+            else:
+                val = call(wrapped, instance, args, kwargs)
             # Detach the token if it was set
             if token:
                 try:
@@ -65,6 +97,10 @@ def with_tracer_wrapper(func):
 
     return _with_tracer
 
+def is_sampled_out(span_context: SpanContext) -> bool:
+    """Check if a valid span context belongs to a trace that is not sampled."""
+    return span_context.is_valid and not span_context.trace_flags.sampled
+
 def resolve_from_alias(my_map, alias):
     """Find a alias that is not none from list of aliases"""
 
@@ -90,6 +126,8 @@ def load_output_processor(wrapper_method, attributes_config_base_path):
             with open(absolute_file_path, encoding='UTF-8') as op_file:
                 wrapper_method["output_processor"] = json.load(op_file)
                 logger.info('Output processor loaded successfully.')
+            if compile_output_processor(wrapper_method["output_processor"]) > 0:
+                logger.error(f"Error: Invalid accessor in the file {absolute_file_path}.")
         except FileNotFoundError:
             logger.error(f"Error: File not found at {absolute_file_path}.")
         except JSONDecodeError:
@@ -138,46 +176,63 @@ def get_wrapper_method(package_name: str, method_name: str):
     wrapper_module = import_module("monocle_apptrace." + package_name)
     return getattr(wrapper_module, method_name)
 
-def set_app_hosting_identifier_attribute(span, span_index):
-    return_value = 0
+def get_app_hosting_identifier():
+    """
+    Identify the infra service the app is hosted on from the environment.
+
+    @return: A (type, name) tuple for the app hosting entity, or None if the service is not identified
+    """
+    app_hosting = None
     # Search env to indentify the infra service type, if found check env for service name if possible
     for type_env, type_name in service_type_map.items():
         if type_env in os.environ:
-            return_value = 1
-            span.set_attribute(f"entity.{span_index}.type", f"app_hosting.{type_name}")
             entity_name_env = service_name_map.get(type_name, "unknown")
-            span.set_attribute(f"entity.{span_index}.name", os.environ.get(entity_name_env, "generic"))
-    return return_value
+            app_hosting = (f"app_hosting.{type_name}", os.environ.get(entity_name_env, "generic"))
+    return app_hosting
+
+def set_app_hosting_identifier_attribute(span, span_index):
+    app_hosting = get_app_hosting_identifier()
+    if app_hosting is None:
+        return 0
+    span.set_attribute(f"entity.{span_index}.type", app_hosting[0])
+    span.set_attribute(f"entity.{span_index}.name", app_hosting[1])
+    return 1
 
 def set_embedding_model(model_name: str):
     """
-    Sets the embedding model in the global context.
+    Sets the embedding model in the current context.
+    Prefer request_context(attributes={EMBEDDING_MODEL_KEY: model_name}), which detaches it at the end of the request.
 
     @param model_name: The name of the embedding model to set
+    @return: The context token, pass it to opentelemetry.context.detach to remove the value
     """
-    embedding_model_context['embedding_model'] = model_name
+    return attach(set_value(EMBEDDING_MODEL_KEY, model_name))
 
 def get_embedding_model() -> str:
     """
-    Retrieves the embedding model from the global context.
+    Retrieves the embedding model from the current context.
 
     @return: The name of the embedding model, or 'unknown' if not set
     """
-    return embedding_model_context.get('embedding_model', 'unknown')
+    return get_value(EMBEDDING_MODEL_KEY) or 'unknown'
 
 def set_attribute(key: str, value: str):
     """
-    Set a value in the global context for a given key.
+    Set a value in the current context for a given key.
+    Prefer request_context(attributes={key: value}), which detaches it at the end of the request.
 
     Args:
         key: The key for the context value to set.
         value: The value to set for the given key.
+
+    Returns:
+        The context token, pass it to opentelemetry.context.detach to remove the value.
     """
-    attach(set_value(key, value))
+    return attach(set_value(key, value))
 
 def get_attribute(key: str) -> str:
     """
-    Retrieve a value from the global context for a given key.
+    Retrieve a value from the current context for a given key.
 
     Args:
         key: The key for the context value to retrieve.
@@ -217,7 +272,7 @@ def get_nested_value(data, keys):
 
 def get_workflow_name(span: Span) -> str:
     try:
-        return get_value("workflow_name") or span.resource.attributes.get("service.name")
+        return get_value(WORKFLOW_NAME_KEY) or span.resource.attributes.get("service.name")
     except Exception as e:
         logger.exception(f"Error getting workflow name: {e}")
         return None
@@ -3,13 +3,22 @@ import logging
 import os
 import inspect
 from importlib.metadata import version
-from urllib.parse import urlparse
-from opentelemetry.trace import Tracer
+from opentelemetry.context import attach, detach
+from opentelemetry.trace import Tracer, use_span
 from opentelemetry.sdk.trace import Span
-from monocle_apptrace.utils import resolve_from_alias, with_tracer_wrapper, get_embedding_model, get_attribute, get_workflow_name, set_embedding_model, set_app_hosting_identifier_attribute
-from monocle_apptrace.utils import set_attribute, get_vectorstore_deployment
+from monocle_apptrace.utils import resolve_from_alias, with_tracer_wrapper, with_specialized_tracer_wrapper, get_embedding_model, get_attribute, get_workflow_name, get_app_hosting_identifier
+from monocle_apptrace.utils import get_vectorstore_deployment
 from monocle_apptrace.utils import get_fully_qualified_class_name, get_nested_value
 from monocle_apptrace.message_processing import extract_messages, extract_assistant_message
+from monocle_apptrace.accessor import get_accessor, static_attribute_cache, STATIC_ATTRIBUTE_KEY
+from monocle_apptrace.enrichment import submit_enrichment
+from monocle_apptrace.provider import get_provider_name
+from monocle_apptrace.request_context import RequestContext, SESSION_PROPERTIES_KEY, EMBEDDING_MODEL_KEY
+from monocle_apptrace.batch import BatchScope, get_item_sample_rate
+from monocle_apptrace.streaming import (StreamMetrics, StreamOutput, TracedStream, AsyncTracedStream,
+                                        get_stream_context, is_streaming, trace_streaming_callback)
+from monocle_apptrace.payload import PayloadBuffer, capture_payload, capture_text, get_payload_policy
+from contextlib import nullcontext
 from functools import wraps
 
 logger = logging.getLogger(__name__)
@@ -20,14 +29,17 @@ PROMPT_INPUT_KEY = "data.input"
 PROMPT_OUTPUT_KEY = "data.output"
 QUERY = "input"
 RESPONSE = "response"
-SESSION_PROPERTIES_KEY = "session"
 INFRA_SERVICE_KEY = "infra_service_name"
+WORKFLOW_SPAN_TYPE = "workflow"
 
 TYPE = "type"
 PROVIDER = "provider_name"
 EMBEDDING_MODEL = "embedding_model"
 VECTOR_STORE = 'vector_store'
 META_DATA = 'metadata'
+HAYSTACK_PIPELINE_PACKAGE = "haystack.core.pipeline.pipeline"
+SKIPPED_CLASS_NAMES = frozenset({"AgentExecutor"})
+MAX_CACHED_SPAN_NAMES = 1024
 
 WORKFLOW_TYPE_MAP = {
     "llama_index": "workflow.llamaindex",
@@ -36,6 +48,69 @@ WORKFLOW_TYPE_MAP = {
 }
 
 
+def get_workflow_type(package_name: str) -> str:
+    workflow_type = "workflow.generic"
+    for (package, package_workflow_type) in WORKFLOW_TYPE_MAP.items():
+        if package_name is not None and package in package_name:
+            workflow_type = package_workflow_type
+    return workflow_type
+
+
+class RootSpanAttributes:
+    """
+    Attributes that are the same for every root span of the process: the monocle_apptrace
+    version, the app hosting entity and the workflow type of each wrapped package.
+    They are resolved on first use or by setup_monocle_telemetry instead of for every root span,
+    call refresh_root_span_attributes() after changing the environment they are read from.
+    """
+
+    def __init__(self):
+        self._resolved = False
+        self.sdk_version = None
+        self.app_hosting = None
+        self._entity_attributes = {}
+
+    def refresh(self):
+        try:
+            self.sdk_version = version("monocle_apptrace")
+        except Exception:
+            self.sdk_version = None
+            logger.warning("Exception finding monocle-apptrace version.")
+        self.app_hosting = get_app_hosting_identifier()
+        self._entity_attributes = {}
+        self._resolved = True
+
+    def get_sdk_version(self):
+        if not self._resolved:
+            self.refresh()
+        return self.sdk_version
+
+    def get_entity_attributes(self, package_name: str, span_index: int):
+        """Returns the workflow type and app hosting entity attributes, and the number of entities they describe."""
+        if not self._resolved:
+            self.refresh()
+        key = (package_name, span_index)
+        entity_attributes = self._entity_attributes.get(key)
+        if entity_attributes is None:
+            attributes = {f"entity.{span_index}.type": get_workflow_type(package_name)}
+            entity_count = 1
+            if self.app_hosting is not None:
+                attributes[f"entity.{span_index + 1}.type"] = self.app_hosting[0]
+                attributes[f"entity.{span_index + 1}.name"] = self.app_hosting[1]
+                entity_count += 1
+            entity_attributes = (attributes, entity_count)
+            self._entity_attributes[key] = entity_attributes
+        return entity_attributes
+
+
+root_span_attributes = RootSpanAttributes()
+
+
+def refresh_root_span_attributes():
+    """Resolve the process level root span attributes again, eg. after the hosting environment variables changed."""
+    root_span_attributes.refresh()
+
+
 def get_embedding_model_haystack(instance):
     try:
         if hasattr(instance, 'get_component'):
@@ -48,40 +123,107 @@ def get_embedding_model_haystack(instance):
 
     return None
 
-@with_tracer_wrapper
-def task_wrapper(tracer: Tracer, to_wrap, wrapped, instance, args, kwargs):
+class WrapperConfig:
+    """
+    Settings of a wrapped method resolved from its to_wrap entry once at instrument time,
+    so the wrappers don't look up config keys or match package names on every call.
+    """
+
+    def __init__(self, to_wrap, use_span_name_getter: bool = False):
+        package = to_wrap.get("package") or ""
+        self.to_wrap = to_wrap
+        self.span_name = to_wrap.get("span_name")
+        span_name_getter = to_wrap.get("span_name_getter")
+        self.span_name_getter = span_name_getter if use_span_name_getter and callable(span_name_getter) else None
+        self.skip_span = bool(to_wrap.get("skip_span"))
+        # The method takes a streaming_callback argument, eg. haystack generators
+        self.streaming_callback = bool(to_wrap.get("streaming_callback"))
+        # The span.type is set at span start too, so the sampler can apply its span type rates
+        output_processor = to_wrap.get("output_processor")
+        span_type = output_processor.get(TYPE) if isinstance(output_processor, dict) else None
+        self.span_type = span_type if isinstance(span_type, str) else None
+        self.start_attributes = {"span.type": self.span_type} if self.span_type else None
+        self.is_haystack_pipeline = HAYSTACK_PIPELINE_PACKAGE in package
+        self.context_input_handlers = tuple(handler for (handler_package, handler) in CONTEXT_INPUT_HANDLERS
+                                            if handler_package in package)
+        self.context_output_handlers = tuple(handler for (handler_package, handler) in CONTEXT_OUTPUT_HANDLERS
+                                             if handler_package in package)
+        self.prompt_output_handler = next((handler for (handler_package, handler) in PROMPT_OUTPUT_HANDLERS
+                                           if handler_package in package), get_prompt_output)
+        self._span_names = {}
+        # Whether the wrapped functions take a streaming_callback parameter, checked once per function
+        self._takes_streaming_callback = {}
+
+    def takes_streaming_callback(self, wrapped) -> bool:
+        function = getattr(wrapped, "__func__", wrapped)
+        takes_callback = self._takes_streaming_callback.get(function)
+        if takes_callback is None:
+            try:
+                takes_callback = "streaming_callback" in inspect.signature(function).parameters
+            except (TypeError, ValueError):
+                takes_callback = False
+            self._takes_streaming_callback[function] = takes_callback
+        return takes_callback
+
+    def get_span_name(self, instance) -> str:
+        if self.span_name_getter is not None:
+            return self.span_name_getter(instance)
+        instance_name = getattr(instance, "name", None)
+        if instance_name:
+            if not isinstance(instance_name, str):
+                return f"{self.span_name}.{instance_name.lower()}"
+            name = self._span_names.get(instance_name)
+            if name is None:
+                name = f"{self.span_name}.{instance_name.lower()}"
+                if len(self._span_names) < MAX_CACHED_SPAN_NAMES:
+                    self._span_names[instance_name] = name
+            return name
+        if self.span_name:
+            return self.span_name
+        return get_fully_qualified_class_name(instance)
+
+
+def get_haystack_pipeline_context(instance, args) -> RequestContext:
+    """Scopes the pipeline input and embedding model to the pipeline run, for the component spans."""
+    inputs = set()
+    workflow_input = get_workflow_input(args, inputs)
+    return RequestContext(attributes={
+        EMBEDDING_MODEL_KEY: get_embedding_model_haystack(instance),
+        DATA_INPUT_KEY: workflow_input
+    })
+
+
+@with_specialized_tracer_wrapper
+def task_wrapper(tracer: Tracer, to_wrap):
     """Instruments and calls every function defined in TO_WRAP."""
+    config = WrapperConfig(to_wrap)
+
+    if config.skip_span:
+        def create_client_wrapper(wrapped, instance, args, kwargs):
+            return_value = wrapped(*args, **kwargs)
+            botocore_processor(tracer, to_wrap, wrapped, instance, args, kwargs, return_value)
+            return return_value
+        return create_client_wrapper
+
+    def wrapper(wrapped, instance, args, kwargs):
+        # Some Langchain objects are wrapped elsewhere, so we ignore them here
+        if instance.__class__.__name__ in SKIPPED_CLASS_NAMES:
+            return wrapped(*args, **kwargs)
+
+        with tracer.start_as_current_span(config.get_span_name(instance), attributes=config.start_attributes) as span:
+            # Sampled out, skip all attribute and event extraction
+            if not span.is_recording():
+                return wrapped(*args, **kwargs)
+            request_scope = get_haystack_pipeline_context(instance, args) if config.is_haystack_pipeline else nullcontext()
+            with request_scope:
+                pre_task_processing(config, instance, args, span)
+                return_value = wrapped(*args, **kwargs)
+                enrich_span(span, process_span, to_wrap=to_wrap, instance=instance, args=args, kwargs=kwargs, return_value=return_value)
+                enrich_span(span, post_task_processing, config=config, return_value=return_value)
 
-    # Some Langchain objects are wrapped elsewhere, so we ignore them here
-    if instance.__class__.__name__ in ("AgentExecutor"):
-        return wrapped(*args, **kwargs)
-
-    if hasattr(instance, "name") and instance.name:
-        name = f"{to_wrap.get('span_name')}.{instance.name.lower()}"
-    elif to_wrap.get("span_name"):
-        name = to_wrap.get("span_name")
-    else:
-        name = get_fully_qualified_class_name(instance)
-
-    if 'haystack.core.pipeline.pipeline' in to_wrap['package']:
-        embedding_model = get_embedding_model_haystack(instance)
-        set_embedding_model(embedding_model)
-        inputs = set()
-        workflow_input = get_workflow_input(args, inputs)
-        set_attribute(DATA_INPUT_KEY, workflow_input)
-
-    if to_wrap.get('skip_span'):
-        return_value = wrapped(*args, **kwargs)
-        botocore_processor(tracer, to_wrap, wrapped, instance, args, kwargs, return_value)
         return return_value
 
-    with tracer.start_as_current_span(name) as span:
-        pre_task_processing(to_wrap, instance, args, span)
-        return_value = wrapped(*args, **kwargs)
-        process_span(to_wrap, span, instance, args, kwargs, return_value)
-        post_task_processing(to_wrap, span, return_value)
-
-    return return_value
+    return wrapper
 
 def botocore_processor(tracer, to_wrap, wrapped, instance, args, kwargs,return_value):
     if kwargs.get("service_name") == "sagemaker-runtime":
@@ -92,12 +234,19 @@ def _instrumented_endpoint_invoke(to_wrap, instance, fn, tracer):
     def with_instrumentation(*args, **kwargs):
 
         with tracer.start_as_current_span("botocore-sagemaker-invoke-endpoint") as span:
+            if not span.is_recording():
+                return fn(*args, **kwargs)
             response = fn(*args, **kwargs)
-            process_span(to_wrap, span, instance=instance,args=args, kwargs=kwargs, return_value=response)
+            enrich_span(span, process_span, to_wrap=to_wrap, instance=instance, args=args, kwargs=kwargs, return_value=response)
             return response
 
     return with_instrumentation
 
+def enrich_span(span, func, **kwargs):
+    """Run an enrichment step on the span, or defer it to the deferred enrichment processor if one handles the span."""
+    if not submit_enrichment(span, func, **kwargs):
+        func(span=span, **kwargs)
+
 def get_workflow_input(args, inputs):
     if args is not None and len(args) > 0:
         for value in args[0].values():
@@ -113,12 +262,9 @@ def get_workflow_input(args, inputs):
 
 def process_span(to_wrap, span, instance, args, kwargs, return_value):
     # Check if the output_processor is a valid JSON (in Python, that means it's a dictionary)
-    instance_args = {}
-    set_provider_name(instance, instance_args)
     span_index = 0
     if is_root_span(span):
         span_index += set_workflow_attributes(to_wrap, span, span_index+1)
-        span_index += set_app_hosting_identifier_attribute(span, span_index+1)
     if 'output_processor' in to_wrap:
         output_processor=to_wrap['output_processor']
         if isinstance(output_processor, dict) and len(output_processor) > 0:
@@ -126,6 +272,7 @@ def process_span(to_wrap, span, instance, args, kwargs, return_value):
                 span.set_attribute("span.type", output_processor['type'])
             else:
                 logger.warning("type of span not found or incorrect written in entity json")
+            arguments = {"instance": instance, "args": args, "kwargs": kwargs, "output": return_value}
             if 'attributes' in output_processor:
                 for processors in output_processor["attributes"]:
                     for processor in processors:
@@ -134,9 +281,14 @@ def process_span(to_wrap, span, instance, args, kwargs, return_value):
 
                         if attribute and accessor:
                             attribute_name = f"entity.{span_index+1}.{attribute}"
+                            accessor_function = get_accessor(accessor)
+                            if accessor_function is None:
+                                continue
                             try:
-                                arguments = {"instance":instance, "args":args, "kwargs":kwargs, "output":return_value}
-                                result = eval(accessor)(arguments)
+                                if processor.get(STATIC_ATTRIBUTE_KEY):
+                                    result = static_attribute_cache.resolve(instance, accessor_function, arguments)
+                                else:
+                                    result = accessor_function.func(arguments)
                                 if result and isinstance(result, str):
                                     span.set_attribute(attribute_name, result)
                             except Exception as e:
@@ -148,7 +300,7 @@ def process_span(to_wrap, span, instance, args, kwargs, return_value):
                 logger.warning("attributes not found or incorrect written in entity json")
             if 'events' in output_processor:
                 events = output_processor['events']
-                arguments = {"instance": instance, "args": args, "kwargs": kwargs, "output": return_value}
+                span_type = output_processor.get('type')
                 accessor_mapping = {
                     "arguments": arguments,
                     "response": return_value
@@ -161,17 +313,16 @@ def process_span(to_wrap, span, instance, args, kwargs, return_value):
                         attribute_key = attribute.get("attribute")
                         accessor = attribute.get("accessor")
                         if accessor:
+                            accessor_function = get_accessor(accessor)
+                            if accessor_function is None or accessor_function.input_key is None:
+                                continue
                             try:
-                                accessor_function = eval(accessor)
-                                for keyword, value in accessor_mapping.items():
-                                    if keyword in accessor:
-                                        evaluated_val = accessor_function(value)
-                                        if isinstance(evaluated_val, list):
-                                            evaluated_val = [str(d) for d in evaluated_val]
-                                        event_attributes[attribute_key] = evaluated_val
+                                event_attributes[attribute_key] = accessor_function.func(accessor_mapping[accessor_function.input_key])
                             except Exception as e:
                                 logger.error(f"Error evaluating accessor for attribute '{attribute_key}': {e}")
-                    span.add_event(name=event_name, attributes=event_attributes)
+                    # Lists become lists of strings, within the payload budget of the span type
+                    span.add_event(name=event_name,
+                                   attributes=capture_payload(event_attributes, get_payload_policy(span_type, event_name)))
 
         else:
             logger.warning("empty or entities json is not in correct format")
@@ -179,125 +330,301 @@ def process_span(to_wrap, span, instance, args, kwargs, return_value):
         span.set_attribute("entity.count", span_index)
 
 def set_workflow_attributes(to_wrap, span: Span, span_index):
-    return_value = 1
+    """Sets the workflow and app hosting entities of a root span, returns the number of entities set."""
+    entity_attributes, entity_count = root_span_attributes.get_entity_attributes(to_wrap.get('package'), span_index)
+    attributes = {}
     workflow_name = get_workflow_name(span=span)
     if workflow_name:
-        span.set_attribute("span.type", "workflow")
-        span.set_attribute(f"entity.{span_index}.name", workflow_name)
-        # workflow type
-    package_name = to_wrap.get('package')
-    workflow_type_set = False
-    for (package, workflow_type) in WORKFLOW_TYPE_MAP.items():
-        if (package_name is not None and package in package_name):
-            span.set_attribute(f"entity.{span_index}.type", workflow_type)
-            workflow_type_set = True
-    if not workflow_type_set:
-        span.set_attribute(f"entity.{span_index}.type", "workflow.generic")
-    return return_value
+        attributes["span.type"] = WORKFLOW_SPAN_TYPE
+        attributes[f"entity.{span_index}.name"] = workflow_name
+    attributes.update(entity_attributes)
+    span.set_attributes(attributes)
+    return entity_count
 
-def post_task_processing(to_wrap, span, return_value):
+def post_task_processing(config: WrapperConfig, span, return_value):
     try:
-        update_span_with_context_output(to_wrap=to_wrap, return_value=return_value, span=span)
+        update_span_with_context_output(config=config, return_value=return_value, span=span)
 
         if is_root_span(span):
-            update_span_with_prompt_output(to_wrap=to_wrap, wrapped_args=return_value, span=span)
+            update_span_with_prompt_output(config=config, wrapped_args=return_value, span=span)
     except:
         logger.exception("exception in post_task_processing")
 
 
-def pre_task_processing(to_wrap, instance, args, span):
+def pre_task_processing(config: WrapperConfig, instance, args, span):
     try:
         if is_root_span(span):
-            try:
-                sdk_version = version("monocle_apptrace")
+            sdk_version = root_span_attributes.get_sdk_version()
+            if sdk_version:
                 span.set_attribute("monocle_apptrace.version", sdk_version)
-            except:
-                logger.warning(f"Exception finding monocle-apptrace version.")
-            update_span_with_prompt_input(to_wrap=to_wrap, wrapped_args=args, span=span)
-        update_span_with_context_input(to_wrap=to_wrap, wrapped_args=args, span=span)
+            update_span_with_prompt_input(config=config, wrapped_args=args, span=span)
+        update_span_with_context_input(config=config, wrapped_args=args, span=span)
     except:
         logger.exception("exception in pre_task_processing")
 
 
-@with_tracer_wrapper
-async def atask_wrapper(tracer, to_wrap, wrapped, instance, args, kwargs):
+@with_specialized_tracer_wrapper
+def atask_wrapper(tracer, to_wrap):
     """Instruments and calls every function defined in TO_WRAP."""
+    config = WrapperConfig(to_wrap)
+
+    async def wrapper(wrapped, instance, args, kwargs):
+        # Some Langchain objects are wrapped elsewhere, so we ignore them here
+        if instance.__class__.__name__ in SKIPPED_CLASS_NAMES:
+            return await wrapped(*args, **kwargs)
+
+        with tracer.start_as_current_span(config.get_span_name(instance), attributes=config.start_attributes) as span:
+            if not span.is_recording():
+                return await wrapped(*args, **kwargs)
+            request_scope = get_haystack_pipeline_context(instance, args) if config.is_haystack_pipeline else nullcontext()
+            with request_scope:
+                pre_task_processing(config, instance, args, span)
+                return_value = await wrapped(*args, **kwargs)
+                enrich_span(span, process_span, to_wrap=to_wrap, instance=instance, args=args, kwargs=kwargs, return_value=return_value)
+                enrich_span(span, post_task_processing, config=config, return_value=return_value)
 
-    # Some Langchain objects are wrapped elsewhere, so we ignore them here
-    if instance.__class__.__name__ in ("AgentExecutor"):
-        return wrapped(*args, **kwargs)
+        return return_value
 
-    if hasattr(instance, "name") and instance.name:
-        name = f"{to_wrap.get('span_name')}.{instance.name.lower()}"
-    elif to_wrap.get("span_name"):
-        name = to_wrap.get("span_name")
-    else:
-        name = get_fully_qualified_class_name(instance)
-    if 'haystack.core.pipeline.pipeline' in to_wrap['package']:
-        embedding_model = get_embedding_model_haystack(instance)
-        set_embedding_model(embedding_model)
-        inputs = set()
-        workflow_input = get_workflow_input(args, inputs)
-        set_attribute(DATA_INPUT_KEY, workflow_input)
-
-    with tracer.start_as_current_span(name) as span:
-        pre_task_processing(to_wrap, instance, args, span)
-        return_value = await wrapped(*args, **kwargs)
-        process_span(to_wrap, span, instance, args, kwargs, return_value)
-        post_task_processing(to_wrap, span, return_value)
-
-    return return_value
-
-
-@with_tracer_wrapper
-async def allm_wrapper(tracer, to_wrap, wrapped, instance, args, kwargs):
-    # Some Langchain objects are wrapped elsewhere, so we ignore them here
-    if instance.__class__.__name__ in ("AgentExecutor"):
-        return wrapped(*args, **kwargs)
+    return wrapper
 
-    if callable(to_wrap.get("span_name_getter")):
-        name = to_wrap.get("span_name_getter")(instance)
 
-    elif hasattr(instance, "name") and instance.name:
-        name = f"{to_wrap.get('span_name')}.{instance.name.lower()}"
-    elif to_wrap.get("span_name"):
-        name = to_wrap.get("span_name")
-    else:
-        name = get_fully_qualified_class_name(instance)
-    with tracer.start_as_current_span(name) as span:
-        provider_name, inference_endpoint = get_provider_name(instance)
-        return_value = await wrapped(*args, **kwargs)
-        kwargs.update({"provider_name": provider_name, "inference_endpoint": inference_endpoint or getattr(instance, 'endpoint', None)})
-        process_span(to_wrap, span, instance, args, kwargs, return_value)
-        update_span_from_llm_response(response=return_value, span=span, instance=instance)
+@with_specialized_tracer_wrapper
+def allm_wrapper(tracer, to_wrap):
+    config = WrapperConfig(to_wrap, use_span_name_getter=True)
+
+    async def wrapper(wrapped, instance, args, kwargs):
+        # Some Langchain objects are wrapped elsewhere, so we ignore them here
+        if instance.__class__.__name__ in SKIPPED_CLASS_NAMES:
+            return await wrapped(*args, **kwargs)
+        if is_streaming(instance):
+            # The invoke a model without native streaming falls back to, traced by the stream span
+            return await wrapped(*args, **kwargs)
 
-    return return_value
+        with tracer.start_as_current_span(config.get_span_name(instance), attributes=config.start_attributes) as span:
+            if not span.is_recording():
+                return await wrapped(*args, **kwargs)
+            provider_name, inference_endpoint = get_provider_name(instance)
+            return_value = await wrapped(*args, **kwargs)
+            kwargs.update({"provider_name": provider_name, "inference_endpoint": inference_endpoint or getattr(instance, 'endpoint', None)})
+            enrich_span(span, process_span, to_wrap=to_wrap, instance=instance, args=args, kwargs=kwargs, return_value=return_value)
+            enrich_span(span, update_span_from_llm_response, response=return_value, instance=instance)
 
+        return return_value
+
+    return wrapper
+
+
+@with_specialized_tracer_wrapper
+def llm_wrapper(tracer: Tracer, to_wrap):
+    config = WrapperConfig(to_wrap, use_span_name_getter=True)
+
+    def wrapper(wrapped, instance, args, kwargs):
+        # Some Langchain objects are wrapped elsewhere, so we ignore them here
+        if instance.__class__.__name__ in SKIPPED_CLASS_NAMES:
+            return wrapped(*args, **kwargs)
+        if is_streaming(instance):
+            # The invoke a model without native streaming falls back to, traced by the stream span
+            return wrapped(*args, **kwargs)
+
+        with tracer.start_as_current_span(config.get_span_name(instance), attributes=config.start_attributes) as span:
+            if not span.is_recording():
+                return wrapped(*args, **kwargs)
+            provider_name, inference_endpoint = get_provider_name(instance)
+            stream_metrics = trace_streaming_callback_argument(config, wrapped, instance, kwargs)
+            return_value = wrapped(*args, **kwargs)
+            if stream_metrics is not None:
+                span.set_attributes(stream_metrics.get_attributes())
+            kwargs.update({"provider_name": provider_name, "inference_endpoint": inference_endpoint or getattr(instance, 'endpoint', None)})
+            enrich_span(span, process_span, to_wrap=to_wrap, instance=instance, args=args, kwargs=kwargs, return_value=return_value)
+            enrich_span(span, update_span_from_llm_response, response=return_value, instance=instance)
+
+        return return_value
 
-@with_tracer_wrapper
-def llm_wrapper(tracer: Tracer, to_wrap, wrapped, instance, args, kwargs):
-    # Some Langchain objects are wrapped elsewhere, so we ignore them here
-    if instance.__class__.__name__ in ("AgentExecutor"):
+    return wrapper
+
+
+def trace_streaming_callback_argument(config: WrapperConfig, wrapped, instance, kwargs):
+    """
+    Wraps the streaming callback passed to the call or set on the instance, returns the metrics it records.
+    The callback of the instance is only passed to the call if the wrapped method takes a streaming_callback
+    parameter, some haystack versions don't, its chunks are not timed then.
+    """
+    if not config.streaming_callback:
+        return None
+    callback = kwargs.get("streaming_callback")
+    if callback is None and config.takes_streaming_callback(wrapped):
+        callback = getattr(instance, "streaming_callback", None)
+    if not callable(callback):
+        return None
+    stream_metrics = StreamMetrics()
+    kwargs["streaming_callback"] = trace_streaming_callback(callback, stream_metrics)
+    return stream_metrics
+
+
+def start_stream_span(tracer: Tracer, config: WrapperConfig, to_wrap, instance, args, kwargs):
+    """
+    Starts the inference span of a streaming call, which is ended by the returned stream proxy.
+
+    @return: The span, the function setting the response attributes from the last chunk and the text
+        of the chunks, and the StreamOutput collecting that text, or (None, None, None) if the span is
+        not recorded
+    """
+    span = tracer.start_span(config.get_span_name(instance), attributes=config.start_attributes)
+    if not span.is_recording():
+        span.end()
+        return None, None, None
+    provider_name, inference_endpoint = get_provider_name(instance)
+    kwargs = {**kwargs, "provider_name": provider_name,
+              "inference_endpoint": inference_endpoint or getattr(instance, 'endpoint', None)}
+
+    def on_finish(span, response, text):
+        # The data.output event gets the text of all the chunks, the response attributes come from the last one
+        enrich_span(span, process_span, to_wrap=to_wrap, instance=instance, args=args, kwargs=kwargs, return_value=text)
+        enrich_span(span, update_span_from_llm_response, response=response, instance=instance)
+
+    output_processor = to_wrap.get("output_processor")
+    span_type = output_processor.get("type") if isinstance(output_processor, dict) else None
+    return span, on_finish, StreamOutput(PayloadBuffer(get_payload_policy(span_type, "data.output")))
+
+
+def call_in_stream_span(span: Span, wrapped, instance, args, kwargs):
+    """Calls the streaming method with the span as the current span, ends the span if the call fails."""
+    token = attach(get_stream_context(span, instance))
+    try:
         return wrapped(*args, **kwargs)
+    except BaseException:
+        span.end()
+        raise
+    finally:
+        detach(token)
+
+
+@with_specialized_tracer_wrapper
+def llm_stream_wrapper(tracer: Tracer, to_wrap):
+    """Instruments streaming inference calls returning an iterator, eg. stream or stream_chat."""
+    config = WrapperConfig(to_wrap, use_span_name_getter=True)
+
+    def wrapper(wrapped, instance, args, kwargs):
+        if instance.__class__.__name__ in SKIPPED_CLASS_NAMES:
+            return wrapped(*args, **kwargs)
+
+        span, on_finish, output = start_stream_span(tracer, config, to_wrap, instance, args, kwargs)
+        if span is None:
+            return wrapped(*args, **kwargs)
+        stream_metrics = StreamMetrics()
+        stream = call_in_stream_span(span, wrapped, instance, args, kwargs)
+        return TracedStream(stream, span, on_finish, stream_metrics, output, instance)
+
+    return wrapper
+
+
+@with_specialized_tracer_wrapper
+def allm_stream_wrapper(tracer: Tracer, to_wrap):
+    """
+    Instruments streaming inference calls returning an async iterator, eg. astream,
+    or a coroutine returning one, eg. astream_chat.
+    """
+    config = WrapperConfig(to_wrap, use_span_name_getter=True)
+
+    async def await_stream(awaitable, span, on_finish, stream_metrics, output, instance):
+        token = attach(get_stream_context(span, instance))
+        try:
+            stream = await awaitable
+        except BaseException:
+            span.end()
+            raise
+        finally:
+            detach(token)
+        return AsyncTracedStream(stream, span, on_finish, stream_metrics, output, instance)
+
+    def wrapper(wrapped, instance, args, kwargs):
+        if instance.__class__.__name__ in SKIPPED_CLASS_NAMES:
+            return wrapped(*args, **kwargs)
+
+        span, on_finish, output = start_stream_span(tracer, config, to_wrap, instance, args, kwargs)
+        if span is None:
+            return wrapped(*args, **kwargs)
+        stream_metrics = StreamMetrics()
+        stream = call_in_stream_span(span, wrapped, instance, args, kwargs)
+        if inspect.isawaitable(stream):
+            return await_stream(stream, span, on_finish, stream_metrics, output, instance)
+        return AsyncTracedStream(stream, span, on_finish, stream_metrics, output, instance)
+
+    return wrapper
+
+
+def start_batch(tracer: Tracer, config: WrapperConfig, item_sample_rate: float, instance, args, kwargs):
+    """Starts the span of a batch call, returns its BatchScope or None if the span is not recorded."""
+    span = tracer.start_span(config.get_span_name(instance))
+    if not span.is_recording():
+        span.end()
+        return None
+    # Only the workflow attributes, the inputs of a large batch are not recorded
+    enrich_span(span, process_span, to_wrap=config.to_wrap, instance=instance, args=(), kwargs={}, return_value=None)
+    return BatchScope(tracer, span, item_sample_rate, args, kwargs)
+
+
+@with_specialized_tracer_wrapper
+def batch_wrapper(tracer: Tracer, to_wrap):
+    """
+    Instruments batch calls, eg. batch or batch_as_completed of langchain runnables,
+    with one span for the batch and sampled spans for its items.
+    """
+    config = WrapperConfig(to_wrap)
+    item_sample_rate = get_item_sample_rate(to_wrap)
+
+    def wrapper(wrapped, instance, args, kwargs):
+        batch = start_batch(tracer, config, item_sample_rate, instance, args, kwargs)
+        if batch is None:
+            return wrapped(*args, **kwargs)
+        try:
+            with use_span(batch.span, record_exception=False, set_status_on_exception=False):
+                return_value = wrapped(*args, **kwargs)
+        except BaseException as e:
+            batch.finish(exception=e)
+            raise
+        if inspect.isgenerator(return_value):
+            return batch.trace_as_completed(return_value)
+        batch.finish(outputs=return_value)
+        return return_value
 
-    if callable(to_wrap.get("span_name_getter")):
-        name = to_wrap.get("span_name_getter")(instance)
+    return wrapper
 
-    elif hasattr(instance, "name") and instance.name:
-        name = f"{to_wrap.get('span_name')}.{instance.name.lower()}"
-    elif to_wrap.get("span_name"):
-        name = to_wrap.get("span_name")
-    else:
-        name = get_fully_qualified_class_name(instance)
 
-    with tracer.start_as_current_span(name) as span:
-        provider_name, inference_endpoint = get_provider_name(instance)
-        return_value = wrapped(*args, **kwargs)
-        kwargs.update({"provider_name": provider_name, "inference_endpoint": inference_endpoint or getattr(instance, 'endpoint', None)})
-        process_span(to_wrap, span, instance, args, kwargs, return_value)
-        update_span_from_llm_response(response=return_value, span=span, instance=instance)
+@with_specialized_tracer_wrapper
+def abatch_wrapper(tracer: Tracer, to_wrap):
+    """
+    Instruments async batch calls, eg. abatch or abatch_as_completed of langchain runnables,
+    with one span for the batch and sampled spans for its items.
+    """
+    config = WrapperConfig(to_wrap)
+    item_sample_rate = get_item_sample_rate(to_wrap)
 
-    return return_value
+    async def await_batch(awaitable, batch: BatchScope):
+        try:
+            with use_span(batch.span, record_exception=False, set_status_on_exception=False):
+                return_value = await awaitable
+        except BaseException as e:
+            batch.finish(exception=e)
+            raise
+        batch.finish(outputs=return_value)
+        return return_value
+
+    def wrapper(wrapped, instance, args, kwargs):
+        batch = start_batch(tracer, config, item_sample_rate, instance, args, kwargs)
+        if batch is None:
+            return wrapped(*args, **kwargs)
+        try:
+            with use_span(batch.span, record_exception=False, set_status_on_exception=False):
+                return_value = wrapped(*args, **kwargs)
+        except BaseException as e:
+            batch.finish(exception=e)
+            raise
+        if inspect.isawaitable(return_value):
+            return await_batch(return_value, batch)
+        return batch.atrace_as_completed(return_value)
+
+    return wrapper
 
 
 def update_llm_endpoint(curr_span: Span, instance):
@@ -330,66 +657,6 @@ def update_llm_endpoint(curr_span: Span, instance):
         )
 
 
-def get_provider_name(instance):
-    provider_url = ""
-    inference_endpoint = ""
-    parsed_provider_url = ""
-    try:
-        base_url = getattr(instance.client._client, "base_url", None)
-        if base_url:
-            if isinstance(getattr(base_url, "host", None), str):
-                provider_url = base_url.host
-            inference_endpoint = base_url if isinstance(base_url, str) else str(base_url)
-    except:
-        pass
-
-    try:
-        if isinstance(instance.client.meta.endpoint_url, str):
-            inference_endpoint = instance.client.meta.endpoint_url
-    except:
-        pass
-
-    api_base = getattr(instance, "api_base", None)
-    if isinstance(api_base, str):
-        provider_url = api_base
-
-    # Handle inference endpoint for Mistral AI (llamaindex)
-    sdk_config = getattr(instance, "_client", None)
-    if sdk_config and hasattr(sdk_config, "sdk_configuration"):
-        inference_endpoint = getattr(sdk_config.sdk_configuration, "server_url", inference_endpoint)
-
-    if provider_url:
-        try:
-            parsed_provider_url = urlparse(provider_url)
-        except:
-            pass
-
-    return parsed_provider_url.hostname if parsed_provider_url else provider_url, inference_endpoint
-
-
-def set_provider_name(instance, instance_args: dict):
-    provider_url = ""
-    parsed_provider_url = ""
-    try:
-        if isinstance(instance.client._client.base_url.host, str):
-            provider_url = instance.client._client.base_url.host
-    except:
-        pass
-
-    try:
-        if isinstance(instance.api_base, str):
-            provider_url = instance.api_base
-    except:
-        pass
-    try:
-        if len(provider_url) > 0:
-            parsed_provider_url = urlparse(provider_url).hostname
-    except:
-        pass
-    if parsed_provider_url or provider_url:
-        instance_args[PROVIDER] = parsed_provider_url or provider_url
-
-
 def is_root_span(curr_span: Span) -> bool:
     return curr_span.parent is None
 
@@ -451,61 +718,97 @@ def update_workflow_type(to_wrap, span: Span):
             span.set_attribute(WORKFLOW_TYPE_KEY, workflow_type)
 
 
-def update_span_with_context_input(to_wrap, wrapped_args, span: Span):
-    package_name: str = to_wrap.get('package')
-    input_arg_text = ""
-    if "langchain_core.retrievers" in package_name and len(wrapped_args) > 0:
-        input_arg_text += wrapped_args[0]
-    if "llama_index.core.indices.base_retriever" in package_name and len(wrapped_args) > 0:
-        input_arg_text += wrapped_args[0].query_str
-    if "haystack.components.retrievers.in_memory" in package_name:
-        input_arg_text += get_attribute(DATA_INPUT_KEY)
-    if input_arg_text:
-        span.add_event(DATA_INPUT_KEY, {QUERY: input_arg_text})
-
-
-def update_span_with_context_output(to_wrap, return_value, span: Span):
-    package_name: str = to_wrap.get('package')
-    output_arg_text = ""
-    if "langchain_core.retrievers" in package_name:
-        output_arg_text += " ".join([doc.page_content for doc in return_value if hasattr(doc, 'page_content')])
-        if len(output_arg_text) > 100:
-            output_arg_text = output_arg_text[:100] + "..."
-    if "llama_index.core.indices.base_retriever" in package_name and len(return_value) > 0:
-        output_arg_text += return_value[0].text
-    if "haystack.components.retrievers.in_memory" in package_name:
-        output_arg_text += " ".join([doc.content for doc in return_value['documents']])
-        if len(output_arg_text) > 100:
-            output_arg_text = output_arg_text[:100] + "..."
-    if output_arg_text:
-        span.add_event(DATA_OUTPUT_KEY, {RESPONSE: output_arg_text})
-
-
-def update_span_with_prompt_input(to_wrap, wrapped_args, span: Span):
+def get_langchain_retriever_input(wrapped_args):
+    return wrapped_args[0] if len(wrapped_args) > 0 else ""
+
+
+def get_llamaindex_retriever_input(wrapped_args):
+    return wrapped_args[0].query_str if len(wrapped_args) > 0 else ""
+
+
+def get_haystack_retriever_input(wrapped_args):
+    return get_attribute(DATA_INPUT_KEY)
+
+
+# The retriever outputs are the document texts, joined by update_span_with_context_output within the payload budget
+def get_langchain_retriever_output(return_value):
+    return [doc.page_content for doc in return_value if hasattr(doc, 'page_content')]
+
+
+def get_llamaindex_retriever_output(return_value):
+    return [return_value[0].text] if len(return_value) > 0 else []
+
+
+def get_haystack_retriever_output(return_value):
+    return [doc.content for doc in return_value['documents']]
+
+
+def update_span_with_context_input(config: WrapperConfig, wrapped_args, span: Span):
+    input_parts = [text for text in (handler(wrapped_args) for handler in config.context_input_handlers) if text]
+    if input_parts:
+        span.add_event(DATA_INPUT_KEY, capture_text(QUERY, input_parts, get_payload_policy(config.span_type, DATA_INPUT_KEY), sep=""))
+
+
+def update_span_with_context_output(config: WrapperConfig, return_value, span: Span):
+    output_parts = [text for handler in config.context_output_handlers for text in handler(return_value)]
+    if any(output_parts):
+        span.add_event(DATA_OUTPUT_KEY, capture_text(RESPONSE, output_parts, get_payload_policy(config.span_type, DATA_OUTPUT_KEY)))
+
+
+def update_span_with_prompt_input(config: WrapperConfig, wrapped_args, span: Span):
     input_arg_text = wrapped_args[0]
 
     prompt_inputs = get_nested_value(input_arg_text, ['prompt_builder', 'question'])
     if prompt_inputs is not None:  # haystack
-        span.add_event(PROMPT_INPUT_KEY, {QUERY: prompt_inputs})
+        prompt_input = {QUERY: prompt_inputs}
     elif isinstance(input_arg_text, dict):
-        span.add_event(PROMPT_INPUT_KEY, {QUERY: input_arg_text['input']})
+        prompt_input = {QUERY: input_arg_text['input']}
     else:
-        span.add_event(PROMPT_INPUT_KEY, {QUERY: input_arg_text})
+        prompt_input = {QUERY: input_arg_text}
+    span.add_event(PROMPT_INPUT_KEY, capture_payload(prompt_input, get_payload_policy(WORKFLOW_SPAN_TYPE, PROMPT_INPUT_KEY)))
 
 
-def update_span_with_prompt_output(to_wrap, wrapped_args, span: Span):
-    package_name: str = to_wrap.get('package')
+def get_llamaindex_query_engine_output(wrapped_args):
+    return {RESPONSE: wrapped_args.response}
 
-    if "llama_index.core.base.base_query_engine" in package_name:
-        span.add_event(PROMPT_OUTPUT_KEY, {RESPONSE: wrapped_args.response})
-    elif "haystack.core.pipeline.pipeline" in package_name:
-        resp = get_nested_value(wrapped_args, ['llm', 'replies'])
-        if resp is not None:
-            if isinstance(resp, list) and hasattr(resp[0], 'content'):
-                span.add_event(PROMPT_OUTPUT_KEY, {RESPONSE: resp[0].content})
-            else:
-                span.add_event(PROMPT_OUTPUT_KEY, {RESPONSE: resp[0]})
-    elif isinstance(wrapped_args, str):
-        span.add_event(PROMPT_OUTPUT_KEY, {RESPONSE: wrapped_args})
-    elif isinstance(wrapped_args, dict):
-        span.add_event(PROMPT_OUTPUT_KEY, wrapped_args)
+
+def get_haystack_pipeline_output(wrapped_args):
+    resp = get_nested_value(wrapped_args, ['llm', 'replies'])
+    if resp is not None:
+        if isinstance(resp, list) and hasattr(resp[0], 'content'):
+            return {RESPONSE: resp[0].content}
+        return {RESPONSE: resp[0]}
+    return None
+
+
+def get_prompt_output(wrapped_args):
+    if isinstance(wrapped_args, str):
+        return {RESPONSE: wrapped_args}
+    if isinstance(wrapped_args, dict):
+        return wrapped_args
+    return None
+
+
+def update_span_with_prompt_output(config: WrapperConfig, wrapped_args, span: Span):
+    prompt_output = config.prompt_output_handler(wrapped_args)
+    if prompt_output is not None:
+        span.add_event(PROMPT_OUTPUT_KEY, capture_payload(prompt_output, get_payload_policy(WORKFLOW_SPAN_TYPE, PROMPT_OUTPUT_KEY)))
+
+
+# Package specific handlers, bound to each wrapped method by WrapperConfig
+CONTEXT_INPUT_HANDLERS = (
+    ("langchain_core.retrievers", get_langchain_retriever_input),
+    ("llama_index.core.indices.base_retriever", get_llamaindex_retriever_input),
+    ("haystack.components.retrievers.in_memory", get_haystack_retriever_input),
+)
+
+CONTEXT_OUTPUT_HANDLERS = (
+    ("langchain_core.retrievers", get_langchain_retriever_output),
+    ("llama_index.core.indices.base_retriever", get_llamaindex_retriever_output),
+    ("haystack.components.retrievers.in_memory", get_haystack_retriever_output),
+)
+
+PROMPT_OUTPUT_HANDLERS = (
+    ("llama_index.core.base.base_query_engine", get_llamaindex_query_engine_output),
+    (HAYSTACK_PIPELINE_PACKAGE, get_haystack_pipeline_output),
+)
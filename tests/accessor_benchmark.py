@@ -0,0 +1,120 @@
+"""
+Compares the per-call cost of the langchain inference entity accessors:
+lambda accessors evaluated with eval() on every call, lambda accessors
+compiled once, and the path accessors shipped in langchain_entities.json.
+Also times process_span with and without the static attribute cache.
+
+    python tests/accessor_benchmark.py
+"""
+import json
+import os
+import timeit
+
+import copy
+
+from monocle_apptrace.accessor import get_accessor, STATIC_ATTRIBUTE_KEY
+from monocle_apptrace import wrap_common
+
+ITERATIONS = 20000
+ENTITIES_PATH = os.path.join(os.path.dirname(__file__), "..", "src", "monocle_apptrace", "metamodel",
+                             "maps", "attributes", "inference", "langchain_entities.json")
+
+
+class FakeChatModel:
+    def __init__(self):
+        self.model_name = "gpt-4o-mini"
+        self.deployment_name = "gpt-4o-mini-deployment"
+        self.azure_endpoint = "https://example.openai.azure.com/"
+
+
+class FakeBedrockModel:
+    """A client without the azure fields, so some lambda accessors raise."""
+    def __init__(self):
+        self.model_id = "anthropic.claude-v2"
+
+
+LAMBDA_ACCESSORS = [
+    "lambda arguments:'inference.azure_oai'",
+    "lambda arguments:arguments['kwargs']['provider_name']",
+    "lambda arguments: resolve_from_alias(arguments['instance'].__dict__, "
+    "['engine', 'azure_deployment', 'deployment_name', 'deployment_id', 'deployment'])",
+    "lambda arguments: resolve_from_alias(arguments['instance'].__dict__, ['azure_endpoint', 'api_base']) "
+    "or arguments['kwargs']['inference_endpoint']",
+    "lambda arguments: resolve_from_alias(arguments['instance'].__dict__, ['model', 'model_name']) "
+    "or arguments['instance'].model_id",
+    "lambda arguments: 'model.llm.'+ (resolve_from_alias(arguments['instance'].__dict__, ['model', 'model_name']) "
+    "or arguments['instance'].model_id)",
+]
+
+
+def load_path_accessors():
+    with open(ENTITIES_PATH, encoding="UTF-8") as op_file:
+        output_processor = json.load(op_file)
+    return [processor["accessor"] for processors in output_processor["attributes"] for processor in processors]
+
+
+def run_eval(accessors, arguments):
+    namespace = vars(wrap_common)
+    for source in accessors:
+        try:
+            eval(source, namespace)(arguments)  # pylint: disable=eval-used
+        except Exception:
+            pass
+
+
+def run_compiled(accessors, arguments):
+    for source in accessors:
+        try:
+            get_accessor(source).func(arguments)
+        except Exception:
+            pass
+
+
+class NoopSpan:
+    parent = object()
+
+    def set_attribute(self, key, value):
+        pass
+
+    def add_event(self, name, attributes=None):
+        pass
+
+
+def load_output_processor(static: bool):
+    with open(ENTITIES_PATH, encoding="UTF-8") as op_file:
+        output_processor = json.load(op_file)
+    output_processor.pop("events")
+    if not static:
+        output_processor = copy.deepcopy(output_processor)
+        for processors in output_processor["attributes"]:
+            for processor in processors:
+                processor.pop(STATIC_ATTRIBUTE_KEY, None)
+    return output_processor
+
+
+def time_process_span():
+    instance, span = FakeChatModel(), NoopSpan()
+    kwargs = {"provider_name": "openai", "inference_endpoint": "https://example.openai.azure.com/"}
+    print("process_span")
+    for label, static in (("per call", False), ("static cached", True)):
+        to_wrap = {"output_processor": load_output_processor(static)}
+        seconds = timeit.timeit(lambda: wrap_common.process_span(to_wrap, span, instance, (), kwargs, None),
+                                number=ITERATIONS)
+        print(f"{label:>15}: {seconds / ITERATIONS * 1e6:8.2f} us per wrapped call")
+
+
+def main():
+    runs = (("eval per call", run_eval, LAMBDA_ACCESSORS),
+            ("compiled lambda", run_compiled, LAMBDA_ACCESSORS),
+            ("compiled path", run_compiled, load_path_accessors()))
+    for instance in (FakeChatModel(), FakeBedrockModel()):
+        print(type(instance).__name__)
+        arguments = {"instance": instance, "args": (), "kwargs": {"provider_name": "openai"}, "output": None}
+        for label, func, accessors in runs:
+            seconds = timeit.timeit(lambda: func(accessors, arguments), number=ITERATIONS)
+            print(f"{label:>15}: {seconds / ITERATIONS * 1e6:8.2f} us per wrapped call ({len(accessors)} accessors)")
+    time_process_span()
+
+
+if __name__ == "__main__":
+    main()
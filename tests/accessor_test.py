@@ -0,0 +1,202 @@
+import json
+import logging
+import os
+import tempfile
+import unittest
+from unittest.mock import Mock, patch
+
+from monocle_apptrace import accessor
+from monocle_apptrace.accessor import (clear_accessor_cache, compile_output_processor, compile_path, get_accessor,
+                                      PathSyntaxError, StaticAttributeCache, static_attribute_cache)
+from monocle_apptrace.utils import load_output_processor
+from monocle_apptrace.wrap_common import process_span
+
+logger = logging.getLogger(__name__)
+
+
+class TestAccessor(unittest.TestCase):
+
+    def setUp(self):
+        clear_accessor_cache()
+
+    def test_accessor_compiled_once(self):
+        """Repeated process_span calls reuse the accessor compiled on first use."""
+        to_wrap = {
+            "output_processor": {
+                "type": "inference",
+                "attributes": [
+                    [
+                        {
+                            "attribute": "name",
+                            "accessor": "lambda arguments: resolve_from_alias(arguments['instance'].__dict__, ['model', 'model_name'])"
+                        }
+                    ]
+                ]
+            }
+        }
+        instance = Mock()
+        instance.model_name = "gpt-4"
+        with patch.object(accessor, "compile_accessor", wraps=accessor.compile_accessor) as mock_compile:
+            for _ in range(3):
+                span = Mock()
+                process_span(to_wrap, span, instance, (), {}, None)
+                span.set_attribute.assert_any_call("entity.1.name", "gpt-4")
+            self.assertEqual(mock_compile.call_count, 1)
+
+    def test_event_accessor_input_key(self):
+        """Event accessors are bound to arguments or response when compiled."""
+        self.assertEqual(get_accessor("lambda arguments: arguments['args']").input_key, "arguments")
+        self.assertEqual(get_accessor("lambda response: response").input_key, "response")
+        self.assertIsNone(get_accessor("lambda x: x").input_key)
+
+    def test_invalid_accessor_reported_at_load_time(self):
+        """Compile errors are logged when the output processor is loaded, not per call."""
+        output_processor = {
+            "type": "inference",
+            "attributes": [
+                [
+                    {"attribute": "name", "accessor": "lambda arguments: arguments["},
+                    {"attribute": "type", "accessor": "lambda arguments: 'model.llm'"}
+                ]
+            ]
+        }
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, "entities.json")
+            with open(file_path, "w", encoding="UTF-8") as op_file:
+                json.dump(output_processor, op_file)
+            wrapper_method = {"output_processor": [file_path]}
+            with self.assertLogs(level='ERROR') as log:
+                load_output_processor(wrapper_method, tmp_dir)
+        self.assertTrue(any("Error compiling accessor" in line for line in log.output))
+
+        span = Mock()
+        with patch.object(accessor.logger, "error") as mock_error:
+            process_span(wrapper_method, span, Mock(), (), {}, None)
+            mock_error.assert_not_called()
+        span.set_attribute.assert_any_call("entity.1.type", "model.llm")
+
+    def test_compile_output_processor_counts_errors(self):
+        output_processor = {
+            "attributes": [[{"attribute": "name", "accessor": "lambda arguments: arguments["}]],
+            "events": [{"name": "data.input", "attributes": [{"attribute": "input", "accessor": "lambda arguments: 1"}]}]
+        }
+        self.assertEqual(compile_output_processor(output_processor), 1)
+
+
+class TestPathAccessor(unittest.TestCase):
+
+    def setUp(self):
+        clear_accessor_cache()
+        instance = Mock()
+        instance.__dict__.update({"model_name": "gpt-4", "azure_endpoint": None})
+        instance.vectorstore = Mock()
+        instance.vectorstore.embeddings.model = "all-MiniLM-L6-v2"
+        self.arguments = {"instance": instance, "args": ("query", ["a", "b"]),
+                          "kwargs": {"provider_name": "openai.com", "inference_endpoint": "https://openai.com"},
+                          "output": "answer"}
+
+    def test_paths(self):
+        cases = {
+            "instance.__dict__|first_of(model,model_name)": "gpt-4",
+            "instance.__dict__|first_of(azure_endpoint,api_base) or kwargs.inference_endpoint": "https://openai.com",
+            "(instance.__dict__|first_of(model,model_name) or instance.model_id)|prefix(model.llm.)": "model.llm.gpt-4",
+            "instance.vectorstore.embeddings.model|prefix('model.embedding.')": "model.embedding.all-MiniLM-L6-v2",
+            "instance.vectorstore|type_name": "Mock",
+            "kwargs.provider_name": "openai.com",
+            "args[1].0": "a",
+            "args.1[1]": "b",
+            "response": "answer",
+            "'inference.azure_oai'": "inference.azure_oai",
+        }
+        for source, expected in cases.items():
+            self.assertEqual(compile_path(source)(self.arguments), expected, source)
+
+    def test_missing_values_resolve_to_none(self):
+        self.assertIsNone(compile_path("kwargs.missing.value")(self.arguments))
+        self.assertIsNone(compile_path("args[5]")(self.arguments))
+        self.assertIsNone(compile_path("kwargs.missing|prefix(model.llm.)")(self.arguments))
+
+    def test_invalid_paths(self):
+        for source in ("arguments.instance", "instance|unknown", "instance.", "(instance", "instance|first_of(a,)"):
+            with self.assertRaises(PathSyntaxError, msg=source):
+                compile_path(source)
+        self.assertIsNone(get_accessor("instance|unknown"))
+
+    def test_process_span_with_path_accessors(self):
+        to_wrap = {
+            "output_processor": {
+                "type": "inference",
+                "attributes": [[
+                    {"attribute": "name", "accessor": "instance.__dict__|first_of(model,model_name)"},
+                    {"attribute": "type", "accessor": "instance.__dict__|first_of(model,model_name)|prefix(model.llm.)"}
+                ]],
+                "events": [
+                    {"name": "data.output", "attributes": [{"attribute": "response", "accessor": "response|assistant_message"}]}
+                ]
+            }
+        }
+        span = Mock()
+        process_span(to_wrap, span, self.arguments["instance"], (), {}, "answer")
+        span.set_attribute.assert_any_call("entity.1.name", "gpt-4")
+        span.set_attribute.assert_any_call("entity.1.type", "model.llm.gpt-4")
+        span.add_event.assert_any_call(name="data.output", attributes={"response": ["answer"]})
+
+
+class ChatClient:
+    def __init__(self, model_name):
+        self.model_name = model_name
+
+
+class TestStaticAttributeCache(unittest.TestCase):
+
+    def setUp(self):
+        static_attribute_cache.clear()
+        self.to_wrap = {
+            "output_processor": {
+                "type": "inference",
+                "attributes": [[
+                    {"attribute": "name", "accessor": "instance.model_name", "static": True},
+                    {"attribute": "provider_name", "accessor": "kwargs.provider_name"}
+                ]]
+            }
+        }
+
+    def test_static_attributes_resolved_once_per_instance(self):
+        client = ChatClient("gpt-4")
+        for provider in ("openai.com", "azure.com"):
+            span = Mock()
+            process_span(self.to_wrap, span, client, (), {"provider_name": provider}, None)
+            span.set_attribute.assert_any_call("entity.1.name", "gpt-4")
+            span.set_attribute.assert_any_call("entity.1.provider_name", provider)
+            client.model_name = "changed"
+
+        other_client = ChatClient("gpt-35")
+        span = Mock()
+        process_span(self.to_wrap, span, other_client, (), {}, None)
+        span.set_attribute.assert_any_call("entity.1.name", "gpt-35")
+
+    def test_entry_dropped_when_instance_collected(self):
+        cache = StaticAttributeCache()
+        accessor_function = get_accessor("instance.model_name")
+        client = ChatClient("gpt-4")
+        self.assertEqual(cache.resolve(client, accessor_function, {"instance": client}), "gpt-4")
+        self.assertEqual(len(cache), 1)
+        del client
+        self.assertEqual(len(cache), 0)
+
+    def test_unhashable_and_unreferenceable_instances(self):
+        cache = StaticAttributeCache()
+        accessor_function = get_accessor("instance|type_name")
+        unhashable = ChatClient("gpt-4")
+        unhashable.__class__.__hash__ = None
+        try:
+            self.assertEqual(cache.resolve(unhashable, accessor_function, {"instance": unhashable}), "ChatClient")
+            self.assertEqual(len(cache), 1)
+        finally:
+            del ChatClient.__hash__
+        self.assertEqual(cache.resolve(42, accessor_function, {"instance": 42}), "int")
+        self.assertEqual(len(cache), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import time
+import unittest
+
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from opentelemetry.trace import Status, StatusCode, set_span_in_context
+
+from monocle_apptrace.aggregation import (COUNT_KEY, DURATION_MAX_KEY, DURATION_MIN_KEY, DURATION_SUM_KEY,
+                                          EXEMPLAR_COUNT_KEY, AggregatingSpanProcessor)
+
+LLM_ATTRIBUTES = {"span.type": "inference", "entity.1.type": "inference.azure_oai", "entity.2.name": "gpt-4o-mini"}
+RETRIEVER_ATTRIBUTES = {"span.type": "retrieval", "entity.1.name": "Chroma"}
+TOKENS = {"completion_tokens": 10, "prompt_tokens": 90, "total_tokens": 100}
+
+
+class TestAggregatingSpanProcessor(unittest.TestCase):
+
+    def setUp(self):
+        self.exporter = InMemorySpanExporter()
+        self.processor = AggregatingSpanProcessor(SimpleSpanProcessor(self.exporter), min_count=5, max_exemplars=2)
+        provider = TracerProvider()
+        provider.add_span_processor(self.processor)
+        self.tracer = provider.get_tracer("monocle_apptrace")
+
+    def call_llm(self, session):
+        with self.tracer.start_as_current_span("langchain.chat", attributes={**LLM_ATTRIBUTES, "session.id": session}) as span:
+            span.add_event("data.input", {"input": "what is coffee?"})
+            span.add_event("metadata", TOKENS)
+
+    def get_spans(self, name):
+        return [span for span in self.exporter.get_finished_spans() if span.name == name]
+
+    def test_loop_is_folded(self):
+        with self.tracer.start_as_current_span("langchain.workflow") as root:
+            for _ in range(20):
+                with self.tracer.start_as_current_span("langchain.retriever", attributes=RETRIEVER_ATTRIBUTES):
+                    pass
+                self.call_llm("s1")
+            with self.tracer.start_as_current_span("langchain.chat", attributes=LLM_ATTRIBUTES) as failed:
+                failed.set_status(Status(StatusCode.ERROR))
+            # Different entities, not folded with the other calls
+            for _ in range(3):
+                with self.tracer.start_as_current_span("langchain.chat", attributes={**LLM_ATTRIBUTES, "entity.2.name": "gpt-4o"}):
+                    pass
+
+        spans = self.exporter.get_finished_spans()
+        # root, 2 groups of 2 exemplars and a summary, the failed call and 3 other model calls
+        self.assertEqual(len(spans), 1 + 2 * 3 + 1 + 3)
+        llm_spans = [span for span in self.get_spans("langchain.chat") if span.attributes.get("entity.2.name") == "gpt-4o-mini"]
+        summary = next(span for span in llm_spans if COUNT_KEY in span.attributes)
+        self.assertEqual(summary.attributes[COUNT_KEY], 18)
+        self.assertEqual(summary.attributes[EXEMPLAR_COUNT_KEY], 2)
+        self.assertEqual(summary.attributes["session.id"], "s1")
+        self.assertEqual(summary.attributes["entity.2.name"], "gpt-4o-mini")
+        self.assertEqual(summary.attributes["aggregate.total_tokens"], 1800)
+        self.assertLessEqual(summary.attributes[DURATION_MIN_KEY], summary.attributes[DURATION_MAX_KEY])
+        self.assertLessEqual(summary.attributes[DURATION_MAX_KEY], summary.attributes[DURATION_SUM_KEY])
+        self.assertEqual(summary.parent.span_id, root.get_span_context().span_id)
+        self.assertNotIn(summary.context.span_id, [span.context.span_id for span in spans if span is not summary])
+        # The token totals over the exported spans are unchanged
+        total_tokens = sum(event.attributes["total_tokens"] for span in llm_spans
+                           for event in span.events if event.name == "metadata")
+        self.assertEqual(total_tokens, 20 * TOKENS["total_tokens"])
+        self.assertEqual(len([span for span in spans if span.status.status_code == StatusCode.ERROR]), 1)
+
+    def test_small_groups_and_parents_kept(self):
+        with self.tracer.start_as_current_span("langchain.workflow"):
+            for _ in range(4):
+                self.call_llm("s1")
+            for _ in range(5):
+                with self.tracer.start_as_current_span("langchain.task"):
+                    self.call_llm("s1")
+        # The tasks have children and the calls are in groups of one or four
+        self.assertEqual(len(self.exporter.get_finished_spans()), 1 + 4 + 5 + 5)
+
+    def test_orphans_flushed(self):
+        processor = AggregatingSpanProcessor(SimpleSpanProcessor(self.exporter), max_buffer_age_millis=10)
+        provider = TracerProvider()
+        provider.add_span_processor(processor)
+        tracer = provider.get_tracer("monocle_apptrace")
+        parent = tracer.start_span("langchain.workflow")
+        with tracer.start_as_current_span("langchain.task", context=set_span_in_context(parent)):
+            pass
+        self.assertEqual(len(self.exporter.get_finished_spans()), 0)
+        time.sleep(0.02)
+        with tracer.start_as_current_span("other.workflow"):
+            pass
+        self.assertEqual([span.name for span in self.exporter.get_finished_spans()], ["langchain.task", "other.workflow"])
+        parent.end()
+        self.assertEqual(len(self.exporter.get_finished_spans()), 3)
+
+    def test_orphans_flushed_without_more_spans(self):
+        processor = AggregatingSpanProcessor(SimpleSpanProcessor(self.exporter), max_buffer_age_millis=50)
+        provider = TracerProvider()
+        provider.add_span_processor(processor)
+        tracer = provider.get_tracer("monocle_apptrace")
+        parent = tracer.start_span("langchain.workflow")
+        with tracer.start_as_current_span("langchain.task", context=set_span_in_context(parent)):
+            pass
+        self.assertEqual(len(self.exporter.get_finished_spans()), 0)
+        # No span ends after the orphan, the worker flushes it once it is too old
+        time.sleep(0.3)
+        self.assertEqual([span.name for span in self.exporter.get_finished_spans()], ["langchain.task"])
+        self.assertEqual(processor._buffered_spans, 0)
+        processor.shutdown()
+        self.assertFalse(processor._worker.is_alive())
+
+    def test_force_flush(self):
+        parent = self.tracer.start_span("langchain.workflow")
+        for _ in range(10):
+            with self.tracer.start_as_current_span("langchain.chat", context=set_span_in_context(parent),
+                                                   attributes=LLM_ATTRIBUTES):
+                pass
+        self.assertEqual(len(self.exporter.get_finished_spans()), 0)
+        self.processor.force_flush()
+        self.assertEqual(len(self.exporter.get_finished_spans()), 3)
+        self.assertEqual(self.exporter.get_finished_spans()[-1].attributes[COUNT_KEY], 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,7 +3,7 @@ import unittest
 from monocle_apptrace.wrapper import WrapperMethod
 from opentelemetry.sdk.trace.export import BatchSpanProcessor, SimpleSpanProcessor
 from monocle_apptrace.instrumentor import setup_monocle_telemetry
-from monocle_apptrace.wrap_common import task_wrapper
+from monocle_apptrace.wrap_common import task_wrapper, refresh_root_span_attributes
 from monocle_apptrace.constants import service_type_map, service_name_map
 from dummy_class import DummyClass
 from test_exporter import TestExporter
@@ -41,6 +41,7 @@ class TestHandler(unittest.TestCase):
             else:
                 entity_name = "test123"
                 os.environ[entity_name_env] = entity_name
+            refresh_root_span_attributes()
 
             self.test_span_exporter.set_trace_check({
                 "entity.2.name": entity_name,
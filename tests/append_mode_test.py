@@ -0,0 +1,144 @@
+import base64
+import gzip
+import json
+import os
+import time
+import unittest
+from unittest.mock import patch
+
+from opentelemetry.sdk.resources import SERVICE_NAME, Resource
+from opentelemetry.sdk.trace import TracerProvider
+
+from monocle_apptrace.exporters.aws.s3_exporter import S3SpanExporter
+from monocle_apptrace.exporters.azure.blob_exporter import AzureBlobSpanExporter
+from object_store_stand_ins import LocalBlobServiceClient, LocalS3Client
+
+PART_SIZE = 4096
+
+
+def get_spans(count):
+    tracer = TracerProvider(resource=Resource({SERVICE_NAME: "coffee_bot"})).get_tracer("monocle_apptrace")
+    spans = []
+    for index in range(count):
+        with tracer.start_as_current_span(f"span_{index}") as span:
+            # Incompressible, so the compressed objects span several parts too
+            span.add_event("data.output", {"response": os.urandom(300).hex()})
+        spans.append(span)
+    return spans
+
+
+def get_names(data):
+    return [json.loads(line)["name"] for line in data.splitlines()]
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+@patch.object(S3SpanExporter, "min_part_size", PART_SIZE)
+class TestAppendMode(unittest.TestCase):
+
+    def get_s3_exporter(self, s3_client, **kwargs):
+        options = dict(bucket_name="test-bucket", s3_client=s3_client, append_mode=True, part_size=PART_SIZE,
+                       max_batch_size=10, backoff_in_seconds=0.01)
+        options.update(kwargs)
+        return S3SpanExporter(**options)
+
+    def test_s3_multipart_object(self):
+        s3_client = LocalS3Client(min_part_size=PART_SIZE)
+        exporter = self.get_s3_exporter(s3_client)
+        exporter.export(get_spans(60))
+        self.assertTrue(exporter.force_flush())
+        object_keys = [key for key in s3_client.objects if key.endswith(".ndjson")]
+        self.assertEqual(len(object_keys), 1)
+        # The batches of 10 spans are appended to one object uploaded in parts
+        self.assertGreater(s3_client.calls.count("upload_part"), 5)
+        self.assertEqual(s3_client.calls.count("complete_multipart_upload"), 1)
+        self.assertEqual(get_names(s3_client.objects[object_keys[0]]), [f"span_{index}" for index in range(60)])
+        manifest = json.loads(s3_client.objects[object_keys[0][:-len(".ndjson")] + ".manifest.json"])
+        self.assertEqual(manifest["object"], object_keys[0])
+        self.assertEqual(manifest["span_count"], 60)
+        self.assertFalse(s3_client.uploads)
+        exporter.shutdown()
+
+    def test_s3_gzip_stream_across_parts(self):
+        s3_client = LocalS3Client(min_part_size=PART_SIZE)
+        exporter = self.get_s3_exporter(s3_client, compression="gzip", write_manifest=False)
+        exporter.export(get_spans(60))
+        self.assertTrue(exporter.force_flush())
+        key, = s3_client.objects
+        self.assertTrue(key.endswith(".ndjson.gz"))
+        self.assertEqual(s3_client.content_encodings[key], "gzip")
+        self.assertGreater(s3_client.calls.count("upload_part"), 1)
+        # One gzip stream, not one per part or batch
+        self.assertEqual(get_names(gzip.decompress(s3_client.objects[key])), [f"span_{index}" for index in range(60)])
+        exporter.shutdown()
+
+    def test_small_object_uploaded_in_one_request(self):
+        s3_client = LocalS3Client(min_part_size=PART_SIZE)
+        exporter = self.get_s3_exporter(s3_client, part_size=1024 * 1024, write_manifest=False)
+        exporter.export(get_spans(3))
+        self.assertTrue(exporter.force_flush())
+        self.assertEqual(s3_client.calls, ["put_object"])
+        key, = s3_client.objects
+        self.assertEqual(get_names(s3_client.objects[key]), ["span_0", "span_1", "span_2"])
+        exporter.shutdown()
+
+    def test_max_object_bytes_and_interval(self):
+        s3_client = LocalS3Client(min_part_size=PART_SIZE)
+        exporter = self.get_s3_exporter(s3_client, max_object_bytes=3 * PART_SIZE, object_interval=0.2,
+                                        export_interval=0.05, write_manifest=False)
+        exporter.export(get_spans(60))
+        # The full objects are committed as they fill up, the last one once it has been open for the interval
+        self.assertTrue(wait_for(lambda: not exporter._open_objects and not exporter.export_queue
+                                 and s3_client.calls[-1] != "upload_part"))
+        self.assertGreater(len(s3_client.objects), 2)
+        names = [name for key in sorted(s3_client.objects) for name in get_names(s3_client.objects[key])]
+        self.assertEqual(sorted(names), sorted(f"span_{index}" for index in range(60)))
+        # An object is committed once a batch takes it over max_object_bytes
+        for data in s3_client.objects.values():
+            self.assertLess(len(data), 3 * PART_SIZE + exporter.max_batch_size * 2000)
+        exporter.shutdown()
+
+    def test_part_retry_and_abort(self):
+        s3_client = LocalS3Client(min_part_size=PART_SIZE)
+        exporter = self.get_s3_exporter(s3_client, max_retries=1, write_manifest=False)
+        s3_client.part_failures = 1
+        exporter.export(get_spans(30))
+        self.assertTrue(exporter.force_flush())
+        key, = s3_client.objects
+        self.assertEqual(len(get_names(s3_client.objects[key])), 30)
+
+        s3_client.part_failures = 2
+        with self.assertLogs("monocle_apptrace.exporters.base_exporter", level="ERROR") as logs:
+            exporter.export(get_spans(30))
+            self.assertTrue(exporter.force_flush())
+        # The first batch fills a part, the object is aborted and the next batches open another one
+        self.assertIn("dropped 10 spans", logs.output[0])
+        self.assertEqual(len(s3_client.aborted), 1)
+        self.assertEqual(sum(len(get_names(data)) for data in s3_client.objects.values()), 50)
+        self.assertFalse(s3_client.uploads)
+        exporter.shutdown()
+
+    def test_blob_staged_blocks(self):
+        service_client = LocalBlobServiceClient()
+        exporter = AzureBlobSpanExporter(container_name="traces", blob_service_client=service_client,
+                                         append_mode=True, part_size=PART_SIZE, max_batch_size=10,
+                                         compression="gzip", write_manifest=False)
+        exporter.export(get_spans(60))
+        self.assertTrue(exporter.force_flush())
+        name, = service_client.blobs
+        self.assertEqual(service_client.content_settings[name].content_encoding, "gzip")
+        self.assertEqual(get_names(gzip.decompress(service_client.blobs[name])),
+                         [f"span_{index}" for index in range(60)])
+        self.assertFalse(service_client.staged_blocks)
+        block_id = exporter._upload_part(exporter._begin_object("blob", None, None), 12, b"{}")
+        self.assertEqual(base64.b64decode(block_id), b"00000012")
+        exporter.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
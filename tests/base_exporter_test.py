@@ -0,0 +1,142 @@
+import json
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SpanExportResult
+
+from monocle_apptrace.exporters.aws.s3_exporter import S3SpanExporter
+from monocle_apptrace.exporters.base_exporter import SpanExporterBase
+
+
+class UploadError(Exception):
+    pass
+
+
+class RecordingExporter(SpanExporterBase):
+    retryable_exceptions = (UploadError,)
+
+    def __init__(self, failures=0, write_manifest=False, **kwargs):
+        super().__init__(write_manifest=write_manifest, **kwargs)
+        self.failures = failures
+        self.attempts = 0
+        self.uploads = []
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def _upload(self, key, data, content_type=None, content_encoding=None) -> None:
+        self.gate.wait()
+        self.attempts += 1
+        if self.failures > 0:
+            self.failures -= 1
+            raise UploadError("connection reset")
+        self.uploads.append([json.loads(line)["name"] for line in data.splitlines()])
+
+
+def get_spans(count):
+    tracer = TracerProvider().get_tracer("monocle_apptrace")
+    spans = []
+    for index in range(count):
+        with tracer.start_as_current_span(f"span_{index}") as span:
+            pass
+        spans.append(span)
+    return spans
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+class TestSpanExporterBase(unittest.TestCase):
+
+    def test_size_trigger(self):
+        exporter = RecordingExporter(max_batch_size=3, export_interval=60)
+        exporter.export(get_spans(7))
+        self.assertTrue(wait_for(lambda: len(exporter.uploads) == 2))
+        self.assertEqual(exporter.uploads, [["span_0", "span_1", "span_2"], ["span_3", "span_4", "span_5"]])
+        self.assertTrue(exporter.force_flush())
+        self.assertEqual(exporter.uploads[2], ["span_6"])
+        exporter.shutdown()
+
+    def test_byte_and_age_triggers(self):
+        spans = get_spans(4)
+        exporter = RecordingExporter(export_interval=60)
+        exporter.max_batch_bytes = 2 * len(exporter._serialize_span(spans[0])) - 1
+        exporter.export(spans)
+        self.assertTrue(wait_for(lambda: len(exporter.uploads) == 2))
+        self.assertEqual(exporter.uploads, [["span_0", "span_1"], ["span_2", "span_3"]])
+        exporter.shutdown()
+
+        exporter = RecordingExporter(export_interval=0.05)
+        exporter.export(spans)
+        self.assertTrue(wait_for(lambda: len(exporter.uploads) == 1))
+        exporter.shutdown()
+
+    def test_retries_dont_block(self):
+        exporter = RecordingExporter(failures=1, max_batch_size=2, export_interval=60, backoff_in_seconds=0.5)
+        start = time.monotonic()
+        self.assertEqual(exporter.export(get_spans(2)), SpanExportResult.SUCCESS)
+        self.assertTrue(wait_for(lambda: exporter.attempts == 1))
+        self.assertEqual(exporter.export(get_spans(2)), SpanExportResult.SUCCESS)
+        # The next batch is uploaded while the failed one waits for its retry
+        self.assertTrue(wait_for(lambda: len(exporter.uploads) == 1))
+        self.assertLess(time.monotonic() - start, 0.4)
+        self.assertTrue(exporter.force_flush())
+        self.assertEqual(exporter.attempts, 3)
+        self.assertEqual(len(exporter.uploads), 2)
+        exporter.shutdown()
+
+    def test_gives_up_after_max_retries(self):
+        exporter = RecordingExporter(failures=10, max_retries=2, backoff_in_seconds=0.01)
+        exporter.export(get_spans(1))
+        with self.assertLogs("monocle_apptrace.exporters.base_exporter", level="ERROR"):
+            self.assertTrue(exporter.force_flush())
+        self.assertEqual(exporter.attempts, 3)
+        self.assertEqual(exporter.uploads, [])
+        exporter.shutdown()
+
+    def test_bounded_queue(self):
+        exporter = RecordingExporter(max_batch_size=1, max_queue_size=3, export_interval=60)
+        exporter.gate.clear()
+        exporter.export(get_spans(1))
+        self.assertTrue(wait_for(lambda: not exporter.export_queue))
+        with self.assertLogs("monocle_apptrace.exporters.base_exporter", level="WARNING"):
+            exporter.export(get_spans(5))
+        self.assertEqual(len(exporter.export_queue), 3)
+        self.assertFalse(exporter.force_flush(timeout_millis=50))
+        exporter.gate.set()
+        self.assertTrue(exporter.force_flush())
+        self.assertEqual(len(exporter.uploads), 4)
+        exporter.shutdown()
+
+    def test_shutdown_drains(self):
+        exporter = RecordingExporter(export_interval=60)
+        exporter.export(get_spans(3))
+        exporter.shutdown()
+        self.assertEqual(exporter.uploads, [["span_0", "span_1", "span_2"]])
+        self.assertEqual(exporter.export(get_spans(1)), SpanExportResult.FAILURE)
+        self.assertFalse(exporter._worker.is_alive())
+
+    @patch("boto3.client")
+    def test_s3_exporter(self, mock_boto_client):
+        mock_s3_client = MagicMock()
+        mock_boto_client.return_value = mock_s3_client
+        exporter = S3SpanExporter(bucket_name="test-bucket", region_name="us-east-1", export_interval=60,
+                                  write_manifest=False)
+        exporter.export(get_spans(3))
+        exporter.export(get_spans(2))
+        mock_s3_client.put_object.assert_not_called()
+        self.assertTrue(exporter.force_flush())
+        body = mock_s3_client.put_object.call_args.kwargs["Body"]
+        self.assertEqual([json.loads(line)["name"] for line in body.splitlines()],
+                         ["span_0", "span_1", "span_2", "span_0", "span_1"])
+        exporter.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,198 @@
+import asyncio
+import gc
+import unittest
+
+from langchain_core.language_models import FakeListChatModel
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import Runnable, RunnableLambda, RunnableSequence
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from opentelemetry.trace import StatusCode
+from wrapt import FunctionWrapper
+
+from monocle_apptrace.batch import (ERROR_COUNT_KEY, ITEM_CALL_COUNT_KEY, ITEM_COUNT_KEY, ITEM_INDEX_KEY,
+                                    MAX_CONCURRENCY_KEY, PEAK_CONCURRENCY_KEY, SAMPLED_ITEM_COUNT_KEY, _active_batches)
+from monocle_apptrace.wrap_common import abatch_wrapper, atask_wrapper, batch_wrapper, llm_wrapper, task_wrapper
+
+BATCH_SIZE = 100
+
+
+class ChatModel:
+    def invoke(self, prompt):
+        return prompt.upper()
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.exporter = InMemorySpanExporter()
+        provider = TracerProvider()
+        provider.add_span_processor(SimpleSpanProcessor(self.exporter))
+        self.tracer = provider.get_tracer("monocle_apptrace")
+        llm_to_wrap = {"package": "langchain.chat_models.base", "object": "BaseChatModel", "span_name": "langchain.chat"}
+        model_class = type("ChatModel", (ChatModel,), {"invoke": FunctionWrapper(ChatModel.invoke, llm_wrapper(self.tracer, llm_to_wrap))})
+        self.model = model_class()
+
+    def get_runnable(self, item_sample_rate=0.0, func=None):
+        """A RunnableLambda instrumented like the langchain runnables, invoking the chat model for every input."""
+        task_to_wrap = {"package": "langchain.schema.runnable", "span_name": "langchain.workflow"}
+        batch_to_wrap = {"package": "langchain.schema.runnable", "span_name": "langchain.batch",
+                         "batch_item_sample_rate": item_sample_rate}
+        runnable_class = type("Runnable", (RunnableLambda,), {
+            "invoke": FunctionWrapper(RunnableLambda.invoke, task_wrapper(self.tracer, task_to_wrap)),
+            "ainvoke": FunctionWrapper(RunnableLambda.ainvoke, atask_wrapper(self.tracer, task_to_wrap)),
+            "batch": FunctionWrapper(Runnable.batch, batch_wrapper(self.tracer, batch_to_wrap)),
+            "batch_as_completed": FunctionWrapper(Runnable.batch_as_completed, batch_wrapper(self.tracer, batch_to_wrap)),
+            "abatch": FunctionWrapper(Runnable.abatch, abatch_wrapper(self.tracer, batch_to_wrap)),
+            "abatch_as_completed": FunctionWrapper(Runnable.abatch_as_completed,
+                                                   abatch_wrapper(self.tracer, batch_to_wrap)),
+        })
+        runnable = runnable_class(func or self.model.invoke)
+        # Unnamed like a RunnableSequence, the span names are not suffixed
+        runnable.name = None
+        return runnable
+
+    def get_sequence(self, item_sample_rate=0.0):
+        """prompt | chat model | parser, with the steps and the sequence batch instrumented like the langchain maps."""
+        def instrument(cls, span_name, wrapper=task_wrapper):
+            to_wrap = {"package": cls.__module__, "object": cls.__name__, "span_name": span_name}
+            return type(cls.__name__, (cls,), {"invoke": FunctionWrapper(cls.invoke, wrapper(self.tracer, to_wrap))})
+
+        batch_to_wrap = {"package": "langchain_core.runnables.base", "object": "RunnableSequence",
+                         "span_name": "langchain.batch", "batch_item_sample_rate": item_sample_rate}
+        sequence_class = type("RunnableSequence", (RunnableSequence,), {
+            "batch": FunctionWrapper(RunnableSequence.batch, batch_wrapper(self.tracer, batch_to_wrap))})
+        prompt = instrument(ChatPromptTemplate, "langchain.prompt").from_template("Tell me about {topic}")
+        model = instrument(FakeListChatModel, "langchain.chat", llm_wrapper)(responses=["Coffee is a drink"])
+        return sequence_class(prompt, model, instrument(StrOutputParser, "langchain.parser")())
+
+    def test_sequence_items(self):
+        inputs = [{"topic": f"coffee {i}"} for i in range(10)]
+        outputs = self.get_sequence(item_sample_rate=0.2).batch(inputs, {"max_concurrency": 3})
+        self.assertEqual(outputs, ["Coffee is a drink"] * 10)
+        batch_span = self.get_batch_span()
+        # An input is one item, whatever its number of steps
+        self.assertEqual(batch_span.attributes[ITEM_COUNT_KEY], 10)
+        self.assertEqual(batch_span.attributes[ITEM_CALL_COUNT_KEY], 10)
+        self.assertEqual(batch_span.attributes[SAMPLED_ITEM_COUNT_KEY], 2)
+        self.assertIn("batch.item_latency.p50_ms", batch_span.attributes)
+
+        spans = self.exporter.get_finished_spans()
+        items = [span for span in spans if span.name == "langchain.batch.item"]
+        self.assertEqual(sorted(item.attributes[ITEM_INDEX_KEY] for item in items), [4, 9])
+        for item in items:
+            self.assertEqual(item.parent.span_id, batch_span.context.span_id)
+            # Every sampled item has the spans of all its steps
+            steps = [span for span in spans if span.parent is not None and span.parent.span_id == item.context.span_id]
+            self.assertEqual(sorted(span.name for span in steps), ["langchain.chat", "langchain.parser", "langchain.prompt"])
+            self.assertLessEqual(item.start_time, min(span.start_time for span in steps))
+            self.assertGreaterEqual(item.end_time, max(span.end_time for span in steps))
+        self.assertEqual(len(spans), 1 + 2 * 4)
+        self.assertEqual(_active_batches, {})
+
+    def get_batch_span(self):
+        return next(span for span in self.exporter.get_finished_spans() if span.name == "langchain.batch")
+
+    def test_one_span_per_batch(self):
+        inputs = [f"prompt {i}" for i in range(BATCH_SIZE)]
+        outputs = self.get_runnable().batch(inputs, {"max_concurrency": 4})
+        self.assertEqual(outputs, [prompt.upper() for prompt in inputs])
+
+        spans = self.exporter.get_finished_spans()
+        self.assertEqual([span.name for span in spans], ["langchain.batch"])
+        attributes = spans[0].attributes
+        self.assertEqual(attributes[ITEM_COUNT_KEY], BATCH_SIZE)
+        self.assertEqual(attributes[ITEM_CALL_COUNT_KEY], BATCH_SIZE)
+        self.assertEqual(attributes[SAMPLED_ITEM_COUNT_KEY], 0)
+        self.assertEqual(attributes[MAX_CONCURRENCY_KEY], 4)
+        self.assertTrue(1 <= attributes[PEAK_CONCURRENCY_KEY] <= 4)
+        self.assertLessEqual(attributes["batch.item_latency.p50_ms"], attributes["batch.item_latency.p99_ms"])
+        self.assertLessEqual(attributes["batch.item_latency.p99_ms"], attributes["batch.item_latency.max_ms"])
+        self.assertEqual(attributes[ERROR_COUNT_KEY], 0)
+        self.assertEqual(_active_batches, {})
+
+    def test_sampled_items(self):
+        self.get_runnable(item_sample_rate=0.1).batch([f"prompt {i}" for i in range(BATCH_SIZE)])
+        batch_span = self.get_batch_span()
+        self.assertEqual(batch_span.attributes[SAMPLED_ITEM_COUNT_KEY], BATCH_SIZE // 10)
+        items = [span for span in self.exporter.get_finished_spans() if span.name == "langchain.workflow"]
+        self.assertEqual(len(items), BATCH_SIZE // 10)
+        for item in items:
+            self.assertEqual(item.parent.span_id, batch_span.context.span_id)
+        # Calls below a sampled item are traced, below the other items nothing is
+        inferences = [span for span in self.exporter.get_finished_spans() if span.name == "langchain.chat"]
+        self.assertEqual(sorted(span.parent.span_id for span in inferences), sorted(item.context.span_id for item in items))
+
+    def test_errors(self):
+        def fail_odd(prompt):
+            if int(prompt) % 2:
+                raise ValueError(prompt)
+            return prompt
+
+        runnable = self.get_runnable(func=fail_odd)
+        outputs = runnable.batch([str(i) for i in range(10)], return_exceptions=True)
+        self.assertEqual(sum(isinstance(output, ValueError) for output in outputs), 5)
+        self.assertEqual(self.get_batch_span().attributes[ERROR_COUNT_KEY], 5)
+
+        self.exporter.clear()
+        with self.assertRaises(ValueError):
+            runnable.batch([str(i) for i in range(10)])
+        self.assertEqual(self.get_batch_span().status.status_code, StatusCode.ERROR)
+        self.assertEqual(_active_batches, {})
+
+    def test_batch_as_completed(self):
+        results = self.get_runnable().batch_as_completed([f"prompt {i}" for i in range(BATCH_SIZE)])
+        self.assertEqual(len(self.exporter.get_finished_spans()), 0)
+        self.assertEqual(sorted(index for (index, _) in results), list(range(BATCH_SIZE)))
+        self.assertEqual(self.get_batch_span().attributes[ITEM_CALL_COUNT_KEY], BATCH_SIZE)
+
+    def test_unconsumed_batch_as_completed(self):
+        runnable = self.get_runnable()
+        results = runnable.batch_as_completed([f"prompt {i}" for i in range(10)])
+        self.assertEqual(len(_active_batches), 1)
+        del results
+        gc.collect()
+        self.assertEqual(_active_batches, {})
+        self.assertEqual(self.get_batch_span().attributes[ITEM_CALL_COUNT_KEY], 0)
+
+        # Abandoned after the first result
+        self.exporter.clear()
+        results = runnable.batch_as_completed([f"prompt {i}" for i in range(10)])
+        next(results)
+        del results
+        gc.collect()
+        self.assertEqual(_active_batches, {})
+        self.assertGreater(self.get_batch_span().attributes[ITEM_CALL_COUNT_KEY], 0)
+
+    def test_unconsumed_abatch_as_completed(self):
+        runnable = self.get_runnable()
+
+        async def abandon(consumed):
+            results = runnable.abatch_as_completed([f"prompt {i}" for i in range(10)])
+            for _ in range(consumed):
+                await results.__anext__()
+            await asyncio.sleep(0)
+
+        for consumed in (0, 1):
+            self.exporter.clear()
+            asyncio.run(abandon(consumed))
+            gc.collect()
+            self.assertEqual(_active_batches, {})
+            self.assertEqual(len([span for span in self.exporter.get_finished_spans()
+                                  if span.name == "langchain.batch"]), 1)
+
+    def test_abatch(self):
+        inputs = [f"prompt {i}" for i in range(BATCH_SIZE)]
+        outputs = asyncio.run(self.get_runnable(item_sample_rate=0.5).abatch(inputs))
+        self.assertEqual(outputs, [prompt.upper() for prompt in inputs])
+        batch_span = self.get_batch_span()
+        self.assertEqual(batch_span.attributes[ITEM_CALL_COUNT_KEY], BATCH_SIZE)
+        self.assertEqual(batch_span.attributes[SAMPLED_ITEM_COUNT_KEY], BATCH_SIZE // 2)
+        self.assertEqual(len([span for span in self.exporter.get_finished_spans() if span.name == "langchain.chat"]),
+                         BATCH_SIZE // 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+"""
+Compares the CPU cost of compressing the objects uploaded by the S3 and Blob
+exporters with the bytes saved, for gzip levels and lzma presets. A batch holds
+500 spans of chat requests: a workflow, a retrieval and an inference span with
+the prompt, the retrieved context and the response, like the langchain
+instrumentation records them.
+
+    python tests/compression_benchmark.py
+"""
+import random
+import time
+
+from opentelemetry.sdk.resources import SERVICE_NAME, Resource
+from opentelemetry.sdk.trace import TracerProvider
+
+from monocle_apptrace.exporters.base_exporter import SpanExporterBase
+
+BATCH_SPANS = 500
+ROUNDS = 5
+SETTINGS = [(None, None), ("gzip", 1), ("gzip", 6), ("gzip", 9), ("lzma", 0), ("lzma", 1), ("lzma", 6)]
+WORDS = ("coffee", "espresso", "grind", "brew", "roast", "bean", "water", "temperature", "ratio", "extraction",
+         "acidity", "body", "aroma", "filter", "pressure", "milk", "crema", "origin", "altitude", "process")
+SYSTEM_PROMPT = "You are a helpful assistant answering questions about coffee, using only the provided context."
+
+
+class BenchmarkExporter(SpanExporterBase):
+    def _upload(self, data: bytes) -> None:
+        pass
+
+
+def get_text(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def get_spans():
+    rng = random.Random(7)
+    tracer = TracerProvider(resource=Resource({SERVICE_NAME: "coffee_bot"})).get_tracer("monocle_apptrace")
+    spans = []
+    while len(spans) < BATCH_SPANS:
+        question = get_text(rng, 12)
+        context = [get_text(rng, 60) for _ in range(3)]
+        with tracer.start_as_current_span("langchain.workflow", attributes={
+                "span.type": "workflow", "entity.1.name": "coffee_bot", "entity.1.type": "workflow.langchain"}) as root:
+            with tracer.start_as_current_span("langchain_core.vectorstores.base.VectorStoreRetriever", attributes={
+                    "span.type": "retrieval", "entity.count": 2, "entity.1.name": "Chroma",
+                    "entity.1.type": "vectorstore.Chroma", "entity.2.name": "text-embedding-3-small",
+                    "entity.2.type": "model.embedding.text-embedding-3-small"}) as retrieval:
+                retrieval.add_event("data.input", {"input": question})
+                retrieval.add_event("data.output", {"response": context[0][:100]})
+            with tracer.start_as_current_span("langchain_openai.chat_models.base.ChatOpenAI", attributes={
+                    "span.type": "inference", "entity.count": 2, "entity.1.type": "inference.azure_oai",
+                    "entity.1.provider_name": "example.openai.azure.com", "entity.1.deployment": "gpt-4o-mini",
+                    "entity.2.name": "gpt-4o-mini", "entity.2.type": "model.llm.gpt-4o-mini"}) as inference:
+                inference.add_event("data.input", {"input": [f"{{'system': '{SYSTEM_PROMPT}'}}",
+                                                             f"{{'user': '{' '.join(context)} {question}'}}"]})
+                inference.add_event("data.output", {"response": [get_text(rng, 80)]})
+                inference.add_event("metadata", {"completion_tokens": rng.randint(50, 200),
+                                                 "prompt_tokens": rng.randint(200, 400), "total_tokens": 600})
+        spans += [retrieval, inference, root]
+    return spans[:BATCH_SPANS]
+
+
+def main():
+    spans = get_spans()
+    print(f"{BATCH_SPANS} spans per object")
+    plain_size = None
+    for compression, level in SETTINGS:
+        exporter = BenchmarkExporter(compression=compression, compression_level=level)
+        lines = [exporter._serialize_span(span) for span in spans]
+        seconds = []
+        for _ in range(ROUNDS):
+            start = time.process_time()
+            data = exporter._serialize_batch(lines)
+            seconds.append(time.process_time() - start)
+        plain_size = plain_size or len(data)
+        label = f"{compression} {level}" if compression else "none"
+        saved_per_second = (plain_size - len(data)) / max(min(seconds), 1e-6) / 2 ** 20
+        print(f"{label:>7}: {min(seconds) * 1000:7.1f} ms CPU per object, {len(data) / 1024:7.1f} KB, "
+              f"{plain_size / len(data):5.1f}x smaller, {saved_per_second:6.1f} MB saved per CPU second")
+
+
+if __name__ == "__main__":
+    main()
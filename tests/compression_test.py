@@ -0,0 +1,75 @@
+import gzip
+import json
+import lzma
+import os
+import unittest
+from unittest.mock import MagicMock, patch
+
+from opentelemetry.sdk.trace import TracerProvider
+
+from monocle_apptrace.exporters.aws.s3_exporter import S3SpanExporter
+from monocle_apptrace.exporters.azure.blob_exporter import AzureBlobSpanExporter
+from monocle_apptrace.exporters.compression import get_compression
+from monocle_apptrace.exporters.dedup import ContentDeduplicator, rehydrate
+
+
+def get_spans(count):
+    tracer = TracerProvider().get_tracer("monocle_apptrace")
+    spans = []
+    for index in range(count):
+        with tracer.start_as_current_span(f"span_{index}") as span:
+            span.add_event("data.input", {"input": ["You are a helpful assistant. " * 20, f"question {index}"]})
+        spans.append(span)
+    return spans
+
+
+class TestObjectCompression(unittest.TestCase):
+
+    @patch("boto3.client")
+    def test_s3_gzip(self, mock_boto_client):
+        mock_s3_client = MagicMock()
+        mock_boto_client.return_value = mock_s3_client
+        exporter = S3SpanExporter(bucket_name="test-bucket", region_name="us-east-1", compression="gzip",
+                                  write_manifest=False)
+        spans = get_spans(20)
+        exporter.export(spans)
+        self.assertTrue(exporter.force_flush())
+        arguments = mock_s3_client.put_object.call_args.kwargs
+        self.assertTrue(arguments["Key"].endswith(".ndjson.gz"))
+        self.assertEqual(arguments["ContentEncoding"], "gzip")
+        self.assertEqual(arguments["ContentType"], "application/x-ndjson")
+        plain = exporter._get_batch_records([exporter._serialize_span(span) for span in spans])
+        self.assertEqual(gzip.decompress(arguments["Body"]), b"\n".join(plain) + b"\n")
+        self.assertLess(len(arguments["Body"]), len(gzip.decompress(arguments["Body"])) / 5)
+        exporter.shutdown()
+
+    @patch("monocle_apptrace.exporters.azure.blob_exporter.BlobServiceClient")
+    def test_blob_lzma_with_dedup(self, mock_blob_service):
+        blob_client = mock_blob_service.from_connection_string.return_value.get_blob_client.return_value
+        exporter = AzureBlobSpanExporter(connection_string="connection", container_name="traces",
+                                         compression="lzma", deduplicator=ContentDeduplicator(),
+                                         write_manifest=False)
+        exporter.export(get_spans(5))
+        self.assertTrue(exporter.force_flush())
+        data, = blob_client.upload_blob.call_args.args
+        content_settings = blob_client.upload_blob.call_args.kwargs["content_settings"]
+        self.assertEqual(content_settings.content_type, "application/x-xz")
+        self.assertIsNone(content_settings.content_encoding)
+        blob_name = mock_blob_service.from_connection_string.return_value.get_blob_client.call_args.kwargs["blob"]
+        self.assertTrue(blob_name.endswith(".ndjson.xz"))
+        spans = list(rehydrate(json.loads(line) for line in lzma.decompress(data).splitlines()))
+        self.assertEqual([span["name"] for span in spans], [f"span_{index}" for index in range(5)])
+        exporter.shutdown()
+
+    @patch("boto3.client")
+    def test_compression_options(self, mock_boto_client):
+        mock_boto_client.return_value = MagicMock()
+        with patch.dict(os.environ, {"MONOCLE_EXPORT_COMPRESSION": "gzip"}):
+            self.assertEqual(S3SpanExporter(bucket_name="test-bucket").compression.name, "gzip")
+        self.assertIsNone(S3SpanExporter(bucket_name="test-bucket").compression)
+        with self.assertRaises(ValueError):
+            get_compression("zstd")
+
+
+if __name__ == '__main__':
+    unittest.main()
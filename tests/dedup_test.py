@@ -0,0 +1,163 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+from opentelemetry.sdk.resources import SERVICE_NAME, Resource
+from opentelemetry.sdk.trace import TracerProvider
+
+from monocle_apptrace.exporters.aws.s3_exporter import S3SpanExporter
+from monocle_apptrace.exporters.dedup import (DICTIONARY_KEY, REF_PREFIX, ContentDeduplicator, parse_records,
+                                              read_spans, rehydrate)
+from monocle_apptrace.exporters.file_exporter import FileSpanExporter
+from monocle_apptrace.exporters.object_layout import get_span_info
+from monocle_apptrace.exporters.okahu.okahu_exporter import OkahuSpanExporter
+
+SYSTEM_PROMPT = "You are a helpful assistant answering questions about coffee. " * 20
+
+
+def get_spans(count, trace_count=1):
+    tracer = TracerProvider(resource=Resource({SERVICE_NAME: "dedup_test"})).get_tracer("monocle_apptrace")
+    spans = []
+    for trace_index in range(trace_count):
+        with tracer.start_as_current_span("langchain.workflow") as root:
+            for index in range(count):
+                with tracer.start_as_current_span("langchain.chat") as span:
+                    span.add_event("data.input", {"input": [f"{{'system': '{SYSTEM_PROMPT}'}}",
+                                                            f"{{'user': 'question {trace_index} {index}'}}"]})
+                    span.add_event("data.output", {"response": ["short answer"]})
+                spans.append(span)
+        spans.append(root)
+    return spans
+
+
+class TestContentDeduplication(unittest.TestCase):
+
+    def test_repeated_strings_emitted_once_per_batch(self):
+        deduplicator = ContentDeduplicator()
+        spans = [json.loads(span.to_json()) for span in get_spans(3)]
+        originals = json.loads(json.dumps(spans))
+        records = []
+        for _ in range(2):
+            deduplicator.begin_batch()
+            for span in json.loads(json.dumps(spans)):
+                entries = deduplicator.dedup(span)
+                if entries:
+                    records.append({DICTIONARY_KEY: entries})
+                records.append(span)
+        dictionaries = [record for record in records if DICTIONARY_KEY in record]
+        self.assertEqual(len(dictionaries), 2)
+        self.assertEqual(list(dictionaries[0][DICTIONARY_KEY].values()), [f"{{'system': '{SYSTEM_PROMPT}'}}"])
+        reference = records[1]["events"][0]["attributes"]["input"][0]
+        self.assertTrue(reference.startswith(REF_PREFIX))
+        # Short strings stay inline
+        self.assertEqual(records[1]["events"][0]["attributes"]["input"][1], "{'user': 'question 0 0'}")
+        self.assertEqual(list(rehydrate(records)), originals * 2)
+
+    def test_process_scope(self):
+        deduplicator = ContentDeduplicator(scope="process")
+        spans = [json.loads(span.to_json()) for span in get_spans(3, trace_count=2)]
+        emitted = []
+        for span in spans:
+            deduplicator.begin_batch()
+            emitted.append(deduplicator.dedup(span))
+        # Until a batch carrying them is stored, the entries are emitted again
+        self.assertEqual(len([entries for entries in emitted if entries]), len(spans) - 2)
+        deduplicator.mark_emitted(deduplicator.take_new_digests())
+        emitted = []
+        for span in spans:
+            deduplicator.begin_batch()
+            emitted.append(deduplicator.dedup(span))
+            deduplicator.mark_emitted(deduplicator.take_new_digests())
+        self.assertEqual(len([entries for entries in emitted if entries]), 0)
+        with self.assertRaises(ValueError):
+            ContentDeduplicator(scope="trace")
+
+    def test_file_exporter(self):
+        with tempfile.TemporaryDirectory() as out_path:
+            exporter = FileSpanExporter(out_path=out_path, deduplicator=ContentDeduplicator())
+            spans = get_spans(10, trace_count=2)
+            exporter.export(spans)
+            exporter.shutdown()
+            paths = sorted(os.path.join(out_path, name) for name in os.listdir(out_path))
+            self.assertEqual(len(paths), 2)
+            with open(paths[0], encoding="utf-8") as file:
+                records = parse_records(file.read())
+            # Every trace file has its dictionary
+            self.assertIn(DICTIONARY_KEY, records[0])
+            self.assertEqual(len(records), 1 + 11)
+            rehydrated = list(read_spans(paths))
+        self.assertEqual(sorted(span["context"]["span_id"] for span in rehydrated),
+                         sorted(json.loads(span.to_json())["context"]["span_id"] for span in spans))
+        chat = next(span for span in rehydrated if span["name"] == "langchain.chat")
+        self.assertIn(SYSTEM_PROMPT, chat["events"][0]["attributes"]["input"][0])
+
+    def test_file_exporter_custom_formatter(self):
+        with tempfile.TemporaryDirectory() as out_path:
+            with self.assertLogs("monocle_apptrace.exporters.file_exporter", level="WARNING"):
+                exporter = FileSpanExporter(out_path=out_path, deduplicator=ContentDeduplicator(),
+                                            formatter=lambda span: f"{span.name}\n")
+            self.assertIsNone(exporter.deduplicator)
+            exporter.export(get_spans(2))
+            exporter.shutdown()
+            with open(os.path.join(out_path, os.listdir(out_path)[0]), encoding="utf-8") as file:
+                self.assertEqual(file.read(), "langchain.chat\nlangchain.chat\nlangchain.workflow\n")
+
+    @patch("boto3.client")
+    def test_s3_exporter(self, mock_boto_client):
+        mock_boto_client.return_value = MagicMock()
+        exporter = S3SpanExporter(bucket_name="test-bucket", region_name="us-east-1")
+        lines = [exporter._serialize_span(span) for span in get_spans(50)]
+        plain = exporter._serialize_batch(lines)
+        exporter.deduplicator = ContentDeduplicator()
+        deduplicated = exporter._serialize_batch(lines)
+        self.assertLess(len(deduplicated), len(plain) / 2)
+        records = [json.loads(line) for line in deduplicated.splitlines()]
+        self.assertEqual(list(rehydrate(records)), [json.loads(line) for line in plain.splitlines()])
+
+    @patch("boto3.client")
+    def test_s3_process_scope_dropped_upload(self, mock_boto_client):
+        s3_client = mock_boto_client.return_value
+        exporter = S3SpanExporter(bucket_name="test-bucket", region_name="us-east-1", write_manifest=False,
+                                  deduplicator=ContentDeduplicator(scope="process"))
+
+        def upload_batch():
+            entries = [(exporter._serialize_span(span), get_span_info(span)) for span in get_spans(3)]
+            for upload in exporter._get_uploads(entries):
+                exporter._try_upload(upload)
+            records = [json.loads(line) for line in s3_client.put_object.call_args.kwargs["Body"].splitlines()]
+            return [record for record in records if DICTIONARY_KEY in record]
+
+        s3_client.put_object.side_effect = Exception("Access denied")
+        self.assertEqual(len(upload_batch()), 1)
+        s3_client.put_object.side_effect = None
+        # The dictionary of the dropped object is uploaded with the next one
+        self.assertEqual(len(upload_batch()), 1)
+        self.assertEqual(upload_batch(), [])
+
+    @patch.dict(os.environ, {"OKAHU_API_KEY": "key", "MONOCLE_DEDUP_PAYLOADS": "process"})
+    def test_okahu_exporter_batch_scope(self):
+        session = MagicMock()
+        session.post.return_value = MagicMock(status_code=200)
+        with self.assertLogs("monocle_apptrace.exporters.okahu.okahu_exporter", level="WARNING"):
+            exporter = OkahuSpanExporter(session=session)
+        for _ in range(2):
+            exporter.export(get_spans(5))
+            # Every request carries its dictionary
+            self.assertEqual(len(json.loads(session.post.call_args.kwargs["data"])["dictionary"]), 1)
+
+    @patch.dict(os.environ, {"OKAHU_API_KEY": "key", "MONOCLE_DEDUP_PAYLOADS": "batch"})
+    def test_okahu_exporter(self):
+        session = MagicMock()
+        session.post.return_value = MagicMock(status_code=200)
+        exporter = OkahuSpanExporter(session=session)
+        exporter.export(get_spans(5))
+        payload = json.loads(session.post.call_args.kwargs["data"])
+        self.assertEqual(len(payload["dictionary"]), 1)
+        spans = list(rehydrate(payload["batch"], payload["dictionary"]))
+        self.assertEqual(spans[0]["events"][0]["attributes"]["input"][0], f"{{'system': '{SYSTEM_PROMPT}'}}")
+
+
+if __name__ == '__main__':
+    unittest.main()
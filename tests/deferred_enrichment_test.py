@@ -0,0 +1,124 @@
+import os
+import threading
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from opentelemetry.context import attach, detach, set_value
+from opentelemetry.sdk.trace import SpanLimits, TracerProvider
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from wrapt import FunctionWrapper
+
+from monocle_apptrace import wrap_common
+from monocle_apptrace.enrichment import DeferredEnrichmentSpanProcessor, _pending_enrichments
+from monocle_apptrace.utils import load_output_processor
+from monocle_apptrace.wrap_common import llm_wrapper, task_wrapper
+
+BASE_PATH = os.path.join(os.path.dirname(__file__), "..", "src", "monocle_apptrace")
+
+
+class FakeChatModel:
+    def __init__(self):
+        self.model_name = "gpt-4o-mini"
+        self.azure_endpoint = "https://example.openai.azure.com/"
+
+    def invoke(self, messages):
+        return "The answer to " + messages[-1].content
+
+
+class TestDeferredEnrichment(unittest.TestCase):
+
+    def setUp(self):
+        self.exporter = InMemorySpanExporter()
+
+    def build(self, deferred, max_queue_size=2048, span_limits=None):
+        provider = TracerProvider(span_limits=span_limits)
+        processor = SimpleSpanProcessor(self.exporter)
+        if deferred:
+            processor = DeferredEnrichmentSpanProcessor(processor, max_queue_size=max_queue_size)
+        provider.add_span_processor(processor)
+        self.provider = provider
+        tracer = provider.get_tracer("monocle_apptrace")
+        to_wrap = {"package": "langchain.chat_models.base", "object": "BaseChatModel", "method": "invoke",
+                   "output_processor": ["metamodel/maps/attributes/inference/langchain_entities.json"]}
+        load_output_processor(to_wrap, BASE_PATH)
+        return type("FakeChatModel", (FakeChatModel,),
+                    {"invoke": FunctionWrapper(FakeChatModel.invoke, llm_wrapper(tracer, to_wrap))})
+
+    def run_and_export(self, deferred, **kwargs):
+        self.exporter.clear()
+        model = self.build(deferred, **kwargs)()
+        messages = [SimpleNamespace(role="system", content="You are a helpful assistant"),
+                    SimpleNamespace(role="user", content="What is Monocle?")]
+        self.assertEqual(model.invoke(messages), "The answer to What is Monocle?")
+        # Mutating the arguments after the call must not change the deferred span
+        messages.append(SimpleNamespace(role="user", content="What is Okahu?"))
+        self.provider.force_flush()
+        spans = self.exporter.get_finished_spans()
+        self.assertEqual(len(spans), 1)
+        return spans[0]
+
+    def test_deferred_span_matches_inline_span(self):
+        token = attach(set_value("workflow_name", "deferred_test"))
+        try:
+            inline_span = self.run_and_export(deferred=False)
+            deferred_span = self.run_and_export(deferred=True)
+        finally:
+            detach(token)
+        self.assertEqual(dict(deferred_span.attributes), dict(inline_span.attributes))
+        self.assertEqual(deferred_span.attributes.get("entity.1.name"), "deferred_test")
+        self.assertEqual([(event.name, dict(event.attributes)) for event in deferred_span.events],
+                         [(event.name, dict(event.attributes)) for event in inline_span.events])
+        self.assertEqual(len(deferred_span.events[0].attributes["input"]), 2)
+        self.assertEqual(len(_pending_enrichments), 0)
+
+    def test_deferred_span_within_span_limits(self):
+        span_limits = SpanLimits(max_span_attributes=3, max_events=1, max_event_attributes=1, max_attribute_length=8)
+        inline_span = self.run_and_export(deferred=False, span_limits=span_limits)
+        deferred_span = self.run_and_export(deferred=True, span_limits=span_limits)
+        self.assertEqual(len(deferred_span.attributes), 3)
+        self.assertEqual(deferred_span.dropped_attributes, inline_span.dropped_attributes)
+        self.assertGreater(deferred_span.dropped_attributes, 0)
+        self.assertEqual(len(deferred_span.events), 1)
+        self.assertEqual(deferred_span.dropped_events, inline_span.dropped_events)
+        self.assertEqual([(event.name, dict(event.attributes)) for event in deferred_span.events],
+                         [(event.name, dict(event.attributes)) for event in inline_span.events])
+        self.assertTrue(all(len(value) <= 8 for value in deferred_span.attributes.values() if isinstance(value, str)))
+
+    def test_enrichment_runs_off_request_thread(self):
+        threads = []
+        request_thread = threading.current_thread()
+        with patch.object(wrap_common, "process_span", side_effect=lambda **kwargs: threads.append(threading.current_thread())):
+            self.run_and_export(deferred=True)
+            self.assertEqual(len(threads), 1)
+            self.assertIsNot(threads[0], request_thread)
+
+    def test_full_queue_enriches_inline(self):
+        threads = []
+        with patch.object(wrap_common, "process_span", side_effect=lambda **kwargs: threads.append(threading.current_thread())):
+            self.run_and_export(deferred=True, max_queue_size=0)
+        self.assertEqual(threads, [threading.current_thread()])
+
+    def test_enrichment_errors_do_not_drop_span(self):
+        with patch.object(wrap_common, "process_span", side_effect=ValueError("broken accessor")):
+            span = self.run_and_export(deferred=True)
+        self.assertEqual(span.name, "deferred_enrichment_test.FakeChatModel")
+        # Only the span.type set at span start for the sampler
+        self.assertEqual(dict(span.attributes), {"span.type": "inference"})
+
+    def test_spans_without_enrichment_pass_through(self):
+        provider = TracerProvider()
+        processor = DeferredEnrichmentSpanProcessor(SimpleSpanProcessor(self.exporter))
+        provider.add_span_processor(processor)
+        with provider.get_tracer("other").start_as_current_span("plain") as span:
+            span.set_attribute("key", "value")
+        self.assertEqual(self.exporter.get_finished_spans()[0].attributes["key"], "value")
+        processor.shutdown()
+        wrapped = FunctionWrapper(FakeChatModel.invoke, task_wrapper(provider.get_tracer("monocle_apptrace"),
+                                                                     {"package": "dummy", "span_name": "dummy"}))
+        self.assertEqual(wrapped(FakeChatModel(), [SimpleNamespace(content="hi")]), "The answer to hi")
+
+
+if __name__ == '__main__':
+    unittest.main()
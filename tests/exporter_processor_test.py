@@ -0,0 +1,138 @@
+import asyncio
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SpanExportResult
+
+from monocle_apptrace.exporters.exporter_processor import (AsyncioExportTaskProcessor, ThreadPoolExportTaskProcessor,
+                                                           get_task_processor_from_env)
+from monocle_apptrace.exporters.okahu.okahu_exporter import OkahuSpanExporter
+
+
+class ConcurrencyProbe:
+    """A task recording how many copies of it run at the same time, held until the gate opens."""
+
+    def __init__(self):
+        self.gate = threading.Event()
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+        self.done = []
+
+    def __call__(self, value):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        self.gate.wait(5)
+        with self.lock:
+            self.running -= 1
+            self.done.append(value)
+
+
+def get_spans(count):
+    tracer = TracerProvider().get_tracer("monocle_apptrace")
+    spans = []
+    for index in range(count):
+        with tracer.start_as_current_span(f"span_{index}") as span:
+            pass
+        spans.append(span)
+    return spans
+
+
+class TestExportTaskProcessors(unittest.TestCase):
+
+    def check_bounded(self, processor):
+        processor.start()
+        probe = ConcurrencyProbe()
+        # 2 running and 3 waiting
+        self.assertTrue(all(processor.queue_task(probe, index) for index in range(5)))
+        self.assertFalse(processor.queue_task(probe, 5))
+        self.assertEqual(processor.dropped_tasks, 1)
+        self.assertFalse(processor.force_flush(timeout_millis=100))
+        probe.gate.set()
+        self.assertTrue(processor.force_flush())
+        self.assertEqual(probe.max_running, 2)
+        self.assertEqual(sorted(probe.done), [0, 1, 2, 3, 4])
+        processor.stop()
+        self.assertFalse(processor.queue_task(probe, 6))
+
+    def test_thread_pool_bounded(self):
+        self.check_bounded(ThreadPoolExportTaskProcessor(max_in_flight=2, max_backlog=3))
+
+    def test_asyncio_bounded(self):
+        self.check_bounded(AsyncioExportTaskProcessor(max_in_flight=2, max_backlog=3))
+
+    def test_asyncio_coroutines(self):
+        processor = AsyncioExportTaskProcessor(max_in_flight=3)
+        processor.start()
+        running = []
+        done = []
+
+        async def send(value):
+            running.append(value)
+            await asyncio.sleep(0.05)
+            self.assertLessEqual(len(running) - len(done), 3)
+            done.append(value)
+
+        for index in range(10):
+            self.assertTrue(processor.queue_task(send, index))
+        # stop drains the queued coroutines
+        processor.stop()
+        self.assertEqual(sorted(done), list(range(10)))
+
+    def test_block_policy(self):
+        processor = ThreadPoolExportTaskProcessor(max_in_flight=1, max_backlog=1, backlog_policy="block",
+                                                  block_timeout=0.1)
+        processor.start()
+        probe = ConcurrencyProbe()
+        processor.queue_task(probe, 0)
+        processor.queue_task(probe, 1)
+        start = time.monotonic()
+        self.assertFalse(processor.queue_task(probe, 2))
+        self.assertGreaterEqual(time.monotonic() - start, 0.1)
+        # Room is made while the new task waits
+        threading.Timer(0.05, probe.gate.set).start()
+        processor.block_timeout = 5
+        self.assertTrue(processor.queue_task(probe, 3))
+        processor.stop()
+        self.assertEqual(sorted(probe.done), [0, 1, 3])
+        with self.assertRaises(ValueError):
+            ThreadPoolExportTaskProcessor(backlog_policy="spill")
+
+    def test_task_processor_from_env(self):
+        with patch.dict("os.environ", {"MONOCLE_EXPORT_TASK_PROCESSOR": "asyncio"}):
+            self.assertIsInstance(get_task_processor_from_env(), AsyncioExportTaskProcessor)
+        with patch.dict("os.environ", {"MONOCLE_EXPORT_TASK_PROCESSOR": "thread"}):
+            self.assertIsInstance(get_task_processor_from_env(), ThreadPoolExportTaskProcessor)
+        with patch.dict("os.environ", {}, clear=True):
+            self.assertIsNone(get_task_processor_from_env())
+
+    @patch.dict("os.environ", {"OKAHU_API_KEY": "test-api-key"})
+    def test_okahu_exporter(self):
+        processor = ThreadPoolExportTaskProcessor(max_in_flight=16)
+        with patch("requests.Session") as mock_session:
+            session = mock_session.return_value
+            exporter = OkahuSpanExporter(task_processor=processor)
+        # The connection pool holds a connection for every request in flight
+        adapter = session.mount.call_args.args[1]
+        self.assertEqual(adapter._pool_maxsize, 16)
+
+        gate = threading.Event()
+        session.post.side_effect = lambda **kwargs: gate.wait(5) and MagicMock(status_code=200)
+        self.assertEqual(exporter.export(get_spans(2)), SpanExportResult.SUCCESS)
+        self.assertFalse(exporter.force_flush(timeout_millis=50))
+        gate.set()
+        self.assertTrue(exporter.force_flush())
+        exporter.export(get_spans(2))
+        # shutdown sends the queued batches before closing the session
+        exporter.shutdown()
+        self.assertEqual(session.post.call_count, 2)
+        session.close.assert_called_once()
+        self.assertEqual(exporter.export(get_spans(1)), SpanExportResult.FAILURE)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import os
+import subprocess
+import sys
+import tempfile
+import textwrap
+import unittest
+
+from opentelemetry.sdk.trace import TracerProvider
+
+from monocle_apptrace.instrumentor import MonocleInstrumentor
+from monocle_apptrace.wrapper import WrapperMethod
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+LAZY_SETUP = """
+import sys
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor, ConsoleSpanExporter
+from monocle_apptrace.instrumentor import setup_monocle_telemetry
+setup_monocle_telemetry(workflow_name="lazy_test", span_processors=[SimpleSpanProcessor(ConsoleSpanExporter())])
+print(sorted(name for name in ("langchain", "langchain_core", "llama_index", "botocore") if name in sys.modules))
+from langchain_core.runnables import RunnableSequence
+print(type(RunnableSequence.__dict__["invoke"]).__name__)
+"""
+
+
+class TestLazyInstrumentation(unittest.TestCase):
+
+    def test_frameworks_wrapped_when_imported(self):
+        output = subprocess.run([sys.executable, "-c", LAZY_SETUP], env=dict(os.environ, PYTHONPATH=SRC_PATH),
+                                capture_output=True, text=True, check=True, timeout=300).stdout.splitlines()
+        self.assertEqual(output, ["[]", "FunctionWrapper"])
+
+    def test_user_method_wrapped_when_imported(self):
+        with tempfile.TemporaryDirectory() as module_path:
+            for name in ("lazy_app", "late_app"):
+                with open(os.path.join(module_path, f"{name}.py"), "w", encoding="utf-8") as module_file:
+                    module_file.write(textwrap.dedent("""
+                        class Assistant:
+                            def answer(self, question):
+                                return "answer to " + question
+                    """))
+            sys.path.insert(0, module_path)
+            instrumentor = MonocleInstrumentor(user_wrapper_methods=[
+                WrapperMethod(package=name, object_name="Assistant", method="answer", span_name=f"{name}.answer")
+                for name in ("lazy_app", "late_app")])
+            try:
+                instrumentor.instrument(tracer_provider=TracerProvider())
+                self.assertNotIn("lazy_app", sys.modules)
+                import lazy_app
+                self.assertTrue(hasattr(lazy_app.Assistant.__dict__["answer"], "__wrapped__"))
+                self.assertEqual(lazy_app.Assistant().answer("hi"), "answer to hi")
+                instrumentor.uninstrument()
+                self.assertFalse(hasattr(lazy_app.Assistant.__dict__["answer"], "__wrapped__"))
+                # The hooks of the modules imported after uninstrument don't wrap them
+                import late_app
+                self.assertFalse(hasattr(late_app.Assistant.__dict__["answer"], "__wrapped__"))
+            finally:
+                if instrumentor.is_instrumented_by_opentelemetry:
+                    instrumentor.uninstrument()
+                sys.path.remove(module_path)
+                sys.modules.pop("lazy_app", None)
+                sys.modules.pop("late_app", None)
+
+
+if __name__ == '__main__':
+    unittest.main()
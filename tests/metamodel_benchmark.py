@@ -0,0 +1,49 @@
+"""
+Measures the cold start cost of loading the langchain, llamaindex, haystack and
+botocore method maps, from the metamodel bundle and from the JSON sources, in a
+fresh interpreter for every run. wrap_common is imported first so only the map
+loading is timed.
+
+    python tests/metamodel_benchmark.py
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+RUNS = 10
+
+CHILD = """
+import json, time
+import monocle_apptrace.wrap_common
+import monocle_apptrace.metamodel_bundle as metamodel_bundle
+if not {use_bundle}:
+    metamodel_bundle.BUNDLE_PATH = "missing.marshal"
+start = time.perf_counter()
+import monocle_apptrace.langchain, monocle_apptrace.llamaindex, monocle_apptrace.haystack, monocle_apptrace.botocore
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "bundle": metamodel_bundle._bundle is not None}}))
+"""
+
+
+def run(use_bundle):
+    src_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+    env = dict(os.environ, PYTHONPATH=src_path)
+    results = []
+    for _ in range(RUNS):
+        output = subprocess.run([sys.executable, "-c", CHILD.format(use_bundle=use_bundle)],
+                                env=env, capture_output=True, text=True, check=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    return results
+
+
+def main():
+    for label, use_bundle in (("json maps", False), ("bundle", True)):
+        results = run(use_bundle)
+        seconds = statistics.median(result["seconds"] for result in results)
+        print(f"{label:>9}: {seconds * 1000:6.2f} ms, loaded from the bundle: {results[0]['bundle']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from monocle_apptrace import metamodel_bundle
+from monocle_apptrace.metamodel_bundle import (BASE_PATH, MAPS_PATH, METHODS_FILES, build_bundle, load_bundle,
+                                               write_bundle)
+from monocle_apptrace.utils import get_wrapper_methods_config
+
+
+class TestMetamodelBundle(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_path = tempfile.mkdtemp()
+        patcher = patch.multiple(metamodel_bundle, _bundle=None, _bundle_loaded=False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_path)
+
+    def copy_package(self):
+        base_path = os.path.join(self.temp_path, "monocle_apptrace")
+        shutil.copytree(os.path.join(BASE_PATH, "metamodel"), os.path.join(base_path, "metamodel"))
+        return base_path
+
+    def test_bundle_is_current(self):
+        # Fails when a map or entity file changed, rebuild with python -m monocle_apptrace.metamodel_bundle
+        self.assertIsNotNone(load_bundle(verify=True))
+        for methods_file in METHODS_FILES:
+            bundled = metamodel_bundle.get_wrapper_methods(methods_file)
+            loaded = get_wrapper_methods_config(
+                wrapper_methods_config_path=os.path.join(BASE_PATH, MAPS_PATH, methods_file),
+                attributes_config_base_path=BASE_PATH)
+            self.assertEqual(bundled, loaded)
+        self.assertIsNotNone(metamodel_bundle._bundle)
+
+    def test_stale_bundle_falls_back_to_json(self):
+        base_path = self.copy_package()
+        bundle_path = os.path.join(self.temp_path, "bundle.marshal")
+        write_bundle(base_path, bundle_path)
+        self.assertIsNotNone(load_bundle(base_path, bundle_path, verify=True))
+        entity_path = os.path.join(base_path, "metamodel", "maps", "attributes", "inference",
+                                   "langchain_entities.json")
+        with open(entity_path, "a", encoding="utf-8") as entity_file:
+            entity_file.write("\n")
+        self.assertIsNone(load_bundle(base_path, bundle_path))
+        self.assertIsNone(load_bundle(base_path, bundle_path, verify=True))
+        with open(bundle_path, "wb") as bundle_file:
+            bundle_file.write(b"not a bundle")
+        self.assertIsNone(load_bundle(base_path, bundle_path))
+
+        with patch.object(metamodel_bundle, "BUNDLE_PATH", os.path.join(self.temp_path, "missing.marshal")):
+            wrapper_methods = metamodel_bundle.get_wrapper_methods("langchain_methods.json")
+        self.assertIsNone(metamodel_bundle._bundle)
+        self.assertTrue(all(callable(wrapper_method["wrapper"]) for wrapper_method in wrapper_methods))
+
+    def test_sources_hashed_only_when_copied(self):
+        base_path = self.copy_package()
+        bundle_path = os.path.join(self.temp_path, "bundle.marshal")
+        bundle = write_bundle(base_path, bundle_path)
+        self.assertIsNotNone(bundle["package_version"])
+        entity_path = os.path.join(base_path, "metamodel", "maps", "attributes", "inference",
+                                   "langchain_entities.json")
+        with patch.object(metamodel_bundle, "_get_digest", wraps=metamodel_bundle._get_digest) as get_digest:
+            # The sizes and modification times match, no source is read
+            self.assertIsNotNone(load_bundle(base_path, bundle_path))
+            get_digest.assert_not_called()
+
+            # A copy of the same source is hashed
+            os.utime(entity_path, ns=(0, 0))
+            self.assertIsNotNone(load_bundle(base_path, bundle_path))
+            self.assertEqual(get_digest.call_count, 1)
+
+            # Unless it belongs to the installed release the bundle was built for
+            with patch.object(metamodel_bundle, "_get_release_version", return_value=bundle["package_version"]):
+                self.assertIsNotNone(load_bundle(base_path, bundle_path))
+            self.assertEqual(get_digest.call_count, 1)
+
+            # A source of another size changed
+            with open(entity_path, "a", encoding="utf-8") as entity_file:
+                entity_file.write("\n")
+            self.assertIsNone(load_bundle(base_path, bundle_path))
+            self.assertEqual(get_digest.call_count, 1)
+
+    def test_build_reports_invalid_maps(self):
+        base_path = self.copy_package()
+        entity_path = os.path.join(base_path, "metamodel", "maps", "attributes", "retrieval",
+                                   "langchain_entities.json")
+        with open(entity_path, encoding="utf-8") as entity_file:
+            entity = json.load(entity_file)
+        entity["attributes"][0][0]["accessor"] = "instance.(model"
+        with open(entity_path, "w", encoding="utf-8") as entity_file:
+            json.dump(entity, entity_file)
+        methods_path = os.path.join(base_path, MAPS_PATH, "botocore_methods.json")
+        with open(methods_path, encoding="utf-8") as methods_file:
+            methods = json.load(methods_file)
+        methods["wrapper_methods"][0]["wrapper_method"] = "missing_wrapper"
+        with open(methods_path, "w", encoding="utf-8") as methods_file:
+            json.dump(methods, methods_file)
+        with self.assertRaises(ValueError) as context:
+            build_bundle(base_path)
+        message = str(context.exception)
+        self.assertIn("attributes/retrieval/langchain_entities.json: invalid accessor", message)
+        self.assertIn("botocore_methods.json entry 0: invalid wrapper_method missing_wrapper", message)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+"""
+In memory stand-ins of the S3 and Blob clients, for testing the exporters without
+a store. They implement the calls the exporters make and the constraints of the
+services that matter to them: the minimum size of the S3 parts and the ordering
+of the parts and blocks of a committed object.
+"""
+import uuid
+
+from botocore.exceptions import ClientError, ConnectionClosedError
+
+
+class LocalS3Client:
+    def __init__(self, min_part_size=5 * 1024 * 1024):
+        self.min_part_size = min_part_size
+        self.objects = {}
+        self.content_types = {}
+        self.content_encodings = {}
+        self.uploads = {}
+        self.aborted = []
+        self.part_failures = 0
+        self.calls = []
+
+    def head_bucket(self, Bucket):
+        return {}
+
+    def create_bucket(self, Bucket, CreateBucketConfiguration=None):
+        return {}
+
+    def put_object(self, Bucket, Key, Body, ContentType=None, ContentEncoding=None):
+        self.calls.append("put_object")
+        self.objects[Key] = bytes(Body)
+        self.content_types[Key] = ContentType
+        self.content_encodings[Key] = ContentEncoding
+        return {"ETag": uuid.uuid4().hex}
+
+    def create_multipart_upload(self, Bucket, Key, ContentType=None, ContentEncoding=None):
+        self.calls.append("create_multipart_upload")
+        upload_id = uuid.uuid4().hex
+        self.uploads[upload_id] = {"key": Key, "parts": {}, "content_type": ContentType,
+                                   "content_encoding": ContentEncoding}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.calls.append("upload_part")
+        if self.part_failures > 0:
+            self.part_failures -= 1
+            raise ConnectionClosedError(endpoint_url="https://local")
+        etag = uuid.uuid4().hex
+        self.uploads[UploadId]["parts"][PartNumber] = (etag, bytes(Body))
+        return {"ETag": etag}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.calls.append("complete_multipart_upload")
+        upload = self.uploads.pop(UploadId)
+        parts = MultipartUpload["Parts"]
+        if [part["PartNumber"] for part in parts] != sorted(upload["parts"]):
+            raise ClientError({"Error": {"Code": "InvalidPartOrder"}}, "CompleteMultipartUpload")
+        for part in parts[:-1]:
+            if len(upload["parts"][part["PartNumber"]][1]) < self.min_part_size:
+                raise ClientError({"Error": {"Code": "EntityTooSmall"}}, "CompleteMultipartUpload")
+        for part in parts:
+            if upload["parts"][part["PartNumber"]][0] != part["ETag"]:
+                raise ClientError({"Error": {"Code": "InvalidPart"}}, "CompleteMultipartUpload")
+        self.objects[Key] = b"".join(upload["parts"][part["PartNumber"]][1] for part in parts)
+        self.content_types[Key] = upload["content_type"]
+        self.content_encodings[Key] = upload["content_encoding"]
+        return {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.calls.append("abort_multipart_upload")
+        self.uploads.pop(UploadId)
+        self.aborted.append(Key)
+        return {}
+
+
+class LocalBlobClient:
+    def __init__(self, service, blob_name):
+        self.service = service
+        self.blob_name = blob_name
+
+    def upload_blob(self, data, overwrite=False, content_settings=None):
+        self.service.blobs[self.blob_name] = bytes(data)
+        self.service.content_settings[self.blob_name] = content_settings
+
+    def stage_block(self, block_id, data):
+        self.service.staged_blocks.setdefault(self.blob_name, {})[block_id] = bytes(data)
+
+    def commit_block_list(self, block_list, content_settings=None):
+        staged = self.service.staged_blocks.pop(self.blob_name)
+        self.service.blobs[self.blob_name] = b"".join(staged[block.id] for block in block_list)
+        self.service.content_settings[self.blob_name] = content_settings
+
+
+class LocalContainerClient:
+    def get_container_properties(self):
+        return {}
+
+
+class LocalBlobServiceClient:
+    def __init__(self):
+        self.blobs = {}
+        self.content_settings = {}
+        self.staged_blocks = {}
+
+    def get_container_client(self, container_name):
+        return LocalContainerClient()
+
+    def create_container(self, container_name):
+        return LocalContainerClient()
+
+    def get_blob_client(self, container, blob):
+        return LocalBlobClient(self, blob)
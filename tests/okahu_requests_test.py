@@ -0,0 +1,112 @@
+import gzip
+import json
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SpanExportResult
+from requests.exceptions import ReadTimeout
+
+from monocle_apptrace.exporters.dedup import ContentDeduplicator, rehydrate
+from monocle_apptrace.exporters.okahu.okahu_exporter import OkahuSpanExporter
+
+SYSTEM_PROMPT = "You are a helpful assistant answering questions about coffee. " * 10
+
+
+def get_spans(count):
+    tracer = TracerProvider().get_tracer("monocle_apptrace")
+    spans = []
+    for index in range(count):
+        with tracer.start_as_current_span(f"span_{index}") as span:
+            span.add_event("data.input", {"input": [SYSTEM_PROMPT, f"question {index} " + "x" * 1000]})
+        spans.append(span)
+    return spans
+
+
+def get_response(status_code):
+    return MagicMock(status_code=status_code, headers={})
+
+
+def get_bodies(session):
+    return [call.kwargs["data"] for call in session.post.call_args_list]
+
+
+@patch.dict("os.environ", {"OKAHU_API_KEY": "test-api-key"})
+class TestOkahuRequests(unittest.TestCase):
+
+    def get_exporter(self, **kwargs):
+        session = MagicMock()
+        session.post.return_value = get_response(200)
+        return OkahuSpanExporter(session=session, backoff_in_seconds=0.01, **kwargs), session
+
+    def test_batch_split_under_max_request_bytes(self):
+        exporter, session = self.get_exporter(max_request_bytes=8000)
+        self.assertEqual(exporter.export(get_spans(20)), SpanExportResult.SUCCESS)
+        bodies = get_bodies(session)
+        self.assertGreater(len(bodies), 3)
+        for body in bodies:
+            self.assertLessEqual(len(body), 8000)
+        names = [span["name"] for body in bodies for span in json.loads(body)["batch"]]
+        self.assertEqual(names, [f"span_{index}" for index in range(20)])
+
+    def test_gzip_bodies(self):
+        exporter, session = self.get_exporter(compression="gzip")
+        exporter.export(get_spans(5))
+        arguments = session.post.call_args.kwargs
+        self.assertEqual(arguments["headers"], {"Content-Encoding": "gzip"})
+        batch = json.loads(gzip.decompress(arguments["data"]))["batch"]
+        self.assertEqual(len(batch), 5)
+        self.assertLess(len(arguments["data"]), len(gzip.decompress(arguments["data"])) / 4)
+        with self.assertRaises(ValueError):
+            OkahuSpanExporter(session=MagicMock(), compression="lzma")
+
+    def test_every_request_carries_its_dictionary(self):
+        exporter, session = self.get_exporter(max_request_bytes=8000, deduplicator=ContentDeduplicator())
+        exporter.export(get_spans(20))
+        bodies = get_bodies(session)
+        self.assertGreater(len(bodies), 1)
+        for body in bodies:
+            payload = json.loads(body)
+            self.assertLessEqual(len(body), 8000)
+            for span in rehydrate(payload["batch"], payload["dictionary"]):
+                self.assertEqual(span["events"][0]["attributes"]["input"][0], SYSTEM_PROMPT)
+
+    def test_retry_per_request(self):
+        exporter, session = self.get_exporter(max_request_bytes=8000, max_retries=2)
+        session.post.side_effect = [get_response(503), ReadTimeout(), get_response(200)] + [get_response(200)] * 10
+        self.assertEqual(exporter.export(get_spans(20)), SpanExportResult.SUCCESS)
+        bodies = get_bodies(session)
+        # The first request is sent three times, the others once
+        self.assertEqual(bodies[0], bodies[2])
+        names = [span["name"] for body in bodies[2:] for span in json.loads(body)["batch"]]
+        self.assertEqual(names, [f"span_{index}" for index in range(20)])
+
+        session.post.reset_mock()
+        session.post.side_effect = [get_response(503)] * 3 + [get_response(200)] * 10
+        # The failed request doesn't keep the others from being sent
+        self.assertEqual(exporter.export(get_spans(20)), SpanExportResult.FAILURE)
+        names = [span["name"] for body in get_bodies(session)[3:] for span in json.loads(body)["batch"]]
+        self.assertEqual(names[-1], "span_19")
+        self.assertNotIn("span_0", names)
+
+        session.post.reset_mock()
+        session.post.side_effect = None
+        session.post.return_value = get_response(400)
+        self.assertEqual(exporter.export(get_spans(1)), SpanExportResult.FAILURE)
+        session.post.assert_called_once()
+
+    def test_retries_bounded_per_export(self):
+        exporter, session = self.get_exporter(max_request_bytes=8000, max_retries=10, max_export_seconds=0.5)
+        session.post.return_value = get_response(503)
+        start = time.monotonic()
+        self.assertEqual(exporter.export(get_spans(20)), SpanExportResult.FAILURE)
+        # The retries of all the requests fit in max_export_seconds instead of blocking the processor thread
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertLess(session.post.call_count, 20)
+        for call in session.post.call_args_list:
+            self.assertLessEqual(call.kwargs["timeout"], 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
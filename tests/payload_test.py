@@ -0,0 +1,124 @@
+import hashlib
+import os
+import unittest
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+from monocle_apptrace import payload
+from monocle_apptrace.payload import (PayloadBuffer, PayloadPolicy, bounded_join, capture_payload, capture_text,
+                                      get_payload_policy, reset_payload_policies, set_payload_policy)
+from monocle_apptrace.wrap_common import WrapperConfig, process_span, update_span_with_context_output
+
+PROMPT = "You are a helpful assistant. " + "Context: coffee is brewed from roasted beans. " * 1000 + "Question: what is coffee?"
+
+
+class TestPayloadCapture(unittest.TestCase):
+
+    def tearDown(self):
+        reset_payload_policies()
+
+    def test_head_and_tail_kept(self):
+        captured = capture_payload({"input": PROMPT}, PayloadPolicy(max_bytes=1024, tail_bytes=256))
+        text = captured["input"]
+        self.assertTrue(text.startswith("You are a helpful assistant."))
+        self.assertTrue(text.endswith("Question: what is coffee?"))
+        self.assertEqual(len(text), 1024 + len(payload.TRUNCATION_MARKER))
+        self.assertTrue(captured["input.truncated"])
+        self.assertEqual(captured["input.length"], len(PROMPT))
+
+    def test_small_payload_unchanged(self):
+        attributes = {"input": ["{'system': 'System message'}", {"user": "What is Task Decomposition?"}], "count": 2}
+        self.assertEqual(capture_payload(attributes, PayloadPolicy()),
+                         {"input": ["{'system': 'System message'}", "{'user': 'What is Task Decomposition?'}"], "count": 2})
+
+    def test_list_shares_budget(self):
+        messages = [{"system": "x" * 600}, {"user": "y" * 600}, {"user": "z" * 600}]
+        captured = capture_payload({"input": messages}, PayloadPolicy(max_bytes=1000))
+        # The first message fits, the second one is cut and the third one is dropped
+        self.assertEqual(captured["input"], [str(messages[0]), str({"user": "y" * 400 + "..."})])
+        self.assertEqual(captured["input.length"], 1800)
+
+    def test_utf8_budget(self):
+        text, size, truncated = bounded_join(["é" * 100, "日本" * 100], " ", 101, tail_bytes=50)
+        self.assertTrue(truncated)
+        head, tail = text.split(payload.TRUNCATION_MARKER)
+        self.assertLessEqual(len(head.encode()), 51)
+        self.assertLessEqual(len(tail.encode()), 50)
+        self.assertEqual(head, "é" * 25)
+        self.assertEqual(tail, "日本" * 8)
+        # Fits in characters but not in bytes
+        self.assertTrue(bounded_join(["é" * 60], "", 100)[2])
+        self.assertEqual(bounded_join(["é" * 50], "", 100), ("é" * 50, 100, False))
+
+    def test_no_full_copy(self):
+        with patch.object(payload, "_utf8_head", wraps=payload._utf8_head) as mock_head:
+            bounded_join([PROMPT, PROMPT], " ", 100)
+        self.assertEqual(len(mock_head.call_args[0][0]), 100)
+
+    def test_hash_and_metadata_only(self):
+        digest = hashlib.sha256(PROMPT.encode()).hexdigest()
+        captured = capture_payload({"input": PROMPT}, PayloadPolicy(max_bytes=100, hash_payload=True))
+        self.assertEqual(captured["input.sha256"], digest)
+        self.assertEqual(len(captured["input"]), 103)
+        captured = capture_payload({"input": [PROMPT, "answer"]}, PayloadPolicy(metadata_only=True))
+        self.assertEqual(captured, {"input.length": len(PROMPT) + 6, "input.count": 2})
+        captured = capture_text("response", [PROMPT], PayloadPolicy(hash_payload=True, metadata_only=True))
+        self.assertEqual(captured, {"response.sha256": digest, "response.length": len(PROMPT)})
+
+    def test_payload_buffer(self):
+        text = "Le café est une boisson. " * 400 + "日本" * 50
+        pieces = [text[start:start + 7] for start in range(0, len(text), 7)]
+        for policy in (PayloadPolicy(max_bytes=256, tail_bytes=64), PayloadPolicy(max_bytes=256, tail_bytes=200),
+                       PayloadPolicy(max_bytes=None), PayloadPolicy(hash_payload=True, metadata_only=True),
+                       PayloadPolicy(max_bytes=100000, hash_payload=True)):
+            buffer = PayloadBuffer(policy)
+            for piece in pieces:
+                buffer.add(piece)
+            # Captured like the whole text, while holding only the head and the tail
+            self.assertEqual(capture_payload({"response": [buffer.get_text()]}, policy),
+                             capture_payload({"response": [text]}, policy))
+            if policy.max_bytes == 256:
+                self.assertLess(len(buffer.get_text()), 600)
+
+    def test_policy_per_span_type_and_event(self):
+        set_payload_policy(PayloadPolicy(metadata_only=True), span_type="inference")
+        set_payload_policy(PayloadPolicy(max_bytes=10), span_type="inference", event_name="data.output")
+        self.assertTrue(get_payload_policy("inference", "data.input").metadata_only)
+        self.assertEqual(get_payload_policy("inference", "data.output").max_bytes, 10)
+        self.assertEqual(get_payload_policy("retrieval", "data.output").max_bytes, payload.RETRIEVAL_OUTPUT_MAX_BYTES)
+        self.assertEqual(get_payload_policy("retrieval", "data.input").max_bytes, payload.DEFAULT_MAX_BYTES)
+
+    def test_policy_from_env(self):
+        with patch.dict(os.environ, {"MONOCLE_PAYLOAD_MAX_BYTES": "2048", "MONOCLE_PAYLOAD_HASH": "true"}):
+            reset_payload_policies()
+        policy = get_payload_policy("inference", "data.input")
+        self.assertEqual((policy.max_bytes, policy.tail_bytes, policy.hash_payload), (2048, 512, True))
+        self.assertTrue(get_payload_policy("retrieval", "data.output").hash_payload)
+
+    def test_inference_events_captured_within_budget(self):
+        set_payload_policy(PayloadPolicy(max_bytes=1024, tail_bytes=256), span_type="inference")
+        to_wrap = {"output_processor": {"type": "inference", "attributes": [], "events": [
+            {"name": "data.input", "attributes": [{"attribute": "input", "accessor": "args|messages"}]},
+            {"name": "data.output", "attributes": [{"attribute": "response", "accessor": "response|assistant_message"}]}]}}
+        args = (SimpleNamespace(messages=[SimpleNamespace(type="system", content=PROMPT)]),)
+        span = MagicMock()
+        span.parent = SimpleNamespace(span_id=1)
+        process_span(to_wrap, span, None, args, {}, "coffee is a drink")
+        span.add_event.assert_any_call(name="data.output", attributes={"response": ["coffee is a drink"]})
+        input_attributes = span.add_event.call_args_list[0].kwargs["attributes"]
+        self.assertTrue(input_attributes["input"][0].startswith("{'system': 'You are a helpful assistant."))
+        self.assertLess(len(input_attributes["input"][0]), 1100)
+        self.assertTrue(input_attributes["input.truncated"])
+
+    def test_retriever_output(self):
+        config = WrapperConfig({"package": "langchain_core.retrievers", "output_processor": {"type": "retrieval"}})
+        span = MagicMock()
+        documents = [SimpleNamespace(page_content="coffee " * 100), SimpleNamespace(page_content="tea")]
+        update_span_with_context_output(config, documents, span)
+        span.add_event.assert_called_once_with("data.output", {"response": ("coffee " * 100)[:100] + "...",
+                                                               "response.truncated": True,
+                                                               "response.length": 704})
+
+
+if __name__ == '__main__':
+    unittest.main()
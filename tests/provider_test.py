@@ -0,0 +1,87 @@
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from monocle_apptrace import provider
+from monocle_apptrace.accessor import static_attribute_cache
+from monocle_apptrace.provider import get_provider_name, invalidate_provider, register_provider_resolver, resolve_provider
+
+
+class URL:
+    """Stands in for httpx.URL, the base_url of openai clients."""
+
+    def __init__(self, url):
+        self.url = url
+        self.host = url.split("/")[2]
+
+    def __str__(self):
+        return self.url
+
+
+class ChatModel:
+    """Unhashable like the pydantic models of langchain and llama-index."""
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def __eq__(self, other):
+        return self is other
+
+
+class TestProviderResolver(unittest.TestCase):
+
+    def tearDown(self):
+        static_attribute_cache.clear()
+
+    def test_openai_client(self):
+        llm = ChatModel(client=SimpleNamespace(_client=SimpleNamespace(base_url=URL("https://api.openai.com/v1/"))))
+        self.assertEqual(resolve_provider(llm), ("api.openai.com", "https://api.openai.com/v1/"))
+
+    def test_azure_openai_client(self):
+        base_url = URL("https://my-resource.openai.azure.com/openai/")
+        llm = ChatModel(azure_endpoint="https://my-resource.openai.azure.com/",
+                        client=SimpleNamespace(_client=SimpleNamespace(base_url=base_url)))
+        self.assertEqual(resolve_provider(llm), ("my-resource.openai.azure.com", "https://my-resource.openai.azure.com/openai/"))
+
+    def test_api_base(self):
+        llm = ChatModel(api_base="https://example.com/")
+        self.assertEqual(resolve_provider(llm), ("example.com", ""))
+
+    def test_mistral_client(self):
+        llm = ChatModel(_client=SimpleNamespace(sdk_configuration=SimpleNamespace(server_url="https://api.mistral.ai")))
+        self.assertEqual(resolve_provider(llm), ("", "https://api.mistral.ai"))
+
+    def test_bedrock_and_sagemaker_clients(self):
+        bedrock_client = SimpleNamespace(meta=SimpleNamespace(endpoint_url="https://bedrock-runtime.us-east-1.amazonaws.com"))
+        self.assertEqual(resolve_provider(ChatModel(client=bedrock_client)),
+                         ("", "https://bedrock-runtime.us-east-1.amazonaws.com"))
+        sagemaker_client = SimpleNamespace(meta=SimpleNamespace(endpoint_url="https://runtime.sagemaker.us-east-1.amazonaws.com"))
+        self.assertEqual(resolve_provider(sagemaker_client), ("", "https://runtime.sagemaker.us-east-1.amazonaws.com"))
+
+    def test_unknown_client(self):
+        self.assertEqual(resolve_provider(ChatModel(client=None)), ("", ""))
+        self.assertEqual(resolve_provider(None), ("", ""))
+
+    def test_resolved_once_per_instance(self):
+        llm = ChatModel(api_base="https://example.com/")
+        with patch.object(provider, "resolve_provider", wraps=resolve_provider) as mock_resolve:
+            for _ in range(3):
+                self.assertEqual(get_provider_name(llm), ("example.com", ""))
+            self.assertEqual(mock_resolve.call_count, 1)
+            llm.api_base = "https://other.example.com/"
+            invalidate_provider(llm)
+            self.assertEqual(get_provider_name(llm), ("other.example.com", ""))
+            self.assertEqual(mock_resolve.call_count, 2)
+
+    def test_register_provider_resolver(self):
+        llm = ChatModel(host_url="https://custom.example.com/generate")
+        self.assertEqual(get_provider_name(llm), ("", ""))
+        register_provider_resolver("custom", lambda instance: {"provider_url": getattr(instance, "host_url", None)})
+        try:
+            self.assertEqual(get_provider_name(llm), ("custom.example.com", ""))
+        finally:
+            del provider.PROVIDER_RESOLVERS["custom"]
+
+
+if __name__ == '__main__':
+    unittest.main()
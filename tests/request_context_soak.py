@@ -0,0 +1,75 @@
+"""
+Soak test for request scoped Monocle state: runs a wrapped haystack-style
+pipeline under request_context for millions of requests, from a thread
+pool, and prints the live object count and the process RSS as it goes.
+Both should stay flat.
+
+    python tests/request_context_soak.py [requests] [threads]
+"""
+import gc
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from opentelemetry.context import get_value
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor, SpanExporter, SpanExportResult
+from wrapt import FunctionWrapper
+
+from monocle_apptrace.instrumentor import on_processor_start
+from monocle_apptrace.request_context import SESSION_PROPERTIES_KEY, request_context
+from monocle_apptrace.utils import get_attribute
+from monocle_apptrace.wrap_common import DATA_INPUT_KEY, task_wrapper
+
+REPORT_EVERY = 100000
+
+
+class NoopExporter(SpanExporter):
+    def export(self, spans):
+        return SpanExportResult.SUCCESS
+
+
+class Pipeline:
+    def run(self, data):
+        return get_attribute(DATA_INPUT_KEY)
+
+
+def build_pipeline():
+    processor = SimpleSpanProcessor(NoopExporter())
+    processor.on_start = on_processor_start
+    provider = TracerProvider()
+    provider.add_span_processor(processor)
+    to_wrap = {"package": "haystack.core.pipeline.pipeline", "object": "Pipeline", "method": "run"}
+    pipeline_class = type("Pipeline", (Pipeline,), {
+        "run": FunctionWrapper(Pipeline.run, task_wrapper(provider.get_tracer("monocle_apptrace"), to_wrap))})
+    return pipeline_class()
+
+
+def current_rss_mb():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    pipeline = build_pipeline()
+    data = {"prompt_builder": {"question": "what is coffee?"}}
+
+    def handle(request_id):
+        with request_context(properties={"request": request_id}):
+            if pipeline.run(data) != "what is coffee?" or get_value(SESSION_PROPERTIES_KEY)["request"] != request_id:
+                raise AssertionError(f"request {request_id} saw state of another request")
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for done in range(0, requests, REPORT_EVERY):
+            list(executor.map(handle, range(done, min(done + REPORT_EVERY, requests)), chunksize=256))
+            gc.collect()
+            print(f"{min(done + REPORT_EVERY, requests):>9} requests: objects {len(gc.get_objects()):>8}, "
+                  f"rss {current_rss_mb():7.1f} MB, {time.time() - start:6.1f}s")
+
+
+if __name__ == "__main__":
+    main()
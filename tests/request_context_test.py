@@ -0,0 +1,173 @@
+import asyncio
+import gc
+import threading
+import tracemalloc
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from opentelemetry.context import Context, attach, detach, get_value
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from wrapt import FunctionWrapper
+
+from monocle_apptrace.instrumentor import on_processor_start
+from monocle_apptrace.request_context import SESSION_PROPERTIES_KEY, WORKFLOW_NAME_KEY, request_context
+from monocle_apptrace.utils import get_attribute, get_embedding_model
+from monocle_apptrace.wrap_common import DATA_INPUT_KEY, task_wrapper
+
+SOAK_REQUESTS = 5000
+
+
+class Pipeline:
+    def run(self, data):
+        # Reads the request state the way the component wrappers do
+        return get_attribute(DATA_INPUT_KEY), get_embedding_model()
+
+
+class TestRequestContext(unittest.TestCase):
+
+    def setUp(self):
+        # Start from an empty context, earlier tests may have left values attached
+        self.token = attach(Context())
+        self.exporter = InMemorySpanExporter()
+        processor = SimpleSpanProcessor(self.exporter)
+        processor.on_start = on_processor_start
+        provider = TracerProvider()
+        provider.add_span_processor(processor)
+        self.tracer = provider.get_tracer("monocle_apptrace")
+
+    def tearDown(self):
+        detach(self.token)
+
+    def test_scope_detaches(self):
+        with request_context(properties={"user": "a"}, workflow_name="wf", attributes={DATA_INPUT_KEY: "query"}):
+            self.assertEqual(get_value(SESSION_PROPERTIES_KEY), {"user": "a"})
+            self.assertEqual(get_value(WORKFLOW_NAME_KEY), "wf")
+            with request_context(properties={"turn": 2}):
+                self.assertEqual(get_value(SESSION_PROPERTIES_KEY), {"user": "a", "turn": 2})
+            self.assertEqual(get_value(SESSION_PROPERTIES_KEY), {"user": "a"})
+        self.assertIsNone(get_value(SESSION_PROPERTIES_KEY))
+        self.assertIsNone(get_attribute(DATA_INPUT_KEY))
+
+    def test_scope_detaches_on_error(self):
+        with self.assertRaises(ValueError):
+            with request_context(properties={"user": "a"}):
+                raise ValueError("request failed")
+        self.assertIsNone(get_value(SESSION_PROPERTIES_KEY))
+
+    def test_decorator(self):
+        @request_context(properties={"user": "sync"})
+        def handle():
+            return get_value(SESSION_PROPERTIES_KEY)
+
+        @request_context(properties={"user": "async"})
+        async def ahandle():
+            await asyncio.sleep(0)
+            return get_value(SESSION_PROPERTIES_KEY)
+
+        self.assertEqual(handle(), {"user": "sync"})
+        self.assertEqual(asyncio.run(ahandle()), {"user": "async"})
+        self.assertIsNone(get_value(SESSION_PROPERTIES_KEY))
+
+    def test_thread_pool_isolation(self):
+        def handle(user):
+            with request_context(properties={"user": user}):
+                with self.tracer.start_as_current_span("request"):
+                    pass
+                return get_value(SESSION_PROPERTIES_KEY)["user"]
+
+        users = [f"user-{i}" for i in range(200)]
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            self.assertEqual(list(executor.map(handle, users)), users)
+        self.assertEqual(sorted(span.attributes["session.user"] for span in self.exporter.get_finished_spans()),
+                         sorted(users))
+
+    def test_asyncio_isolation(self):
+        async def handle(user):
+            with request_context(properties={"user": user}):
+                await asyncio.sleep(0.001)
+                with self.tracer.start_as_current_span("request"):
+                    await asyncio.sleep(0)
+                return get_value(SESSION_PROPERTIES_KEY)["user"]
+
+        async def main():
+            return await asyncio.gather(*[handle(f"user-{i}") for i in range(200)])
+
+        users = [f"user-{i}" for i in range(200)]
+        self.assertEqual(asyncio.run(main()), users)
+        self.assertEqual(sorted(span.attributes["session.user"] for span in self.exporter.get_finished_spans()),
+                         sorted(users))
+
+    def test_shared_scope_in_threads(self):
+        scope = request_context(workflow_name="wf")
+        entered = threading.Barrier(2)
+        first_exited = threading.Event()
+
+        def handle(first):
+            with scope:
+                entered.wait(5)
+                if not first:
+                    first_exited.wait(5)
+                workflow_name = get_value(WORKFLOW_NAME_KEY)
+            if first:
+                first_exited.set()
+            return workflow_name, get_value(WORKFLOW_NAME_KEY)
+
+        # The first thread exits while the second one is still in the scope
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            results = list(executor.map(handle, [True, False]))
+        self.assertEqual(results, [("wf", None), ("wf", None)])
+
+    def test_shared_scope_in_tasks(self):
+        scope = request_context(properties={"user": "a"})
+
+        async def handle(delay):
+            with scope:
+                await asyncio.sleep(delay)
+                properties = get_value(SESSION_PROPERTIES_KEY)
+            return properties, get_value(SESSION_PROPERTIES_KEY)
+
+        async def main():
+            # The first task to enter the scope exits it first
+            return await asyncio.gather(handle(0.01), handle(0.02))
+
+        self.assertEqual(asyncio.run(main()), [({"user": "a"}, None)] * 2)
+        with scope:
+            self.assertEqual(get_value(SESSION_PROPERTIES_KEY), {"user": "a"})
+        self.assertIsNone(get_value(SESSION_PROPERTIES_KEY))
+
+    def test_haystack_pipeline_state_scoped_to_run(self):
+        to_wrap = {"package": "haystack.core.pipeline.pipeline", "object": "Pipeline", "method": "run"}
+        pipeline_class = type("Pipeline", (Pipeline,), {"run": FunctionWrapper(Pipeline.run, task_wrapper(self.tracer, to_wrap))})
+        data = {"prompt_builder": {"question": "what is coffee?"}}
+        self.assertEqual(pipeline_class().run(data), ("what is coffee?", "unknown"))
+        self.assertIsNone(get_attribute(DATA_INPUT_KEY))
+
+    def test_soak_memory_is_flat(self):
+        to_wrap = {"package": "haystack.core.pipeline.pipeline", "object": "Pipeline", "method": "run"}
+        pipeline = type("Pipeline", (Pipeline,), {"run": FunctionWrapper(Pipeline.run, task_wrapper(self.tracer, to_wrap))})()
+        data = {"prompt_builder": {"question": "what is coffee?"}}
+
+        def run_requests(count):
+            for i in range(count):
+                with request_context(properties={"request": i}):
+                    pipeline.run(data)
+            self.exporter.clear()
+
+        run_requests(1000)
+        gc.collect()
+        tracemalloc.start()
+        try:
+            start, _ = tracemalloc.get_traced_memory()
+            run_requests(SOAK_REQUESTS)
+            gc.collect()
+            end, _ = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertLess(end - start, 64 * 1024)
+        self.assertIsNone(get_value(SESSION_PROPERTIES_KEY))
+
+
+if __name__ == '__main__':
+    unittest.main()
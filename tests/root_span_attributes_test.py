@@ -0,0 +1,70 @@
+import os
+import unittest
+from unittest.mock import patch
+
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from wrapt import FunctionWrapper
+
+from monocle_apptrace import wrap_common
+from monocle_apptrace.constants import AWS_LAMBDA_ENV_NAME, AWS_LAMBDA_FUNCTION_IDENTIFIER_ENV_NAME
+from monocle_apptrace.wrap_common import RootSpanAttributes, refresh_root_span_attributes, task_wrapper, WORKFLOW_TYPE_MAP
+
+
+class DummyChain:
+    def invoke(self, prompt):
+        return "answer to " + prompt
+
+
+class TestRootSpanAttributes(unittest.TestCase):
+
+    def setUp(self):
+        self.exporter = InMemorySpanExporter()
+        provider = TracerProvider()
+        provider.add_span_processor(SimpleSpanProcessor(self.exporter))
+        to_wrap = {"package": "langchain.schema.runnable", "object": "RunnableSequence", "method": "invoke",
+                   "span_name": "langchain.workflow"}
+        self.chain_class = type("DummyChain", (DummyChain,), {
+            "invoke": FunctionWrapper(DummyChain.invoke, task_wrapper(provider.get_tracer("monocle_apptrace"), to_wrap))})
+        refresh_root_span_attributes()
+
+    def tearDown(self):
+        refresh_root_span_attributes()
+
+    def invoke(self):
+        self.exporter.clear()
+        self.chain_class().invoke("what is coffee?")
+        return self.exporter.get_finished_spans()[0].attributes
+
+    def test_resolved_once_per_process(self):
+        with patch.object(wrap_common, "version", return_value="1.2.3") as mock_version, \
+                patch.object(wrap_common, "get_app_hosting_identifier", return_value=None) as mock_app_hosting:
+            refresh_root_span_attributes()
+            for _ in range(3):
+                attributes = self.invoke()
+            mock_version.assert_called_once()
+            mock_app_hosting.assert_called_once()
+        self.assertEqual(attributes["monocle_apptrace.version"], "1.2.3")
+        self.assertEqual(attributes["entity.1.type"], WORKFLOW_TYPE_MAP["langchain"])
+        self.assertEqual(attributes["entity.count"], 1)
+
+    def test_refresh_picks_up_environment_changes(self):
+        with patch.dict(os.environ, {AWS_LAMBDA_ENV_NAME: "true", AWS_LAMBDA_FUNCTION_IDENTIFIER_ENV_NAME: "my_func"}):
+            self.assertNotIn("entity.2.type", self.invoke())
+            refresh_root_span_attributes()
+            attributes = self.invoke()
+        self.assertEqual(attributes["entity.2.type"], "app_hosting.aws.lambda")
+        self.assertEqual(attributes["entity.2.name"], "my_func")
+        self.assertEqual(attributes["entity.count"], 2)
+
+    def test_workflow_type_per_package(self):
+        root_span_attributes = RootSpanAttributes()
+        self.assertEqual(root_span_attributes.get_entity_attributes("llama_index.core.base.base_query_engine", 1),
+                         ({"entity.1.type": "workflow.llamaindex"}, 1))
+        self.assertEqual(root_span_attributes.get_entity_attributes("my_app.chain", 1),
+                         ({"entity.1.type": "workflow.generic"}, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,31 @@
 import unittest
 from unittest.mock import patch, MagicMock
 import datetime
+import json
+import multiprocessing
+import os
+import re
+from opentelemetry.sdk.resources import SERVICE_NAME, Resource
+from opentelemetry.sdk.trace import TracerProvider
 from monocle_apptrace.exporters.aws.s3_exporter import S3SpanExporter
+from monocle_apptrace.exporters.object_layout import ObjectKeyLayout
+
+
+def send_process(layout, connection):
+    connection.send((os.getpid(), layout.get_key(("coffee_bot", "2024-12-10", "10"), "monocle_trace_", "%Y", ".ndjson")))
+    connection.close()
+
+
+def get_spans(workflows, start_times):
+    spans = []
+    for workflow in workflows:
+        tracer = TracerProvider(resource=Resource({SERVICE_NAME: workflow})).get_tracer("monocle_apptrace")
+        for start_time in start_times:
+            with tracer.start_as_current_span("langchain.workflow", start_time=start_time) as span:
+                pass
+            spans.append(span)
+    return spans
+
 
 class TestS3SpanExporter(unittest.TestCase):
     @patch('boto3.client')
@@ -10,28 +34,68 @@ class TestS3SpanExporter(unittest.TestCase):
         mock_s3_client = MagicMock()
         mock_boto_client.return_value = mock_s3_client
 
-        # Instantiate the exporter with a custom prefix
         exporter = S3SpanExporter(bucket_name="test-bucket", region_name="us-east-1")
         file_prefix = "monocle_trace_"
         # Mock current time for consistency
         mock_current_time = datetime.datetime(2024, 12, 10, 10, 0, 0)
-        with patch('datetime.datetime') as mock_datetime:
-            mock_datetime.now.return_value = mock_current_time
-            mock_datetime.strftime = datetime.datetime.strftime
-
-            # Call the private method to upload data (we are testing the file naming logic)
-            test_span_data = "{\"trace_id\": \"123\"}"
-            exporter._S3SpanExporter__upload_to_s3(test_span_data)
-
-            # Generate expected file name
-            expected_file_name = f"{file_prefix}{mock_current_time.strftime(exporter.time_format)}.ndjson"
-
-            # Verify the S3 client was called with the correct file name
-            mock_s3_client.put_object.assert_called_once_with(
-                Bucket="test-bucket",
-                Key=expected_file_name,
-                Body=test_span_data
-            )
+        # 2024-12-10 10:00:00 and 11:59:59 UTC
+        start_times = [1733824800 * 10 ** 9, (1733824800 + 7199) * 10 ** 9]
+        with patch('monocle_apptrace.exporters.object_layout.datetime') as mock_datetime:
+            mock_datetime.datetime.now.return_value = mock_current_time
+            mock_datetime.datetime.fromtimestamp = datetime.datetime.fromtimestamp
+            mock_datetime.timezone = datetime.timezone
+            exporter.export(get_spans(["coffee bot", "tea/bot"], start_times))
+            self.assertTrue(exporter.force_flush())
+
+        keys = [call.kwargs["Key"] for call in mock_s3_client.put_object.call_args_list]
+        object_keys = [key for key in keys if key.endswith(".ndjson")]
+        # One object per workflow and hour, each with its manifest
+        self.assertEqual(len(object_keys), 4)
+        self.assertEqual(len(set(keys)), 8)
+        timestamp = mock_current_time.strftime(exporter.time_format)
+        pattern = (rf"workflow=(coffee_bot|tea_bot)/date=2024-12-10/hour=(10|11)/"
+                   rf"{file_prefix}{timestamp}_\d+-[0-9a-f]{{8}}_\d{{6}}_[0-9a-f]{{8}}\.ndjson")
+        for key in object_keys:
+            self.assertRegex(key, pattern)
+
+        manifests = {call.kwargs["Key"]: json.loads(call.kwargs["Body"])
+                     for call in mock_s3_client.put_object.call_args_list if call.kwargs["Key"].endswith(".json")}
+        manifest = manifests[object_keys[0][:-len(".ndjson")] + ".manifest.json"]
+        self.assertEqual(manifest["object"], object_keys[0])
+        self.assertEqual(manifest["workflow"], "coffee_bot")
+        self.assertEqual(manifest["span_count"], 1)
+        self.assertEqual(manifest["start_time"], "2024-12-10T10:00:00.000000Z")
+        self.assertEqual(len(manifest["trace_ids"]), 1)
+        exporter.shutdown()
+
+    @patch('boto3.client')
+    def test_legacy_key_template(self, mock_boto_client):
+        mock_s3_client = MagicMock()
+        mock_boto_client.return_value = mock_s3_client
+        exporter = S3SpanExporter(bucket_name="test-bucket", region_name="us-east-1",
+                                  key_template="{file_prefix}{timestamp}{extension}", write_manifest=False)
+        exporter.export(get_spans(["coffee_bot"], [None]))
+        self.assertTrue(exporter.force_flush())
+        key = mock_s3_client.put_object.call_args.kwargs["Key"]
+        self.assertTrue(re.fullmatch(r"monocle_trace_\d{4}-\d\d-\d\d_\d\d\.\d\d\.\d\d\.ndjson", key), key)
+        exporter.shutdown()
+
+    @unittest.skipUnless(hasattr(os, "fork"), "fork is not available")
+    def test_forked_process_token(self):
+        layout = ObjectKeyLayout(key_template="{process}")
+        parent_token = layout.get_key(("coffee_bot", "2024-12-10", "10"), "", "%Y", "")
+        context = multiprocessing.get_context("fork")
+        receiver, sender = context.Pipe(duplex=False)
+        child = context.Process(target=send_process, args=(layout, sender))
+        child.start()
+        child_pid, child_token = receiver.recv()
+        child.join()
+        # The worker forked after the token was made gets its own
+        self.assertTrue(parent_token.startswith(f"{os.getpid()}-"))
+        self.assertTrue(child_token.startswith(f"{child_pid}-"))
+        self.assertNotEqual(parent_token.split("-")[1], child_token.split("-")[1])
+        self.assertEqual(layout.get_key(("coffee_bot", "2024-12-10", "10"), "", "%Y", ""), parent_token)
+
 
 if __name__ == '__main__':
     unittest.main()
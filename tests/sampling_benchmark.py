@@ -0,0 +1,84 @@
+"""
+Measures the per-request overhead of Monocle wrappers at several head
+sampling rates of the MonocleSampler, and with the inference spans sampled
+out by a span type rate, against the same uninstrumented workload. A request
+is a workflow span with two inference calls using the inbuilt langchain
+inference output processor.
+
+    python tests/sampling_benchmark.py
+"""
+import os
+import timeit
+
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor, SpanExporter, SpanExportResult
+from wrapt import FunctionWrapper
+
+from monocle_apptrace.sampling import MonocleSampler
+from monocle_apptrace.utils import load_output_processor
+from monocle_apptrace.wrap_common import llm_wrapper, task_wrapper
+
+ITERATIONS = 5000
+SAMPLERS = {
+    "rate 1.0": MonocleSampler(rate=1.0),
+    "rate 0.1": MonocleSampler(rate=0.1),
+    "rate 0.01": MonocleSampler(rate=0.01),
+    "rate 0.0": MonocleSampler(rate=0.0),
+    "inference 0.0": MonocleSampler(rate=1.0, span_type_rates={"inference": 0.0}),
+}
+BASE_PATH = os.path.join(os.path.dirname(__file__), "..", "src", "monocle_apptrace")
+
+
+class NoopExporter(SpanExporter):
+    def export(self, spans):
+        return SpanExportResult.SUCCESS
+
+
+class FakeChatModel:
+    def __init__(self):
+        self.model_name = "gpt-4o-mini"
+        self.azure_endpoint = "https://example.openai.azure.com/"
+
+    def invoke(self, prompt):
+        return "The answer to " + prompt
+
+
+class FakeChain:
+    def __init__(self, llm):
+        self.llm = llm
+
+    def invoke(self, prompt):
+        return self.llm.invoke(self.llm.invoke(prompt))
+
+
+def build_workload(sampler):
+    chain = FakeChain(FakeChatModel())
+    if sampler is None:
+        return chain
+    provider = TracerProvider(sampler=sampler)
+    provider.add_span_processor(SimpleSpanProcessor(NoopExporter()))
+    tracer = provider.get_tracer("monocle_apptrace")
+    llm_to_wrap = {"package": "langchain.chat_models.base", "object": "BaseChatModel", "method": "invoke",
+                   "output_processor": ["metamodel/maps/attributes/inference/langchain_entities.json"]}
+    load_output_processor(llm_to_wrap, BASE_PATH)
+    chain_to_wrap = {"package": "langchain.schema.runnable", "object": "RunnableSequence", "method": "invoke",
+                     "span_name": "langchain.workflow"}
+    chain.llm.invoke = FunctionWrapper(chain.llm.invoke, llm_wrapper(tracer, llm_to_wrap))
+    chain.invoke = FunctionWrapper(chain.invoke, task_wrapper(tracer, chain_to_wrap))
+    return chain
+
+
+def main():
+    chain = build_workload(None)
+    seconds = timeit.timeit(lambda: chain.invoke("what is coffee?"), number=ITERATIONS)
+    baseline = seconds / ITERATIONS * 1e6
+    print(f"{'uninstrumented':>16}: {baseline:8.2f} us per request")
+    for label, sampler in SAMPLERS.items():
+        chain = build_workload(sampler)
+        seconds = timeit.timeit(lambda: chain.invoke("what is coffee?"), number=ITERATIONS)
+        per_call = seconds / ITERATIONS * 1e6
+        print(f"{label:>16}: {per_call:8.2f} us per request (+{per_call - baseline:.2f} us)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+import asyncio
+import os
+import unittest
+from unittest.mock import patch
+
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from opentelemetry.context import Context, attach, detach
+from opentelemetry.sdk.trace.sampling import ALWAYS_OFF, ALWAYS_ON, Decision, ParentBased
+from opentelemetry.trace import NonRecordingSpan, SpanContext, TraceFlags, use_span
+from wrapt import FunctionWrapper
+
+from monocle_apptrace import wrap_common
+from monocle_apptrace.instrumentor import MonocleInstrumentor, setup_monocle_telemetry
+from monocle_apptrace.request_context import request_context
+from monocle_apptrace.sampling import MonocleSampler, get_monocle_sampler
+from monocle_apptrace.wrap_common import allm_wrapper, atask_wrapper, llm_wrapper, task_wrapper
+
+
+class DummyLLM:
+    def chat(self, prompt):
+        return "answer to " + prompt
+
+    async def achat(self, prompt):
+        return "answer to " + prompt
+
+
+class TestSamplingFastPath(unittest.TestCase):
+
+    def wrap(self, sampler, wrapper, method):
+        self.exporter = InMemorySpanExporter()
+        provider = TracerProvider(sampler=sampler)
+        provider.add_span_processor(SimpleSpanProcessor(self.exporter))
+        tracer = provider.get_tracer("monocle_apptrace")
+        to_wrap = {"package": "dummy", "object": "DummyLLM", "method": method.__name__,
+                   "span_name": "dummy.llm", "output_processor": {"type": "inference", "attributes": []}}
+        return FunctionWrapper(method, wrapper(tracer, to_wrap))
+
+    def test_sampled_out_wrappers_skip_extraction(self):
+        llm = DummyLLM()
+        with patch.object(wrap_common, "process_span") as mock_process_span, \
+                patch.object(wrap_common, "pre_task_processing") as mock_pre_task_processing, \
+                patch.object(wrap_common, "get_provider_name") as mock_get_provider_name:
+            for wrapper in (task_wrapper, llm_wrapper):
+                wrapped = self.wrap(ALWAYS_OFF, wrapper, DummyLLM.chat)
+                self.assertEqual(wrapped(llm, "hi"), "answer to hi")
+            for wrapper in (atask_wrapper, allm_wrapper):
+                wrapped = self.wrap(ALWAYS_OFF, wrapper, DummyLLM.achat)
+                self.assertEqual(asyncio.run(wrapped(llm, "hi")), "answer to hi")
+            mock_process_span.assert_not_called()
+            mock_pre_task_processing.assert_not_called()
+            mock_get_provider_name.assert_not_called()
+        self.assertEqual(self.exporter.get_finished_spans(), ())
+
+    def test_sampled_out_parent_skips_span_creation(self):
+        parent = NonRecordingSpan(SpanContext(trace_id=0x1234, span_id=0x5678, is_remote=True,
+                                              trace_flags=TraceFlags(TraceFlags.DEFAULT)))
+        wrapped = self.wrap(ParentBased(ALWAYS_ON), task_wrapper, DummyLLM.chat)
+        with use_span(parent), patch("opentelemetry.sdk.trace.Tracer.start_span") as mock_start_span:
+            self.assertEqual(wrapped(DummyLLM(), "hi"), "answer to hi")
+            mock_start_span.assert_not_called()
+
+    def test_sampled_parent_keeps_trace(self):
+        parent = NonRecordingSpan(SpanContext(trace_id=0x1234, span_id=0x5678, is_remote=True,
+                                              trace_flags=TraceFlags(TraceFlags.SAMPLED)))
+        wrapped = self.wrap(ParentBased(ALWAYS_ON), task_wrapper, DummyLLM.chat)
+        with use_span(parent):
+            wrapped(DummyLLM(), "hi")
+        spans = self.exporter.get_finished_spans()
+        self.assertEqual(len(spans), 1)
+        self.assertEqual(spans[0].context.trace_id, 0x1234)
+        self.assertEqual(spans[0].parent.span_id, 0x5678)
+
+
+class TestMonocleSampler(unittest.TestCase):
+
+    def setUp(self):
+        self.token = attach(Context())
+
+    def tearDown(self):
+        detach(self.token)
+
+    def get_tracer(self, sampler):
+        self.exporter = InMemorySpanExporter()
+        provider = TracerProvider(sampler=sampler)
+        provider.add_span_processor(SimpleSpanProcessor(self.exporter))
+        return provider.get_tracer("monocle_apptrace")
+
+    def test_decision_by_trace_id(self):
+        sampler = MonocleSampler(rate=0.1)
+        trace_ids = range(0, 2 ** 64, 2 ** 54 + 12345)
+        decisions = [sampler.should_sample(None, trace_id, "workflow").decision for trace_id in trace_ids]
+        # Another process with the same rate makes the same decisions
+        self.assertEqual(decisions, [MonocleSampler(rate=0.1).should_sample(None, trace_id, "workflow").decision
+                                     for trace_id in trace_ids])
+        sampled = decisions.count(Decision.RECORD_AND_SAMPLE)
+        self.assertTrue(0.05 * len(decisions) < sampled < 0.15 * len(decisions))
+
+    def test_workflow_rates(self):
+        tracer = self.get_tracer(MonocleSampler(rate=1.0, workflow_rates={"billing_bot": 0.0}))
+        with request_context(workflow_name="billing_bot"):
+            with tracer.start_as_current_span("langchain.workflow"):
+                with tracer.start_as_current_span("langchain.chat"):
+                    pass
+        with tracer.start_as_current_span("langchain.workflow", attributes={"session.id": "s1"}):
+            pass
+        spans = self.exporter.get_finished_spans()
+        self.assertEqual(len(spans), 1)
+        # The attributes given at span start are kept
+        self.assertEqual(spans[0].attributes["session.id"], "s1")
+
+    def test_span_type_rates(self):
+        tracer = self.get_tracer(MonocleSampler(rate=1.0, span_type_rates={"retrieval": 0.0}))
+        to_wrap = {"package": "dummy", "object": "DummyLLM", "method": "chat",
+                   "span_name": "dummy.retriever", "output_processor": {"type": "retrieval", "attributes": []}}
+        wrapped = FunctionWrapper(DummyLLM.chat, task_wrapper(tracer, to_wrap))
+        with patch.object(wrap_common, "process_span") as mock_process_span:
+            with tracer.start_as_current_span("langchain.workflow"):
+                self.assertEqual(wrapped(DummyLLM(), "hi"), "answer to hi")
+            mock_process_span.assert_not_called()
+        self.assertEqual([span.name for span in self.exporter.get_finished_spans()], ["langchain.workflow"])
+
+    def test_span_type_rate_nested_in_trace(self):
+        sampler = MonocleSampler(rate=0.5, span_type_rates={"inference": 0.1})
+        tracer = self.get_tracer(sampler)
+        for _ in range(200):
+            with tracer.start_as_current_span("langchain.workflow"):
+                with tracer.start_as_current_span("langchain.chat", attributes={"span.type": "inference"}):
+                    pass
+        spans = self.exporter.get_finished_spans()
+        workflow_traces = {span.context.trace_id for span in spans if span.name == "langchain.workflow"}
+        inference_traces = {span.context.trace_id for span in spans if span.name == "langchain.chat"}
+        self.assertTrue(inference_traces < workflow_traces)
+        self.assertTrue(0 < len(inference_traces) < 0.25 * len(workflow_traces))
+
+    def test_configuration(self):
+        with patch.dict(os.environ, {"MONOCLE_SAMPLING_RATE": "0.2",
+                                     "MONOCLE_WORKFLOW_SAMPLING_RATES": "billing_bot=0.5, chat_bot=2, bad",
+                                     "MONOCLE_SPAN_TYPE_SAMPLING_RATES": "retrieval=0.1"}):
+            sampler = get_monocle_sampler("my_app")
+            self.assertEqual(sampler.rate, 0.2)
+            self.assertEqual(sampler.workflow_rates, {"billing_bot": 0.5, "chat_bot": 1.0, "my_app": 0.2})
+            self.assertEqual(sampler.span_type_rates, {"retrieval": 0.1})
+            # The arguments take precedence over the environment
+            sampler = get_monocle_sampler("my_app", sampling_rate=0.01, span_type_sampling_rates={})
+            self.assertEqual(sampler.workflow_rates["my_app"], 0.01)
+            self.assertEqual(sampler.span_type_rates, {})
+        with patch.dict(os.environ, {}, clear=True):
+            self.assertIsNone(get_monocle_sampler("my_app"))
+
+    def test_existing_tracer_provider(self):
+        existing_provider = TracerProvider()
+        processor = SimpleSpanProcessor(InMemorySpanExporter())
+        with patch("opentelemetry.trace.get_tracer_provider", return_value=existing_provider), \
+                patch("opentelemetry.trace.set_tracer_provider") as mock_set_tracer_provider, \
+                patch.object(MonocleInstrumentor, "is_instrumented_by_opentelemetry", False), \
+                patch.object(MonocleInstrumentor, "instrument") as mock_instrument:
+            with self.assertLogs("monocle_apptrace.instrumentor", level="WARNING") as logs:
+                setup_monocle_telemetry("my_app", span_processors=[processor], sampling_rate=0.1)
+        # The processors and the instrumentation use the provider already set, whose sampler is kept
+        mock_set_tracer_provider.assert_not_called()
+        mock_instrument.assert_called_once_with(tracer_provider=existing_provider)
+        self.assertIn(processor, existing_provider._active_span_processor._span_processors)
+        self.assertNotIsInstance(existing_provider.sampler, MonocleSampler)
+        self.assertIn("sampler", logs.output[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
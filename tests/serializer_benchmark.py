@@ -0,0 +1,68 @@
+"""
+Measures the spans serialized per second by the S3 and Blob exporters and by the
+Okahu exporter, before and after the direct serializer of span_serializer.py, on
+the chat request spans of compression_benchmark.py. orjson is used when it is
+installed, MONOCLE_BENCHMARK_NO_ORJSON=1 measures the json module fallback.
+
+    python tests/serializer_benchmark.py
+"""
+import json
+import os
+import time
+
+from compression_benchmark import get_spans
+
+from monocle_apptrace.exporters import span_serializer
+from monocle_apptrace.exporters.okahu.okahu_exporter import remove_0x_from_start
+from monocle_apptrace.exporters.span_serializer import dumps, format_span, serialize_span
+
+ROUNDS = 5
+
+
+def object_store_to_json(spans):
+    return [span.to_json(indent=0).replace("\n", "").encode("utf-8") for span in spans]
+
+
+def okahu_to_json(spans):
+    batch = []
+    for span in spans:
+        obj = json.loads(span.to_json())
+        obj["parent_id"] = "None" if obj["parent_id"] is None else remove_0x_from_start(obj["parent_id"])
+        obj["context"]["trace_id"] = remove_0x_from_start(obj["context"]["trace_id"])
+        obj["context"]["span_id"] = remove_0x_from_start(obj["context"]["span_id"])
+        batch.append(obj)
+    return json.dumps({"batch": batch})
+
+
+def object_store_direct(spans):
+    return [serialize_span(span) for span in spans]
+
+
+def okahu_direct(spans):
+    return dumps({"batch": [format_span(span, id_prefix="", root_parent_id="None") for span in spans]})
+
+
+def measure(serialize, spans):
+    seconds = []
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        serialize(spans)
+        seconds.append(time.perf_counter() - start)
+    return len(spans) / min(seconds)
+
+
+def main():
+    if os.environ.get("MONOCLE_BENCHMARK_NO_ORJSON"):
+        span_serializer.orjson = None
+    spans = get_spans()
+    print(f"{len(spans)} spans, JSON backend: {'orjson' if span_serializer.orjson is not None else 'json'}")
+    for label, before, after in (("S3/Blob", object_store_to_json, object_store_direct),
+                                 ("Okahu", okahu_to_json, okahu_direct)):
+        before_rate = measure(before, spans)
+        after_rate = measure(after, spans)
+        print(f"{label:>8}: to_json {before_rate:9,.0f} spans/s, direct {after_rate:9,.0f} spans/s, "
+              f"{after_rate / before_rate:4.1f}x")
+
+
+if __name__ == "__main__":
+    main()
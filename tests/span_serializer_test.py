@@ -0,0 +1,64 @@
+import json
+import unittest
+from unittest.mock import MagicMock, patch
+
+from opentelemetry.sdk.resources import SERVICE_NAME, Resource
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.trace import Link, SpanKind, Status, StatusCode
+
+from monocle_apptrace.exporters import span_serializer
+from monocle_apptrace.exporters.okahu.okahu_exporter import OkahuSpanExporter
+from monocle_apptrace.exporters.span_serializer import dumps, format_span, serialize_span
+
+# Whole microseconds, where to_json and format_span round the same
+START_TIME = 1733824800123456000
+
+
+def get_spans():
+    tracer = TracerProvider(resource=Resource({SERVICE_NAME: "coffee_bot"})).get_tracer("monocle_apptrace")
+    with tracer.start_as_current_span("langchain.workflow", start_time=START_TIME, end_on_exit=False) as root:
+        with tracer.start_as_current_span("inference", kind=SpanKind.CLIENT, start_time=START_TIME + 1000,
+                                          links=[Link(root.get_span_context(), {"link": 1})],
+                                          attributes={"span.type": "inference", "entity.count": 2,
+                                                      "tags": ["a", "b"]}, end_on_exit=False) as inference:
+            inference.add_event("data.input", {"input": ["Qu'est-ce que l'espresso ? ☕"]},
+                                timestamp=START_TIME + 2000)
+            inference.set_status(Status(StatusCode.ERROR, "rate limited"))
+            inference.end(end_time=START_TIME + 5000000)
+        root.end(end_time=START_TIME + 9000000)
+    return [inference, root]
+
+
+class TestSpanSerializer(unittest.TestCase):
+
+    def test_same_span_as_to_json(self):
+        for span in get_spans():
+            self.assertEqual(json.loads(json.dumps(format_span(span))), json.loads(span.to_json()))
+            self.assertEqual(json.loads(serialize_span(span)), json.loads(span.to_json()))
+        self.assertNotIn(b"\n", serialize_span(span))
+
+    def test_json_backends(self):
+        span = get_spans()[0]
+        with patch.object(span_serializer, "orjson", None):
+            data = serialize_span(span)
+            self.assertIn("☕".encode("utf-8"), data)
+            # A lone surrogate isn't valid UTF-8, it is escaped
+            self.assertEqual(json.loads(dumps({"text": "\ud800"})), {"text": "\ud800"})
+        self.assertEqual(json.loads(serialize_span(span)), json.loads(data))
+
+    @patch.dict("os.environ", {"OKAHU_API_KEY": "test-api-key"})
+    def test_okahu_batch(self):
+        session = MagicMock()
+        session.post.return_value.status_code = 200
+        exporter = OkahuSpanExporter(session=session)
+        inference, root = get_spans()
+        exporter.export([inference, root])
+        batch = json.loads(session.post.call_args.kwargs["data"])["batch"]
+        self.assertEqual(batch[0]["context"]["trace_id"], f"{inference.context.trace_id:032x}")
+        self.assertEqual(batch[0]["parent_id"], f"{root.context.span_id:016x}")
+        self.assertEqual(batch[1]["parent_id"], "None")
+        self.assertEqual(batch[0]["events"], json.loads(inference.to_json())["events"])
+
+
+if __name__ == '__main__':
+    unittest.main()
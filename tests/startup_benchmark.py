@@ -0,0 +1,58 @@
+"""
+Measures the startup cost of setup_monocle_telemetry: the time to import
+monocle_apptrace and set up the telemetry, the resident memory it adds and the
+frameworks it imports, in a fresh interpreter for every run. The "langchain app"
+scenario imports langchain_core before the setup, like a service that only uses
+langchain.
+
+    python tests/startup_benchmark.py
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+RUNS = 5
+FRAMEWORKS = ("langchain", "langchain_core", "llama_index", "haystack", "botocore")
+
+CHILD = """
+import json, os, sys, time
+def get_rss():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+if {import_app}:
+    import langchain_core.runnables
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor, ConsoleSpanExporter
+rss = get_rss()
+start = time.perf_counter()
+from monocle_apptrace.instrumentor import setup_monocle_telemetry
+setup_monocle_telemetry(workflow_name="startup_benchmark", span_processors=[SimpleSpanProcessor(ConsoleSpanExporter())])
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "rss": get_rss() - rss,
+                   "frameworks": [name for name in {frameworks} if name in sys.modules]}}))
+"""
+
+
+def run(import_app):
+    src_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+    env = dict(os.environ, PYTHONPATH=src_path)
+    results = []
+    for _ in range(RUNS):
+        output = subprocess.run([sys.executable, "-c", CHILD.format(import_app=import_app, frameworks=FRAMEWORKS)],
+                                env=env, capture_output=True, text=True, check=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    return results
+
+
+def main():
+    for label, import_app in (("no framework", False), ("langchain app", True)):
+        results = run(import_app)
+        seconds = statistics.median(result["seconds"] for result in results)
+        rss = statistics.median(result["rss"] for result in results)
+        print(f"{label:>14}: setup {seconds * 1000:7.1f} ms, +{rss / 2 ** 20:6.1f} MB RSS, "
+              f"imported {', '.join(results[0]['frameworks']) or 'no framework'}")
+
+
+if __name__ == "__main__":
+    main()
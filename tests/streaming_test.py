@@ -0,0 +1,224 @@
+import asyncio
+import time
+import unittest
+
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from opentelemetry.trace import StatusCode
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+from wrapt import FunctionWrapper
+
+from monocle_apptrace.langchain import LANGCHAIN_METHODS
+from monocle_apptrace.payload import PayloadPolicy, capture_payload, reset_payload_policies, set_payload_policy
+from monocle_apptrace.streaming import (CHUNK_COUNT_KEY, DURATION_KEY, INTER_CHUNK_LATENCY_MAX_KEY,
+                                        INTER_CHUNK_LATENCY_P50_KEY, TIME_TO_FIRST_TOKEN_KEY)
+from monocle_apptrace.wrap_common import allm_stream_wrapper, llm_stream_wrapper, llm_wrapper
+
+CHUNKS = ["Coffee", " is", " a", " drink"]
+CHUNK_DELAY = 0.01
+
+
+class ChatModel:
+    model_name = "gpt-4o-mini"
+
+    def __init__(self, tracer=None, fail_after=None):
+        self.tracer = tracer
+        self.fail_after = fail_after
+
+    def stream(self, prompt):
+        for i, chunk in enumerate(CHUNKS):
+            if i == self.fail_after:
+                raise ConnectionError("stream interrupted")
+            if self.tracer is not None:
+                with self.tracer.start_as_current_span("http.request"):
+                    pass
+            time.sleep(CHUNK_DELAY)
+            yield chunk
+
+    async def astream(self, prompt):
+        for chunk in CHUNKS:
+            await asyncio.sleep(CHUNK_DELAY)
+            yield chunk
+
+    async def astream_chat(self, prompt):
+        # llama_index style, a coroutine returning the async generator
+        return self.astream(prompt)
+
+
+class Generator:
+    """Haystack style generator calling a streaming callback."""
+    model = "gpt-4o-mini"
+
+    def __init__(self, streaming_callback=None):
+        self.streaming_callback = streaming_callback
+
+    def run(self, prompt, streaming_callback=None):
+        callback = streaming_callback or self.streaming_callback
+        for chunk in CHUNKS:
+            time.sleep(CHUNK_DELAY)
+            if callback:
+                callback(chunk)
+        return {"replies": ["".join(CHUNKS)]}
+
+
+class TestStreaming(unittest.TestCase):
+
+    def setUp(self):
+        self.exporter = InMemorySpanExporter()
+        provider = TracerProvider()
+        provider.add_span_processor(SimpleSpanProcessor(self.exporter))
+        self.tracer = provider.get_tracer("monocle_apptrace")
+        self.to_wrap = {"package": "langchain.chat_models.base", "object": "BaseChatModel", "span_name": "langchain.chat"}
+
+    def wrap(self, cls, method, wrapper, to_wrap=None):
+        wrapped = FunctionWrapper(getattr(cls, method), wrapper(self.tracer, to_wrap or self.to_wrap))
+        return type(cls.__name__, (cls,), {method: wrapped})
+
+    def get_span(self, name="langchain.chat"):
+        return next(span for span in self.exporter.get_finished_spans() if span.name == name)
+
+    def assert_stream_attributes(self, span, chunk_count):
+        self.assertEqual(span.attributes[CHUNK_COUNT_KEY], chunk_count)
+        self.assertGreaterEqual(span.attributes[TIME_TO_FIRST_TOKEN_KEY], CHUNK_DELAY * 1000 * 0.9)
+        self.assertGreaterEqual(span.attributes[INTER_CHUNK_LATENCY_P50_KEY], CHUNK_DELAY * 1000 * 0.9)
+        self.assertGreaterEqual(span.attributes[INTER_CHUNK_LATENCY_MAX_KEY], span.attributes[INTER_CHUNK_LATENCY_P50_KEY])
+        self.assertGreaterEqual(span.attributes[DURATION_KEY], CHUNK_DELAY * 1000 * chunk_count * 0.9)
+
+    def test_stream(self):
+        model = self.wrap(ChatModel, "stream", llm_stream_wrapper)(self.tracer)
+        stream = model.stream("what is coffee?")
+        self.assertEqual(next(stream), "Coffee")
+        # The span stays open while the application reads the stream
+        self.assertEqual([span.name for span in self.exporter.get_finished_spans()], ["http.request"])
+        self.assertEqual(list(stream), CHUNKS[1:])
+
+        span = self.get_span()
+        self.assert_stream_attributes(span, len(CHUNKS))
+        for child in [span for span in self.exporter.get_finished_spans() if span.name == "http.request"]:
+            self.assertEqual(child.parent.span_id, span.context.span_id)
+
+    def test_astream(self):
+        model = self.wrap(ChatModel, "astream", allm_stream_wrapper)()
+
+        async def consume():
+            return [chunk async for chunk in model.astream("what is coffee?")]
+
+        self.assertEqual(asyncio.run(consume()), CHUNKS)
+        self.assert_stream_attributes(self.get_span(), len(CHUNKS))
+
+    def test_astream_chat_coroutine(self):
+        model = self.wrap(ChatModel, "astream_chat", allm_stream_wrapper)()
+
+        async def consume():
+            stream = await model.astream_chat("what is coffee?")
+            return [chunk async for chunk in stream]
+
+        self.assertEqual(asyncio.run(consume()), CHUNKS)
+        self.assert_stream_attributes(self.get_span(), len(CHUNKS))
+
+    def test_stream_error(self):
+        model = self.wrap(ChatModel, "stream", llm_stream_wrapper)(fail_after=2)
+        with self.assertRaises(ConnectionError):
+            for _ in model.stream("what is coffee?"):
+                pass
+        span = self.get_span()
+        self.assertEqual(span.status.status_code, StatusCode.ERROR)
+        self.assertEqual(span.attributes[CHUNK_COUNT_KEY], 2)
+        self.assertEqual(span.events[0].name, "exception")
+
+    def test_stream_closed_early(self):
+        model = self.wrap(ChatModel, "stream", llm_stream_wrapper)()
+        stream = model.stream("what is coffee?")
+        next(stream)
+        stream.close()
+        span = self.get_span()
+        self.assertEqual(span.attributes[CHUNK_COUNT_KEY], 1)
+        self.assertNotIn(INTER_CHUNK_LATENCY_P50_KEY, span.attributes)
+
+    def test_langchain_chat_model_stream(self):
+        to_wrap = next(method for method in LANGCHAIN_METHODS
+                       if method["object"] == "BaseChatModel" and method["method"] == "stream")
+        model = self.wrap(FakeListChatModel, "stream", llm_stream_wrapper, to_wrap)(responses=["Coffee is a drink"])
+        self.assertEqual("".join(chunk.content for chunk in model.stream("what is coffee?")), "Coffee is a drink")
+        span = self.exporter.get_finished_spans()[0]
+        self.assertEqual(span.attributes["span.type"], "inference")
+        self.assertEqual(span.attributes[CHUNK_COUNT_KEY], len("Coffee is a drink"))
+        self.assertIn(TIME_TO_FIRST_TOKEN_KEY, span.attributes)
+        events = {event.name: event.attributes for event in span.events}
+        # The output is the text of all the chunks, not the last one
+        self.assertEqual(events["data.output"]["response"], ("Coffee is a drink",))
+        self.assertEqual(events["data.input"]["input"], ("{'human': 'what is coffee?'}",))
+
+    def test_langchain_chat_model_without_native_streaming(self):
+        stream_to_wrap, invoke_to_wrap = (
+            next(method for method in LANGCHAIN_METHODS
+                 if method["object"] == "BaseChatModel" and method["method"] == name)
+            for name in ("stream", "invoke"))
+
+        class NonStreamingChatModel(FakeListChatModel):
+            def _should_stream(self, *, async_api, run_manager=None, **kwargs):
+                return False
+
+        model_class = self.wrap(NonStreamingChatModel, "invoke", llm_wrapper, invoke_to_wrap)
+        model = self.wrap(model_class, "stream", llm_stream_wrapper, stream_to_wrap)(responses=["Coffee is a drink"])
+        self.assertEqual("".join(chunk.content for chunk in model.stream("what is coffee?")), "Coffee is a drink")
+        # The invoke the stream falls back to is traced by the stream span only
+        spans = [span for span in self.exporter.get_finished_spans() if span.attributes.get("span.type") == "inference"]
+        self.assertEqual(len(spans), 1)
+        self.assertEqual(spans[0].attributes[CHUNK_COUNT_KEY], 1)
+
+        # A plain invoke of the same model is still traced
+        self.assertEqual(model.invoke("what is coffee?").content, "Coffee is a drink")
+        spans = [span for span in self.exporter.get_finished_spans() if span.attributes.get("span.type") == "inference"]
+        self.assertEqual(len(spans), 2)
+
+    def test_stream_output_within_payload_budget(self):
+        to_wrap = next(method for method in LANGCHAIN_METHODS
+                       if method["object"] == "BaseChatModel" and method["method"] == "stream")
+        response = "".join(f"word{i} " for i in range(2000))
+        policy = PayloadPolicy(max_bytes=100, tail_bytes=20, hash_payload=True)
+        self.addCleanup(reset_payload_policies)
+        set_payload_policy(policy, "inference", "data.output")
+        model = self.wrap(FakeListChatModel, "stream", llm_stream_wrapper, to_wrap)(responses=[response])
+        self.assertEqual("".join(chunk.content for chunk in model.stream("what is coffee?")), response)
+        output = next(event for event in self.exporter.get_finished_spans()[0].events if event.name == "data.output")
+        # The same attributes as the whole response captured at once
+        self.assertEqual(dict(output.attributes),
+                         {key: tuple(value) if isinstance(value, list) else value
+                          for key, value in capture_payload({"response": [response]}, policy).items()})
+        self.assertTrue(output.attributes["response.truncated"])
+        self.assertEqual(output.attributes["response.length"], len(response))
+
+    def test_haystack_streaming_callback(self):
+        to_wrap = {"package": "haystack.components.generators.openai", "object": "OpenAIGenerator",
+                   "span_name": "haystack.generator", "streaming_callback": True}
+        received = []
+        generator = self.wrap(Generator, "run", llm_wrapper, to_wrap)(streaming_callback=received.append)
+        generator.run("what is coffee?")
+        self.assertEqual(received, CHUNKS)
+        self.assert_stream_attributes(self.get_span("haystack.generator"), len(CHUNKS))
+
+        self.exporter.clear()
+        generator = self.wrap(Generator, "run", llm_wrapper, to_wrap)()
+        generator.run("what is coffee?")
+        self.assertNotIn(CHUNK_COUNT_KEY, self.get_span("haystack.generator").attributes)
+
+    def test_haystack_run_without_streaming_callback_parameter(self):
+        to_wrap = {"package": "haystack.components.generators.openai", "object": "OpenAIGenerator",
+                   "span_name": "haystack.generator", "streaming_callback": True}
+
+        class LegacyGenerator(Generator):
+            # Older haystack releases only read the callback set on the component
+            def run(self, prompt):
+                return super().run(prompt)
+
+        received = []
+        generator = self.wrap(LegacyGenerator, "run", llm_wrapper, to_wrap)(streaming_callback=received.append)
+        self.assertEqual(generator.run("what is coffee?"), {"replies": ["".join(CHUNKS)]})
+        self.assertEqual(received, CHUNKS)
+        self.assertNotIn(CHUNK_COUNT_KEY, self.get_span("haystack.generator").attributes)
+
+
+if __name__ == '__main__':
+    unittest.main()
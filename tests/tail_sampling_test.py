@@ -0,0 +1,108 @@
+import time
+import unittest
+
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from opentelemetry.trace import Status, StatusCode, set_span_in_context
+
+from monocle_apptrace.tail_sampling import TailSamplingSpanProcessor
+
+TRACES = 1000
+
+
+class TestTailSamplingSpanProcessor(unittest.TestCase):
+
+    def get_tracer(self, **kwargs):
+        self.exporter = InMemorySpanExporter()
+        self.processor = TailSamplingSpanProcessor(SimpleSpanProcessor(self.exporter), **kwargs)
+        provider = TracerProvider()
+        provider.add_span_processor(self.processor)
+        return provider.get_tracer("monocle_apptrace")
+
+    def run_trace(self, tracer, tokens=10, error=False, span_type="inference", delay=0.0):
+        with tracer.start_as_current_span("langchain.workflow") as root:
+            with tracer.start_as_current_span("langchain.chat", attributes={"span.type": span_type}) as span:
+                span.add_event("metadata", {"completion_tokens": tokens, "prompt_tokens": tokens, "total_tokens": 2 * tokens})
+                if error:
+                    span.set_status(Status(StatusCode.ERROR))
+                time.sleep(delay)
+        return root.get_span_context().trace_id
+
+    def get_trace_ids(self):
+        return {span.context.trace_id for span in self.exporter.get_finished_spans()}
+
+    def test_healthy_traces_sampled(self):
+        tracer = self.get_tracer(sample_rate=0.05)
+        for _ in range(TRACES):
+            self.run_trace(tracer)
+        kept = self.get_trace_ids()
+        self.assertTrue(0.02 * TRACES < len(kept) < 0.08 * TRACES)
+        # Whole traces are kept or dropped
+        self.assertEqual(len(self.exporter.get_finished_spans()), 2 * len(kept))
+        self.assertEqual(self.processor.kept_traces + self.processor.dropped_traces, TRACES)
+        self.assertEqual(self.processor._buffered_spans, 0)
+
+    def test_interesting_traces_kept(self):
+        tracer = self.get_tracer(sample_rate=0.0, latency_threshold_millis=20, token_threshold=1000,
+                                 keep_span_types=["retrieval"])
+        self.run_trace(tracer)
+        interesting = {
+            self.run_trace(tracer, error=True),
+            self.run_trace(tracer, tokens=600),
+            self.run_trace(tracer, span_type="retrieval"),
+            self.run_trace(tracer, delay=0.03)
+        }
+        self.assertEqual(self.get_trace_ids(), interesting)
+
+    def test_late_spans_follow_decision(self):
+        tracer = self.get_tracer(sample_rate=0.0)
+        with tracer.start_as_current_span("langchain.workflow") as root:
+            late = tracer.start_span("langchain.task")
+            failed = tracer.start_span("langchain.chat")
+        failed.set_status(Status(StatusCode.ERROR))
+        failed.end()
+        late.end()
+        # The root ended first and the trace was dropped, the failed span alone is not a trace
+        self.assertEqual(len(self.exporter.get_finished_spans()), 0)
+        self.assertEqual(self.processor._buffered_spans, 0)
+        self.assertEqual(self.processor._decided[root.get_span_context().trace_id], False)
+
+    def test_orphans_evicted(self):
+        tracer = self.get_tracer(sample_rate=0.0, max_trace_age_millis=10)
+        root = tracer.start_span("langchain.workflow")
+        with tracer.start_as_current_span("langchain.chat", context=set_span_in_context(root)) as span:
+            span.set_status(Status(StatusCode.ERROR))
+        time.sleep(0.02)
+        self.run_trace(tracer)
+        self.assertEqual([span.name for span in self.exporter.get_finished_spans()], ["langchain.chat"])
+        self.assertEqual(self.processor.evicted_traces, 1)
+
+    def test_orphans_evicted_without_more_spans(self):
+        tracer = self.get_tracer(sample_rate=1.0, max_trace_age_millis=50)
+        root = tracer.start_span("langchain.workflow")
+        with tracer.start_as_current_span("langchain.chat", context=set_span_in_context(root)):
+            pass
+        self.assertEqual(self.exporter.get_finished_spans(), ())
+        # No span ends after the orphan, the worker decides it once it is too old
+        time.sleep(0.3)
+        self.assertEqual([span.name for span in self.exporter.get_finished_spans()], ["langchain.chat"])
+        self.assertEqual(self.processor.evicted_traces, 1)
+        self.assertEqual(self.processor._buffered_spans, 0)
+        self.processor.shutdown()
+        self.assertFalse(self.processor._worker.is_alive())
+
+    def test_buffer_bound(self):
+        tracer = self.get_tracer(sample_rate=1.0, max_buffered_spans=10)
+        roots = [tracer.start_span("langchain.workflow") for _ in range(20)]
+        for root in roots:
+            with tracer.start_as_current_span("langchain.chat", context=set_span_in_context(root)):
+                pass
+        self.assertLessEqual(self.processor._buffered_spans, 10)
+        self.assertEqual(len(self.exporter.get_finished_spans()), 10)
+        self.processor.force_flush()
+        self.assertEqual(len(self.exporter.get_finished_spans()), 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import unittest
+
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from wrapt import FunctionWrapper
+
+from monocle_apptrace.wrap_common import (WrapperConfig, get_haystack_pipeline_output, get_langchain_retriever_input,
+                                          get_langchain_retriever_output, get_prompt_output, llm_wrapper, task_wrapper)
+
+
+class CountingDict(dict):
+    """to_wrap entry that counts the config lookups done after instrumentation."""
+    lookups = 0
+
+    def get(self, key, default=None):
+        CountingDict.lookups += 1
+        return super().get(key, default)
+
+    def __getitem__(self, key):
+        CountingDict.lookups += 1
+        return super().__getitem__(key)
+
+
+class Retriever:
+    def __init__(self, name=None):
+        self.name = name
+
+    def invoke(self, query):
+        return []
+
+
+class AgentExecutor(Retriever):
+    pass
+
+
+class Agent(Retriever):
+    pass
+
+
+class TestWrapperConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.exporter = InMemorySpanExporter()
+        provider = TracerProvider()
+        provider.add_span_processor(SimpleSpanProcessor(self.exporter))
+        self.tracer = provider.get_tracer("monocle_apptrace")
+
+    def wrap(self, wrapper, to_wrap, cls=Retriever):
+        return type(cls.__name__, (cls,), {"invoke": FunctionWrapper(cls.invoke, wrapper(self.tracer, to_wrap))})
+
+    def test_handlers_bound_by_package(self):
+        config = WrapperConfig({"package": "langchain_core.retrievers", "span_name": "retriever"})
+        self.assertEqual(config.context_input_handlers, (get_langchain_retriever_input,))
+        self.assertEqual(config.context_output_handlers, (get_langchain_retriever_output,))
+        self.assertIs(config.prompt_output_handler, get_prompt_output)
+        config = WrapperConfig({"package": "haystack.core.pipeline.pipeline"})
+        self.assertTrue(config.is_haystack_pipeline)
+        self.assertEqual(config.context_input_handlers, ())
+        self.assertIs(config.prompt_output_handler, get_haystack_pipeline_output)
+
+    def test_span_names(self):
+        config = WrapperConfig({"package": "my_app", "span_name": "my_app.task",
+                                "span_name_getter": lambda instance: "from_getter"})
+        self.assertEqual(config.get_span_name(Retriever("Search")), "my_app.task.search")
+        self.assertEqual(config.get_span_name(Retriever()), "my_app.task")
+        self.assertEqual(WrapperConfig({"package": "my_app"}).get_span_name(Retriever()),
+                         "wrapper_config_test.Retriever")
+        llm_config = WrapperConfig(config.to_wrap, use_span_name_getter=True)
+        self.assertEqual(llm_config.get_span_name(Retriever("Search")), "from_getter")
+
+    def test_no_config_lookups_per_call(self):
+        to_wrap = CountingDict(package="langchain_core.retrievers", object="BaseRetriever", method="invoke",
+                               span_name="langchain.retriever")
+        task_retriever = self.wrap(task_wrapper, to_wrap)("Search")
+        llm_retriever = self.wrap(llm_wrapper, to_wrap)("Search")
+        with self.tracer.start_as_current_span("parent"):
+            CountingDict.lookups = 0
+            task_retriever.invoke("what is coffee?")
+            llm_retriever.invoke("what is coffee?")
+        self.assertEqual(CountingDict.lookups, 0)
+        self.assertEqual([span.name for span in self.exporter.get_finished_spans()],
+                         ["langchain.retriever.search", "langchain.retriever.search", "parent"])
+
+    def test_only_agent_executor_skipped(self):
+        to_wrap = {"package": "langchain.chains.base", "span_name": "langchain.task"}
+        self.wrap(task_wrapper, to_wrap, AgentExecutor)().invoke("hi")
+        self.assertEqual(len(self.exporter.get_finished_spans()), 0)
+        self.wrap(task_wrapper, to_wrap, Agent)().invoke("hi")
+        self.assertEqual(len(self.exporter.get_finished_spans()), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()